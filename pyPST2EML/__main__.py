@@ -1,45 +1,203 @@
 """ PYTHON STANDARD LIBRARY """
 import argparse
+from contextlib import nullcontext
+import json
 from os.path import abspath, exists, dirname, join
 import logging
+import sys
 
 # own modules
+from .metrics import Profiler, print_metrics
 from .pst2eml import make_eml_search_friendly, pst_2_eml, str2bool
+from .quarantine import ErrorBudgetExceeded, print_failures
 
 folder = abspath(join(dirname(__file__), "test"))
 
-parser = argparse.ArgumentParser(description='Processing emails for easier desktop searches')
-parser.add_argument('--pst', dest='PST_nEML',type=str2bool,
-              help='processing .PST (Y) or folder of .eml/.ics (N) (default: N)', default = "N")
-parser.add_argument('--folder', "-f", dest='folder',type=str , default = "",
-              help="folder where processing will occur, if none then test folder used:")
-parser.add_argument('--filename',"-n", dest='fn',type=str,action="store", default = "c:/",
-              help='file to be processed (required for .PST processing, optional for .eml processing)')
-parser.add_argument('--embedded_libpst', dest='embedded_libpst',type=str, default = "Y",
-              help='use the package provided libpst (default: Y)')
-parser.add_argument("--test","-t",dest='test',type=str, default = "N",
-              help='will run over test files')
-parser.add_argument("--verbose","-v",dest='verbosity',type=int,default=2)
-
-args,  unknown = parser.parse_known_args()
-myargs = vars(args)
-
-if myargs["verbosity"]==4:
-  logging.basicConfig(level=logging.DEBUG)
-  logging.info("logging set to DEBUG")
-  stop_error = True
-else:
-  logging.basicConfig(level=logging.WARN)
-  logging.info("logging set to WARN")
-
-if myargs["test"]=="Y":
-    myargs["PST_nEML"]=False
-    myargs["folder"]=folder
-
-if myargs["PST_nEML"]:
-  pst_2_eml(**myargs)
-else:
-    if exists(myargs["folder"]):
-        make_eml_search_friendly(myargs["folder"])
-    else:
-        print("need to provide .pst file path or .eml folder for processing")
\ No newline at end of file
+#subcommand -> (module, function), imported only when the subcommand runs
+SUBCOMMANDS = {"search":(".search_index","search_cli"),"export":(".exporters","export_cli"),
+  "pack":(".packed","pack_cli"),"unpack":(".packed","unpack_cli"),"rehydrate":(".attachments","rehydrate_cli"),
+  "rename":(".rename_plan","rename_cli"),"catalog":(".catalog","catalog_cli"),"watch":(".watch","watch_cli"),
+  "distributed":(".distributed","distributed_cli")}
+
+def main(argv=None):
+  """ command line entry point (python -m pyPST2EML, pst2eml console script)
+  Parameters:
+  -----------
+  argv: list
+      arguments (default: sys.argv[1:])
+  Returns:
+  --------
+  exit_code: int
+  """
+  argv = sys.argv[1:] if argv is None else argv
+  if argv[:1] and argv[0] in SUBCOMMANDS:
+    from importlib import import_module
+    module, function = SUBCOMMANDS[argv[0]]
+    return getattr(import_module(module,__package__),function)(argv[1:])
+
+  parser = argparse.ArgumentParser(description='Processing emails for easier desktop searches')
+  parser.add_argument('--pst', dest='PST_nEML',type=str2bool,
+                help='processing .PST (Y) or folder of .eml/.ics (N) (default: N)', default = "N")
+  parser.add_argument('--folder', "-f", dest='folder',type=str , default = "",
+                help="folder where processing will occur, if none then test folder used:")
+  parser.add_argument('--filename',"-n", dest='fn',type=str,action="store", default = "c:/",
+                help='file to be processed (required for .PST processing, optional for .eml processing)')
+  parser.add_argument('--embedded_libpst', dest='embedded_libpst',type=str, default = "Y",
+                help='use the package provided libpst (default: Y)')
+  parser.add_argument("--test","-t",dest='test',type=str, default = "N",
+                help='will run over test files')
+  parser.add_argument("--headers",dest='headers_only',type=str2bool, default = "N",
+                help='only read the header block of each .eml/.ics (default: N)')
+  parser.add_argument("--jobs","-j",dest='jobs',type=int, default = 1,
+                help='number of processes used for .eml/.ics folders, one folder per process (default: 1)')
+  parser.add_argument("--manifest","-m",dest='manifest',type=str2bool, default = "N",
+                help='keep a manifest in the folder and only process new or modified files on the next runs (default: N)')
+  parser.add_argument("--reader",dest='reader',type=str, default = "readpst", choices=["readpst","native"],
+                help='.PST reader: bundled readpst.exe or the pure python reader (default: readpst)')
+  parser.add_argument("--pipeline",dest='pipeline',type=str2bool, default = "N",
+                help='with --pst Y, rename and touch the .eml/.ics files while readpst is still extracting (default: N)')
+  parser.add_argument("--batch",dest='batch',type=str, default = "",
+                help='folder or glob pattern of .pst/.ost files converted in one run, one output folder per archive')
+  parser.add_argument("--workers",dest='workers',type=int, default = 2,
+                help='with --batch, number of archives converted at the same time (default: 2)')
+  parser.add_argument("--readpst_jobs",dest='readpst_jobs',type=int, default = 0,
+                help='with --batch, readpst -j parallel jobs per archive (default: readpst default)')
+  parser.add_argument("--names",dest='policy',type=str, default = None, choices=["windows","linux"],
+                help='file name length limits: 260 characters full path or 255 bytes per name (default: running platform)')
+  parser.add_argument("--metadata",dest='metadata',type=str, default = None, choices=["win32","xattr","sidecar"],
+                help='where the sender, subject and recipients are written: windows file properties, extended attributes or one index per folder (default: win32 on windows, xattr elsewhere)')
+  parser.add_argument("--index",dest='index',type=str2bool, default = "N",
+                help='build a full-text search index of the folder, queried with: python -m pyPST2EML search (default: N)')
+  parser.add_argument("--attachments",dest='attachments',type=str2bool, default = "N",
+                help='store each attachment once in the folder and replace it by a stub in the messages, rebuilt with: python -m pyPST2EML rehydrate (default: N)')
+  parser.add_argument("--dedup",dest='dedup',type=str, default = "",
+                help='dedup index file shared by the runs over several archives: messages already seen (same Message-ID and content) are left untouched')
+  parser.add_argument("--catalog",dest='catalog',type=str2bool, default = "N",
+                help='keep a compact catalog of the senders, recipients and dates for analytics, queried with: python -m pyPST2EML catalog (default: N)')
+  parser.add_argument("--layout",dest='layout',type=str, default = "flat", choices=["flat","date","hash"],
+                help='.eml/.ics folders: move the renamed messages of each folder to date (YYYY/MM) or hash buckets so no folder gets too large (default: flat)')
+  parser.add_argument("--bucket_files",dest='bucket_files',type=int, default = 5000,
+                help='with --layout, files per bucket, the next ones go to <bucket>_2, <bucket>_3... (default: 5000)')
+  parser.add_argument("--io_workers",dest='io_workers',type=int, default = 0,
+                help='.eml/.ics folders on network shares: threads renaming and writing the metadata so the round trips overlap (default: 0, one file after the other)')
+  parser.add_argument("--read_workers",dest='read_workers',type=int, default = 8,
+                help='with --io_workers, threads reading the files ahead (default: 8)')
+  parser.add_argument("--io_queue",dest='io_queue',type=int, default = 256,
+                help='with --io_workers, files waiting to be renamed at most (default: 256)')
+  parser.add_argument("--read_queue",dest='read_queue',type=int, default = 64,
+                help='with --io_workers, files read ahead at most (default: 64)')
+  parser.add_argument("--distributed",dest='distributed',type=int, default = 0,
+                help='worker processes claiming shards of the work (folders, or archives matching -n with --pst Y) through lease files, workers of other hosts join with: python -m pyPST2EML distributed worker (default: 0, not distributed)')
+  parser.add_argument("--sharding",dest='sharding',type=str, default = "folder", choices=["folder","hash"],
+                help='with --distributed, .eml/.ics folders packed by number of files or grouped by a hash of their path (default: folder)')
+  parser.add_argument("--shard_files",dest='shard_files',type=int, default = 20000,
+                help='with --distributed, files per shard (default: 20000)')
+  parser.add_argument("--work_dir",dest='work_dir',type=str, default = "",
+                help='with --distributed, shared folder of the shards, leases and results (default: .pst2eml_work in the eml folder)')
+  parser.add_argument("--on_error",dest='on_error',type=str, default = "quarantine", choices=["quarantine","skip","raise"],
+                help='.eml/.ics files which fail (bad headers, corrupt content): moved to the quarantine folder with a reason record, left in place, or stop the run (default: quarantine)')
+  parser.add_argument("--max_errors",dest='max_errors',type=int, default = None,
+                help='failed files before the run stops (default: no limit)')
+  parser.add_argument("--max_error_rate",dest='max_error_rate',type=float, default = None,
+                help='share of failed files before the run stops, checked after 100 files, e.g. 0.05 (default: no limit)')
+  parser.add_argument("--quarantine",dest='quarantine',type=str, default = "",
+                help='quarantine folder (default: .pst2eml_quarantine in the eml folder)')
+  parser.add_argument("--retry_quarantine",dest='retry_quarantine',type=str2bool, default = "N",
+                help='move the quarantined files back to their folders and process only them (default: N)')
+  parser.add_argument("--metrics",dest='metrics',type=str, default = "",
+                help='.eml/.ics folders: json file receiving the per stage times, rates and slowest files of the run')
+  parser.add_argument("--progress",dest='progress',type=str2bool, default = "N",
+                help='.eml/.ics folders: show the files done, rates and ETA while processing (default: N)')
+  parser.add_argument("--profile",dest='profile',type=str, default = None, choices=["cprofile","sample"],
+                help='profile the run with cProfile or a low overhead sampling profiler (main process only)')
+  parser.add_argument("--profile_output",dest='profile_output',type=str, default = None,
+                help='with --profile, file receiving the cProfile stats or the sampling report')
+  parser.add_argument("--verbose","-v",dest='verbosity',type=int,default=2)
+
+  args,  unknown = parser.parse_known_args(argv)
+  myargs = vars(args)
+
+  if myargs["verbosity"]==4:
+    logging.basicConfig(level=logging.DEBUG)
+    logging.info("logging set to DEBUG")
+  else:
+    logging.basicConfig(level=logging.WARN)
+    logging.info("logging set to WARN")
+
+  if myargs["test"]=="Y":
+      myargs["PST_nEML"]=False
+      myargs["folder"]=folder
+
+  myargs["errors"] = {"mode":myargs["on_error"],"max_errors":myargs["max_errors"],
+    "max_error_rate":myargs["max_error_rate"],"folder":myargs["quarantine"] or None}
+
+  if myargs["batch"]:
+    from .batch import convert_batch, print_report
+    print_report(convert_batch(myargs["batch"],workers=myargs["workers"],reader=myargs["reader"],
+      readpst_jobs=myargs["readpst_jobs"]))
+  elif myargs["PST_nEML"]:
+    try:
+      summary = pst_2_eml(**myargs)
+    except ErrorBudgetExceeded as e:
+      print(e)
+      print_failures(e.report)
+      return 2
+    if summary is not None:
+      print(f"processed {summary['processed']}, skipped {summary['skipped']}, failed {summary['failed']} files")
+      if "errors" in summary:
+        print_failures(summary["errors"])
+  else:
+      if exists(myargs["folder"]):
+          profiler = Profiler(myargs["profile"],myargs["profile_output"]) if myargs["profile"] else nullcontext()
+          staged = None
+          if myargs["io_workers"]>0:
+            staged = {"io_workers":myargs["io_workers"],"read_workers":myargs["read_workers"],
+              "io_queue":myargs["io_queue"],"read_queue":myargs["read_queue"]}
+          layout = None
+          if myargs["layout"]!="flat":
+            from .layout import Layout
+            layout = Layout(myargs["layout"],myargs["bucket_files"])
+          distributed = None
+          if myargs["distributed"]>0:
+            distributed = {"workers":myargs["distributed"],"sharding":myargs["sharding"],
+              "shard_files":myargs["shard_files"],"work_dir":myargs["work_dir"] or None}
+          try:
+            with profiler:
+              summary = make_eml_search_friendly(myargs["folder"],headers_only=myargs["headers_only"],
+                  jobs=myargs["jobs"],manifest=myargs["manifest"],policy=myargs["policy"],
+                  metadata=myargs["metadata"],index=myargs["index"],metrics=bool(myargs["metrics"]),
+                  progress=myargs["progress"],attachments=myargs["attachments"],dedup=myargs["dedup"] or None,
+                  staged=staged,catalog=myargs["catalog"],layout=layout,distributed=distributed,
+                  errors=myargs["errors"],retry_quarantined=myargs["retry_quarantine"])
+          except ErrorBudgetExceeded as e:
+            print(e)
+            print_failures(e.report)
+            return 2
+          print(f"processed {summary['processed']}, skipped {summary['skipped']}, failed {summary['failed']}, duplicates {summary['duplicates']}, unchanged {summary['unchanged']} files in {summary['folders']} folders")
+          if summary["errors"]["failures"]:
+            print(f"errors: {summary['errors']['failures']} failed files ({summary['quarantined']} quarantined)")
+            print_failures(summary["errors"])
+          if "shards" in summary:
+            print(f"distributed: {summary['shards']} shards ({summary['failed_shards']} failed) by {summary['workers']} workers")
+          if "dedup" in summary:
+            report = summary["dedup"]
+            print(f"dedup: {report['duplicates']} duplicates dropped out of {report['checked']} messages checked, "
+              f"{report['lookups']} index lookups ({report['false_positives']} filter false positives), {report['messages']} messages in the index")
+          if "attachments" in summary:
+            report = summary["attachments"]
+            ratio = f"{report['dedup_ratio']:.2f}" if report["dedup_ratio"] else "-"
+            print(f"attachments: {report['attachments']} stored once ({report['duplicates']} duplicates, dedup ratio {ratio}), "
+              f"{report['removed_bytes']/1e6:.1f} MB saved in the messages, store: {report['store']['objects']} files {report['store']['bytes']/1e6:.1f} MB")
+          if "metrics" in summary:
+            run_metrics = summary.pop("metrics")
+            print_metrics(run_metrics)
+            if myargs["metrics"]:
+              run_metrics["summary"] = summary
+              with open(myargs["metrics"],"w",encoding="utf-8") as fo:
+                json.dump(run_metrics,fo,indent=2)
+      else:
+          print("need to provide .pst file path or .eml folder for processing")
+  return 0
+
+if __name__=="__main__":
+  sys.exit(main())
@@ -0,0 +1,355 @@
+"""
+content-addressed attachment store
+
+readpst writes the attachments base64 encoded inside every .eml, a deck forwarded 200 times is stored
+200 times. AttachmentStore.extract streams a message line by line, decodes and hashes (sha256) the
+body of its base64 attachments and stores each content once in objects/<2 hex>/<sha256> under the
+store folder (.pst2eml_attachments at the root of the processed folder), the body of the part is replaced
+in the message by a single stub line (only read as a stub in that place by rehydrate):
+
+X-PST2EML-Attachment: sha256=<hex> size=<decoded bytes> line=<base64 line length> eol=crlf blank=<n>
+
+only bodies with a regular layout (same line length and end of line, canonical base64, as written by
+readpst and the mail clients) are stored, so rehydrate() rebuilds the original message byte for byte.
+The other parts are left untouched.
+
+Example:
+--------
+python -m pyPST2EML rehydrate C:\\outlook\\archives\\eml\\2021Q1\\Inbox\\budget.eml -o C:\\temp\\budget.eml
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+import binascii
+from email.parser import BytesHeaderParser
+import hashlib
+import os
+from os.path import abspath, dirname, exists, join
+import re
+from shutil import copymode
+import sys
+import tempfile
+from threading import Lock
+
+STORE_NAME = ".pst2eml_attachments"
+#smaller attachments (decoded size) stay in the message
+MIN_BYTES = 16*1024
+STUB_PREFIX = b"X-PST2EML-Attachment: "
+STUB = re.compile(rb"X-PST2EML-Attachment: sha256=([0-9a-f]{64}) size=(\d+) line=(\d+) eol=(crlf|lf) blank=(\d+)")
+EOLS = {b"\r\n":"crlf",b"\n":"lf"}
+COPY_BYTES = 1024*1024
+
+def is_store_folder(name):
+    return name==STORE_NAME
+
+def is_attachment_part(headers):
+    """ True for a base64 part with a file name or an attachment disposition """
+    if (headers.get("Content-Transfer-Encoding") or "").strip().lower()!="base64":
+        return False
+    if headers.get_content_maintype()=="multipart":
+        return False
+    disposition = (headers.get("Content-Disposition") or "").lower()
+    return disposition.startswith("attachment") or headers.get_filename() is not None or \
+        headers.get_param("name") is not None
+
+class _Parts:
+    """ follows the MIME structure (nested multiparts) of a message read line by line """
+    def __init__(self):
+        self.parser = BytesHeaderParser()
+        self.boundaries = []
+        self.in_headers = True
+        self.header_lines = []
+        #headers of the current part, set at the end of its header block
+        self.headers = None
+
+    def feed(self,line):
+        """ Returns the kind of line: "header" (line of a header block), "headers" (blank line ending a header
+        block, self.headers then holds the block), "boundary" or "body" """
+        if self.in_headers:
+            self.header_lines.append(line)
+            if line not in (b"\r\n",b"\n"):
+                return "header"
+            self.in_headers = False
+            self.headers = self.parser.parsebytes(b"".join(self.header_lines))
+            boundary = self.headers.get_boundary() if self.headers.get_content_maintype()=="multipart" else None
+            if boundary:
+                self.boundaries.append(boundary.encode("latin-1"))
+            return "headers"
+        if self.boundaries and line.startswith(b"--"):
+            marker = line.rstrip(b" \t\r\n")
+            for depth in range(len(self.boundaries)-1,-1,-1):
+                if marker==b"--"+self.boundaries[depth] or marker==b"--"+self.boundaries[depth]+b"--":
+                    if marker.endswith(b"--") and marker!=b"--"+self.boundaries[depth]:
+                        #closing boundary: back to the epilogue of the enclosing multipart
+                        del self.boundaries[depth:]
+                    else:
+                        del self.boundaries[depth+1:]
+                        self.in_headers = True
+                        self.header_lines = []
+                    return "boundary"
+        return "body"
+
+class _Body:
+    """ base64 body of an attachment part being decoded into a temporary file of the store """
+    def __init__(self,store,start):
+        self.start = start
+        self.hasher = hashlib.sha256()
+        self.fd, self.tmp_fp = tempfile.mkstemp(dir=store.tmp_folder)
+        self.size = 0
+        self.lines = 0
+        self.line_length = None
+        self.eol = None
+        self.blank = 0
+        self.last_short = False
+        self.regular = True
+
+    def feed(self,line):
+        if not self.regular:
+            return
+        content = line.rstrip(b"\r\n")
+        eol = line[len(content):]
+        if eol not in EOLS or (self.eol is not None and eol!=self.eol):
+            self.regular = False
+            return
+        self.eol = eol
+        if not content:
+            #only trailing blank lines (before the next boundary) are allowed
+            self.blank+=1
+            self.regular = self.lines>0
+            return
+        if self.blank or self.last_short:
+            self.regular = False
+            return
+        if self.line_length is None:
+            if len(content)%4:
+                self.regular = False
+                return
+            self.line_length = len(content)
+        elif len(content)>self.line_length:
+            self.regular = False
+            return
+        try:
+            data = binascii.a2b_base64(content)
+        except binascii.Error:
+            self.regular = False
+            return
+        #only the last line can be shorter or padded, and it must be the canonical encoding of its bytes
+        if len(content)<self.line_length or len(data)!=self.line_length//4*3:
+            self.last_short = True
+        if binascii.b2a_base64(data,newline=False)!=content:
+            self.regular = False
+            return
+        self.hasher.update(data)
+        os.write(self.fd,data)
+        self.size+=len(data)
+        self.lines+=1
+
+    def close(self):
+        os.close(self.fd)
+
+class AttachmentStore:
+    """ content-addressed store of the attachments of the messages of a folder
+    Parameters:
+    -----------
+    root: str
+        folder holding the store folder (STORE_NAME), usually the processed .eml folder
+    min_bytes: int
+        smaller attachments stay in the messages
+    """
+    def __init__(self,root,min_bytes=MIN_BYTES):
+        self.folder = join(root,STORE_NAME)
+        self.tmp_folder = join(self.folder,"tmp")
+        os.makedirs(self.tmp_folder,exist_ok=True)
+        self.min_bytes = min_bytes
+        #attachments: parts replaced by a stub, duplicates: of them already in the store,
+        #referenced_bytes: decoded size of the replaced parts, stored_bytes: added to the store,
+        #removed_bytes: size of the messages before - after
+        self.stats = {"messages":0,"attachments":0,"duplicates":0,"referenced_bytes":0,"stored_bytes":0,
+            "removed_bytes":0}
+        #extract can be called from several threads (see staged_io)
+        self.lock = Lock()
+
+    def object_path(self,digest):
+        return join(self.folder,"objects",digest[:2],digest)
+
+    def extract(self,eml_fp):
+        """ replaces the attachments of the message by stubs (the file is rewritten only if one of them
+        is stored)
+        Returns:
+        --------
+        count: int
+            number of attachments replaced by a stub
+        """
+        fd, out_fp = tempfile.mkstemp(dir=dirname(eml_fp),prefix=".pst2eml_")
+        count = 0
+        try:
+            with open(eml_fp,"rb") as fi, os.fdopen(fd,"wb") as fo:
+                count = self._extract(fi,fo)
+            if count:
+                removed = os.path.getsize(eml_fp)-os.path.getsize(out_fp)
+                copymode(eml_fp,out_fp)
+                os.replace(out_fp,eml_fp)
+                with self.lock:
+                    self.stats["messages"]+=1
+                    self.stats["removed_bytes"]+=removed
+        finally:
+            if exists(out_fp):
+                os.unlink(out_fp)
+        return count
+
+    def _extract(self,fi,fo):
+        parts = _Parts()
+        body = None
+        count = 0
+        pos = 0
+        for line in iter(fi.readline,b""):
+            line_start = pos
+            pos+= len(line)
+            kind = parts.feed(line)
+            if kind=="body" and body is not None:
+                body.feed(line)
+                continue
+            if kind=="boundary" and body is not None:
+                count+= self._finish(body,fi,fo,line_start)
+                body = None
+            fo.write(line)
+            if kind=="headers" and is_attachment_part(parts.headers):
+                body = _Body(self,pos)
+        if body is not None:
+            count+= self._finish(body,fi,fo,pos)
+        return count
+
+    def _finish(self,body,fi,fo,end):
+        """ stores the body and writes its stub, or copies the original lines if it cannot be rebuilt """
+        body.close()
+        if body.regular and body.lines and body.size>=self.min_bytes:
+            digest = body.hasher.hexdigest()
+            fp = self.object_path(digest)
+            stored = not exists(fp)
+            if stored:
+                os.makedirs(dirname(fp),exist_ok=True)
+                os.replace(body.tmp_fp,fp)
+            else:
+                os.unlink(body.tmp_fp)
+            with self.lock:
+                if stored:
+                    self.stats["stored_bytes"]+=body.size
+                else:
+                    self.stats["duplicates"]+=1
+                self.stats["attachments"]+=1
+                self.stats["referenced_bytes"]+=body.size
+            fo.write(STUB_PREFIX+f"sha256={digest} size={body.size} line={body.line_length} "
+                f"eol={EOLS[body.eol]} blank={body.blank}".encode("ascii")+body.eol)
+            return 1
+        os.unlink(body.tmp_fp)
+        resume = fi.tell()
+        fi.seek(body.start)
+        remaining = end-body.start
+        while remaining>0:
+            data = fi.read(min(COPY_BYTES,remaining))
+            fo.write(data)
+            remaining-= len(data)
+        fi.seek(resume)
+        return 0
+
+    def usage(self):
+        """ Returns the number of objects and bytes in the store """
+        objects = 0
+        size = 0
+        for root, _, files in os.walk(join(self.folder,"objects")):
+            for fn in files:
+                objects+=1
+                size+=os.path.getsize(join(root,fn))
+        return {"objects":objects,"bytes":size}
+
+    def report(self):
+        """ stats of the run with the dedup ratio (referenced / stored bytes) and the store usage """
+        report = dict(self.stats)
+        report["dedup_ratio"] = self.stats["referenced_bytes"]/self.stats["stored_bytes"] if self.stats["stored_bytes"] else None
+        report["store"] = self.usage()
+        return report
+
+def merge_stats(stats):
+    """ adds up AttachmentStore.stats (e.g. of several processes) """
+    merged = {}
+    for stat in stats:
+        for key, value in stat.items():
+            merged[key] = merged.get(key,0)+value
+    return merged
+
+def find_store(eml_fp):
+    """ Returns the store folder of the closest parent folder holding one (None if not found) """
+    folder = dirname(abspath(eml_fp))
+    while True:
+        if exists(join(folder,STORE_NAME)):
+            return join(folder,STORE_NAME)
+        parent = dirname(folder)
+        if parent==folder:
+            return None
+        folder = parent
+
+def rehydrate(eml_fp,fo,store=None):
+    """ writes into fo (binary file object) the original message, with its stubs replaced by the stored attachments
+    Parameters:
+    -----------
+    eml_fp: str
+        message processed by AttachmentStore.extract
+    store: str
+        store folder (default: see find_store)
+    Returns:
+    --------
+    count: int
+        number of attachments restored
+    """
+    store = store or find_store(eml_fp)
+    count = 0
+    parts = _Parts()
+    #first body line of an attachment part: where extract writes its stub (the same line elsewhere, e.g.
+    #quoted in a text body, is copied as is)
+    stub_line = False
+    with open(eml_fp,"rb") as fi:
+        for line in fi:
+            kind = parts.feed(line)
+            if not (stub_line and kind=="body" and line.startswith(STUB_PREFIX)):
+                stub_line = kind=="headers" and is_attachment_part(parts.headers)
+                fo.write(line)
+                continue
+            stub_line = False
+            match = STUB.match(line)
+            if match is None or store is None:
+                raise ValueError(f"cannot rehydrate {eml_fp}: "+("no attachment store found" if store is None else f"invalid stub {line!r}"))
+            digest, size, line_length, eol, blank = match.groups()
+            digest = digest.decode("ascii")
+            eol = b"\r\n" if eol==b"crlf" else b"\n"
+            chunk = int(line_length)//4*3
+            #whole lines per read
+            read_size = chunk*max(1,COPY_BYTES//chunk)
+            restored = 0
+            with open(join(store,"objects",digest[:2],digest),"rb") as fa:
+                while True:
+                    data = fa.read(read_size)
+                    if not data:
+                        break
+                    restored+= len(data)
+                    fo.write(b"".join([binascii.b2a_base64(data[i:i+chunk],newline=False)+eol
+                        for i in range(0,len(data),chunk)]))
+            if restored!=int(size):
+                raise ValueError(f"cannot rehydrate {eml_fp}: attachment {digest} has {restored} bytes instead of {int(size)}")
+            fo.write(eol*int(blank))
+            count+=1
+    return count
+
+def rehydrate_cli(argv=None):
+    """ python -m pyPST2EML rehydrate <eml file> [-o <output>] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML rehydrate",
+        description="rebuild a message whose attachments were moved to the attachment store")
+    parser.add_argument("eml",type=str)
+    parser.add_argument("--output","-o",dest="output",type=str,default=None,help="output file (default: standard output)")
+    parser.add_argument("--store",dest="store",type=str,default=None,help="store folder (default: closest parent folder store)")
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output,"wb") as fo:
+            rehydrate(args.eml,fo,args.store)
+    else:
+        rehydrate(args.eml,sys.stdout.buffer,args.store)
+    return 0
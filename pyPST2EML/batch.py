@@ -0,0 +1,172 @@
+"""
+batch conversion of several .pst/.ost files
+
+the archives are scheduled largest first (longest processing time first, which keeps the makespan
+close to the optimum) on a pool of workers processes, each archive is converted into its own folder
+(named after the archive) with readpst (using its own -j parallel jobs option) or the native reader.
+A failing archive is reported and the other ones keep going.
+
+the report (per archive timing and throughput) is returned and written as batch_report.json in the
+output folder
+
+Example:
+--------
+python -m pyPST2EML --batch "C:\\outlook\\archives\\2021Q*.pst" --workers 3 --readpst_jobs 4
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import json
+import logging
+import os
+from os.path import abspath, basename, dirname, getsize, isdir, join, splitext
+from subprocess import call
+from time import perf_counter
+
+# own modules
+from .pst2eml import pst_2_eml_native, readpst_command, safe_folder_name
+
+PST_EXTENSIONS = (".pst",".ost")
+
+REPORT_NAME = "batch_report.json"
+
+def find_archives(source):
+    """ Returns the .pst/.ost files of a folder (recursively) or matching a glob pattern """
+    if isdir(source):
+        fps = glob(join(source,"**","*"),recursive=True)
+    else:
+        fps = glob(source,recursive=True)
+    return [abspath(fp) for fp in fps if splitext(fp)[1].lower() in PST_EXTENSIONS and os.path.isfile(fp)]
+
+def output_folders(archives,EML_folder):
+    """ Returns dict archive -> output folder named after the archive (suffixed if two archives share a name) """
+    folders = {}
+    used = set()
+    for archive in archives:
+        name = splitext(basename(archive))[0]
+        candidate = name
+        i = 1
+        while candidate.lower() in used:
+            candidate = f"{name}[{i}]"
+            i += 1
+        used.add(candidate.lower())
+        folders[archive] = join(EML_folder,candidate)
+    return folders
+
+def convert_archive(pst_full_path,output_folder,reader="readpst",readpst_jobs=0):
+    """ converts one archive, never raises: failures are part of the returned report
+    Returns:
+    --------
+    report: dict
+        archive, output, size in bytes, status ("ok"/"failed"), error, seconds, MB/s and number of files written
+    """
+    size = getsize(pst_full_path)
+    report = {"archive":pst_full_path,"output":output_folder,"size":size,"status":"ok","error":None}
+    start = perf_counter()
+    try:
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        if reader=="native":
+            pst_2_eml_native(pst_full_path,output_folder)
+        else:
+            command = readpst_command(pst_full_path,output_folder)
+            if readpst_jobs:
+                command[1:1] = ["-j",str(readpst_jobs)]
+            returncode = call(command)
+            if returncode!=0:
+                raise Exception(f"readpst return code {returncode}")
+    except Exception as e:
+        logging.error(f"failed converting {pst_full_path}: {e}")
+        report["status"] = "failed"
+        report["error"] = repr(e)
+    seconds = perf_counter()-start
+    report["seconds"] = seconds
+    report["mb_per_s"] = size/1024/1024/seconds if seconds>0 else None
+    report["files"] = sum([len(files) for root, directory, files in os.walk(output_folder)])
+    return report
+
+def extract_archive(pst_full_path,output_folder,reader="readpst",readpst_jobs=0):
+    """ extracts an archive into output_folder without renaming its messages (readpst -e, or one
+    <nid>.eml file per message with the native reader): they are processed as they appear (see watch)
+    or once the archive is converted (see distributed)
+    Returns:
+    --------
+    report: dict
+        see convert_archive
+    """
+    if reader!="native":
+        return convert_archive(pst_full_path,output_folder,reader,readpst_jobs)
+    from .pst_reader import PSTFile
+    report = {"archive":pst_full_path,"output":output_folder,"size":os.path.getsize(pst_full_path),"status":"ok","error":None}
+    start = perf_counter()
+    files = 0
+    try:
+        with PSTFile(pst_full_path) as pst:
+            for message in pst.iter_messages():
+                folder_path = join(output_folder,*[safe_folder_name(name) for name in message.folder_path])
+                os.makedirs(folder_path,exist_ok=True)
+                with open(join(folder_path,f"{message.nid}.eml"),"xb") as fo:
+                    fo.write(message.to_eml())
+                files+=1
+    except Exception as e:
+        logging.error(f"failed converting {pst_full_path}: {e}")
+        report["status"] = "failed"
+        report["error"] = repr(e)
+    seconds = perf_counter()-start
+    report["seconds"] = seconds
+    report["mb_per_s"] = report["size"]/1024/1024/seconds if seconds>0 else None
+    report["files"] = files
+    return report
+
+def convert_batch(source,EML_folder=None,workers=2,reader="readpst",readpst_jobs=0):
+    """ converts every archive found in source (see find_archives)
+    Parameters:
+    -----------
+    source: str
+        folder of archives or glob pattern
+    EML_folder: str
+        output folder, one sub folder per archive (default: eml folder next to the archives)
+    workers: int
+        number of archives converted at the same time
+    reader: str
+        "readpst" or "native" (see pst2eml.pst_2_eml)
+    readpst_jobs: int
+        value of the readpst -j option (0: readpst default)
+    Returns:
+    --------
+    report: dict
+        "archives": per archive reports (see convert_archive) largest archive first, and the totals
+    """
+    archives = find_archives(source)
+    if EML_folder is None:
+        EML_folder = join(source if isdir(source) else dirname(abspath(source)),"eml")
+    if not os.path.exists(EML_folder):
+        os.makedirs(EML_folder)
+    #largest first
+    archives.sort(key=getsize,reverse=True)
+    folders = output_folders(archives,EML_folder)
+    start = perf_counter()
+    reports = []
+    with ProcessPoolExecutor(max_workers=max(1,workers)) as executor:
+        futures = [executor.submit(convert_archive,archive,folders[archive],reader,readpst_jobs) for archive in archives]
+        for future in futures:
+            archive_report = future.result()
+            reports.append(archive_report)
+            logging.info(f"{archive_report['status']} {archive_report['archive']} in {archive_report['seconds']:.1f}s")
+    seconds = perf_counter()-start
+    size = sum([r["size"] for r in reports])
+    report = {"archives":reports,"seconds":seconds,"size":size,
+        "mb_per_s":size/1024/1024/seconds if seconds>0 else None,
+        "failed":len([r for r in reports if r["status"]!="ok"])}
+    with open(join(EML_folder,REPORT_NAME),"w",encoding="utf-8") as fo:
+        json.dump(report,fo,indent=2)
+    return report
+
+def print_report(report):
+    for r in report["archives"]:
+        rate = f"{r['mb_per_s']:.1f}MB/s" if r["mb_per_s"] else "-"
+        print(f"{r['status']:6} {r['seconds']:8.1f}s {r['size']/1024/1024:10.1f}MB {rate:>10} {r['files']:8} files  {r['archive']}")
+        if r["error"]:
+            print(f"       {r['error']}")
+    print(f"{len(report['archives'])} archives, {report['failed']} failed, {report['seconds']:.1f}s")
@@ -0,0 +1,448 @@
+"""
+benchmarks for the .eml processing
+
+bench_header_only: compares eml_get_parameters full parsing (default) with the header-only mode
+    on generated messages carrying large attachments
+bench_metadata: files per second written by each metadata backend (see metadata)
+bench_export: ingest rate and batch latency of the exporters against the local fake servers
+    (see fake_servers), with failures injected to exercise the retries
+bench_staged: make_eml_search_friendly one file after the other and staged (see staged_io) with a
+    network share latency added to the file system calls (see injected_latency)
+bench_startup: cold start time of the command line (python -m pyPST2EML) for --help and a small folder,
+    with the slowest imports (python -X importtime)
+run_suite: times eml_get_parameters, get_sentdate, rename_eml and make_eml_search_friendly on generated
+    corpora (see corpus) of several sizes, the results are written as JSON and compared with a
+    previous run (see compare_results) to spot regressions between versions
+
+Example:
+--------
+python -m pyPST2EML.benchmark --count=5 --size=20
+python -m pyPST2EML.benchmark --metadata=2000
+python -m pyPST2EML.benchmark --export=20000
+python -m pyPST2EML.benchmark --staged=2000 --latency=5
+python -m pyPST2EML.benchmark --startup=20
+python -m pyPST2EML.benchmark --suite=1000,10000,100000 --output=bench_0.2.0.json --compare=bench_0.1.json
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+import builtins
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+import json
+import os
+from os.path import abspath, dirname, exists, join
+import platform
+from shutil import copytree, rmtree
+from statistics import median
+from subprocess import DEVNULL, PIPE, check_output, run
+import sys
+from tempfile import mkdtemp
+from time import perf_counter, sleep
+
+# own modules
+from . import __version__
+from .corpus import generate_corpus
+from .exporters import ElasticsearchExporter, SonicExporter
+from .fake_servers import FakeElasticsearch, FakeSonic
+from .metadata import WRITERS, get_writer
+from .pst2eml import (eml_get_parameters, get_sentdate, load_eml, make_eml_search_friendly, parse_date_tolerant,
+    rename_eml)
+from .search_index import SearchIndex
+
+def make_large_attachment_fixtures(folder,count=5,size_mb=20):
+    """ writes .eml files carrying one large binary attachment each
+    Parameters:
+    -----------
+    folder: str
+        folder where the .eml files are written
+    count: int
+        number of files
+    size_mb: int
+        size of the attachment of each file in MB (before base64 encoding)
+    Returns:
+    --------
+    fps: list
+        full paths of the generated files
+    """
+    fps = []
+    for i in range(count):
+        msg = EmailMessage()
+        msg["From"] = "Alice Sender <alice@example.com>"
+        msg["To"] = "Bob Receiver <bob@example.com>"
+        msg["Subject"] = f"RE: quarterly deck {i}"
+        msg["Date"] = "Fri, 24 Aug 2001 09:53:36 +0100"
+        msg.set_content("please find the deck attached\n")
+        msg.add_attachment(os.urandom(size_mb*1024*1024),maintype="application",
+            subtype="octet-stream",filename=f"deck_{i}.pptx")
+        fp = abspath(join(folder,f"large_{i}.eml"))
+        with open(fp,"wb") as fo:
+            fo.write(msg.as_bytes())
+        fps.append(fp)
+    return fps
+
+def bench_header_only(fps,repeat=3):
+    """ times eml_get_parameters with and without headers_only on the given files
+    Returns:
+    --------
+    results: dict
+        best time in seconds over repeat for each mode and whether both modes return the same parameters
+    """
+    results = {}
+    params = {}
+    for mode, headers_only in [("full",False),("headers_only",True)]:
+        best = None
+        for _ in range(repeat):
+            start = perf_counter()
+            params[mode] = [eml_get_parameters(fp,headers_only=headers_only) for fp in fps]
+            elapsed = perf_counter()-start
+            if best is None or elapsed<best:
+                best = elapsed
+        results[mode] = best
+    results["identical"] = params["full"]==params["headers_only"]
+    return results
+
+def bench_metadata(folder,count=1000,backends=None):
+    """ times each metadata backend writing the attributes and times of count empty files
+    Parameters:
+    -----------
+    folder: str
+        folder where a sub folder of files is created per backend
+    backends: list
+        backend names (default: all), the backends not available on this platform are reported as None
+    Returns:
+    --------
+    results: dict
+        backend -> {"files","failed","seconds","files_per_second"} (stats of the writer, flush included)
+    """
+    results = {}
+    sent_date = datetime(2001,8,24,9,53,36,tzinfo=timezone.utc)
+    for backend in backends or list(WRITERS):
+        try:
+            writer = get_writer(backend)
+        except Exception:
+            results[backend] = None
+            continue
+        backend_folder = join(folder,backend)
+        os.makedirs(backend_folder,exist_ok=True)
+        fps = []
+        for i in range(count):
+            fp = join(backend_folder,f"{i}.eml")
+            open(fp,"wb").close()
+            fps.append(fp)
+        for i, fp in enumerate(fps):
+            writer.write(fp,"Alice Sender <alice@example.com>",f"quarterly deck {i}",
+                "TO:Bob Receiver <bob@example.com>",sent_date)
+        writer.flush()
+        results[backend] = dict(writer.stats,files_per_second=writer.files_per_second())
+    return results
+
+def bench_export(folder,count=20000,fail_rate=0.01,batch_size=500,workers=4):
+    """ exports count generated messages to the fake Elasticsearch and Sonic servers
+    Parameters:
+    -----------
+    folder: str
+        folder of the generated search index
+    fail_rate: float
+        fraction of the items / commands failing on the fake servers
+    Returns:
+    --------
+    results: dict
+        target -> export report (see exporters.Exporter.export) with the number of distinct
+        messages received by the fake server
+    """
+    index = SearchIndex(folder)
+    sent_date = datetime(2001,8,24,9,53,36,tzinfo=timezone.utc)
+    words = ["budget","forecast","meeting","review","deck","quarter","minutes","agenda","été","réunion"]
+    index.add(folder,[{"name":f"{i}.eml","send_to":"Bob Receiver <bob@example.com>",
+        "sent_from":f"sender{i%97}@example.com","subject":f"{words[i%10]} {i}",
+        "sent_date":sent_date+timedelta(minutes=i),"body":" ".join(words[(i+j)%10] for j in range(200))}
+        for i in range(count)])
+    results = {}
+    try:
+        with FakeElasticsearch(fail_rate=fail_rate) as server:
+            exporter = ElasticsearchExporter(server.url,batch_size=batch_size,workers=workers,backoff=0.01)
+            results["elasticsearch"] = dict(exporter.export(index.records()),received=len(server.documents))
+        with FakeSonic(fail_rate=fail_rate/100) as server:
+            exporter = SonicExporter("127.0.0.1",server.port,batch_size=batch_size,workers=workers,backoff=0.01)
+            results["sonic"] = dict(exporter.export(index.records()),received=len(server.documents))
+    finally:
+        index.close()
+    return results
+
+#file system calls slowed down by injected_latency, os.path.isfile/getsize go through os.stat
+LATENCY_CALLS = ["rename","replace","utime","stat","scandir","listdir","setxattr"]
+
+@contextmanager
+def injected_latency(seconds):
+    """ adds seconds (one network round trip) to the file system calls of LATENCY_CALLS and to open,
+    the sleeps release the GIL like a blocking network call
+    """
+    originals = {name:getattr(os,name) for name in LATENCY_CALLS if hasattr(os,name)}
+    original_open = builtins.open
+    def slowed(function):
+        def call(*args,**kwargs):
+            sleep(seconds)
+            return function(*args,**kwargs)
+        return call
+    for name, function in originals.items():
+        setattr(os,name,slowed(function))
+    builtins.open = slowed(original_open)
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(os,name,function)
+        builtins.open = original_open
+
+def bench_staged(folder,count=2000,latency=0.005,io_workers=16,metadata="sidecar"):
+    """ processes the same generated corpus one file after the other then staged, with latency added to
+    each file system call
+    Returns:
+    --------
+    results: dict
+        mode -> seconds and files per second, "identical": True if both runs gave the same file names
+    """
+    corpus = join(folder,f"staged_{count}")
+    if not exists(corpus):
+        generate_corpus(corpus,count)
+    results = {}
+    names = {}
+    for mode, staged in [("serial",None),("staged",{"io_workers":io_workers})]:
+        work = join(folder,f"staged_{mode}")
+        if exists(work):
+            rmtree(work)
+        copytree(corpus,work)
+        with injected_latency(latency):
+            start = perf_counter()
+            make_eml_search_friendly(work,metadata=metadata,staged=staged)
+            seconds = perf_counter()-start
+        names[mode] = sorted(os.path.relpath(join(root,fn),work) for root, _, files in os.walk(work) for fn in files)
+        results[mode] = {"seconds":seconds,"files_per_second":count/seconds}
+    results["identical"] = names["serial"]==names["staged"]
+    return results
+
+def bench_startup(folder,repeat=20,files=20,top=10):
+    """ runs the command line in new processes, as a job scheduler starts it
+    Parameters:
+    -----------
+    repeat: int
+        runs per command
+    files: int
+        messages of the small folder processed
+    top: int
+        slowest imports reported
+    Returns:
+    --------
+    results: dict
+        command -> min and median milliseconds ("python" is the interpreter alone), "imports": [(module,
+        cumulative milliseconds)] for --help
+    """
+    corpus = join(folder,f"startup_{files}")
+    if not exists(corpus):
+        generate_corpus(corpus,files)
+    work = join(folder,"startup_work")
+    env = dict(os.environ,PYTHONPATH=os.pathsep.join([dirname(dirname(abspath(__file__)))]+
+        ([os.environ["PYTHONPATH"]] if os.environ.get("PYTHONPATH") else [])))
+    commands = {"python":[sys.executable,"-c","pass"],"--help":[sys.executable,"-m","pyPST2EML","--help"],
+        f"{files} files":[sys.executable,"-m","pyPST2EML","-f",work,"--metadata","sidecar"]}
+    results = {}
+    for name, command in commands.items():
+        times = []
+        for _ in range(repeat):
+            if name.endswith("files"):
+                if exists(work):
+                    rmtree(work)
+                copytree(corpus,work)
+            start = perf_counter()
+            run(command,stdout=DEVNULL,stderr=DEVNULL,env=env,check=True)
+            times.append((perf_counter()-start)*1000)
+        results[name] = {"min_ms":min(times),"median_ms":median(times)}
+    imports = run([sys.executable,"-X","importtime","-m","pyPST2EML","--help"],stdout=DEVNULL,stderr=PIPE,env=env,
+        universal_newlines=True).stderr
+    cumulative = []
+    #import time: <self us> | <cumulative us> | <module indented by depth>
+    for line in imports.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and len(fields)==3 and fields[1].strip().isdigit():
+            cumulative.append((fields[2].strip(),int(fields[1])/1000))
+    results["imports"] = sorted(cumulative,key=lambda item:-item[1])[:top]
+    return results
+
+#files whose header block is kept in memory for the get_sentdate stage
+SENTDATE_SAMPLE = 10000
+
+#slow down reported by compare_results
+REGRESSION_THRESHOLD = 1.10
+
+def timed(stage,count,function,*args,**kwargs):
+    """ Returns (result of function, {"seconds","files","files_per_second"}) """
+    start = perf_counter()
+    result = function(*args,**kwargs)
+    seconds = perf_counter()-start
+    print(f"  {stage:26} {count:8} files {seconds:9.3f}s {count/seconds if seconds>0 else 0:10.0f} files/s")
+    return result, {"seconds":seconds,"files":count,"files_per_second":count/seconds if seconds>0 else None}
+
+def bench_corpus(folder,count,seed=0):
+    """ times the processing stages on a generated corpus of count files
+    Parameters:
+    -----------
+    folder: str
+        the corpus is generated in folder/corpus_<count> (kept and reused by the next runs), the
+        stages modifying the files work on copies removed afterwards
+    Returns:
+    --------
+    results: dict
+        stage -> {"seconds","files","files_per_second"}
+    """
+    corpus = join(folder,f"corpus_{count}")
+    results = {}
+    print(f"{count} files")
+    if not exists(join(corpus,".complete")):
+        if exists(corpus):
+            rmtree(corpus)
+        fps, results["generate_corpus"] = timed("generate_corpus",count,generate_corpus,corpus,count,seed)
+        open(join(corpus,".complete"),"w").close()
+    fps = sorted([join(root,fn) for root, directories, files in os.walk(corpus) for fn in files if fn!=".complete"])
+
+    params, results["eml_get_parameters"] = timed("eml_get_parameters",len(fps),
+        lambda:[eml_get_parameters(fp) for fp in fps])
+    _, results["eml_get_parameters_headers"] = timed("eml_get_parameters headers",len(fps),
+        lambda:[eml_get_parameters(fp,headers_only=True) for fp in fps])
+
+    sample = [(fp,)+load_eml(fp,headers_only=True) for fp in fps[:SENTDATE_SAMPLE]]
+    parse_date_tolerant.cache_clear()
+    _, results["get_sentdate"] = timed("get_sentdate",len(sample),
+        lambda:[get_sentdate(msg_strings,msg,fp,False) for fp, msg, msg_strings in sample])
+    del sample
+
+    work = join(folder,f"work_{count}")
+    if exists(work):
+        rmtree(work)
+    copytree(corpus,work)
+    work_fps = [join(work,os.path.relpath(fp,corpus)) for fp in fps]
+    _, results["rename_eml"] = timed("rename_eml",len(fps),
+        lambda:[rename_eml(fp,subject,ignore_ext=False) for fp, (send_to, sent_from, subject, sent_date) in zip(work_fps,params)])
+    rmtree(work)
+
+    copytree(corpus,work)
+    os.remove(join(work,".complete"))
+    _, results["make_eml_search_friendly"] = timed("make_eml_search_friendly",len(fps),make_eml_search_friendly,work)
+    rmtree(work)
+    return results
+
+def run_suite(folder,sizes=(1000,10000,100000),seed=0):
+    """ runs bench_corpus for each corpus size
+    Returns:
+    --------
+    report: dict
+        version, git commit, python, platform, date and "results": size -> stage -> timings
+    """
+    try:
+        commit = check_output(["git","rev-parse","--short","HEAD"],cwd=dirname(__file__),stderr=DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    report = {"version":__version__,"commit":commit,"python":sys.version.split()[0],
+        "platform":platform.platform(),"date":datetime.now().isoformat(timespec="seconds"),"seed":seed,"results":{}}
+    for count in sizes:
+        report["results"][str(count)] = bench_corpus(folder,count,seed)
+    return report
+
+def compare_results(previous,current,threshold=REGRESSION_THRESHOLD):
+    """ prints the files/s ratio current/previous of each size and stage present in both reports
+    Returns:
+    --------
+    regressions: list
+        (size, stage, ratio) of the stages slower than previous by more than threshold
+    """
+    regressions = []
+    print(f"{previous.get('version')} ({previous.get('commit')}) -> {current.get('version')} ({current.get('commit')})")
+    for size, stages in current["results"].items():
+        for stage, timing in stages.items():
+            before = previous["results"].get(size,{}).get(stage)
+            if not before or not before["files_per_second"] or not timing["files_per_second"]:
+                continue
+            ratio = timing["files_per_second"]/before["files_per_second"]
+            flag = ""
+            if ratio*threshold<1:
+                flag = "REGRESSION"
+                regressions.append((size,stage,ratio))
+            print(f"  {size:>8} {stage:26} {before['files_per_second']:10.0f} -> {timing['files_per_second']:10.0f} files/s  x{ratio:.2f} {flag}")
+    return regressions
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='benchmark header-only parsing on large attachments')
+    parser.add_argument("--folder","-f",dest="folder",type=str,default="",
+                    help="folder for the generated fixtures (default: new temporary folder)")
+    parser.add_argument("--count",dest="count",type=int,default=5)
+    parser.add_argument("--size",dest="size_mb",type=int,default=20,
+                    help="attachment size in MB")
+    parser.add_argument("--repeat",dest="repeat",type=int,default=3)
+    parser.add_argument("--metadata",dest="metadata",type=int,default=0,
+                    help="number of files written by each metadata backend instead of the header-only benchmark")
+    parser.add_argument("--export",dest="export",type=int,default=0,
+                    help="number of messages sent to the fake search servers instead of the header-only benchmark")
+    parser.add_argument("--staged",dest="staged",type=int,default=0,
+                    help="number of generated messages processed one after the other then staged with --latency")
+    parser.add_argument("--latency",dest="latency",type=float,default=5,
+                    help="milliseconds added to each file system call with --staged (default: 5)")
+    parser.add_argument("--io_workers",dest="io_workers",type=int,default=16)
+    parser.add_argument("--startup",dest="startup",type=int,default=0,
+                    help="runs of the cold start benchmark (--help and a small folder in new processes)")
+    parser.add_argument("--suite",dest="suite",type=str,default="",
+                    help="comma separated corpus sizes of the benchmark suite instead of the header-only benchmark")
+    parser.add_argument("--output",dest="output",type=str,default="",
+                    help="with --suite, json file receiving the results (default: bench_<version>.json in the folder)")
+    parser.add_argument("--compare",dest="compare",type=str,default="",
+                    help="with --suite, json results of a previous run to compare with")
+    args = parser.parse_args()
+
+    folder = args.folder or mkdtemp(prefix="pst2eml_bench_")
+    if args.suite:
+        report = run_suite(folder,[int(size) for size in args.suite.split(",")])
+        output = args.output or join(folder,f"bench_{__version__}.json")
+        with open(output,"w",encoding="utf-8") as fo:
+            json.dump(report,fo,indent=2)
+        print(f"results written in {output}")
+        if args.compare:
+            with open(args.compare,encoding="utf-8") as fi:
+                regressions = compare_results(json.load(fi),report)
+            raise SystemExit(1 if regressions else 0)
+        raise SystemExit
+    if args.startup:
+        results = bench_startup(folder,args.startup)
+        for name, timing in results.items():
+            if name!="imports":
+                print(f"{name:10}: min {timing['min_ms']:.0f}ms, median {timing['median_ms']:.0f}ms")
+        print("slowest imports (cumulative):")
+        for module, ms in results["imports"]:
+            print(f"  {ms:7.1f}ms {module}")
+        raise SystemExit
+    if args.staged:
+        results = bench_staged(folder,args.staged,args.latency/1000,args.io_workers)
+        for mode in ["serial","staged"]:
+            print(f"{mode:7}: {results[mode]['seconds']:.2f}s, {results[mode]['files_per_second']:.0f} files/s")
+        print(f"identical file names: {results['identical']}")
+        raise SystemExit
+    if args.export:
+        for target, report in bench_export(folder,args.export).items():
+            latency = report["batch_latency"]
+            print(f"{target:14}: {report['sent']} sent, {report['failed']} failed, {report['received']} received, "
+                f"{report['retries']} retries, {report['records_per_second']:.0f} records/s, "
+                f"batch latency p50 {latency['p50']*1000:.1f}ms p95 {latency['p95']*1000:.1f}ms")
+        raise SystemExit
+    if args.metadata:
+        for backend, stats in bench_metadata(folder,args.metadata).items():
+            if stats is None:
+                print(f"{backend:8}: not available")
+            else:
+                print(f"{backend:8}: {stats['files']} files, {stats['failed']} failed, {stats['seconds']:.3f}s, {stats['files_per_second']:.0f} files/s")
+        raise SystemExit
+    fps = make_large_attachment_fixtures(folder,args.count,args.size_mb)
+    results = bench_header_only(fps,args.repeat)
+    print(f"{args.count} files with {args.size_mb}MB attachment in {folder}")
+    print(f"full parsing : {results['full']:.3f}s")
+    print(f"headers only : {results['headers_only']:.3f}s")
+    print(f"speed-up     : {results['full']/results['headers_only']:.1f}x")
+    print(f"identical results: {results['identical']}")
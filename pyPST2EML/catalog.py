@@ -0,0 +1,294 @@
+"""
+columnar message catalog for analytics over millions of messages
+
+make_eml_search_friendly(catalog=True) keeps the parameters of every processed message (MessageRecord,
+a __slots__ record while in flight) in a Catalog saved at the root of the processed folder
+(.pst2eml_catalog). The catalog is stored by column in arrays (array module):
+* sender: address id, the sender and recipient addresses (lower case) share one dictionary
+* recipients: address ids of all the messages one after the other, recipient_offsets[i] is the first of message i
+* date: sent date as epoch seconds, month: months since 1970-01 (UTC, negative before 1970)
+* folder: folder id (dictionary of the folders relative to the root)
+about 28 bytes + 4 bytes per recipient per message, the dictionaries hold the distinct addresses
+and folders only.
+
+the queries (count, counts_per_sender_month, top_correspondents) scan the columns, with numpy when it is
+installed (pip install numpy) or in pure python otherwise.
+
+Example:
+--------
+python -m pyPST2EML catalog -f C:\\outlook\\archives\\eml\\2021Q1 --top 20 --after 2021-01-01
+python -m pyPST2EML catalog -f C:\\outlook\\archives\\eml\\2021Q1 --months --sender alice@example.com
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from array import array
+from collections import Counter
+from datetime import timezone
+from email.utils import getaddresses
+import json
+import os
+from os.path import exists, join, relpath
+import struct
+import sys
+
+CATALOG_NAME = ".pst2eml_catalog"
+CATALOG_MAGIC = b"PSTCAT01"
+HEADER_LENGTH = struct.Struct("<I")
+
+#numpy module once imported (see get_numpy), None if not installed
+_numpy = False
+
+#name -> array typecode, numpy dtype
+COLUMNS = {"sender":("I","uint32"),"recipient_offsets":("I","uint32"),"recipients":("I","uint32"),
+    "date":("q","int64"),"month":("i","int32"),"folder":("I","uint32")}
+
+def get_numpy():
+    """ Returns numpy (OPTIONAL INSTALL, imported on the first query: it takes longer than the rest of the
+    package to import) or None """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = None
+    return _numpy
+
+def is_catalog_file(fn):
+    return fn.startswith(CATALOG_NAME)
+
+def month_name(month):
+    """ "YYYY-MM" of a month column value """
+    return f"{1970+month//12}-{month%12+1:02d}"
+
+class MessageRecord:
+    """ parameters of a processed message (see pst2eml.msg_get_parameters) """
+    __slots__ = ["send_to","sent_from","subject","sent_date","folder","name"]
+
+    def __init__(self,send_to,sent_from,subject,sent_date,folder="",name=""):
+        self.send_to = send_to
+        self.sent_from = sent_from
+        self.subject = subject
+        self.sent_date = sent_date
+        self.folder = folder
+        self.name = name
+
+    def __getstate__(self):
+        return (self.send_to,self.sent_from,self.subject,self.sent_date,self.folder,self.name)
+
+    def __setstate__(self,state):
+        self.send_to, self.sent_from, self.subject, self.sent_date, self.folder, self.name = state
+
+def addresses(value):
+    """ lower case addresses of a From/To header value """
+    return [address.lower() for _, address in getaddresses([str(value or "")]) if address]
+
+class Dictionary:
+    """ value <-> id """
+    def __init__(self,values=None):
+        self.values = list(values or [])
+        self.ids = {value:i for i, value in enumerate(self.values)}
+
+    def id(self,value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def __len__(self):
+        return len(self.values)
+
+class Catalog:
+    """ columns of the messages of a folder tree
+    Parameters:
+    -----------
+    root: str
+        folder holding the catalog file, the folders of the records are stored relative to it
+    """
+    def __init__(self,root):
+        self.root = root
+        self.fp = join(root,CATALOG_NAME)
+        self.columns = {name:array(typecode) for name, (typecode, _) in COLUMNS.items()}
+        self.columns["recipient_offsets"].append(0)
+        self.addresses = Dictionary()
+        self.folders = Dictionary()
+
+    def __len__(self):
+        return len(self.columns["date"])
+
+    def add(self,record):
+        """ appends a MessageRecord (all its values are computed first: a record which fails leaves the
+        columns as they were) """
+        columns = self.columns
+        sent_from = addresses(record.sent_from)
+        send_to = addresses(record.send_to)
+        utc = record.sent_date.astimezone(timezone.utc)
+        date = int(utc.timestamp())
+        month = (utc.year-1970)*12+utc.month-1
+        folder = self.folders.id(relpath(record.folder,self.root) if record.folder else ".")
+        sender = self.addresses.id(sent_from[0] if sent_from else "")
+        recipients = [self.addresses.id(address) for address in send_to]
+        columns["sender"].append(sender)
+        columns["recipients"].extend(recipients)
+        columns["recipient_offsets"].append(len(columns["recipients"]))
+        columns["date"].append(date)
+        columns["month"].append(month)
+        columns["folder"].append(folder)
+
+    def nbytes(self):
+        """ bytes used by the columns (the dictionaries not included) """
+        return sum(column.itemsize*len(column) for column in self.columns.values())
+
+    def save(self):
+        header = {"count":len(self),"byteorder":sys.byteorder,
+            "columns":{name:[column.typecode,len(column)] for name, column in self.columns.items()},
+            "addresses":self.addresses.values,"folders":self.folders.values}
+        header = json.dumps(header,ensure_ascii=False).encode("utf-8")
+        tmp_fp = self.fp+".tmp"
+        with open(tmp_fp,"wb") as fo:
+            fo.write(CATALOG_MAGIC+HEADER_LENGTH.pack(len(header))+header)
+            for name in COLUMNS:
+                self.columns[name].tofile(fo)
+        os.replace(tmp_fp,self.fp)
+
+    @classmethod
+    def load(cls,root):
+        """ Returns the catalog saved in root (an empty one if there is none) """
+        catalog = cls(root)
+        if not exists(catalog.fp):
+            return catalog
+        with open(catalog.fp,"rb") as fi:
+            if fi.read(len(CATALOG_MAGIC))!=CATALOG_MAGIC:
+                raise ValueError(f"{catalog.fp} is not a catalog")
+            header = json.loads(fi.read(HEADER_LENGTH.unpack(fi.read(HEADER_LENGTH.size))[0]).decode("utf-8"))
+            for name in COLUMNS:
+                typecode, length = header["columns"][name]
+                column = array(typecode)
+                column.fromfile(fi,length)
+                if header["byteorder"]!=sys.byteorder:
+                    column.byteswap()
+                if typecode!=COLUMNS[name][0]:
+                    #catalog saved with another column type (month was unsigned before)
+                    column = array(COLUMNS[name][0],column)
+                catalog.columns[name] = column
+        catalog.addresses = Dictionary(header["addresses"])
+        catalog.folders = Dictionary(header["folders"])
+        return catalog
+
+    def _view(self,name):
+        return get_numpy().frombuffer(self.columns[name],dtype=COLUMNS[name][1])
+
+    def _mask(self,after=None,before=None,sender=None):
+        """ numpy boolean mask of the messages matching the filters (None: all of them) """
+        mask = None
+        if after is not None:
+            mask = self._view("date")>=int(after.timestamp())
+        if before is not None:
+            selected = self._view("date")<int(before.timestamp())
+            mask = selected if mask is None else mask&selected
+        if sender is not None:
+            selected = self._view("sender")==self.addresses.ids.get(sender.lower(),-1)
+            mask = selected if mask is None else mask&selected
+        return mask
+
+    def _selected(self,after=None,before=None,sender=None):
+        """ pure python: indexes of the messages matching the filters """
+        date = self.columns["date"]
+        after = int(after.timestamp()) if after is not None else None
+        before = int(before.timestamp()) if before is not None else None
+        sender_id = self.addresses.ids.get(sender.lower(),-1) if sender is not None else None
+        senders = self.columns["sender"]
+        return [i for i in range(len(date)) if (after is None or date[i]>=after) and
+            (before is None or date[i]<before) and (sender_id is None or senders[i]==sender_id)]
+
+    def count(self,after=None,before=None,sender=None):
+        """ number of messages sent in [after, before[ (by sender) """
+        if after is None and before is None and sender is None:
+            return len(self)
+        if get_numpy() is not None:
+            return int(self._mask(after,before,sender).sum())
+        return len(self._selected(after,before,sender))
+
+    def counts_per_sender_month(self,after=None,before=None,sender=None):
+        """ Returns dict (sender address, "YYYY-MM") -> number of messages """
+        if not len(self):
+            return {}
+        numpy = get_numpy()
+        if numpy is not None:
+            senders = self._view("sender").astype(numpy.int64)
+            months = self._view("month").astype(numpy.int64)
+            mask = self._mask(after,before,sender)
+            if mask is not None:
+                senders = senders[mask]
+                months = months[mask]
+            first = int(months.min()) if len(months) else 0
+            span = int(months.max())-first+1 if len(months) else 1
+            counts = numpy.bincount(senders*span+(months-first))
+            return {(self.addresses.values[key//span],month_name(first+key%span)):int(counts[key])
+                for key in numpy.flatnonzero(counts).tolist()}
+        senders = self.columns["sender"]
+        months = self.columns["month"]
+        counts = Counter((senders[i],months[i]) for i in self._selected(after,before,sender))
+        return {(self.addresses.values[s],month_name(m)):count for (s, m), count in counts.items()}
+
+    def top_correspondents(self,n=10,after=None,before=None,senders=True,recipients=True):
+        """ Returns [(address, messages sent and/or received)] of the n most frequent addresses """
+        if not len(self):
+            return []
+        numpy = get_numpy()
+        if numpy is not None:
+            size = len(self.addresses)
+            counts = numpy.zeros(size,dtype=numpy.int64)
+            mask = self._mask(after,before)
+            if senders:
+                sender = self._view("sender")
+                counts+= numpy.bincount(sender if mask is None else sender[mask],minlength=size)
+            if recipients:
+                recipient = self._view("recipients")
+                if mask is not None:
+                    recipient = recipient[numpy.repeat(mask,numpy.diff(self._view("recipient_offsets")))]
+                counts+= numpy.bincount(recipient,minlength=size)
+            if self.addresses.ids.get("") is not None:
+                counts[self.addresses.ids[""]] = 0
+            top = numpy.argsort(-counts,kind="stable")[:n]
+            return [(self.addresses.values[i],int(counts[i])) for i in top.tolist() if counts[i]>0]
+        counts = Counter()
+        sender = self.columns["sender"]
+        recipient = self.columns["recipients"]
+        offsets = self.columns["recipient_offsets"]
+        selected = range(len(self)) if after is None and before is None else self._selected(after,before)
+        for i in selected:
+            if senders:
+                counts[sender[i]]+=1
+            if recipients:
+                counts.update(recipient[offsets[i]:offsets[i+1]])
+        counts.pop(self.addresses.ids.get(""),None)
+        return [(self.addresses.values[i],count) for i, count in counts.most_common(n)]
+
+def catalog_cli(argv=None):
+    """ catalog subcommand: python -m pyPST2EML catalog -f <folder> [--top N | --months] [--sender] [--after] [--before] """
+    from .search_index import parse_date_filter
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML catalog",
+        description='statistics of the catalog built with --catalog Y')
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True,help="folder processed with --catalog Y")
+    parser.add_argument("--top",dest="top",type=int,default=0,help="most frequent correspondents")
+    parser.add_argument("--months",dest="months",action="store_true",help="messages per sender per month")
+    parser.add_argument("--sender","-s",dest="sender",type=str,default=None,help="sender address")
+    parser.add_argument("--after",dest="after",type=str,default=None)
+    parser.add_argument("--before",dest="before",type=str,default=None)
+    args = parser.parse_args(argv)
+    if not exists(join(args.folder,CATALOG_NAME)):
+        print(f"no catalog in {args.folder}, process it with --catalog Y first")
+        return 1
+    catalog = Catalog.load(args.folder)
+    after, before = parse_date_filter(args.after), parse_date_filter(args.before)
+    if args.months:
+        for (sender, month), count in sorted(catalog.counts_per_sender_month(after,before,args.sender).items()):
+            print(f"{month} {count:8} {sender or '-'}")
+    if args.top:
+        for address, count in catalog.top_correspondents(args.top,after,before):
+            print(f"{count:8} {address}")
+    print(f"{catalog.count(after,before,args.sender)} of {len(catalog)} messages, {catalog.nbytes()/max(1,len(catalog)):.1f} bytes per message")
+    return 0
@@ -0,0 +1,218 @@
+"""
+synthetic mail corpus generator for the benchmarks (see benchmark.run_suite)
+
+generate_corpus writes count .eml/.ics files, reproducible for a given seed, spread over a few folders, with:
+* message sizes following a log-normal distribution (median and spread in parameters)
+* a number of base64 attachments per message drawn from a geometric distribution
+* subjects in ascii, latin-1 (raw 8 bit), utf-8 / Big5 / ISO-2022-JP RFC 2047 encoded words, with
+    RE:/FW: prefixes, characters forbidden in file names and over long subjects
+* a share of subjects drawn from a small pool so file names collide (see pst2eml.incrementalfilename)
+* the date formats met in the archives (RFC 2822, without timezone, timezone names, day names, ...)
+* a share of .ics calendar items as written by readpst
+
+Example:
+--------
+python -m pyPST2EML.corpus C:\\temp\\corpus --count=10000
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from base64 import b64encode, encodebytes
+from datetime import datetime, timedelta, timezone
+import math
+import os
+from os.path import join
+import random
+
+FOLDERS = ["Inbox","Inbox/Projects","Inbox/Projects/2021","Sent Items","Archive","Calendar"]
+
+SUBJECT_WORDS = ["budget","forecast","meeting","review","deck","quarter","minutes","agenda","invoice","contract",
+    "release","roadmap","customer","support","travel","expense","report","planning","hiring","offsite"]
+
+#subjects repeated across the corpus so that renamed files collide
+COLLIDING_SUBJECTS = ["status","hello","RE: status","FW: report: Q1","weekly sync","(no subject)",""]
+
+UNICODE_SUBJECTS = {
+    "latin-1":["bonne année","réunion d'équipe à Paris","Prévisions été / automne","Ã©tÃ© Ã  venir"],
+    "utf-8":["réunion d'équipe","Über die Prognose","プロジェクト会議","月報: 三月","café ☕ & gâteau"],
+    "big5":["AVIS安維斯汽車租賃股份有限公司-電子發票證明聯開立通知","會議記錄","季度預算"],
+    "iso-2022-jp":["プロジェクト会議の議事録","月次報告書","出張のお知らせ"],
+}
+
+def format_dates(date):
+    """ the same date written in the formats met in the archives """
+    offset = date.strftime("%z")
+    return [
+        date.strftime("%a, %d %b %Y %H:%M:%S ")+offset,
+        date.strftime("%a, %d %b %Y %H:%M:%S ")+offset+" (CET)",
+        date.strftime("%d %b %Y %H:%M ")+offset,
+        date.strftime("%a, %d %b %Y %H:%M:%S"),
+        date.strftime("%A, %B %d, %Y %I:%M %p"),
+        date.strftime("%a, %d %b %Y %H:%M:%S")+" W. Europe Standard Time",
+        date.strftime("%a, %d %b %Y %H:%M:%S")+" (GMT)",
+        date.strftime("%a, %d %b %Y %H:%M:%S ").lower()+offset,
+        date.astimezone(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S -0000"),
+    ]
+
+def encoded_word(text,charset,rng):
+    """ RFC 2047 encoded word (base64 or quoted-printable) of text """
+    data = text.encode(charset)
+    if charset=="iso-2022-jp" or rng.random()<0.5:
+        return f"=?{charset}?B?{b64encode(data).decode('ascii')}?="
+    qp = "".join([chr(b) if 33<=b<127 and chr(b) not in "=?_" else ("_" if b==32 else f"={b:02X}") for b in data])
+    return f"=?{charset}?Q?{qp}?="
+
+class CorpusGenerator:
+    """ reproducible random messages, see generate_corpus for the parameters """
+    def __init__(self,seed=0,size_median_kb=4,size_sigma=1.0,attachment_mean=0.3,attachment_median_kb=32,
+        collision_ratio=0.3,ics_ratio=0.05):
+        self.rng = random.Random(seed)
+        self.size_median_kb = size_median_kb
+        self.size_sigma = size_sigma
+        self.attachment_mean = attachment_mean
+        self.attachment_median_kb = attachment_median_kb
+        self.collision_ratio = collision_ratio
+        self.ics_ratio = ics_ratio
+        self.start = datetime(2001,1,1,tzinfo=timezone(timedelta(hours=1)))
+
+    def lognormal_bytes(self,median_kb):
+        return max(16,int(self.rng.lognormvariate(math.log(median_kb*1024),self.size_sigma)))
+
+    def attachment_count(self):
+        """ geometric distribution of mean attachment_mean """
+        if self.attachment_mean<=0:
+            return 0
+        p = 1/(1+self.attachment_mean)
+        count = 0
+        while self.rng.random()>p:
+            count+=1
+        return count
+
+    def text(self,size):
+        words = []
+        length = 0
+        while length<size:
+            word = self.rng.choice(SUBJECT_WORDS)
+            words.append(word)
+            length+= len(word)+1
+        lines = [" ".join(words[i:i+12]) for i in range(0,len(words),12)]
+        return "\r\n".join(lines)
+
+    def subject(self):
+        """ Returns (raw header value as bytes, charset of the body) """
+        rng = self.rng
+        draw = rng.random()
+        if draw<self.collision_ratio:
+            return rng.choice(COLLIDING_SUBJECTS).encode("ascii"), "us-ascii"
+        draw = rng.random()
+        if draw<0.5:
+            subject = " ".join(rng.choices(SUBJECT_WORDS,k=rng.randint(1,8)))
+            subject = rng.choice(["","","RE: ","FW: ","RE: FW: "])+subject
+            if rng.random()<0.2:
+                subject+= rng.choice([": v2"," / draft"," *urgent*"," <ext>"," | Q3"," \"final\"","?"])
+            if rng.random()<0.02:
+                subject = (subject+" ")*40
+            return subject.encode("ascii"), "us-ascii"
+        charset = rng.choice(list(UNICODE_SUBJECTS))
+        subject = rng.choice(UNICODE_SUBJECTS[charset])
+        if charset=="latin-1":
+            return subject.encode("latin-1"), "iso-8859-1"
+        return encoded_word(subject,charset,rng).encode("ascii"), "utf-8"
+
+    def date(self):
+        date = self.start+timedelta(seconds=self.rng.randint(0,20*365*86400))
+        return date, self.rng.choice(format_dates(date))
+
+    def eml(self,i):
+        rng = self.rng
+        subject, charset = self.subject()
+        date, date_text = self.date()
+        sender = f"Sender {i%53} <sender{i%53}@example.com>"
+        recipients = ", ".join([f"user{rng.randint(0,500)}@example.com" for _ in range(rng.randint(1,4))])
+        headers = [b"From: "+sender.encode("ascii"),b"To: "+recipients.encode("ascii"),b"Subject: "+subject,
+            b"Date: "+date_text.encode("ascii"),f"Message-ID: <{i}.{rng.getrandbits(32)}@example.com>".encode("ascii"),
+            b"MIME-Version: 1.0"]
+        body = self.text(self.lognormal_bytes(self.size_median_kb))
+        body_bytes = body.encode("ascii")
+        attachments = self.attachment_count()
+        if not attachments:
+            headers.append(f"Content-Type: text/plain; charset=\"{charset}\"".encode("ascii"))
+            return b"\r\n".join(headers)+b"\r\n\r\n"+body_bytes+b"\r\n"
+        boundary = f"----=_Part_{i}_{rng.getrandbits(32)}"
+        headers.append(f"Content-Type: multipart/mixed; boundary=\"{boundary}\"".encode("ascii"))
+        parts = [f"--{boundary}\r\nContent-Type: text/plain; charset=\"{charset}\"\r\n\r\n".encode("ascii")+body_bytes]
+        for j in range(attachments):
+            size = self.lognormal_bytes(self.attachment_median_kb)
+            data = rng.getrandbits(8*size).to_bytes(size,"little")
+            parts.append(f"--{boundary}\r\nContent-Type: application/octet-stream; name=\"attachment_{j}.bin\"\r\n"
+                f"Content-Disposition: attachment; filename=\"attachment_{j}.bin\"\r\n"
+                "Content-Transfer-Encoding: base64\r\n\r\n".encode("ascii")+encodebytes(data).replace(b"\n",b"\r\n"))
+        return (b"\r\n".join(headers)+b"\r\n\r\n"+b"\r\n".join(parts)+f"\r\n--{boundary}--\r\n".encode("ascii"))
+
+    def ics(self,i):
+        rng = self.rng
+        date, _ = self.date()
+        start = date.astimezone(timezone.utc)
+        summary = rng.choice(COLLIDING_SUBJECTS[:-1]+[" ".join(rng.choices(SUBJECT_WORDS,k=4))])
+        lines = ["BEGIN:VCALENDAR","VERSION:2.0","PRODID:LibPST v0.6.45","BEGIN:VEVENT",
+            "DTSTAMP:"+start.strftime("%Y%m%dT%H%M%SZ"),
+            "SUMMARY:"+summary.replace(",","\\,"),
+            "DESCRIPTION:"+self.text(self.lognormal_bytes(1)).replace("\r\n","\\n").replace(",","\\,"),
+            "DTSTART;VALUE=DATE-TIME:"+start.strftime("%Y%m%dT%H%M%SZ"),
+            "DTEND;VALUE=DATE-TIME:"+(start+timedelta(hours=1)).strftime("%Y%m%dT%H%M%SZ"),
+            "LOCATION:Room "+str(rng.randint(1,40)),"STATUS:CONFIRMED","END:VEVENT","END:VCALENDAR",""]
+        return "\n".join(lines).encode("utf-8")
+
+def generate_corpus(folder,count,seed=0,**kwargs):
+    """ writes count .eml/.ics files into sub folders of folder
+    Parameters:
+    -----------
+    folder: str
+        output folder (created if needed)
+    count: int
+        number of files
+    seed: int
+        same seed and parameters give the same files
+    size_median_kb, size_sigma: float
+        log-normal distribution of the text body size
+    attachment_mean: float
+        average number of attachments per message (geometric distribution)
+    attachment_median_kb: float
+        median attachment size (same log-normal spread)
+    collision_ratio: float
+        share of the subjects drawn from COLLIDING_SUBJECTS
+    ics_ratio: float
+        share of .ics files
+    Returns:
+    --------
+    fps: list
+        full paths of the generated files
+    """
+    generator = CorpusGenerator(seed,**kwargs)
+    fps = []
+    for folder_name in FOLDERS:
+        os.makedirs(join(folder,folder_name),exist_ok=True)
+    for i in range(count):
+        if generator.rng.random()<generator.ics_ratio:
+            fp = join(folder,"Calendar",f"{i+1}.ics")
+            data = generator.ics(i)
+        else:
+            fp = join(folder,generator.rng.choice(FOLDERS[:-1]),f"{i+1}.eml")
+            data = generator.eml(i)
+        with open(fp,"wb") as fo:
+            fo.write(data)
+        fps.append(fp)
+    return fps
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='generate a synthetic .eml/.ics corpus')
+    parser.add_argument("folder",type=str)
+    parser.add_argument("--count",dest="count",type=int,default=1000)
+    parser.add_argument("--seed",dest="seed",type=int,default=0)
+    parser.add_argument("--size",dest="size_median_kb",type=float,default=4,help="median body size in KB")
+    parser.add_argument("--attachments",dest="attachment_mean",type=float,default=0.3,
+                    help="average number of attachments per message")
+    args = parser.parse_args()
+    fps = generate_corpus(args.folder,args.count,args.seed,size_median_kb=args.size_median_kb,
+        attachment_mean=args.attachment_mean)
+    print(f"{len(fps)} files written in {args.folder}")
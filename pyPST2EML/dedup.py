@@ -0,0 +1,275 @@
+"""
+cross-archive message deduplication
+
+quarterly archives overlap (Sent Items, moved mail), the same message is extracted from several .pst.
+DedupIndex keeps in a SQLite file (shared by the runs over all the archives) a 16 bytes key per message:
+blake2b of its normalized Message-ID and of a fingerprint of its sender, recipients, subject, sent date
+and body text (see message_key), with the path of its first copy.
+
+a Bloom filter (BloomFilter, about 1.2 bytes per message for 1% false positives, kept next to the
+index file) answers "new message" without reading the index for most messages, only the messages it
+reports as possibly known are looked up in SQLite, the new keys are inserted in batches.
+
+with several processes (make_eml_search_friendly jobs>1) each worker claims the keys directly in the
+index (INSERT OR IGNORE, so two copies processed at the same time are told apart) without the Bloom filter,
+the keys are added to the filter of the main process at the end of the run.
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import timezone
+from hashlib import blake2b
+import math
+import os
+import re
+import sqlite3
+import struct
+
+BLOOM_MAGIC = b"PSTBLOOM"
+BLOOM_HEADER = struct.Struct("<8sQQQ")
+#body text chars included in the fingerprint
+BODY_FINGERPRINT_CHARS = 65536
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    key BLOB PRIMARY KEY,
+    message_id TEXT,
+    path TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+WHITESPACE = re.compile(r"\s+")
+
+def normalize(text):
+    """ lower case with the whitespace runs collapsed to a space """
+    return WHITESPACE.sub(" ",str(text or "")).strip().lower()
+
+def normalize_message_id(message_id):
+    return normalize(message_id).strip("<>")
+
+def message_key(message_id,sent_from,send_to,subject,sent_date,body=""):
+    """ 16 bytes key of a message
+    Parameters:
+    -----------
+    message_id: str
+        Message-ID header (None if missing: the key only depends on the fingerprint)
+    sent_from, send_to, subject: str
+        as returned by pst2eml.msg_get_parameters
+    sent_date: datetime
+        timezone aware sent date (compared in UTC)
+    body: str
+        body text (see search_index.message_text), empty in header-only mode
+    """
+    h = blake2b(digest_size=16)
+    for value in (normalize_message_id(message_id),normalize(sent_from),normalize(send_to),normalize(subject),
+        sent_date.astimezone(timezone.utc).isoformat(),normalize(body[:BODY_FINGERPRINT_CHARS])):
+        h.update(value.encode("utf-8","surrogatepass"))
+        h.update(b"\0")
+    return h.digest()
+
+class BloomFilter:
+    """ Bloom filter of 16 bytes keys (already uniformly distributed hashes)
+    Parameters:
+    -----------
+    capacity: int
+        number of keys for which the false positive rate is error_rate
+    """
+    def __init__(self,capacity,error_rate=0.01,bits=None,hashes=None,count=0,data=None):
+        capacity = max(1,capacity)
+        self.bits = bits or max(8,int(math.ceil(-capacity*math.log(error_rate)/math.log(2)**2)))
+        self.hashes = hashes or max(1,int(round(self.bits/capacity*math.log(2))))
+        self.count = count
+        self.capacity = capacity
+        self.data = data if data is not None else bytearray((self.bits+7)//8)
+
+    def _positions(self,key):
+        #double hashing (Kirsch-Mitzenmacher) on the two halves of the key
+        h1 = int.from_bytes(key[:8],"little")
+        h2 = int.from_bytes(key[8:16],"little")|1
+        bits = self.bits
+        return [(h1+i*h2)%bits for i in range(self.hashes)]
+
+    def add(self,key):
+        data = self.data
+        for position in self._positions(key):
+            data[position>>3]|= 1<<(position&7)
+        self.count+=1
+
+    def __contains__(self,key):
+        data = self.data
+        for position in self._positions(key):
+            if not data[position>>3]&(1<<(position&7)):
+                return False
+        return True
+
+    def save(self,fp):
+        tmp_fp = fp+".tmp"
+        with open(tmp_fp,"wb") as fo:
+            fo.write(BLOOM_HEADER.pack(BLOOM_MAGIC,self.bits,self.hashes,self.count))
+            fo.write(self.data)
+        os.replace(tmp_fp,fp)
+
+    @classmethod
+    def load(cls,fp):
+        """ Returns the saved filter (None if missing or invalid) """
+        try:
+            with open(fp,"rb") as fi:
+                magic, bits, hashes, count = BLOOM_HEADER.unpack(fi.read(BLOOM_HEADER.size))
+                data = bytearray(fi.read())
+        except (OSError,struct.error):
+            return None
+        if magic!=BLOOM_MAGIC or len(data)!=(bits+7)//8:
+            return None
+        #capacity for the 1% design false positive rate
+        capacity = int(bits*math.log(2)**2/-math.log(0.01))
+        return cls(capacity,bits=bits,hashes=hashes,count=count,data=data)
+
+class DedupIndex:
+    """ persistent index of the messages seen by the previous runs
+    Parameters:
+    -----------
+    fp: str
+        SQLite index file, the Bloom filter is saved in fp+".bloom"
+    capacity: int
+        initial number of messages of the Bloom filter, it is rebuilt twice as large when full
+    shared: bool
+        used by a worker process: keys are claimed directly in the index, without the Bloom filter
+    batch_size: int
+        new keys inserted per transaction
+    """
+    def __init__(self,fp,capacity=1000000,shared=False,batch_size=10000):
+        self.fp = os.path.abspath(fp)
+        self.bloom_fp = self.fp+".bloom"
+        self.shared = shared
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(self.fp,timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('count', 0)")
+        self.db.commit()
+        #key -> [message_id, path] of the new messages not inserted yet
+        self.pending = {}
+        #new keys of the run (returned by the workers to the main process, see add_keys)
+        self.new_keys = []
+        self.stats = {"checked":0,"duplicates":0,"lookups":0,"false_positives":0}
+        self.bloom = None
+        if not shared:
+            self.bloom = self._load_bloom(capacity)
+
+    def count(self):
+        return self.db.execute("SELECT value FROM meta WHERE name='count'").fetchone()[0]
+
+    def _load_bloom(self,capacity):
+        count = self.count()
+        bloom = BloomFilter.load(self.bloom_fp)
+        if bloom is None or bloom.count!=count or count>bloom.capacity:
+            bloom = self._rebuild_bloom(max(capacity,2*count))
+        return bloom
+
+    def _rebuild_bloom(self,capacity):
+        bloom = BloomFilter(capacity)
+        for (key,) in self.db.execute("SELECT key FROM messages"):
+            bloom.add(key)
+        for key in self.pending:
+            bloom.add(key)
+        return bloom
+
+    def _grow(self):
+        """ rebuilds the Bloom filter twice as large once it holds more keys than its capacity (its false
+        positive rate, and so the index lookups, would grow with each new key) """
+        if self.bloom.count>self.bloom.capacity:
+            self.bloom = self._rebuild_bloom(2*self.bloom.count)
+
+    def _lookup(self,key):
+        self.stats["lookups"]+=1
+        row = self.db.execute("SELECT path FROM messages WHERE key=?",(key,)).fetchone()
+        return row[0] if row else None
+
+    def claim(self,key,message_id,fp):
+        """ registers the message unless it was already seen
+        Parameters:
+        -----------
+        key: bytes
+            see message_key
+        fp: str
+            full path to the message
+        Returns:
+        --------
+        first: str
+            path of the first copy if the message is a duplicate, else None (the message is registered)
+        """
+        self.stats["checked"]+=1
+        fp = os.path.abspath(fp)
+        if self.shared:
+            first = self._lookup(key)
+            if first is None:
+                with self.db:
+                    inserted = self.db.execute("INSERT OR IGNORE INTO messages (key, message_id, path) VALUES (?,?,?)",
+                        (key,message_id,fp)).rowcount
+                    if inserted:
+                        self.db.execute("UPDATE meta SET value=value+1 WHERE name='count'")
+                if inserted:
+                    self.new_keys.append(key)
+                    return None
+                #claimed by another process in the meantime
+                first = self._lookup(key)
+        else:
+            first = None
+            if key in self.pending:
+                first = self.pending[key][1]
+            elif key in self.bloom:
+                first = self._lookup(key)
+                if first is None:
+                    self.stats["false_positives"]+=1
+            if first is None:
+                self.pending[key] = [message_id,fp]
+                self.bloom.add(key)
+                self._grow()
+                if len(self.pending)>=self.batch_size:
+                    self.flush()
+                return None
+        if first==fp:
+            #same file seen again (run without manifest over a processed folder)
+            return None
+        self.stats["duplicates"]+=1
+        return first
+
+    def moved(self,key,fp):
+        """ records the new path of a registered message (after renaming) """
+        fp = os.path.abspath(fp)
+        if key in self.pending:
+            self.pending[key][1] = fp
+        else:
+            with self.db:
+                self.db.execute("UPDATE messages SET path=? WHERE key=?",(fp,key))
+
+    def add_keys(self,keys):
+        """ adds to the Bloom filter the keys registered by worker processes """
+        for key in keys:
+            self.bloom.add(key)
+        self._grow()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            inserted = 0
+            for key, (message_id, fp) in self.pending.items():
+                inserted+= self.db.execute("INSERT OR IGNORE INTO messages (key, message_id, path) VALUES (?,?,?)",
+                    (key,message_id,fp)).rowcount
+            self.db.execute("UPDATE meta SET value=value+? WHERE name='count'",(inserted,))
+        self.new_keys.extend(self.pending)
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        if self.bloom is not None:
+            count = self.count()
+            if count>self.bloom.capacity:
+                self.bloom = self._rebuild_bloom(2*count)
+            self.bloom.count = count
+            self.bloom.save(self.bloom_fp)
+        self.db.close()
@@ -0,0 +1,806 @@
+"""
+distributed processing: shards claimed through lease files by workers on one or several hosts
+
+reprocessing a whole company archive does not fit on one machine. A coordinator splits the corpus into
+shards recorded in a work manifest (shards.json in the work folder, .pst2eml_work at the root of the
+eml folder by default) with the processing options, then any number of workers, on the hosts sharing
+the file system, process the shards:
+* folder: the folders of an eml tree packed into shards of about shard_files files (largest first)
+* hash: the folders grouped by ranges of a hash of their path: the same folder always lands in the same
+    shard whatever the size of the others
+* pst: one shard per archive (see batch.find_archives), converted into its own output folder then processed
+a folder is never split between shards: the name collisions (see pst2eml.incrementalfilename) only depend
+on its content, the files get the same names as with a single process.
+
+leases: a worker claims a shard by creating its lease file (leases/<shard>.lease) with O_CREAT|O_EXCL,
+a single worker succeeds. While the shard runs, a thread touches the lease every ttl/4 seconds (the
+mtime is the heartbeat, compared with the previous look and not with the clock of another host). A lease
+whose mtime did not change for ttl seconds (or held by a dead process of the same host) is expired: it
+is renamed away (again a single worker succeeds) and the shard is claimed again, so the shards of a
+crashed worker are picked up by the others. A worker whose lease was taken over stops its shard after
+the current folder and drops its result, until then its renames never replace a file renamed by the
+new owner of the shard (see pst2eml.rename_no_replace). The ttl must be much longer than a stall of the file system
+(default LEASE_TTL), the lease files need a file system where O_EXCL and rename are atomic (local
+disks, SMB, NFSv3 and later).
+
+results: each shard writes its per folder summaries (manifest records, search index documents, catalog
+records, attachments and dedup stats) in results/<shard>.json once done (json and not pickle: anyone
+who can write in the work folder could run code in the coordinator), the coordinator merges them
+(merge_results) into the manifest, search index and catalog at the root of the eml folder: these SQLite
+and catalog files are only written by a single process. The dedup index is shared by the workers (see
+dedup.DedupIndex shared, its SQLite WAL mode needs all the workers on the same host).
+
+a crashed shard is processed again from the start: its messages already renamed are renamed again (as
+with a run without manifest), the output folder of an archive is emptied first.
+
+Example:
+--------
+on one host: python -m pyPST2EML -f /srv/eml --distributed 8
+on several hosts:
+python -m pyPST2EML distributed plan -f /srv/eml --sharding hash --shards 64 --index Y
+python -m pyPST2EML distributed worker -f /srv/eml (on each host, as many times as wanted)
+python -m pyPST2EML distributed merge -f /srv/eml
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from datetime import datetime, timezone
+from hashlib import blake2b
+import heapq
+import json
+import logging
+import math
+import os
+from os.path import abspath, exists, isdir, join, normpath, relpath
+import shutil
+import socket
+from threading import Event, Thread
+from time import monotonic, perf_counter, sleep, time
+from uuid import uuid4
+
+# own modules
+from .attachments import AttachmentStore, is_store_folder, merge_stats
+from .layout import LAYOUTS, MAX_FILES, Layout, get_layout, is_buckets_folder
+from .manifest import Manifest
+from .quarantine import ON_ERROR, ErrorPolicy, get_error_policy, is_quarantine_folder, print_failures
+from .work_folder import WORK_NAME, is_work_folder
+PLAN_NAME = "shards.json"
+REPORT_NAME = "distributed_report.json"
+SHARDINGS = ("folder","hash","pst")
+#seconds without heartbeat before a lease is expired
+LEASE_TTL = 60.0
+#files per shard (folder and hash shardings)
+SHARD_FILES = 20000
+
+class LeaseLost(Exception):
+    """ the lease of the shard being processed was taken over by another worker """
+
+def default_work_dir(root):
+    return join(root,WORK_NAME)
+
+def write_atomic(fp,data,indent=1):
+    """ writes a json file through a temporary file, readers never see it partially written """
+    tmp_fp = f"{fp}.{os.getpid()}.{uuid4().hex[:8]}.tmp"
+    with open(tmp_fp,"w",encoding="utf-8") as fo:
+        json.dump(data,fo,indent=indent)
+    os.replace(tmp_fp,fp)
+
+def to_work_path(fp,work_dir):
+    """ path stored in the work manifest: relative to the work folder so the hosts may mount it elsewhere """
+    try:
+        return relpath(abspath(fp),work_dir).replace(os.sep,"/")
+    except ValueError:
+        #another drive (windows)
+        return abspath(fp)
+
+def from_work_path(path,work_dir):
+    return normpath(join(work_dir,*path.split("/")))
+
+def path_hash(rel):
+    """ 64 bits hash of a "/" separated relative path """
+    return int.from_bytes(blake2b(rel.encode("utf-8","surrogatepass"),digest_size=8).digest(),"big")
+
+def walk_folders(root):
+    """ yields (folder, number of files) of an eml tree, without the attachment store, work folder and buckets
+    (see layout) """
+    for folder, directory, files in os.walk(root):
+        directory[:] = [name for name in directory if not is_store_folder(name) and not is_work_folder(name)
+            and not is_quarantine_folder(name) and not is_buckets_folder(name)]
+        yield folder, len(files)
+
+def pack_folders(sizes,count):
+    """ Returns count lists of folders with about the same number of files (largest folder first to the
+    emptiest shard) """
+    heap = [(0,i) for i in range(count)]
+    shards = [[] for _ in range(count)]
+    for rel, files in sorted(sizes.items(),key=lambda item:(-item[1],item[0])):
+        total, i = heapq.heappop(heap)
+        shards[i].append(rel)
+        heapq.heappush(heap,(total+files,i))
+    return shards
+
+def plan_shards(root,work_dir=None,sharding="folder",shards=None,shard_files=SHARD_FILES,source=None,
+        reader="readpst",readpst_jobs=0,replan=False,**options):
+    """ splits the work into shards and writes the work manifest, an existing plan is returned as is
+    (resumed) unless replan
+    Parameters:
+    -----------
+    root: str
+        eml folder (the output folder of the archives with the pst sharding)
+    work_dir: str
+        shared folder of the work manifest, leases and results (default: .pst2eml_work in root)
+    sharding: str
+        "folder", "hash" or "pst", see the module documentation
+    shards: int
+        number of shards (folder, hash: default one per shard_files files)
+    source: str
+        pst sharding: folder of archives or glob pattern (see batch.find_archives)
+    reader: str
+        pst sharding: "readpst" or "native"
+    readpst_jobs: int
+        pst sharding: value of the readpst -j option
+    options:
+        processing options of make_eml_search_friendly: ignore_ext, headers_only, manifest, policy,
+        metadata, index, attachments, dedup, staged, catalog, layout, errors (the error budgets apply
+        to each shard)
+    Returns:
+    --------
+    plan: dict
+        root, sharding, options and the shards (id, kind, folders or archive and output, files or size)
+    """
+    if sharding not in SHARDINGS:
+        raise ValueError(f"unknown sharding {sharding}")
+    root = abspath(root)
+    work_dir = abspath(work_dir or default_work_dir(root))
+    plan_fp = join(work_dir,PLAN_NAME)
+    if exists(plan_fp) and not replan:
+        return read_plan(work_dir)
+    if exists(work_dir):
+        shutil.rmtree(work_dir)
+    #output folder of the pst sharding
+    os.makedirs(root,exist_ok=True)
+    for name in ("leases","results"):
+        os.makedirs(join(work_dir,name))
+    layout = get_layout(options.get("layout"))
+    options["layout"] = {"kind":layout.kind,"max_files":layout.max_files,"hash_levels":layout.hash_levels} if layout is not None else None
+    if options.get("dedup"):
+        options["dedup"] = to_work_path(options["dedup"],work_dir)
+    if options.get("errors") is not None:
+        errors = get_error_policy(options["errors"],root).config()
+        #root as mounted on each host
+        del errors["root"]
+        errors["folder"] = to_work_path(errors["folder"],work_dir)
+        options["errors"] = errors
+    plan = {"root":to_work_path(root,work_dir),"sharding":sharding,"options":options,"unchanged":[],
+        "created":datetime.now(timezone.utc).isoformat(),"shards":[]}
+    #created for the workers, which open it read only
+    run_manifest = Manifest(root) if options.get("manifest") else None
+    if sharding=="pst":
+        from .batch import find_archives, output_folders
+        archives = sorted(find_archives(source),key=os.path.getsize,reverse=True)
+        folders = output_folders(archives,root)
+        for i, archive in enumerate(archives):
+            plan["shards"].append({"id":f"{i:05d}","kind":"pst","archive":to_work_path(archive,work_dir),
+                "output":to_work_path(folders[archive],work_dir),"size":os.path.getsize(archive),
+                "reader":reader,"readpst_jobs":readpst_jobs})
+    else:
+        sizes = {}
+        for folder, files in walk_folders(root):
+            if run_manifest is not None and run_manifest.folder_unchanged(folder):
+                plan["unchanged"].append(run_manifest.folder_file_count(folder))
+                continue
+            sizes[relpath(folder,root).replace(os.sep,"/")] = files
+        count = shards or max(1,math.ceil(sum(sizes.values())/shard_files))
+        if sharding=="hash":
+            groups = [[] for _ in range(count)]
+            for rel in sorted(sizes):
+                groups[path_hash(rel)*count>>64].append(rel)
+        else:
+            groups = pack_folders(sizes,min(count,max(1,len(sizes))))
+        shard_list = []
+        for i, group in enumerate(groups):
+            if group:
+                shard = {"kind":"folders","folders":group,"files":sum(sizes[rel] for rel in group)}
+                if sharding=="hash":
+                    shard["range"] = [f"{(i<<64)//count:016x}",f"{((i+1)<<64)//count-1:016x}"]
+                shard_list.append(shard)
+        #largest first
+        shard_list.sort(key=lambda shard:-shard["files"])
+        for i, shard in enumerate(shard_list):
+            plan["shards"].append({"id":f"{i:05d}",**shard})
+    if run_manifest is not None:
+        run_manifest.close()
+    write_atomic(plan_fp,plan)
+    log_msg = "%d %s shards planned in %s"%(len(plan["shards"]),sharding,work_dir)
+    logging.info(log_msg)
+    return plan
+
+def read_plan(work_dir):
+    with open(join(work_dir,PLAN_NAME),encoding="utf-8") as fi:
+        return json.load(fi)
+
+def read_lease(fp):
+    """ content of a lease file ({} if missing or still being written) """
+    try:
+        with open(fp,encoding="utf-8") as fi:
+            return json.load(fi)
+    except (FileNotFoundError,ValueError):
+        return {}
+
+def pid_alive(pid):
+    """ False if no process of this host has the pid (only known on posix, else True) """
+    if os.name!="posix" or not pid:
+        return True
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Lease:
+    """ lease of a shard held by a worker
+    Parameters:
+    -----------
+    fp: str
+        lease file
+    worker: str
+        worker id (host:pid:random)
+    """
+    def __init__(self,fp,worker):
+        self.fp = fp
+        self.worker = worker
+        self.token = uuid4().hex
+
+    def acquire(self):
+        """ True if the lease file was created by this worker """
+        try:
+            fd = os.open(self.fp,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd,"w",encoding="utf-8") as fo:
+            json.dump({"worker":self.worker,"host":socket.gethostname(),"pid":os.getpid(),"token":self.token,
+                "acquired":datetime.now(timezone.utc).isoformat()},fo)
+        return True
+
+    def renew(self):
+        """ heartbeat, False if the lease was taken over """
+        try:
+            os.utime(self.fp)
+        except OSError:
+            return False
+        return read_lease(self.fp).get("token")==self.token
+
+    def release(self):
+        if read_lease(self.fp).get("token")==self.token:
+            try:
+                os.remove(self.fp)
+            except FileNotFoundError:
+                pass
+
+class Heartbeat(Thread):
+    """ renews a lease every interval seconds until stopped, sets lost if it was taken over """
+    def __init__(self,lease,interval):
+        super().__init__(daemon=True)
+        self.lease = lease
+        self.interval = interval
+        self.stopped = Event()
+        self.lost = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.lease.renew():
+                log_msg = "lease lost: %s"%(self.lease.fp)
+                logging.warning(log_msg)
+                self.lost.set()
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def result_path(work_dir,shard):
+    return join(work_dir,"results",f"{shard['id']}.json")
+
+def iso_date(date):
+    return date.isoformat() if date is not None else None
+
+def parse_date(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+def encode_summary(summary):
+    """ json friendly copy of a folder summary: dates as ISO strings, catalog records as tuples and dedup
+    keys as hex strings (see decode_summary) """
+    summary = dict(summary)
+    if "documents" in summary:
+        summary["documents"] = [{**document,"sent_date":iso_date(document["sent_date"])} for document in summary["documents"]]
+    if "catalog" in summary:
+        summary["catalog"] = [(str(record.send_to or ""),str(record.sent_from or ""),record.subject,iso_date(record.sent_date),
+            record.folder,record.name) for record in summary["catalog"]]
+    if "dedup_keys" in summary:
+        summary["dedup_keys"] = [key.hex() for key in summary["dedup_keys"]]
+    return summary
+
+def decode_summary(summary):
+    """ folder summary of encode_summary """
+    if "documents" in summary:
+        for document in summary["documents"]:
+            document["sent_date"] = parse_date(document["sent_date"])
+    if "catalog" in summary:
+        from .catalog import MessageRecord
+        summary["catalog"] = [MessageRecord(send_to,sent_from,subject,parse_date(sent_date),folder,name)
+            for send_to, sent_from, subject, sent_date, folder, name in summary["catalog"]]
+    if "dedup_keys" in summary:
+        summary["dedup_keys"] = [bytes.fromhex(key) for key in summary["dedup_keys"]]
+    return summary
+
+def write_result(work_dir,shard,result):
+    result = {**result,"folders":[(rel,encode_summary(summary)) for rel, summary in result["folders"]]}
+    write_atomic(result_path(work_dir,shard),result,indent=None)
+
+def read_result(work_dir,shard,folders=True):
+    """ result of a shard (None if not done), with the folder summaries decoded if folders """
+    try:
+        with open(result_path(work_dir,shard),encoding="utf-8") as fi:
+            result = json.load(fi)
+    except FileNotFoundError:
+        return None
+    if folders:
+        result["folders"] = [(rel,decode_summary(summary)) for rel, summary in result["folders"]]
+    return result
+
+def plan_layout(options):
+    layout = options.get("layout")
+    return Layout(layout["kind"],layout["max_files"],layout["hash_levels"]) if layout else None
+
+def plan_error_policy(root,options,work_dir):
+    """ ErrorPolicy of the plan options (None if not set) """
+    if options.get("errors") is None:
+        return None
+    return ErrorPolicy(root,**{**options["errors"],"folder":from_work_path(options["errors"]["folder"],work_dir)})
+
+def process_folders(root,folders,options,work_dir,lost=None,error_policy=None):
+    """ processes the folders of a shard (see pst2eml.process_eml_folder)
+    Parameters:
+    -----------
+    folders: list
+        "/" separated folders relative to root
+    lost: Event
+        set when the lease was taken over: raises LeaseLost before the next folder
+    error_policy: ErrorPolicy
+        see pst2eml.process_eml_folder errors
+    Returns:
+    --------
+    summaries: list
+        (relative folder, summary with its records, documents, catalog, attachments and dedup stats)
+    """
+    from .pst2eml import process_eml_folder
+    known_manifest = Manifest(root,readonly=True) if options.get("manifest") else None
+    dedup = from_work_path(options["dedup"],work_dir) if options.get("dedup") else None
+    layout = plan_layout(options)
+    summaries = []
+    try:
+        for rel in folders:
+            if lost is not None and lost.is_set():
+                raise LeaseLost(rel)
+            folder = normpath(join(root,*rel.split("/")))
+            if not isdir(folder):
+                continue
+            with os.scandir(folder) as entries:
+                files = [entry.name for entry in entries if not entry.is_dir()]
+            known = known_manifest.known_files(folder) if known_manifest is not None else None
+            summary = process_eml_folder(folder,files,options.get("ignore_ext",False),options.get("headers_only",False),
+                known,options.get("policy"),options.get("metadata"),options.get("index",False),None,
+                root if options.get("attachments") else None,dedup,options.get("staged"),options.get("catalog",False),layout,
+                error_policy)
+            summaries.append((rel,summary))
+    finally:
+        if known_manifest is not None:
+            known_manifest.close()
+    return summaries
+
+class ShardWorker:
+    """ claims and processes the shards of a work manifest until none is left
+    Parameters:
+    -----------
+    work_dir: str
+        work folder (see plan_shards)
+    ttl: float
+        seconds without heartbeat before a lease is expired
+    poll: float
+        seconds between two looks at the leases of the other workers (default: ttl/10, 5 at most)
+    retry_failed: bool
+        the shards which failed (an exception, not a crash) are processed again
+    """
+    def __init__(self,work_dir,ttl=LEASE_TTL,poll=None,retry_failed=False):
+        self.work_dir = abspath(work_dir)
+        self.plan = read_plan(self.work_dir)
+        self.root = from_work_path(self.plan["root"],self.work_dir)
+        self.ttl = ttl
+        self.poll = poll or min(ttl/10,5.0)
+        self.retry_failed = retry_failed
+        self.host = socket.gethostname()
+        self.worker = f"{self.host}:{os.getpid()}:{uuid4().hex[:6]}"
+        #lease file -> ((inode, mtime_ns, size), monotonic time it was first seen so)
+        self.seen = {}
+
+    def lease_path(self,shard):
+        return join(self.work_dir,"leases",f"{shard['id']}.lease")
+
+    def done(self,shard):
+        fp = result_path(self.work_dir,shard)
+        if not exists(fp):
+            return False
+        return not self.retry_failed or read_result(self.work_dir,shard)["status"]=="ok"
+
+    def expired(self,fp):
+        """ Returns the (inode, mtime_ns, size) of an expired lease, None if it is alive """
+        try:
+            st = os.stat(fp)
+        except FileNotFoundError:
+            return None
+        key = (st.st_ino,st.st_mtime_ns,st.st_size)
+        lease = read_lease(fp)
+        if lease.get("host")==self.host and not pid_alive(lease.get("pid")):
+            return key
+        now = monotonic()
+        seen = self.seen.get(fp)
+        if seen is None or seen[0]!=key:
+            self.seen[fp] = (key,now)
+            return None
+        return key if now-seen[1]>=self.ttl else None
+
+    def steal(self,fp,key):
+        """ removes an expired lease, True if this worker removed it (and it was not renewed meanwhile) """
+        stale_fp = f"{fp}.expired.{uuid4().hex[:8]}"
+        try:
+            os.rename(fp,stale_fp)
+        except FileNotFoundError:
+            return False
+        st = os.stat(stale_fp)
+        if (st.st_ino,st.st_mtime_ns,st.st_size)!=key:
+            #renewed or claimed again between the check and the rename: put back
+            try:
+                os.link(stale_fp,fp)
+            except OSError:
+                pass
+            os.remove(stale_fp)
+            return False
+        log_msg = "expired lease taken over: %s (%s)"%(fp,read_lease(stale_fp).get("worker"))
+        logging.warning(log_msg)
+        os.remove(stale_fp)
+        self.seen.pop(fp,None)
+        return True
+
+    def claim(self):
+        """ Returns (shard, lease, pending) with the first shard claimed (None if none could be) and
+        pending True while some shards are not done """
+        pending = False
+        for shard in self.plan["shards"]:
+            if self.done(shard):
+                continue
+            pending = True
+            lease = Lease(self.lease_path(shard),self.worker)
+            if not lease.acquire():
+                key = self.expired(lease.fp)
+                if key is None or not self.steal(lease.fp,key) or not lease.acquire():
+                    continue
+            if self.done(shard):
+                #completed by another worker since the first check
+                lease.release()
+                continue
+            return shard, lease, True
+        return None, None, pending
+
+    def process(self,shard,lost):
+        """ Returns the result of a shard (status, per folder summaries and the archive report) """
+        options = self.plan["options"]
+        result = {"id":shard["id"],"worker":self.worker,"status":"ok","error":None,"archive":None,"folders":[]}
+        error_policy = plan_error_policy(self.root,options,self.work_dir)
+        start = perf_counter()
+        try:
+            if shard["kind"]=="pst":
+                from .batch import extract_archive
+                output = from_work_path(shard["output"],self.work_dir)
+                if exists(output):
+                    #left by a crashed worker
+                    shutil.rmtree(output)
+                report = extract_archive(from_work_path(shard["archive"],self.work_dir),output,shard["reader"],shard["readpst_jobs"])
+                result["archive"] = report
+                if report["status"]!="ok":
+                    result["status"] = "failed"
+                    result["error"] = report["error"]
+                else:
+                    folders = [relpath(folder,self.root).replace(os.sep,"/") for folder, files in walk_folders(output)]
+                    result["folders"] = process_folders(self.root,folders,options,self.work_dir,lost,error_policy)
+            else:
+                result["folders"] = process_folders(self.root,shard["folders"],options,self.work_dir,lost,error_policy)
+        except LeaseLost:
+            raise
+        except Exception as e:
+            log_msg = "shard %s failed: %r"%(shard["id"],e)
+            logging.error(log_msg)
+            result["status"] = "failed"
+            result["error"] = repr(e)
+        if error_policy is not None:
+            result["errors"] = {"files":error_policy.files,"failures":error_policy.failures}
+        result["seconds"] = perf_counter()-start
+        return result
+
+    def run(self,wait=True):
+        """ processes shards until all are done
+        Parameters:
+        -----------
+        wait: bool
+            keep watching the leases of the other workers (to take over the shards of a crashed one) until
+            every shard is done, else return once no shard can be claimed
+        Returns:
+        --------
+        summary: dict
+            worker id, shards processed, failed and lost
+        """
+        summary = {"worker":self.worker,"shards":0,"failed":0,"lost":0}
+        while True:
+            shard, lease, pending = self.claim()
+            if shard is None:
+                if not pending or not wait:
+                    break
+                sleep(self.poll)
+                continue
+            log_msg = "%s processing shard %s"%(self.worker,shard["id"])
+            logging.info(log_msg)
+            heartbeat = Heartbeat(lease,self.ttl/4)
+            heartbeat.start()
+            try:
+                result = self.process(shard,heartbeat.lost)
+            except LeaseLost:
+                result = None
+            finally:
+                heartbeat.stop()
+            if result is None or heartbeat.lost.is_set():
+                #another worker processes it again
+                summary["lost"]+=1
+                continue
+            write_result(self.work_dir,shard,result)
+            lease.release()
+            summary["shards"]+=1
+            summary["failed"]+=result["status"]!="ok"
+        return summary
+
+def run_worker(work_dir,ttl=LEASE_TTL,poll=None,retry_failed=False,wait=True):
+    """ runs a ShardWorker (entry point of the worker processes) """
+    return ShardWorker(work_dir,ttl,poll,retry_failed).run(wait)
+
+def shard_status(work_dir):
+    """ Returns the number of shards done, failed, leased (being processed) and pending, with the leases
+    (shard, worker, seconds since the last heartbeat as seen from this host) """
+    work_dir = abspath(work_dir)
+    plan = read_plan(work_dir)
+    status = {"shards":len(plan["shards"]),"done":0,"failed":0,"leased":0,"pending":0,"leases":[]}
+    for shard in plan["shards"]:
+        result = read_result(work_dir,shard,folders=False)
+        if result is not None:
+            status["done" if result["status"]=="ok" else "failed"]+=1
+            continue
+        fp = join(work_dir,"leases",f"{shard['id']}.lease")
+        try:
+            age = time()-os.stat(fp).st_mtime
+        except FileNotFoundError:
+            status["pending"]+=1
+            continue
+        status["leased"]+=1
+        status["leases"].append({"shard":shard["id"],"worker":read_lease(fp).get("worker"),"heartbeat_age":age})
+    return status
+
+def merge_results(work_dir):
+    """ records the results of all the shards in the manifest, search index, catalog and dedup filter at the
+    root of the eml folder and writes the report (distributed_report.json in the work folder), done once:
+    the report of a merged plan is returned as is
+    Returns:
+    --------
+    summary: dict
+        as for make_eml_search_friendly with the shards, failed shards and workers
+    """
+    from .pst2eml import merge_summaries
+    work_dir = abspath(work_dir)
+    report_fp = join(work_dir,REPORT_NAME)
+    if exists(report_fp):
+        with open(report_fp,encoding="utf-8") as fi:
+            return json.load(fi)["summary"]
+    plan = read_plan(work_dir)
+    status = shard_status(work_dir)
+    if status["leased"] or status["pending"]:
+        raise RuntimeError(f"{status['leased']+status['pending']} shards of {work_dir} are not done")
+    root = from_work_path(plan["root"],work_dir)
+    options = plan["options"]
+    run_manifest = Manifest(root) if options.get("manifest") else None
+    search_index = None
+    if options.get("index"):
+        from .search_index import SearchIndex
+        search_index = SearchIndex(root)
+    run_catalog = None
+    if options.get("catalog"):
+        from .catalog import Catalog
+        run_catalog = Catalog.load(root) if options.get("manifest") else Catalog(root)
+    dedup_index = None
+    if options.get("dedup"):
+        from .dedup import DedupIndex
+        dedup_index = DedupIndex(from_work_path(options["dedup"],work_dir))
+    error_policy = plan_error_policy(root,options,work_dir)
+    store_stats = []
+    dedup_stats = []
+    summaries = [{"processed":0,"skipped":0,"failed":0,"unchanged":unchanged} for unchanged in plan["unchanged"]]
+    shards = []
+    try:
+        for shard in plan["shards"]:
+            result = read_result(work_dir,shard)
+            shards.append({"id":shard["id"],"status":result["status"],"error":result["error"],"worker":result["worker"],
+                "seconds":result["seconds"],"folders":len(result["folders"]),"archive":result["archive"]})
+            if "errors" in result:
+                error_policy.merge(result["errors"],check=False)
+            for rel, summary in result["folders"]:
+                folder = normpath(join(root,*rel.split("/")))
+                if "attachments" in summary:
+                    store_stats.append(summary.pop("attachments"))
+                if "dedup" in summary:
+                    dedup_stats.append(summary.pop("dedup"))
+                    dedup_index.add_keys(summary.pop("dedup_keys"))
+                if run_manifest is not None:
+                    run_manifest.record(folder,summary.pop("records"))
+                if search_index is not None:
+                    search_index.add(folder,summary.pop("documents"))
+                if run_catalog is not None:
+                    for record in summary.pop("catalog"):
+                        #folder as mounted on this host
+                        record.folder = folder
+                        run_catalog.add(record)
+                summaries.append(summary)
+    finally:
+        if run_manifest is not None:
+            run_manifest.close()
+        if search_index is not None:
+            search_index.close()
+        if dedup_index is not None:
+            dedup_index.close()
+        if run_catalog is not None:
+            run_catalog.save()
+    summary = merge_summaries(summaries)
+    summary["shards"] = len(shards)
+    summary["failed_shards"] = len([shard for shard in shards if shard["status"]!="ok"])
+    summary["workers"] = len({shard["worker"] for shard in shards})
+    if error_policy is not None:
+        error_policy.save_report()
+        summary["errors"] = error_policy.report()
+    if dedup_index is not None:
+        summary["dedup"] = merge_stats([dedup_index.stats]+dedup_stats)
+        summary["dedup"]["messages"] = dedup_index.bloom.count
+    if options.get("attachments"):
+        store = AttachmentStore(root)
+        store.stats = merge_stats(store_stats)
+        summary["attachments"] = store.report()
+    write_atomic(report_fp,{"summary":summary,"shards":shards})
+    log_msg = "%d shards merged (%d failed) from %d workers: processed %d, failed %d files"%(
+        summary["shards"],summary["failed_shards"],summary["workers"],summary["processed"],summary["failed"])
+    logging.info(log_msg)
+    return summary
+
+def run_distributed(root,workers=2,work_dir=None,sharding="folder",shards=None,shard_files=SHARD_FILES,source=None,
+        reader="readpst",readpst_jobs=0,ttl=LEASE_TTL,**options):
+    """ plans (or resumes an unfinished plan), runs workers processes on this host and merges their results,
+    workers started on other hosts against the same work folder take their share of the shards
+    Parameters:
+    -----------
+    workers: int
+        worker processes started on this host
+    see plan_shards for the other parameters
+    Returns:
+    --------
+    summary: dict
+        see merge_results
+    """
+    from multiprocessing import Process
+    from multiprocessing.connection import wait as wait_processes
+    root = abspath(root)
+    work_dir = abspath(work_dir or default_work_dir(root))
+    replan = exists(join(work_dir,REPORT_NAME))
+    plan_shards(root,work_dir,sharding,shards,shard_files,source,reader,readpst_jobs,replan=replan,**options)
+    start = perf_counter()
+    processes = [Process(target=run_worker,args=(work_dir,ttl)) for _ in range(max(1,workers))]
+    for process in processes:
+        process.start()
+    running = {process.sentinel:process for process in processes}
+    while running:
+        #joined as they exit so a crashed worker is seen as dead by the others (see ShardWorker.expired)
+        for sentinel in wait_processes(list(running)):
+            process = running.pop(sentinel)
+            process.join()
+            if process.exitcode!=0:
+                log_msg = "worker %d exited with code %s"%(process.pid,process.exitcode)
+                logging.error(log_msg)
+    summary = merge_results(work_dir)
+    summary["seconds"] = perf_counter()-start
+    return summary
+
+def options_parser(parser):
+    """ processing options of the plan subcommand """
+    from .pst2eml import str2bool
+    parser.add_argument("--headers",dest="headers_only",type=str2bool,default="N",help="only read the header block of each file (default: N)")
+    parser.add_argument("--manifest","-m",dest="manifest",type=str2bool,default="N",help="skip the files unchanged since the previous run (default: N)")
+    parser.add_argument("--names",dest="policy",type=str,default=None,choices=["windows","linux"],help="file name length limits")
+    parser.add_argument("--metadata",dest="metadata",type=str,default=None,choices=["win32","xattr","sidecar"],help="metadata backend")
+    parser.add_argument("--index",dest="index",type=str2bool,default="N",help="full-text search index (default: N)")
+    parser.add_argument("--attachments",dest="attachments",type=str2bool,default="N",help="content-addressed attachment store (default: N)")
+    parser.add_argument("--dedup",dest="dedup",type=str,default="",help="dedup index file (workers on a single host)")
+    parser.add_argument("--catalog",dest="catalog",type=str2bool,default="N",help="columnar catalog of the messages (default: N)")
+    parser.add_argument("--layout",dest="layout",type=str,default="flat",choices=LAYOUTS,help="bucketed layout of the folders (default: flat)")
+    parser.add_argument("--bucket_files",dest="bucket_files",type=int,default=MAX_FILES,help=f"files per bucket (default: {MAX_FILES})")
+    parser.add_argument("--io_workers",dest="io_workers",type=int,default=0,help="threads overlapping the renames and metadata writes (network shares)")
+    parser.add_argument("--on_error",dest="on_error",type=str,default="quarantine",choices=ON_ERROR,help="files which fail: moved to the quarantine folder, left in place or fail the shard (default: quarantine)")
+    parser.add_argument("--max_errors",dest="max_errors",type=int,default=None,help="failed files per shard before the shard fails (default: no limit)")
+    parser.add_argument("--max_error_rate",dest="max_error_rate",type=float,default=None,help="share of failed files per shard before the shard fails (default: no limit)")
+    parser.add_argument("--quarantine",dest="quarantine",type=str,default=None,help="quarantine folder (default: .pst2eml_quarantine in the eml folder)")
+
+def distributed_cli(argv=None):
+    """ distributed subcommand: python -m pyPST2EML distributed plan|worker|status|merge -f <eml folder> [options] """
+    from .pst2eml import str2bool
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML distributed",
+        description='process an eml folder (or archives) with workers on several hosts sharing the file system')
+    actions = parser.add_subparsers(dest="action",required=True)
+    plan_parser = actions.add_parser("plan",help="split the work into shards")
+    plan_parser.add_argument("--sharding",dest="sharding",type=str,default="folder",choices=SHARDINGS,help="shards of folders, of folder path hash ranges or of archives (default: folder)")
+    plan_parser.add_argument("--shards",dest="shards",type=int,default=None,help="number of shards (default: one per --shard_files files)")
+    plan_parser.add_argument("--shard_files",dest="shard_files",type=int,default=SHARD_FILES,help=f"files per shard (default: {SHARD_FILES})")
+    plan_parser.add_argument("--source",dest="source",type=str,default=None,help="with --sharding pst: folder of archives or glob pattern")
+    plan_parser.add_argument("--reader",dest="reader",type=str,default="readpst",choices=["readpst","native"],help="archives reader (default: readpst)")
+    plan_parser.add_argument("--readpst_jobs",dest="readpst_jobs",type=int,default=0,help="readpst -j parallel jobs per archive")
+    plan_parser.add_argument("--replan",dest="replan",type=str2bool,default="N",help="replace an existing plan (default: N, resumed)")
+    options_parser(plan_parser)
+    worker_parser = actions.add_parser("worker",help="claim and process shards until all are done")
+    worker_parser.add_argument("--ttl",dest="ttl",type=float,default=LEASE_TTL,help=f"seconds without heartbeat before a lease expires (default: {LEASE_TTL:.0f})")
+    worker_parser.add_argument("--retry_failed",dest="retry_failed",type=str2bool,default="N",help="process the failed shards again (default: N)")
+    worker_parser.add_argument("--wait",dest="wait",type=str2bool,default="Y",help="wait for the shards leased by other workers (default: Y)")
+    actions.add_parser("status",help="shards done, failed, leased and pending")
+    actions.add_parser("merge",help="record the results in the manifest, search index and catalog")
+    for action_parser in actions.choices.values():
+        action_parser.add_argument("--folder","-f",dest="folder",type=str,required=True,help="eml folder (archives output folder with --sharding pst)")
+        action_parser.add_argument("--work_dir","-w",dest="work_dir",type=str,default=None,help=f"shared work folder (default: {WORK_NAME} in the eml folder)")
+        action_parser.add_argument("--verbose","-v",dest="verbosity",type=int,default=2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbosity==4 else logging.WARN)
+    work_dir = args.work_dir or default_work_dir(abspath(args.folder))
+    if args.action=="plan":
+        if args.sharding=="pst" and not args.source:
+            print("--source is required with --sharding pst")
+            return 1
+        plan = plan_shards(args.folder,work_dir,args.sharding,args.shards,args.shard_files,args.source,args.reader,
+            args.readpst_jobs,args.replan,headers_only=args.headers_only,manifest=args.manifest,policy=args.policy,
+            metadata=args.metadata,index=args.index,attachments=args.attachments,dedup=args.dedup or None,
+            catalog=args.catalog,layout=Layout(args.layout,args.bucket_files) if args.layout!="flat" else None,
+            staged={"io_workers":args.io_workers} if args.io_workers>0 else None,
+            errors={"mode":args.on_error,"max_errors":args.max_errors,"max_error_rate":args.max_error_rate,"folder":args.quarantine})
+        print(f"{len(plan['shards'])} {plan['sharding']} shards in {work_dir}")
+        return 0
+    if not exists(join(work_dir,PLAN_NAME)):
+        print(f"no plan in {work_dir}, run: python -m pyPST2EML distributed plan -f {args.folder}")
+        return 1
+    if args.action=="worker":
+        summary = run_worker(work_dir,args.ttl,retry_failed=args.retry_failed,wait=args.wait)
+        print(f"{summary['worker']}: {summary['shards']} shards processed, {summary['failed']} failed, {summary['lost']} lost")
+    elif args.action=="status":
+        status = shard_status(work_dir)
+        print(f"{status['shards']} shards: {status['done']} done, {status['failed']} failed, {status['leased']} leased, {status['pending']} pending")
+        for lease in status["leases"]:
+            print(f"  {lease['shard']} {lease['worker']} heartbeat {lease['heartbeat_age']:.0f}s ago")
+    else:
+        try:
+            summary = merge_results(work_dir)
+        except RuntimeError as e:
+            print(e)
+            return 1
+        print(f"processed {summary['processed']}, skipped {summary['skipped']}, failed {summary['failed']}, duplicates {summary['duplicates']}, "
+            f"unchanged {summary['unchanged']} files in {summary['folders']} folders, {summary['shards']} shards "
+            f"({summary['failed_shards']} failed) by {summary['workers']} workers")
+        if "errors" in summary:
+            print_failures(summary["errors"])
+    return 0
@@ -0,0 +1,403 @@
+"""
+bulk export of the extracted messages to an external search engine
+
+the records (path, subject, from, to, date and body text, see search_index.SearchIndex.records) are
+grouped in batches sent by workers threads, each keeping its own persistent connection:
+* ElasticsearchExporter: POST /_bulk with an NDJSON body (one index action per message, the relative
+    path is the document _id so sending a message twice replaces it, a hash of the path when it is
+    longer than the 512 bytes allowed for an _id, see document_id)
+* SonicExporter: PUSH commands pipelined on an ingest channel (the relative path, url quoted, is the
+    object so the search results give back the files)
+
+backpressure: the batches wait in a bounded queue, reading the records stops while the workers are busy
+retries: a batch failing on a connection error or a server overload (429 / 5xx) is sent again after an
+exponential backoff, for Elasticsearch only its failed items are sent again
+
+the report gives the number of records sent and failed, the ingest rate and the batch latencies
+
+Example:
+--------
+python -m pyPST2EML export -f C:\\outlook\\archives\\eml\\2021Q1 --target elasticsearch --url http://localhost:9200
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from base64 import b64encode
+from hashlib import blake2b
+import http.client
+import json
+import logging
+import os
+from os.path import join
+from queue import Queue
+import socket
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from urllib.parse import quote, urlsplit
+
+# own modules
+from .search_index import INDEX_NAME, SearchIndex
+
+class ExportError(Exception):
+    pass
+
+class Exporter:
+    """ sends records in batches from workers threads, the subclasses implement connect, send and close
+    Parameters:
+    -----------
+    batch_size: int
+        records per bulk request
+    workers: int
+        batches sent at the same time (one persistent connection per worker)
+    max_retries: int
+        sending attempts of a batch after the first one
+    backoff: float
+        seconds before the first retry, doubled on each retry
+    queue_size: int
+        batches waiting for a worker before reading the records blocks (default: 2 per worker)
+    """
+    name = None
+
+    def __init__(self,batch_size=500,workers=4,max_retries=5,backoff=0.5,queue_size=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue_size = queue_size or 2*workers
+        self.lock = Lock()
+
+    def connect(self):
+        raise NotImplementedError
+
+    def send(self,connection,batch):
+        """ sends a batch, Returns (records to send again, number of records rejected), raises
+        OSError / ExportError / http.client.HTTPException when the whole batch must be sent again (any other
+        exception is handled the same way by the workers)
+        """
+        raise NotImplementedError
+
+    def close(self,connection):
+        pass
+
+    def _worker(self,queue,stats):
+        connection = None
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            start = perf_counter()
+            pending = batch
+            rejected = 0
+            attempt = 0
+            while pending:
+                try:
+                    if connection is None:
+                        connection = self.connect()
+                    pending, batch_rejected = self.send(connection,pending)
+                    rejected+= batch_rejected
+                except Exception as e:
+                    #any error: a worker must keep reading the queue until its None, export() waits on it
+                    log_msg = "%s batch failed: %r"%(self.name,e)
+                    logging.warning(log_msg)
+                    if connection is not None:
+                        try:
+                            self.close(connection)
+                        except Exception:
+                            pass
+                    connection = None
+                if pending:
+                    attempt+=1
+                    if attempt>self.max_retries:
+                        log_msg = "%s: giving up on %d records after %d retries"%(self.name,len(pending),self.max_retries)
+                        logging.error(log_msg)
+                        rejected+= len(pending)
+                        break
+                    with self.lock:
+                        stats["retries"]+=1
+                    sleep(self.backoff*2**(attempt-1))
+            with self.lock:
+                stats["latencies"].append(perf_counter()-start)
+                stats["sent"]+= len(batch)-rejected
+                stats["failed"]+= rejected
+        if connection is not None:
+            try:
+                self.close(connection)
+            except Exception:
+                pass
+
+    def export(self,records):
+        """ sends the records
+        Parameters:
+        -----------
+        records: iterable
+            dicts with path, sent_date, sent_from, send_to, subject and body
+        Returns:
+        --------
+        report: dict
+            records read, sent and failed, batches, retries, seconds, records_per_second and
+            batch_latency (mean, p50, p95, max in seconds)
+        """
+        stats = {"records":0,"sent":0,"failed":0,"batches":0,"retries":0,"latencies":[]}
+        queue = Queue(maxsize=self.queue_size)
+        threads = [Thread(target=self._worker,args=(queue,stats),daemon=True) for _ in range(max(1,self.workers))]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        batch = []
+        for record in records:
+            batch.append(record)
+            stats["records"]+=1
+            if len(batch)>=self.batch_size:
+                #blocks while queue_size batches are waiting
+                queue.put(batch)
+                stats["batches"]+=1
+                batch = []
+        if batch:
+            queue.put(batch)
+            stats["batches"]+=1
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        seconds = perf_counter()-start
+        latencies = sorted(stats.pop("latencies"))
+        stats["seconds"] = seconds
+        stats["records_per_second"] = stats["sent"]/seconds if seconds>0 else None
+        stats["batch_latency"] = latency_summary(latencies)
+        return stats
+
+def latency_summary(latencies):
+    """ mean, p50, p95 and max of sorted latencies in seconds (None if empty) """
+    if not latencies:
+        return None
+    return {"mean":sum(latencies)/len(latencies),"p50":latencies[len(latencies)//2],
+        "p95":latencies[min(len(latencies)-1,int(len(latencies)*0.95))],"max":latencies[-1]}
+
+#bytes of an Elasticsearch _id
+MAX_ID_BYTES = 512
+
+def document_id(path):
+    """ _id of a message: its relative path, or a hash of it if longer than MAX_ID_BYTES (the path is also a field
+    of the document) """
+    encoded = path.encode("utf-8")
+    if len(encoded)<=MAX_ID_BYTES:
+        return path
+    return "blake2b:"+blake2b(encoded,digest_size=20).hexdigest()
+
+class ElasticsearchExporter(Exporter):
+    """ Elasticsearch (or OpenSearch) _bulk API
+    Parameters:
+    -----------
+    url: str
+        http(s)://[user:password@]host:port of the cluster
+    index: str
+        index receiving the messages
+    timeout: float
+        seconds before a request is considered failed
+    """
+    name = "elasticsearch"
+
+    def __init__(self,url="http://localhost:9200",index="pst2eml",timeout=60,**kwargs):
+        super().__init__(**kwargs)
+        parts = urlsplit(url)
+        self.https = parts.scheme=="https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 9200)
+        self.index = index
+        self.timeout = timeout
+        self.headers = {"Content-Type":"application/x-ndjson"}
+        if parts.username:
+            credentials = f"{parts.username}:{parts.password or ''}".encode("utf-8")
+            self.headers["Authorization"] = "Basic "+b64encode(credentials).decode("ascii")
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host,self.port,timeout=self.timeout)
+        return http.client.HTTPConnection(self.host,self.port,timeout=self.timeout)
+
+    def close(self,connection):
+        connection.close()
+
+    def bulk_body(self,batch):
+        lines = []
+        for record in batch:
+            lines.append(json.dumps({"index":{"_index":self.index,"_id":document_id(record["path"])}}))
+            lines.append(json.dumps({"path":record["path"],"date":record["sent_date"],"from":record["sent_from"],
+                "to":record["send_to"],"subject":record["subject"],"body":record["body"]},ensure_ascii=False))
+        return ("\n".join(lines)+"\n").encode("utf-8")
+
+    def send(self,connection,batch):
+        connection.request("POST","/_bulk",body=self.bulk_body(batch),headers=self.headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status==429 or response.status>=500:
+            raise ExportError(f"HTTP {response.status}")
+        if response.status>=300:
+            log_msg = "%s: HTTP %d %r"%(self.name,response.status,data[:200])
+            logging.error(log_msg)
+            return [], len(batch)
+        result = json.loads(data)
+        if not isinstance(result,dict):
+            raise ExportError(f"unexpected _bulk response {data[:200]!r}")
+        if not result.get("errors"):
+            return [], 0
+        items = result.get("items")
+        if not isinstance(items,list) or len(items)!=len(batch):
+            raise ExportError(f"_bulk response with errors and {len(items) if isinstance(items,list) else 'no'} items for {len(batch)} records")
+        retry = []
+        rejected = 0
+        for record, item in zip(batch,items):
+            action = item.get("index") if isinstance(item,dict) else None
+            status = action.get("status") if isinstance(action,dict) else None
+            if not isinstance(status,int):
+                raise ExportError(f"_bulk response item without index status: {item!r}"[:300])
+            if status==429 or status>=500:
+                retry.append(record)
+            elif status>=300:
+                log_msg = "%s: %s rejected %s"%(self.name,record["path"],action.get("error"))
+                logging.error(log_msg)
+                rejected+=1
+        return retry, rejected
+
+class SonicExporter(Exporter):
+    """ Sonic ingest channel
+    Parameters:
+    -----------
+    host, port: str, int
+        Sonic server
+    password: str
+        auth_password of the Sonic configuration
+    collection, bucket: str
+        where the messages are pushed
+    timeout: float
+        seconds before a command is considered failed
+    """
+    name = "sonic"
+    #commands written before reading their responses
+    PIPELINE_DEPTH = 128
+
+    def __init__(self,host="localhost",port=1491,password="SecretPassword",collection="pst2eml",bucket="default",
+        timeout=60,**kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.collection = collection
+        self.bucket = bucket
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.create_connection((self.host,self.port),timeout=self.timeout)
+        stream = sock.makefile("rwb")
+        connection = {"socket":sock,"stream":stream,"buffer":20000}
+        self._expect(connection,"CONNECTED")
+        self._command(connection,f"START ingest {self.password}")
+        started = self._expect(connection,"STARTED")
+        #STARTED ingest protocol(1) buffer(20000)
+        for token in started.split():
+            if token.startswith("buffer("):
+                connection["buffer"] = int(token[len("buffer("):-1])
+        return connection
+
+    def close(self,connection):
+        try:
+            self._command(connection,"QUIT")
+            connection["stream"].flush()
+        finally:
+            connection["stream"].close()
+            connection["socket"].close()
+
+    def _command(self,connection,line):
+        connection["stream"].write(line.encode("utf-8")+b"\r\n")
+
+    def _read(self,connection):
+        connection["stream"].flush()
+        line = connection["stream"].readline()
+        if not line:
+            raise ExportError("connection closed by the server")
+        return line.decode("utf-8").strip()
+
+    def _expect(self,connection,prefix):
+        line = self._read(connection)
+        if not line.startswith(prefix):
+            raise ExportError(f"expected {prefix}, got {line}")
+        return line
+
+    def push_lines(self,record,buffer):
+        """ PUSH commands of a record, its text is cut in chunks fitting the server buffer """
+        text = " ".join([str(record[key] or "") for key in ["subject","sent_from","send_to","body"]])
+        text = " ".join(text.split())
+        prefix = f"PUSH {self.collection} {self.bucket} {quote(record['path'],safe='/')} "
+        #up to 4 bytes per character once utf-8 encoded and escaped, room left for the prefix and the quotes
+        size = max(1,(buffer-len(prefix.encode("utf-8"))-8)//4)
+        lines = []
+        for i in range(0,len(text),size):
+            chunk = text[i:i+size].replace("\\","\\\\").replace('"','\\"')
+            if chunk.strip():
+                lines.append(f'{prefix}"{chunk}"')
+        return lines
+
+    def send(self,connection,batch):
+        failed = set()
+        #record index of the commands sent and not yet answered
+        outstanding = []
+        def read_responses(count):
+            for _ in range(count):
+                i = outstanding.pop(0)
+                response = self._read(connection)
+                if not response.startswith("OK"):
+                    log_msg = "%s: %s %s"%(self.name,batch[i]["path"],response)
+                    logging.error(log_msg)
+                    failed.add(i)
+        for i, record in enumerate(batch):
+            for line in self.push_lines(record,connection["buffer"]):
+                self._command(connection,line)
+                outstanding.append(i)
+                if len(outstanding)>=self.PIPELINE_DEPTH:
+                    read_responses(len(outstanding))
+        read_responses(len(outstanding))
+        return [], len(failed)
+
+EXPORTERS = {"elasticsearch":ElasticsearchExporter,"sonic":SonicExporter}
+
+def print_export_report(report):
+    print(f"{report['sent']} records sent, {report['failed']} failed, {report['retries']} retries, "
+        f"{report['batches']} batches in {report['seconds']:.1f}s ({report['records_per_second'] or 0:.0f} records/s)")
+    latency = report["batch_latency"]
+    if latency:
+        print(f"batch latency: mean {latency['mean']*1000:.1f}ms, p50 {latency['p50']*1000:.1f}ms, "
+            f"p95 {latency['p95']*1000:.1f}ms, max {latency['max']*1000:.1f}ms")
+
+def export_cli(argv=None):
+    """ export subcommand: python -m pyPST2EML export -f <folder> --target elasticsearch|sonic """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML export",
+        description='send the messages of the index built with --index Y to a search engine')
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True,
+                    help="folder processed with --index Y")
+    parser.add_argument("--target",dest="target",type=str,default="elasticsearch",choices=list(EXPORTERS))
+    parser.add_argument("--url",dest="url",type=str,default="http://localhost:9200",
+                    help="elasticsearch url (default: http://localhost:9200)")
+    parser.add_argument("--es_index",dest="es_index",type=str,default="pst2eml")
+    parser.add_argument("--host",dest="host",type=str,default="localhost",help="sonic host")
+    parser.add_argument("--port",dest="port",type=int,default=1491,help="sonic port")
+    parser.add_argument("--password",dest="password",type=str,default="SecretPassword",help="sonic password")
+    parser.add_argument("--collection",dest="collection",type=str,default="pst2eml",help="sonic collection")
+    parser.add_argument("--batch_size",dest="batch_size",type=int,default=500)
+    parser.add_argument("--workers",dest="workers",type=int,default=4)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(join(args.folder,INDEX_NAME)):
+        print(f"no index in {args.folder}, process it with --index Y first")
+        return 1
+    options = {"batch_size":args.batch_size,"workers":args.workers}
+    if args.target=="elasticsearch":
+        exporter = ElasticsearchExporter(args.url,args.es_index,**options)
+    else:
+        exporter = SonicExporter(args.host,args.port,args.password,args.collection,**options)
+    index = SearchIndex(args.folder)
+    try:
+        report = exporter.export(index.records())
+    finally:
+        index.close()
+    print_export_report(report)
+    return 1 if report["failed"] else 0
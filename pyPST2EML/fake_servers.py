@@ -0,0 +1,173 @@
+"""
+local stand-ins for the search engines of exporters, to run an export offline (see benchmark.bench_export)
+
+FakeElasticsearch: HTTP/1.1 keep-alive server answering POST /_bulk like Elasticsearch, a fail_rate
+    fraction of the items is answered 429 (rejected execution) to exercise the retries
+FakeSonic: TCP server speaking the Sonic ingest channel protocol (START, PUSH, QUIT), a fail_rate
+    fraction of the PUSH commands closes the connection to exercise the reconnections
+
+both keep the received documents in memory (documents: id -> document or pushed text)
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import socketserver
+from threading import Lock, Thread
+
+class FakeServer:
+    """ runs a server in a background thread on a free local port
+    Parameters:
+    -----------
+    fail_rate: float
+        fraction of the items (Elasticsearch) or commands (Sonic) failing
+    seed: int
+        seed of the failures
+    """
+    def __init__(self,fail_rate=0.0,seed=0):
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.documents = {}
+        self.requests = 0
+        self.failures = 0
+        self.server = None
+        self.thread = None
+
+    def should_fail(self):
+        with self.lock:
+            fail = self.fail_rate>0 and self.random.random()<self.fail_rate
+            if fail:
+                self.failures+=1
+            return fail
+
+    def make_server(self):
+        raise NotImplementedError
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.server = self.make_server()
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc):
+        self.stop()
+
+class FakeElasticsearch(FakeServer):
+    """ POST /_bulk with index actions, documents: (index, _id) -> document, items: index actions received """
+    def __init__(self,**kwargs):
+        super().__init__(**kwargs)
+        self.items = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def make_server(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self,*args):
+                pass
+
+            def reply(self,status,result):
+                data = json.dumps(result).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type","application/json")
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length",0)))
+                if self.path.split("?")[0]!="/_bulk":
+                    return self.reply(404,{"error":"not found"})
+                with fake.lock:
+                    fake.requests+=1
+                lines = body.decode("utf-8").splitlines()
+                items = []
+                errors = False
+                for action_line, document_line in zip(lines[0::2],lines[1::2]):
+                    action = json.loads(action_line)["index"]
+                    document = json.loads(document_line)
+                    with fake.lock:
+                        fake.items+=1
+                    if fake.should_fail():
+                        errors = True
+                        items.append({"index":{"_index":action["_index"],"_id":action["_id"],"status":429,
+                            "error":{"type":"es_rejected_execution_exception"}}})
+                        continue
+                    with fake.lock:
+                        fake.documents[(action["_index"],action["_id"])] = document
+                    items.append({"index":{"_index":action["_index"],"_id":action["_id"],"status":201}})
+                self.reply(200,{"took":1,"errors":errors,"items":items})
+        return ThreadingHTTPServer(("127.0.0.1",0),Handler)
+
+class FakeSonic(FakeServer):
+    """ Sonic ingest channel, documents: (collection, bucket, object) -> list of pushed texts """
+    BUFFER = 20000
+
+    def __init__(self,password="SecretPassword",**kwargs):
+        super().__init__(**kwargs)
+        self.password = password
+
+    def make_server(self):
+        fake = self
+        class Handler(socketserver.StreamRequestHandler):
+            def send(self,line):
+                self.wfile.write(line.encode("utf-8")+b"\r\n")
+                self.wfile.flush()
+
+            def handle(self):
+                self.send("CONNECTED <sonic-server v1.4.0>")
+                started = False
+                for raw in self.rfile:
+                    if len(raw)>fake.BUFFER:
+                        self.send("ERR buffer_overflow")
+                        continue
+                    line = raw.decode("utf-8").rstrip("\r\n")
+                    command, _, rest = line.partition(" ")
+                    if command=="START":
+                        mode, _, password = rest.partition(" ")
+                        if mode!="ingest" or password!=fake.password:
+                            self.send("ENDED authentication_failed")
+                            return
+                        started = True
+                        self.send(f"STARTED ingest protocol(1) buffer({fake.BUFFER})")
+                    elif command=="QUIT":
+                        self.send("ENDED quit")
+                        return
+                    elif not started:
+                        self.send("ENDED not_recognized")
+                        return
+                    elif command=="PUSH":
+                        with fake.lock:
+                            fake.requests+=1
+                        if fake.should_fail():
+                            return
+                        parts = rest.split(" ",3)
+                        if len(parts)<4 or not (parts[3].startswith('"') and parts[3].endswith('"')):
+                            self.send("ERR invalid_format(PUSH <collection> <bucket> <object> \"<text>\")")
+                            continue
+                        collection, bucket, obj, text = parts
+                        text = text[1:-1].replace('\\"','"').replace("\\\\","\\")
+                        with fake.lock:
+                            fake.documents.setdefault((collection,bucket,obj),[]).append(text)
+                        self.send("OK")
+                    else:
+                        self.send(f"ERR unknown_command({command})")
+        return socketserver.ThreadingTCPServer(("127.0.0.1",0),Handler)
@@ -0,0 +1,123 @@
+"""
+subject to file name normalization
+
+clean_subject turns a decoded subject into a file name stem with the rules of pst2eml:
+* new lines and tabs are replaced by spaces, "FW: " and "RE: " are removed
+* the characters forbidden in windows file names are replaced (":" by a space, '"' by "'", the other
+    ones by "-"), "Ã©" (utf-8 read as latin-1) is fixed and the characters 1 to 31 are removed
+the single character rules are applied in one pass with precompiled translate tables
+
+FilenamePolicy shortens the names for the limits of a platform profile:
+* WINDOWS: full path length of 260 characters (same truncation as before the profiles)
+* LINUX: 255 bytes (utf-8) per path component, cut on a character boundary
+the [n] suffix added by incrementalfilename to a name already taken is made to fit too (see
+pst2eml.new_eml_path: the name is shortened by the size of the suffix once the counter is known)
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from email.header import decode_header
+import logging
+import os
+
+#https://docs.microsoft.com/en-us/windows/win32/fileio/naming-a-file
+SUBJECT_FORBIDDEN = ':/\\*?"<>|'
+SUBJECT_REPLACEMENT = " ----'---"
+SUBJECT_CONTROL = "".join([chr(i) for i in range(32)])
+SUBJECT_TABLE = str.maketrans(SUBJECT_FORBIDDEN,SUBJECT_REPLACEMENT,SUBJECT_CONTROL)
+#same rules for pure ascii subjects (most of them), bytes.translate is several times faster
+SUBJECT_BYTES_TABLE = bytes.maketrans(SUBJECT_FORBIDDEN.encode("ascii"),SUBJECT_REPLACEMENT.encode("ascii"))
+SUBJECT_BYTES_CONTROL = SUBJECT_CONTROL.encode("ascii")
+
+#removed before the single character rules, in this order
+SUBJECT_PREFIXES = ("FW: ","RE: ")
+
+#frequent encoding errors
+SUBJECT_FIXES = (("Ã©","é"),)
+
+#TL;DR: japanese encoding in outlook is a mess
+JAPANESE_ENCODINGS = {"ISO-2022-JP","ISO-2022-JP-1", "ISO-2022-JP-2","ISO-2022-JP-3", "ISO-2022-JP-2004",
+    "CP932","WINDOWS-31J","ShiftJIS","CP942","SJIS","UCS2","SHIFT_JISX0213","SHIFT_JISX0208"}
+
+def decode_subject(subject,default_charset="latin-1"):
+    """ decodes the RFC 2047 encoded words of a subject, returned as is when it has none """
+    if isinstance(subject,str) and "=?" not in subject:
+        #decode_header would return [(subject, None)]
+        return subject
+    decoded = ""
+    for subject_string, subject_encoding in decode_header(subject):
+        if not subject_encoding:
+            #when encoding is None, just append the fragment
+            if type(subject_string)==bytes:
+                decoded+=str(subject_string,default_charset)
+            else:
+                decoded+= subject_string
+        else:
+            if subject_encoding.upper() in JAPANESE_ENCODINGS:
+                subject_encoding = "CP932"
+            decoded+= subject_string.decode(subject_encoding,"ignore")
+    return decoded
+
+def clean_subject(subject):
+    """ Returns the file name stem for a decoded subject ("NoSubject" if nothing is left) """
+    subject = subject.replace("\n"," ").replace("\t"," ")
+    for prefix in SUBJECT_PREFIXES:
+        subject = subject.replace(prefix,"")
+    for old, new in SUBJECT_FIXES:
+        subject = subject.replace(old,new)
+    if subject.isascii():
+        subject = subject.encode("ascii").translate(SUBJECT_BYTES_TABLE,SUBJECT_BYTES_CONTROL).decode("ascii")
+    else:
+        subject = subject.translate(SUBJECT_TABLE)
+    if len(subject)==0:
+        subject="NoSubject"
+    return subject
+
+class FilenamePolicy:
+    """ length limits of the file names of a platform
+    Parameters:
+    -----------
+    name: str
+        profile name
+    max_path: int
+        longest full path in characters (None: no limit)
+    max_component_bytes: int
+        longest file name in utf-8 bytes (None: no limit)
+    """
+    def __init__(self,name,max_path=None,max_component_bytes=None):
+        self.name = name
+        self.max_path = max_path
+        self.max_component_bytes = max_component_bytes
+
+    def __repr__(self):
+        return f"FilenamePolicy({self.name!r})"
+
+    def fit(self,folder_path,stem,fp_ext,reserve=0):
+        """ Returns the stem shortened for the file folder_path/stem+fp_ext to fit the profile limits, with
+        reserve characters (ascii) left for a suffix added to the stem """
+        if self.max_path is not None:
+            #windows seems to still have issues renaming when full path length >260
+            #https://docs.microsoft.com/en-us/windows/win32/fileio/naming-a-file#maximum-path-length-limitation
+            if len(os.path.abspath(os.path.join(folder_path,stem+fp_ext)))+reserve>self.max_path:
+                stem = stem[:max(0,self.max_path-4-len(folder_path)-reserve)]
+        if self.max_component_bytes is not None:
+            limit = self.max_component_bytes-reserve
+            encoded = stem.encode("utf-8","surrogatepass")
+            ext_size = len(fp_ext.encode("utf-8","surrogatepass"))
+            if len(encoded)+ext_size>limit:
+                #an incomplete multi-byte character at the cut is dropped
+                stem = encoded[:max(0,limit-ext_size)].decode("utf-8","ignore")
+                logging.debug(f"file name shortened to {len(stem)} characters: {stem}")
+        return stem
+
+WINDOWS = FilenamePolicy("windows",max_path=260)
+LINUX = FilenamePolicy("linux",max_component_bytes=255)
+
+PROFILES = {"windows":WINDOWS,"linux":LINUX}
+
+def get_policy(policy=None):
+    """ Returns the FilenamePolicy for a profile name or policy (None: profile of the running platform) """
+    if isinstance(policy,FilenamePolicy):
+        return policy
+    if policy is None:
+        return WINDOWS if os.name=="nt" else LINUX
+    return PROFILES[policy]
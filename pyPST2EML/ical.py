@@ -0,0 +1,253 @@
+"""
+streaming iCalendar (RFC 5545) reader for the .ics calendar items
+
+readpst writes each calendar item as a .ics file and shared calendar exports hold thousands of events in
+a single one. read_ics reads the file once, line by line (the folded lines are unfolded on the fly, a
+property is cut at MAX_LINE_CHARS), and only keeps what the renaming needs from the first event (VEVENT,
+VTODO or VJOURNAL, the VALARM inside it are ignored):
+* SUMMARY: subject
+* DTSTART (else DTSTAMP): sent date, with its TZID resolved against the VTIMEZONE blocks of the file
+    (dateutil.tz.tzical, cached by block as every item of an export repeats the same definitions), else
+    as an IANA zone name, else in local time like the floating times
+* ORGANIZER, ATTENDEE: sender and recipients, UID: message id
+* DESCRIPTION: body (not in headers_only mode)
+
+the reading stops once the first event is complete and its time zone known, so the time and memory do
+not depend on the size of the file.
+
+the result is an email.message.Message with the Subject, From, To, Date and Message-ID headers and the
+description as text/plain body, so the renaming, the file times, the search index and the dedup
+(see pst2eml.msg_get_parameters) handle a calendar item like a message.
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+from email.message import Message
+from email.utils import format_datetime, formataddr
+from functools import lru_cache
+import io
+import logging
+
+#components whose properties are read (the first one of the file)
+EVENT_COMPONENTS = ("VEVENT","VTODO","VJOURNAL")
+#longer unfolded lines (inline attachments) are cut
+MAX_LINE_CHARS = 1024*1024
+#attendees kept (invitations to whole distribution lists)
+MAX_ATTENDEES = 500
+TEXT_ESCAPES = {"n":"\n","N":"\n",",":",",";":";","\\":"\\"}
+
+def unfold(fi,max_chars=MAX_LINE_CHARS):
+    """ yields the logical lines (content lines unfolded, without end of line) of a text file """
+    parts = None
+    size = 0
+    for line in fi:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ","\t") and parts is not None:
+            if size<max_chars:
+                parts.append(line[1:max_chars-size+1])
+                size+= len(parts[-1])
+            continue
+        if parts is not None:
+            yield "".join(parts)
+        parts = [line[:max_chars]]
+        size = len(parts[0])
+    if parts is not None:
+        yield "".join(parts)
+
+def split_property(line):
+    """ Returns (NAME, {PARAM: value}, value) of a content line (quoted parameter values may hold ; : ,) """
+    quoted = False
+    fields = []
+    start = 0
+    for i, c in enumerate(line):
+        if c=='"':
+            quoted = not quoted
+        elif not quoted and c in ";:":
+            fields.append(line[start:i])
+            start = i+1
+            if c==":":
+                break
+    else:
+        #no value
+        return line.strip().upper(), {}, ""
+    params = {}
+    for field in fields[1:]:
+        key, _, value = field.partition("=")
+        params[key.strip().upper()] = value.strip('"')
+    return fields[0].strip().upper(), params, line[start:]
+
+def unescape_text(value):
+    """ TEXT value without its backslash escapes """
+    if "\\" not in value:
+        return value
+    out = []
+    i = 0
+    while i<len(value):
+        c = value[i]
+        if c=="\\" and i+1<len(value):
+            out.append(TEXT_ESCAPES.get(value[i+1],value[i+1]))
+            i+=2
+        else:
+            out.append(c)
+            i+=1
+    return "".join(out)
+
+def single_line(text):
+    return " ".join(text.split())
+
+def address(value,params):
+    """ "Name <address>" of a CAL-ADDRESS property (ORGANIZER, ATTENDEE) """
+    mail = value[7:] if value[:7].lower()=="mailto:" else value
+    return formataddr((params.get("CN",""),mail.strip()))
+
+@lru_cache(maxsize=256)
+def tz_from_block(block,tzid):
+    """ tzinfo defined by a VTIMEZONE block (None if invalid) """
+    from dateutil.tz import tzical
+    try:
+        return tzical(io.StringIO(block)).get(tzid)
+    except Exception:
+        log_msg = "invalid VTIMEZONE for TZID %s"%(tzid)
+        logging.warning(log_msg)
+        return None
+
+@lru_cache(maxsize=256)
+def tz_from_name(tzid):
+    """ tzinfo of an IANA zone name (None if unknown) """
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:
+        from dateutil.tz import gettz
+        return gettz(tzid) if "/" in tzid else None
+    try:
+        return ZoneInfo(tzid)
+    except (ValueError,LookupError,OSError):
+        return None
+
+def parse_ical_datetime(value,params,vtimezones):
+    """ timezone aware datetime of a DATE-TIME / DATE value
+    Parameters:
+    -----------
+    params: dict
+        property parameters (TZID, VALUE)
+    vtimezones: dict
+        TZID -> VTIMEZONE block text of the file
+    """
+    value = value.strip()
+    if params.get("VALUE","").upper()=="DATE" or len(value)==8:
+        return datetime.strptime(value[:8],"%Y%m%d").astimezone()
+    if value.endswith("Z"):
+        return datetime.strptime(value[:15],"%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
+    date = datetime.strptime(value[:15],"%Y%m%dT%H%M%S")
+    tzid = params.get("TZID")
+    if tzid is None:
+        #floating time
+        return date.astimezone()
+    tz = None
+    if tzid in vtimezones:
+        tz = tz_from_block(vtimezones[tzid],tzid)
+    if tz is None:
+        tz = tz_from_name(tzid.lstrip("/"))
+    if tz is None:
+        log_msg = "unknown TZID %s, taken as local time"%(tzid)
+        logging.info(log_msg)
+        return date.astimezone()
+    return date.replace(tzinfo=tz)
+
+def read_ics(eml_fp,headers_only=False):
+    """ reads the first event of an iCalendar file in a single pass
+    Parameters:
+    -----------
+    eml_fp: str
+        full path to the .ics file
+    headers_only: bool
+        the description is not kept
+    Returns:
+    --------
+    msg: email.message.Message
+        Subject, From, To, Date and Message-ID headers of the first event, its description as body
+        (None if the file is not an iCalendar object, e.g. a message saved as .ics)
+    msg_strings: list
+        empty, the fallbacks of pst2eml.msg_get_parameters have nothing to scan
+    """
+    #properties of the first event: name -> (params, value), attendees
+    event = None
+    attendees = []
+    event_done = False
+    calendar = False
+    stack = []
+    #TZID -> VTIMEZONE block text
+    vtimezones = {}
+    block = None
+    block_tzid = None
+    with open(eml_fp,encoding="utf-8-sig",errors="replace") as fi:
+        for line in unfold(fi):
+            if not line:
+                continue
+            name, params, value = split_property(line)
+            if not stack:
+                if not (name=="BEGIN" and value.strip().upper()=="VCALENDAR"):
+                    break
+                calendar = True
+            if name=="BEGIN":
+                component = value.strip().upper()
+                stack.append(component)
+                if component=="VTIMEZONE":
+                    block = [line]
+                    block_tzid = None
+                elif block is not None:
+                    block.append(line)
+                elif component in EVENT_COMPONENTS and event is None:
+                    event = {}
+                continue
+            if block is not None:
+                block.append(line)
+            if name=="END":
+                component = stack.pop() if stack else None
+                if component=="VTIMEZONE" and block is not None:
+                    if block_tzid is not None:
+                        vtimezones[block_tzid] = "\n".join(block)+"\n"
+                    block = None
+                elif component in EVENT_COMPONENTS and event is not None and not event_done:
+                    event_done = True
+                if event_done:
+                    tzid = event.get("DTSTART",event.get("DTSTAMP",({},"")))[0].get("TZID")
+                    if tzid is None or tzid in vtimezones:
+                        break
+                if not stack:
+                    break
+                continue
+            if block is not None:
+                if name=="TZID" and stack[-1]=="VTIMEZONE":
+                    block_tzid = value.strip()
+            elif event is not None and not event_done and stack[-1] in EVENT_COMPONENTS:
+                if name=="ATTENDEE":
+                    if len(attendees)<MAX_ATTENDEES:
+                        attendees.append(address(value,params))
+                elif name in ("SUMMARY","DTSTART","DTSTAMP","ORGANIZER","UID") or (name=="DESCRIPTION" and not headers_only):
+                    event.setdefault(name,(params,value))
+    if not calendar:
+        return None
+    event = event or {}
+    msg = Message()
+    if "SUMMARY" in event:
+        msg["Subject"] = single_line(unescape_text(event["SUMMARY"][1]))
+    if "ORGANIZER" in event:
+        msg["From"] = address(event["ORGANIZER"][1],event["ORGANIZER"][0])
+    if attendees:
+        msg["To"] = ", ".join(attendees)
+    for date_name in ("DTSTART","DTSTAMP"):
+        if date_name in event:
+            try:
+                date = parse_ical_datetime(event[date_name][1],event[date_name][0],vtimezones)
+            except ValueError:
+                log_msg = "invalid %s in %s: %s"%(date_name,eml_fp,event[date_name][1])
+                logging.warning(log_msg)
+                continue
+            msg["Date"] = format_datetime(date)
+            break
+    if "UID" in event:
+        msg["Message-ID"] = "<"+single_line(event["UID"][1])+">"
+    if "DESCRIPTION" in event:
+        msg.set_payload(unescape_text(event["DESCRIPTION"][1]),"utf-8")
+    return msg, []
@@ -0,0 +1,178 @@
+"""
+bucketed output layout: keeps the folders small
+
+readpst reproduces the Outlook folder tree, an Inbox of 150k messages ends up as a single folder of
+150k files: listings, collision probes (see pst2eml.incrementalfilename), backup and indexing tools slow
+down at that size. With a layout, the rename step moves each message of a folder into a bucket of that
+folder, under its .pst2eml_buckets sub folder:
+* date: YYYY/MM of the sent date (Inbox/.pst2eml_buckets/2021/03/budget.eml)
+* hash: 2 hex digits of a hash of the subject and sent date per level (Inbox/.pst2eml_buckets/3f/budget.eml,
+    256 buckets per level, hash_levels levels), for mailboxes whose messages are all from a few months
+
+a bucket holds max_files files at most, the next files go to <bucket>_2, <bucket>_3, ... The collisions
+are resolved in the bucket only.
+
+the buckets of each original folder are listed with their number of files in the layout file of the
+folder (.pst2eml_layout.json): original folder -> buckets (see folder_buckets), the original folder of a
+bucket is the parent of its .pst2eml_buckets folder (see original_folder). The buckets are kept apart
+from the sub folders of the folder (Outlook folders such as Inbox/2021 cannot be mistaken for a bucket):
+the folder walks (see pst2eml.make_eml_search_friendly) skip the .pst2eml_buckets folders so the
+messages are not processed again, in the same run or the next ones.
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from hashlib import blake2b
+import json
+import logging
+import os
+from os.path import abspath, basename, dirname, isdir, join
+
+# own modules
+from .metadata import is_sidecar_file
+
+LAYOUT_NAME = ".pst2eml_layout.json"
+#sub folder of an original folder holding its buckets
+BUCKETS_NAME = ".pst2eml_buckets"
+LAYOUTS = ("flat","date","hash")
+#files per bucket
+MAX_FILES = 5000
+
+def is_layout_file(fn):
+    """ True for the layout file and its temporary file """
+    return fn.startswith(LAYOUT_NAME)
+
+def is_buckets_folder(name):
+    return name==BUCKETS_NAME
+
+class Layout:
+    """ bucket of a message
+    Parameters:
+    -----------
+    kind: str
+        "date" or "hash"
+    max_files: int
+        files per bucket, a full bucket continues in <bucket>_2, <bucket>_3, ...
+    hash_levels: int
+        hash layout: number of levels of 256 buckets
+    """
+    def __init__(self,kind="date",max_files=MAX_FILES,hash_levels=1):
+        if kind not in ("date","hash"):
+            raise ValueError(f"unknown layout {kind}")
+        self.kind = kind
+        self.max_files = max_files
+        self.hash_levels = hash_levels
+
+    def bucket(self,subject,sent_date):
+        """ "/" separated bucket of a message (before the max_files overflow) """
+        if self.kind=="date":
+            return f"{sent_date.year:04d}/{sent_date.month:02d}"
+        digest = blake2b(f"{subject}\n{sent_date.isoformat()}".encode("utf-8","surrogatepass"),digest_size=8).hexdigest()
+        return "/".join(digest[2*i:2*i+2] for i in range(self.hash_levels))
+
+def get_layout(layout=None):
+    """ Returns the Layout for a layout name or Layout (None for the flat layout: no bucket) """
+    if layout is None or isinstance(layout,Layout):
+        return layout
+    if layout=="flat":
+        return None
+    return Layout(layout)
+
+def read_layout_file(folder):
+    """ content of the layout file of a folder ({} if there is none) """
+    fp = join(folder,LAYOUT_NAME)
+    try:
+        with open(fp,encoding="utf-8") as fi:
+            return json.load(fi)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log_msg = "invalid layout file: %s"%(fp)
+        logging.warning(log_msg)
+        return {}
+
+def folder_buckets(folder):
+    """ Returns dict bucket ("/" separated, relative to the folder, e.g. ".pst2eml_buckets/2021/03") -> number
+    of files of an original folder """
+    return read_layout_file(folder).get("buckets",{})
+
+def original_folder(fp):
+    """ original folder of a (bucketed) message file or bucket folder, fp's folder if it is not in a bucket """
+    folder = dirname(abspath(fp))
+    path = folder
+    while path!=dirname(path):
+        if is_buckets_folder(basename(path)):
+            return dirname(path)
+        path = dirname(path)
+    return folder
+
+class FolderBuckets:
+    """ buckets of the messages of an original folder, the mapping is kept in its layout file
+    Parameters:
+    -----------
+    layout: Layout or str
+        see get_layout (None: only recount and save, with the layout of the layout file)
+    folder: str
+        original folder
+    """
+    def __init__(self,layout,folder):
+        self.layout = get_layout(layout)
+        self.folder = abspath(folder)
+        #bucket -> files, counted on first use
+        self.counts = {}
+        self.data = read_layout_file(self.folder)
+        self.buckets = self.data.get("buckets",{})
+        self.changed = False
+
+    def _count(self,bucket):
+        if bucket not in self.counts:
+            path = join(self.folder,*bucket.split("/"))
+            count = 0
+            if isdir(path):
+                with os.scandir(path) as entries:
+                    count = sum(1 for entry in entries if entry.is_file() and not is_sidecar_file(entry.name))
+            self.counts[bucket] = count
+        return self.counts[bucket]
+
+    def destination(self,subject,sent_date,create=True):
+        """ Returns the folder of the next message (created unless create is False), counted in its bucket """
+        base = BUCKETS_NAME+"/"+self.layout.bucket(subject,sent_date)
+        bucket = base
+        i = 1
+        while self._count(bucket)>=self.layout.max_files:
+            i+=1
+            bucket = f"{base}_{i}"
+        path = join(self.folder,*bucket.split("/"))
+        if create:
+            os.makedirs(path,exist_ok=True)
+        self.counts[bucket]+=1
+        self.buckets[bucket] = self.counts[bucket]
+        self.changed = True
+        return path
+
+    def recount(self,bucket):
+        """ updates the number of files of a bucket files were moved to or from (see rename_plan), an empty
+        bucket is dropped """
+        self.counts.pop(bucket,None)
+        if self._count(bucket):
+            self.buckets[bucket] = self.counts[bucket]
+        else:
+            self.buckets.pop(bucket,None)
+        self.changed = True
+
+    def save(self):
+        """ writes the layout file of the folder if buckets were used (removed when no bucket is left) """
+        if not self.changed:
+            return
+        fp = join(self.folder,LAYOUT_NAME)
+        if not self.buckets:
+            if os.path.exists(fp):
+                os.remove(fp)
+            self.changed = False
+            return
+        layout = self.layout or Layout(self.data.get("layout","date"),self.data.get("max_files",MAX_FILES))
+        data = {"layout":layout.kind,"max_files":layout.max_files,"buckets":dict(sorted(self.buckets.items()))}
+        tmp_fp = fp+".tmp"
+        with open(tmp_fp,"w",encoding="utf-8") as fo:
+            json.dump(data,fo,indent=1)
+        os.replace(tmp_fp,fp)
+        self.changed = False
@@ -0,0 +1,134 @@
+"""
+persistent processing manifest for incremental runs of make_eml_search_friendly
+
+the manifest is a SQLite file stored at the root of the processed folder, it keeps for every
+processed file its final name, size, mtime and inode together with the extracted parameters,
+and for every folder its mtime and inode once all its files have been processed
+
+on the next run:
+* a file whose name, size, mtime and inode match its manifest entry is not parsed nor renamed again
+* a folder whose mtime and inode did not change (no file added, removed or renamed) and whose files
+    all match their entries is skipped without being listed nor parsed, a file rewritten in place
+    does not change the folder mtime so each file is still compared (the root folder is always
+    checked file by file as it holds the manifest itself)
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import os
+from os.path import abspath, exists, join, relpath
+from pathlib import Path
+import sqlite3
+
+MANIFEST_NAME = ".pst2eml_manifest.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    original_name TEXT,
+    send_to TEXT,
+    sent_from TEXT,
+    subject TEXT,
+    sent_date TEXT,
+    PRIMARY KEY (folder, name)
+);
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+"""
+
+def is_manifest_file(fn):
+    """ True for the manifest and its SQLite journal files """
+    return fn.startswith(MANIFEST_NAME)
+
+def file_key(st):
+    """ (size, mtime_ns, inode) used to decide if a file changed since it was processed """
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class Manifest:
+    """ SQLite manifest of the processed files of a folder tree
+    Parameters:
+    -----------
+    root: str
+        root folder of the tree, the manifest file is created in it
+    readonly: bool
+        only look up the known files of an existing manifest (workers of a distributed run, the
+        coordinator records the results, see distributed)
+    """
+    def __init__(self,root,readonly=False):
+        self.root = root
+        self.fp = join(root,MANIFEST_NAME)
+        if readonly:
+            self.db = sqlite3.connect(Path(abspath(self.fp)).as_uri()+"?mode=ro",uri=True)
+        else:
+            self.db = sqlite3.connect(self.fp)
+            self.db.executescript(SCHEMA)
+
+    def _rel(self,folder):
+        return relpath(folder,self.root)
+
+    def folder_unchanged(self,folder):
+        """ True if the folder was completely processed, no entry was added, removed or renamed since
+        (folder mtime and inode) and none of its files was modified (see file_key) """
+        if os.path.samefile(folder,self.root):
+            return False
+        row = self.db.execute("SELECT mtime_ns, inode FROM folders WHERE folder=?",
+            (self._rel(folder),)).fetchone()
+        if row is None:
+            return False
+        st = os.stat(folder)
+        if row!=(st.st_mtime_ns,st.st_ino):
+            return False
+        for name, key in self.known_files(folder).items():
+            try:
+                if file_key(os.stat(join(folder,name)))!=key:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def folder_file_count(self,folder):
+        """ number of files recorded for the folder """
+        row = self.db.execute("SELECT files FROM folders WHERE folder=?",(self._rel(folder),)).fetchone()
+        return row[0] if row else 0
+
+    def known_files(self,folder):
+        """ Returns dict file name -> (size, mtime_ns, inode) of the files recorded for the folder """
+        rows = self.db.execute("SELECT name, size, mtime_ns, inode FROM files WHERE folder=?",
+            (self._rel(folder),))
+        return {name:(size,mtime_ns,inode) for name, size, mtime_ns, inode in rows}
+
+    def record(self,folder,records):
+        """ stores the records returned by process_eml_folder then the folder current state
+        Parameters:
+        -----------
+        folder: str
+            processed folder
+        records: list
+            dicts with name, size, mtime_ns, inode, status, original_name, send_to, sent_from, subject, sent_date
+        """
+        rel = self._rel(folder)
+        with self.db:
+            self.db.executemany("""INSERT OR REPLACE INTO files
+                (folder, name, size, mtime_ns, inode, status, original_name, send_to, sent_from, subject, sent_date)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                [(rel,r["name"],r["size"],r["mtime_ns"],r["inode"],r["status"],r["original_name"],
+                  r["send_to"],r["sent_from"],r["subject"],r["sent_date"]) for r in records])
+            #entries of files which are not in the folder anymore (or in its buckets, see layout)
+            names = set(os.listdir(folder))
+            stale = [(rel,name) for name in self.known_files(folder) if name not in names and not exists(join(folder,name))]
+            self.db.executemany("DELETE FROM files WHERE folder=? AND name=?",stale)
+            st = os.stat(folder)
+            count = self.db.execute("SELECT COUNT(*) FROM files WHERE folder=?",(rel,)).fetchone()[0]
+            self.db.execute("INSERT OR REPLACE INTO folders (folder, mtime_ns, inode, files) VALUES (?,?,?,?)",
+                (rel,st.st_mtime_ns,st.st_ino,count))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,292 @@
+"""
+file metadata backends
+
+a MetadataWriter sets on a renamed .eml/.ics file the author (sender), title (subject) and comments
+(recipients) of the message, and its times to the sent date, so desktop search tools can filter on them:
+* win32: windows summary information property set (COM structured storage) and creation time
+* xattr: freedesktop extended attributes (user.dublincore.creator, user.dublincore.title,
+    user.xdg.comment) read by the linux desktop search tools, and access/modification times
+* sidecar: access/modification times, the attributes of all the files of a folder are written at
+    once in a single index (.pst2eml_metadata.json) of that folder by flush()
+
+each writer counts the files written, failed and the time spent (see MetadataWriter.stats), the files
+whose batched update failed in flush() are listed in failed_files. clear() removes the attributes of a
+file again (see rename_plan.undo)
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import errno
+import json
+import logging
+import os
+from os.path import basename, dirname, exists, join
+from threading import Lock, local
+from time import perf_counter
+
+# own modules
+from .metrics import NULL_METRICS
+
+SIDECAR_NAME = ".pst2eml_metadata.json"
+
+#https://www.freedesktop.org/wiki/CommonExtendedAttributes/
+XATTR_NAMES = {"author":"user.dublincore.creator","title":"user.dublincore.title","comments":"user.xdg.comment"}
+#longer values are cut (the attributes of a file share a single 4KB block on ext4)
+XATTR_MAX_BYTES = 1024
+
+def is_sidecar_file(fn):
+    """ True for the sidecar index and its temporary file """
+    return fn.startswith(SIDECAR_NAME)
+
+class MetadataWriter:
+    """ sets the attributes and times of files, the subclasses implement set_attributes and can
+    override set_times and flush
+    """
+    name = None
+
+    def __init__(self):
+        self.stats = {"files":0,"failed":0,"seconds":0.0}
+        #paths of the files whose update failed in flush
+        self.failed_files = []
+        #write can be called from several threads (see staged_io)
+        self.lock = Lock()
+        #times the "attributes" and "times" stages, see metrics.RunMetrics
+        self.metrics = NULL_METRICS
+
+    def write(self,fp,author,title,comments,sent_date):
+        """ sets the attributes and times of a file
+        Parameters:
+        -----------
+        fp: str
+            full path to the file
+        author, title, comments: str
+            sender, subject and recipients of the message
+        sent_date: datetime
+            date at which the message was sent
+        Returns:
+        --------
+        success: bool
+            False if one of the updates failed (the failure is logged)
+        """
+        start = perf_counter()
+        success = True
+        try:
+            with self.metrics.stage("attributes"):
+                self.set_attributes(fp,author,title,comments)
+        except Exception:
+            log_msg = "failed updating file attrributes for: %s"%fp
+            logging.error(log_msg)
+            success = False
+        try:
+            with self.metrics.stage("times"):
+                self.set_times(fp,sent_date)
+        except Exception:
+            log_msg ="failed changing creation date: %s"%fp
+            logging.error(log_msg)
+            success = False
+        with self.lock:
+            self.stats["files"]+=1
+            if not success:
+                self.stats["failed"]+=1
+            self.stats["seconds"]+=perf_counter()-start
+        return success
+
+    def set_attributes(self,fp,author,title,comments):
+        raise NotImplementedError
+
+    def clear(self,fp):
+        """ removes the attributes set by set_attributes (the times are left to the caller) """
+        raise NotImplementedError
+
+    def set_times(self,fp,sent_date):
+        """ sets the access and modification times to sent_date """
+        atime = int(sent_date.timestamp())
+        os.utime(fp,(atime,atime))
+
+    def flush(self):
+        """ writes the pending batched updates, returns False if one of them failed (see failed_files) """
+        return True
+
+    def files_per_second(self):
+        return self.stats["files"]/self.stats["seconds"] if self.stats["seconds"]>0 else None
+
+class Win32Writer(MetadataWriter):
+    """ windows summary information (author, title, comments) and creation time """
+    name = "win32"
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import win32file
+            import win32con
+            from win32com import storagecon
+            import pywintypes
+            import pythoncom
+        except ImportError:
+            print("you might need to install pywin32")
+            print(">python -m pip install pywin32")
+            print("if this was not enough you might need to run")
+            print("python -m pip install --upgrade pywin32==225")
+            print("then")
+            print("python venv\\Scripts\\pywin32_postinstall.py -install")
+            raise
+        self.win32file = win32file
+        self.win32con = win32con
+        self.storagecon = storagecon
+        self.pywintypes = pywintypes
+        self.pythoncom = pythoncom
+        #COM is initialized once per thread
+        self.com = local()
+
+    def set_attributes(self,fp,author,title,comments):
+        storagecon = self.storagecon
+        pythoncom = self.pythoncom
+        if not getattr(self.com,"initialized",False):
+            pythoncom.CoInitialize()
+            self.com.initialized = True
+        flags=storagecon.STGM_READWRITE | storagecon.STGM_SHARE_EXCLUSIVE | storagecon.STGM_DIRECT
+        pss=pythoncom.StgOpenStorageEx(fp, flags, storagecon.STGFMT_FILE, 0 , pythoncom.IID_IPropertySetStorage,None)
+        try:
+            ps=pss.Create(pythoncom.FMTID_SummaryInformation,pythoncom.IID_IPropertyStorage,0,storagecon.STGM_READWRITE|storagecon.STGM_SHARE_EXCLUSIVE)
+        except:
+            try:
+                ps=pss.Open(pythoncom.FMTID_SummaryInformation,storagecon.STGM_READWRITE|storagecon.STGM_SHARE_EXCLUSIVE)
+            except:
+                log_msg = "failed opening the summary information of: %s (author: %s, title: %s)"%(fp,author,title)
+                logging.error(log_msg)
+                raise
+        ps.WriteMultiple((storagecon.PIDSI_KEYWORDS,storagecon.PIDSI_COMMENTS,storagecon.PIDSI_AUTHOR,storagecon.PIDSI_TITLE),('keywords',comments,author,title))
+        ps=None
+        pss=None
+
+    def clear(self,fp):
+        """ deletes the summary information properties (the creation time is not restored) """
+        storagecon = self.storagecon
+        pythoncom = self.pythoncom
+        if not getattr(self.com,"initialized",False):
+            pythoncom.CoInitialize()
+            self.com.initialized = True
+        flags=storagecon.STGM_READWRITE | storagecon.STGM_SHARE_EXCLUSIVE | storagecon.STGM_DIRECT
+        pss=pythoncom.StgOpenStorageEx(fp, flags, storagecon.STGFMT_FILE, 0 , pythoncom.IID_IPropertySetStorage,None)
+        try:
+            ps=pss.Open(pythoncom.FMTID_SummaryInformation,storagecon.STGM_READWRITE|storagecon.STGM_SHARE_EXCLUSIVE)
+        except pythoncom.com_error:
+            #no summary information: nothing to remove
+            return
+        ps.DeleteMultiple((storagecon.PIDSI_KEYWORDS,storagecon.PIDSI_COMMENTS,storagecon.PIDSI_AUTHOR,storagecon.PIDSI_TITLE))
+        ps=None
+        pss=None
+
+    def set_times(self,fp,sent_date):
+        win32con = self.win32con
+        atime = int(sent_date.timestamp())
+        try:
+            #HERE WE TRY TO CHANGE the FILE CREATE DATE
+            winfile = self.win32file.CreateFile(fp, win32con.GENERIC_WRITE,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
+                None, win32con.OPEN_EXISTING,
+                win32con.FILE_ATTRIBUTE_NORMAL, None)
+            self.win32file.SetFileTime(winfile, self.pywintypes.Time(atime), None, None)
+            winfile.close()
+        except:
+            log_msg = "error changing creation date for fname :%s"%(fp)
+            logging.info(log_msg)
+        #NOW WE CHANGE THE LAST CHANGE TIME
+        super().set_times(fp,sent_date)
+
+class XattrWriter(MetadataWriter):
+    """ freedesktop extended attributes (linux), the file system must support user.* attributes """
+    name = "xattr"
+
+    def __init__(self):
+        super().__init__()
+        if not hasattr(os,"setxattr"):
+            raise OSError("extended attributes are not supported on this platform")
+
+    def set_attributes(self,fp,author,title,comments):
+        for key, value in [("author",author),("title",title),("comments",comments)]:
+            if value:
+                #an incomplete multi-byte character at the cut is dropped
+                value = str(value).encode("utf-8","surrogatepass")[:XATTR_MAX_BYTES]
+                value = value.decode("utf-8","ignore").encode("utf-8")
+                os.setxattr(fp,XATTR_NAMES[key],value)
+
+    def clear(self,fp):
+        for name in XATTR_NAMES.values():
+            try:
+                os.removexattr(fp,name)
+            except OSError as e:
+                if e.errno!=errno.ENODATA:
+                    raise
+
+class SidecarWriter(MetadataWriter):
+    """ one json index per folder: file name -> author, title, comments and sent_date, merged into the
+    existing index (entries of files not in the folder anymore or cleared are dropped, an empty index is
+    removed) by flush
+    """
+    name = "sidecar"
+
+    def __init__(self):
+        super().__init__()
+        #folder -> file name -> entry
+        self.pending = {}
+        #folder -> file names whose entry is dropped (see clear)
+        self.cleared = {}
+
+    def _entry(self,fp):
+        return self.pending.setdefault(dirname(fp),{}).setdefault(basename(fp),{})
+
+    def set_attributes(self,fp,author,title,comments):
+        self._entry(fp).update({"author":author,"title":title,"comments":comments})
+
+    def clear(self,fp):
+        self.pending.get(dirname(fp),{}).pop(basename(fp),None)
+        self.cleared.setdefault(dirname(fp),set()).add(basename(fp))
+
+    def set_times(self,fp,sent_date):
+        self._entry(fp)["sent_date"] = sent_date.isoformat()
+        super().set_times(fp,sent_date)
+
+    def flush(self):
+        start = perf_counter()
+        success = True
+        for folder in list(self.pending)+[folder for folder in self.cleared if folder not in self.pending]:
+            entries = self.pending.get(folder,{})
+            cleared = self.cleared.get(folder,set())
+            index_fp = join(folder,SIDECAR_NAME)
+            try:
+                index = {}
+                if exists(index_fp):
+                    with open(index_fp,encoding="utf-8") as fi:
+                        index = json.load(fi)
+                names = set(os.listdir(folder))
+                index = {name:entry for name, entry in index.items() if name in names and name not in cleared}
+                for name, entry in entries.items():
+                    index.setdefault(name,{}).update(entry)
+                if index:
+                    with open(index_fp+".tmp","w",encoding="utf-8") as fo:
+                        json.dump(index,fo,ensure_ascii=False,indent=1,sort_keys=True)
+                    os.replace(index_fp+".tmp",index_fp)
+                elif exists(index_fp):
+                    os.remove(index_fp)
+            except Exception:
+                log_msg = "failed writing the metadata index of: %s"%folder
+                logging.error(log_msg)
+                self.stats["failed"]+=len(entries)
+                self.failed_files.extend([join(folder,name) for name in list(entries)+sorted(cleared)])
+                success = False
+        self.pending = {}
+        self.cleared = {}
+        self.stats["seconds"]+=perf_counter()-start
+        return success
+
+WRITERS = {"win32":Win32Writer,"xattr":XattrWriter,"sidecar":SidecarWriter}
+
+def default_backend():
+    """ win32 on windows, xattr elsewhere """
+    return "win32" if os.name=="nt" else "xattr"
+
+def get_writer(backend=None):
+    """ Returns a MetadataWriter for a backend name (None: default_backend) or the given writer """
+    if isinstance(backend,MetadataWriter):
+        return backend
+    return WRITERS[backend or default_backend()]()
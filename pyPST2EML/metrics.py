@@ -0,0 +1,344 @@
+"""
+run instrumentation of make_eml_search_friendly
+
+RunMetrics collects for a run:
+* per stage (parse, subject, date, rename, attributes, times, body, flush, ...) the number of calls,
+    cumulative / min / max time and a log scale histogram of the durations (with p50/p95/p99 estimates)
+* the number of files and bytes, files/s and bytes/s
+* the slowest files with their size
+* optionally a live progress line with an ETA on stderr
+
+NULL_METRICS has the same interface and does nothing, it is used when the instrumentation is disabled
+so the instrumented code only pays for a no-op method call
+
+the stage times of folders processed in other processes (jobs>1) are summed, so their total can be
+larger than the wall time of the run
+
+Profiler wraps cProfile or a sampling profiler (a thread looking at the main thread stack every
+interval seconds) around a run, only the current process is profiled
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from collections import Counter
+import heapq
+import io
+import sys
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+#histogram bucket upper bounds: 10us doubling up to about 10s, then +inf
+HISTOGRAM_BOUNDS = [1e-5*2**i for i in range(21)]
+
+class _NullStage:
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        return False
+
+class NullMetrics:
+    """ disabled instrumentation """
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self,name):
+        return self._stage
+
+    def add(self,name,seconds):
+        pass
+
+    def file_done(self,path,size,seconds):
+        pass
+
+    def to_dict(self):
+        return None
+
+NULL_METRICS = NullMetrics()
+
+class _Stage:
+    __slots__ = ["metrics","name","start"]
+
+    def __init__(self,metrics,name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.metrics.add(self.name,perf_counter()-self.start)
+        return False
+
+class StageStats:
+    """ count, total, min, max and histogram of the durations of a stage """
+    __slots__ = ["count","total","min","max","histogram"]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.histogram = [0]*(len(HISTOGRAM_BOUNDS)+1)
+
+    def add(self,seconds):
+        self.count+=1
+        self.total+=seconds
+        if self.min is None or seconds<self.min:
+            self.min = seconds
+        if seconds>self.max:
+            self.max = seconds
+        i = 0
+        while i<len(HISTOGRAM_BOUNDS) and seconds>HISTOGRAM_BOUNDS[i]:
+            i+=1
+        self.histogram[i]+=1
+
+    def merge(self,other):
+        """ adds the stats of other (a StageStats.to_dict) """
+        self.count+=other["count"]
+        self.total+=other["total"]
+        if other["min"] is not None and (self.min is None or other["min"]<self.min):
+            self.min = other["min"]
+        self.max = max(self.max,other["max"])
+        for bound, count in other["histogram"]:
+            self.histogram[HISTOGRAM_BOUNDS.index(bound) if bound is not None else len(HISTOGRAM_BOUNDS)]+=count
+
+    def percentile(self,q):
+        """ upper bound of the histogram bucket holding the q quantile """
+        if not self.count:
+            return None
+        target = q*self.count
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen+=count
+            if seen>=target:
+                return min(HISTOGRAM_BOUNDS[i],self.max) if i<len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {"count":self.count,"total":self.total,"mean":self.total/self.count if self.count else None,
+            "min":self.min,"max":self.max,"p50":self.percentile(0.5),"p95":self.percentile(0.95),
+            "p99":self.percentile(0.99),
+            #[bucket upper bound in seconds (None: above the last bound), count] of the non empty buckets
+            "histogram":[[HISTOGRAM_BOUNDS[i] if i<len(HISTOGRAM_BOUNDS) else None,count]
+                for i, count in enumerate(self.histogram) if count]}
+
+class Progress:
+    """ progress line with an ETA written on stderr at most every interval seconds
+    Parameters:
+    -----------
+    total: int
+        expected number of files (None: no ETA)
+    """
+    def __init__(self,total=None,interval=0.5,stream=None):
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.start = perf_counter()
+        self.last = 0.0
+        self.done = 0
+        self.bytes = 0
+
+    def update(self,files=1,size=0,force=False):
+        self.done+=files
+        self.bytes+=size
+        now = perf_counter()
+        if not force and now-self.last<self.interval:
+            return
+        self.last = now
+        elapsed = now-self.start
+        rate = self.done/elapsed if elapsed>0 else 0
+        line = f"\r{self.done}"+(f"/{self.total}" if self.total else "")+f" files {rate:.0f} files/s {self.bytes/elapsed/1e6 if elapsed>0 else 0:.1f} MB/s"
+        if self.total and rate>0:
+            remaining = max(0,self.total-self.done)/rate
+            line+= f" ETA {int(remaining//60)}:{int(remaining%60):02d}"
+        self.stream.write(line+"   ")
+        self.stream.flush()
+
+    def close(self):
+        self.update(0,force=True)
+        self.stream.write("\n")
+        self.stream.flush()
+
+class RunMetrics(NullMetrics):
+    """ enabled instrumentation
+    Parameters:
+    -----------
+    slowest: int
+        number of slowest files kept
+    progress: Progress
+        updated on each file_done (None: no progress line)
+    """
+    enabled = True
+
+    def __init__(self,slowest=20,progress=None):
+        self.stages = {}
+        self.files = 0
+        self.bytes = 0
+        self.slowest_count = slowest
+        #min heap of (seconds, path, size)
+        self.slowest = []
+        self.progress = progress
+        self.start = perf_counter()
+        self.seconds = None
+        #stages timed from several threads (see staged_io)
+        self.lock = Lock()
+
+    def stage(self,name):
+        """ context manager adding the time spent in its block to the stage """
+        return _Stage(self,name)
+
+    def add(self,name,seconds):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.add(seconds)
+
+    def file_done(self,path,size,seconds):
+        self.files+=1
+        self.bytes+=size
+        if len(self.slowest)<self.slowest_count:
+            heapq.heappush(self.slowest,(seconds,path,size))
+        elif seconds>self.slowest[0][0]:
+            heapq.heapreplace(self.slowest,(seconds,path,size))
+        if self.progress is not None:
+            self.progress.update(1,size)
+
+    def merge(self,other):
+        """ adds the metrics of another run (a RunMetrics.to_dict, e.g. from a worker process) """
+        if not other:
+            return
+        for name, stats in other["stages"].items():
+            self.stages.setdefault(name,StageStats()).merge(stats)
+        self.files+=other["files"]
+        self.bytes+=other["bytes"]
+        for slow in other["slowest"]:
+            entry = (slow["seconds"],slow["path"],slow["size"])
+            if len(self.slowest)<self.slowest_count:
+                heapq.heappush(self.slowest,entry)
+            elif entry[0]>self.slowest[0][0]:
+                heapq.heapreplace(self.slowest,entry)
+        if self.progress is not None:
+            self.progress.update(other["files"],other["bytes"])
+
+    def stop(self):
+        """ ends the run (wall time) and the progress line """
+        self.seconds = perf_counter()-self.start
+        if self.progress is not None:
+            self.progress.close()
+
+    def to_dict(self):
+        seconds = self.seconds if self.seconds is not None else perf_counter()-self.start
+        return {"seconds":seconds,"files":self.files,"bytes":self.bytes,
+            "files_per_second":self.files/seconds if seconds>0 else None,
+            "bytes_per_second":self.bytes/seconds if seconds>0 else None,
+            "stages":{name:stats.to_dict() for name, stats in sorted(self.stages.items(),key=lambda item:-item[1].total)},
+            "slowest":[{"path":path,"size":size,"seconds":s} for s, path, size in sorted(self.slowest,reverse=True)]}
+
+def get_metrics(metrics):
+    """ Returns NULL_METRICS for None/False, a new RunMetrics for True, else metrics """
+    if metrics is True:
+        return RunMetrics()
+    if not metrics:
+        return NULL_METRICS
+    return metrics
+
+def print_metrics(data,stream=None):
+    """ human readable stage table and slowest files of a RunMetrics.to_dict """
+    stream = stream or sys.stdout
+    stream.write(f"{data['files']} files, {data['bytes']/1e6:.1f} MB in {data['seconds']:.2f}s "
+        f"({data['files_per_second'] or 0:.0f} files/s, {(data['bytes_per_second'] or 0)/1e6:.1f} MB/s)\n")
+    stream.write(f"{'stage':12} {'calls':>8} {'total s':>9} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9}\n")
+    for name, stats in data["stages"].items():
+        stream.write(f"{name:12} {stats['count']:8} {stats['total']:9.3f} {(stats['mean'] or 0)*1000:9.3f} "
+            f"{(stats['p95'] or 0)*1000:9.3f} {stats['max']*1000:9.3f}\n")
+    if data["slowest"]:
+        stream.write("slowest files:\n")
+        for slow in data["slowest"]:
+            stream.write(f"  {slow['seconds']*1000:9.1f}ms {slow['size']:>12} bytes  {slow['path']}\n")
+
+class SamplingProfiler:
+    """ counts the functions on the stack of a thread every interval seconds """
+    def __init__(self,interval=0.005,thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or get_ident()
+        #function -> samples where it is running (self) / on the stack (cumulative)
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.samples = 0
+        self._stop = Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples+=1
+            self.own[self._name(frame)]+=1
+            seen = set()
+            while frame is not None:
+                name = self._name(frame)
+                if name not in seen:
+                    self.cumulative[name]+=1
+                    seen.add(name)
+                frame = frame.f_back
+
+    @staticmethod
+    def _name(frame):
+        code = frame.f_code
+        return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+    def enable(self):
+        self._thread = Thread(target=self._run,daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self,top=25):
+        lines = [f"{self.samples} samples every {self.interval*1000:.0f}ms","  own%   cum%  function"]
+        for name, count in self.cumulative.most_common(top):
+            lines.append(f"{100*self.own[name]/max(1,self.samples):6.1f} {100*count/max(1,self.samples):6.1f}  {name}")
+        return "\n".join(lines)
+
+class Profiler:
+    """ profiles the block of a with statement
+    Parameters:
+    -----------
+    mode: str
+        "cprofile" (deterministic, slower) or "sample" (statistical, low overhead)
+    output: str
+        file receiving the cProfile stats (pstats format) or the sampling report (None: printed only)
+    """
+    def __init__(self,mode="cprofile",output=None,top=25):
+        self.mode = mode
+        self.output = output
+        self.top = top
+        if mode=="cprofile":
+            import cProfile
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = SamplingProfiler()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self,*exc):
+        self.profiler.disable()
+        if self.mode=="cprofile":
+            stream = io.StringIO()
+            import pstats
+            pstats.Stats(self.profiler,stream=stream).sort_stats("cumulative").print_stats(self.top)
+            report = stream.getvalue()
+            if self.output:
+                self.profiler.dump_stats(self.output)
+        else:
+            report = self.profiler.report(self.top)
+            if self.output:
+                with open(self.output,"w",encoding="utf-8") as fo:
+                    fo.write(report)
+        print(report)
+        return False
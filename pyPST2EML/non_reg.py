@@ -1,7 +1,7 @@
 from os import rename
 from pathlib import Path
 
-from pst2eml import eml_get_parameters, rename_eml
+from pyPST2EML.pst2eml import eml_get_parameters, parse_sent_date, rename_eml
 
 def nonreg():
     tests = [{"name":"big5_subject",
@@ -52,7 +52,7 @@ def nonreg():
                 print(f"failed test {test_name} - wrong subject decoding")
                 print(f"{subject} vs should be {subj}")
         if "sent_date" in test:
-            sent = test["sent_date"]
+            sent = parse_sent_date(test["sent_date"])
             try:
                 assert sent == sent_date
             except:
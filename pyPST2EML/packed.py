@@ -0,0 +1,331 @@
+"""
+packed output: one compressed container per folder instead of one file per message
+
+millions of small .eml files mean millions of inodes, slow listings, backups and indexing. pack_folder
+writes the messages of each folder of an .eml tree into <output>/<folder>/messages.mbox.gz:
+* every message is a separate gzip member in mboxrd format (a "From " line, the lines starting with
+    ">*From " escaped with one more ">"), the container can be appended to and zcat gives a valid mbox
+* messages.idx.sqlite next to it is the offset index: name (as the renamed .eml would be called, see
+    pst2eml.new_eml_path), subject, sender, recipients, sent date, offset and length of the member and
+    size of the message
+
+PackReader lists and searches the index and reads any message by decompressing its member only,
+the message is given back byte for byte.
+
+Example:
+--------
+python -m pyPST2EML pack -f C:\\outlook\\archives\\eml\\2021Q1 -o C:\\outlook\\archives\\packed\\2021Q1
+python -m pyPST2EML unpack C:\\outlook\\archives\\packed\\2021Q1\\Inbox --name "budget.eml" -o C:\\temp
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from datetime import timezone
+from email.utils import parseaddr
+from io import BytesIO
+import logging
+import os
+from os.path import abspath, exists, join, relpath
+import re
+import sqlite3
+import sys
+import zlib
+
+# own modules
+from .pst2eml import load_eml, msg_get_parameters, new_eml_path, str2bool
+from .search_index import parse_date_filter
+
+CONTAINER_NAME = "messages.mbox.gz"
+INDEX_NAME = "messages.idx.sqlite"
+#compressed bytes read at once when decompressing a member
+READ_BYTES = 64*1024
+MBOXRD_FROM = re.compile(rb"^>*From ")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    name TEXT PRIMARY KEY,
+    original_name TEXT,
+    subject TEXT,
+    sent_from TEXT,
+    send_to TEXT,
+    sent_date TEXT,
+    sent_ts INTEGER,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_sent_ts ON messages (sent_ts);
+CREATE INDEX IF NOT EXISTS messages_sent_from ON messages (sent_from);
+"""
+
+COLUMNS = ["name","original_name","subject","sent_from","send_to","sent_date","sent_ts","offset","length","size"]
+
+def mboxrd_member(data,sent_from,sent_date,compresslevel=6):
+    """ gzip member of a message in mboxrd format """
+    address = parseaddr(str(sent_from or ""))[1] or "MAILER-DAEMON"
+    envelope = f"From {address.replace(' ','_')} {sent_date.astimezone(timezone.utc).strftime('%a %b %d %H:%M:%S %Y')}\n"
+    lines = data.split(b"\n")
+    escaped = b"\n".join([b">"+line if MBOXRD_FROM.match(line) else line for line in lines])
+    if not escaped.endswith(b"\n"):
+        escaped+= b"\n"
+    compressor = zlib.compressobj(compresslevel,zlib.DEFLATED,31)
+    return compressor.compress(envelope.encode("ascii")+escaped+b"\n")+compressor.flush()
+
+class PackWriter:
+    """ appends messages to the container and the index of a folder
+    Parameters:
+    -----------
+    folder: str
+        folder of the container (created if needed)
+    """
+    def __init__(self,folder,policy=None,compresslevel=6):
+        os.makedirs(folder,exist_ok=True)
+        self.folder = abspath(folder)
+        self.policy = policy
+        self.compresslevel = compresslevel
+        self.db = sqlite3.connect(join(folder,INDEX_NAME))
+        self.db.executescript(SCHEMA)
+        #file names already used (collisions are resolved as for the renamed files)
+        self.names = {name for (name,) in self.db.execute("SELECT name FROM messages")}
+        self.container = open(join(folder,CONTAINER_NAME),"ab")
+        #a member written before a crash but not indexed is skipped by the readers
+        self.offset = self.container.seek(0,os.SEEK_END)
+        self.rows = []
+        self.stats = {"messages":0,"bytes_in":0,"bytes_out":0}
+
+    def exists(self,fp):
+        return os.path.basename(fp) in self.names
+
+    def add(self,eml_fp,send_to,sent_from,subject,sent_date,ext=".eml"):
+        """ appends the file eml_fp, Returns the name of the message in the container """
+        name = os.path.basename(new_eml_path(self.folder,subject,ext,policy=self.policy,exists=self.exists))
+        self.names.add(name)
+        with open(eml_fp,"rb") as fi:
+            data = fi.read()
+        member = mboxrd_member(data,sent_from,sent_date,self.compresslevel)
+        self.container.write(member)
+        self.rows.append((name,os.path.basename(eml_fp),subject,str(sent_from or ""),str(send_to or ""),
+            sent_date.isoformat(),int(sent_date.timestamp()),self.offset,len(member),len(data)))
+        self.offset+= len(member)
+        self.stats["messages"]+=1
+        self.stats["bytes_in"]+=len(data)
+        self.stats["bytes_out"]+=len(member)
+        return name
+
+    def flush(self):
+        """ makes the appended messages durable then visible in the index """
+        self.container.flush()
+        os.fsync(self.container.fileno())
+        with self.db:
+            self.db.executemany(f"INSERT INTO messages ({', '.join(COLUMNS)}) VALUES ({', '.join('?'*len(COLUMNS))})",
+                self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.container.close()
+        self.db.close()
+
+class PackReader:
+    """ reads the messages of a folder container
+    Parameters:
+    -----------
+    folder: str
+        folder of the container and of its index
+    """
+    def __init__(self,folder):
+        self.folder = folder
+        self.db = sqlite3.connect(join(folder,INDEX_NAME))
+        self.db.row_factory = sqlite3.Row
+        self.container = open(join(folder,CONTAINER_NAME),"rb")
+
+    def entries(self,subject=None,sender=None,after=None,before=None):
+        """ index entries (in the container order) matching the filters
+        Parameters:
+        -----------
+        subject, sender: str
+            part of the subject / sender (case insensitive)
+        after, before: datetime
+            sent on or after / before
+        """
+        where = []
+        values = []
+        if subject:
+            where.append("subject LIKE ?")
+            values.append(f"%{subject}%")
+        if sender:
+            where.append("sent_from LIKE ?")
+            values.append(f"%{sender}%")
+        if after is not None:
+            where.append("sent_ts>=?")
+            values.append(int(after.timestamp()))
+        if before is not None:
+            where.append("sent_ts<?")
+            values.append(int(before.timestamp()))
+        query = "SELECT * FROM messages"+(" WHERE "+" AND ".join(where) if where else "")+" ORDER BY offset"
+        return [dict(row) for row in self.db.execute(query,values)]
+
+    def entry(self,name):
+        row = self.db.execute("SELECT * FROM messages WHERE name=?",(name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return dict(row)
+
+    def _lines(self,entry):
+        """ decompressed lines of the member of entry """
+        self.container.seek(entry["offset"])
+        remaining = entry["length"]
+        decompressor = zlib.decompressobj(31)
+        tail = b""
+        while remaining>0 and not decompressor.eof:
+            chunk = self.container.read(min(READ_BYTES,remaining))
+            if not chunk:
+                raise ValueError(f"truncated container {self.folder}: {entry['name']}")
+            remaining-= len(chunk)
+            lines = (tail+decompressor.decompress(chunk)).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                yield line+b"\n"
+        if tail:
+            yield tail
+
+    def write(self,entry,fo):
+        """ writes the message of entry (dict or name) into fo (binary file object), byte for byte """
+        if isinstance(entry,str):
+            entry = self.entry(entry)
+        remaining = entry["size"]
+        lines = self._lines(entry)
+        #envelope "From " line
+        next(lines)
+        for line in lines:
+            if remaining<=0:
+                break
+            if MBOXRD_FROM.match(line):
+                line = line[1:]
+            line = line[:remaining]
+            fo.write(line)
+            remaining-= len(line)
+
+    def read(self,entry):
+        """ Returns the message of entry (dict or name) as bytes """
+        buffer = BytesIO()
+        self.write(entry,buffer)
+        return buffer.getvalue()
+
+    def __iter__(self):
+        """ yields (entry, message bytes) in the container order, one message in memory at a time """
+        for entry in self.entries():
+            yield entry, self.read(entry)
+
+    def close(self):
+        self.container.close()
+        self.db.close()
+
+def is_pack_file(fn):
+    return fn==CONTAINER_NAME or fn.startswith(INDEX_NAME)
+
+def pack_folder(eml_folder,output,ignore_ext=False,remove=False,policy=None,compresslevel=6):
+    """ packs every folder of an .eml/.ics tree into a container of the same folder of output
+    Parameters:
+    -----------
+    eml_folder: str
+        tree of .eml/.ics files (e.g. readpst output)
+    output: str
+        root of the containers (can be eml_folder itself)
+    remove: bool
+        delete each file once its container is flushed
+    Returns:
+    --------
+    summary: dict
+        number of folders, messages packed and skipped, bytes read and written
+    """
+    summary = {"folders":0,"packed":0,"skipped":0,"bytes_in":0,"bytes_out":0}
+    for root, directories, files in os.walk(eml_folder):
+        directories.sort()
+        targets = [fn for fn in files if (fn.find(".eml")>=0 or fn.find(".ics")>=0 or ignore_ext) and not is_pack_file(fn)]
+        if not targets:
+            continue
+        writer = PackWriter(join(output,relpath(root,eml_folder)),policy,compresslevel)
+        packed = []
+        try:
+            for fn in targets:
+                eml_fp = abspath(join(root,fn))
+                try:
+                    msg, msg_strings = load_eml(eml_fp,headers_only=True)
+                    send_to, sent_from, subject, sent_date = msg_get_parameters(msg,msg_strings,eml_fp)
+                except Exception:
+                    log_msg = "not packed, cannot read the headers of: %s"%eml_fp
+                    logging.error(log_msg)
+                    summary["skipped"]+=1
+                    continue
+                ext = ".eml" if ignore_ext else os.path.splitext(fn)[1]
+                writer.add(eml_fp,send_to,sent_from,subject,sent_date,ext)
+                packed.append(eml_fp)
+        finally:
+            writer.close()
+        summary["folders"]+=1
+        summary["packed"]+=writer.stats["messages"]
+        summary["bytes_in"]+=writer.stats["bytes_in"]
+        summary["bytes_out"]+=writer.stats["bytes_out"]
+        if remove:
+            for eml_fp in packed:
+                os.unlink(eml_fp)
+    return summary
+
+def pack_cli(argv=None):
+    """ pack subcommand: python -m pyPST2EML pack -f <eml folder> -o <output> [--remove Y] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML pack",
+        description='write each folder of .eml/.ics files as one compressed container with an offset index')
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True)
+    parser.add_argument("--output","-o",dest="output",type=str,default=None,help="root of the containers (default: --folder)")
+    parser.add_argument("--remove",dest="remove",type=str2bool,default="N",help="delete the packed files (default: N)")
+    parser.add_argument("--level",dest="level",type=int,default=6,help="gzip compression level (default: 6)")
+    parser.add_argument("--names",dest="policy",type=str,default=None,choices=["windows","linux"])
+    args = parser.parse_args(argv)
+    summary = pack_folder(args.folder,args.output or args.folder,remove=args.remove,policy=args.policy,
+        compresslevel=args.level)
+    ratio = summary["bytes_out"]/summary["bytes_in"] if summary["bytes_in"] else 0
+    print(f"packed {summary['packed']} messages ({summary['skipped']} skipped) of {summary['folders']} folders: "
+        f"{summary['bytes_in']/1e6:.1f} MB -> {summary['bytes_out']/1e6:.1f} MB ({ratio:.0%})")
+    return 1 if summary["skipped"] else 0
+
+def unpack_cli(argv=None):
+    """ unpack subcommand: python -m pyPST2EML unpack <container folder> [--name] [--subject] [--sender] [-o] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML unpack",
+        description='list or extract messages of a container written by pack')
+    parser.add_argument("folder",type=str,help="folder of the container")
+    parser.add_argument("--name","-n",dest="name",type=str,default=None,help="message name (see --list)")
+    parser.add_argument("--subject",dest="subject",type=str,default=None)
+    parser.add_argument("--sender","-s",dest="sender",type=str,default=None)
+    parser.add_argument("--after",dest="after",type=str,default=None)
+    parser.add_argument("--before",dest="before",type=str,default=None)
+    parser.add_argument("--list","-l",dest="list",action="store_true",help="only list the matching messages")
+    parser.add_argument("--output","-o",dest="output",type=str,default=None,
+                    help="folder receiving the messages (default: the message is written on the standard output)")
+    args = parser.parse_args(argv)
+    if not exists(join(args.folder,INDEX_NAME)):
+        print(f"no container in {args.folder}")
+        return 1
+    reader = PackReader(args.folder)
+    try:
+        if args.name:
+            entries = [reader.entry(args.name)]
+        else:
+            entries = reader.entries(args.subject,args.sender,parse_date_filter(args.after),
+                parse_date_filter(args.before))
+        if args.list:
+            for entry in entries:
+                print(f"{entry['sent_date']:25} {entry['sent_from'][:30]:30} {entry['name']}")
+            return 0
+        if args.output is None:
+            for entry in entries:
+                reader.write(entry,sys.stdout.buffer)
+            return 0
+        os.makedirs(args.output,exist_ok=True)
+        for entry in entries:
+            with open(join(args.output,entry["name"]),"wb") as fo:
+                reader.write(entry,fo)
+        print(f"{len(entries)} messages written in {args.output}")
+    finally:
+        reader.close()
+    return 0
@@ -0,0 +1,249 @@
+"""
+overlapped extraction and post-processing of a .pst
+
+readpst is started in the background and the output tree is polled: each .eml/.ics file is renamed
+and gets its attributes (see pst2eml.process_eml_folder) as soon as readpst is done writing it, so the
+wall time is about max(extraction, post-processing) instead of their sum
+
+a file is considered complete when its size and mtime did not change between two polls and it was
+not modified for settle seconds, or when readpst exited. Files are renamed in place so the disk usage
+is the same as with the two separate steps. The names a file was renamed from are free again: a new
+file written with that name later is processed too. A message whose subject would give it a name
+readpst may still write (N.eml, see extractor_name) is held back and renamed once readpst exited.
+
+only the folders whose mtime changed (a file was added or renamed) and the files still pending are
+looked at on each poll
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import logging
+import os
+from os.path import join
+import re
+from subprocess import Popen
+from time import sleep, time
+
+# own modules
+from .attachments import is_store_folder
+from .layout import is_buckets_folder, is_layout_file
+from .manifest import Manifest, file_key, is_manifest_file
+from .metadata import is_sidecar_file
+from .quarantine import get_error_policy, is_quarantine_folder
+from .search_index import SearchIndex, is_index_file
+from .pst2eml import merge_summaries, process_eml_folder
+from .work_folder import is_work_folder
+
+#stem of the files written by readpst: 1.eml, 2.eml, ...
+EXTRACTOR_NAME = re.compile(r"^[0-9]+$")
+
+def extractor_name(subject):
+    """ True if a message renamed after subject could take the name of a file the extractor did not write yet """
+    return EXTRACTOR_NAME.match(subject.strip()) is not None
+
+class OutputTreeWatcher:
+    """ finds the completed files of a folder tree being written by an extractor
+    Parameters:
+    -----------
+    root: str
+        output folder of the extractor
+    settle: float
+        seconds without modification before a stable file is considered complete
+    """
+    def __init__(self,root,settle=1.0):
+        self.root = root
+        self.settle = settle
+        #folder -> mtime_ns at the last scan
+        self.folders = {}
+        #folder -> sub folders at the last scan
+        self.subfolders = {}
+        #file path -> (size, mtime_ns) of the files not yet returned
+        self.pending = {}
+        #folder -> {name: file_key} of the files returned or produced by the post-processing, not returned
+        #again unless they are removed or changed (see add)
+        self.done = {}
+
+    def ignored(self,name,is_dir=False):
+        """ True for the files and folders written by the post-processing itself """
+        if is_dir:
+            return is_store_folder(name) or is_work_folder(name) or is_quarantine_folder(name) or is_buckets_folder(name)
+        return is_manifest_file(name) or is_sidecar_file(name) or is_index_file(name) or is_layout_file(name)
+
+    def add(self,fp,st=None):
+        """ adds a file to the pending ones unless it is pending or was returned, a returned file is added
+        again if st (its os.stat) shows that it was replaced or modified since
+        Returns:
+        --------
+        added: bool
+        """
+        if fp in self.pending:
+            return False
+        folder, fn = os.path.split(fp)
+        done = self.done.get(folder)
+        if done is not None and fn in done:
+            if st is None or file_key(st)==done[fn]:
+                return False
+            del done[fn]
+        #first seen: never complete on this poll
+        self.pending[fp] = None
+        return True
+
+    def forget(self,fp):
+        """ the file was removed or renamed: a new file with its name is a new file """
+        folder, fn = os.path.split(fp)
+        self.done.get(folder,{}).pop(fn,None)
+
+    def processed(self,folder,records):
+        """ records the files renamed by the post-processing of folder (see process_eml_folder), their
+        original names are free again """
+        done = self.done.setdefault(folder,{})
+        for record in records:
+            if record["original_name"]!=record["name"]:
+                done.pop(record["original_name"],None)
+            #files moved into a sub folder (see layout) are not watched
+            if os.path.dirname(record["name"])=="":
+                done[record["name"]] = (record["size"],record["mtime_ns"],record["inode"])
+
+    def _scan(self,folder):
+        try:
+            st = os.stat(folder)
+        except FileNotFoundError:
+            return
+        if self.folders.get(folder)!=st.st_mtime_ns:
+            self.folders[folder] = st.st_mtime_ns
+            subfolders = []
+            names = set()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    is_dir = entry.is_dir()
+                    if self.ignored(entry.name,is_dir):
+                        continue
+                    if is_dir:
+                        subfolders.append(entry.path)
+                    else:
+                        names.add(entry.name)
+                        self.add(entry.path)
+            self.subfolders[folder] = subfolders
+            done = self.done.get(folder)
+            if done:
+                for fn in [fn for fn in done if fn not in names]:
+                    del done[fn]
+        for subfolder in self.subfolders.get(folder,[]):
+            self._scan(subfolder)
+
+    def completed(self,finished=False,scan=True):
+        """ Returns dict folder -> sorted list of the file names completed since the previous call
+        Parameters:
+        -----------
+        finished: bool
+            the extractor exited, every pending file is complete
+        scan: bool
+            look for new files in the tree first (False: the new files were given with add)
+        """
+        if scan:
+            self._scan(self.root)
+        now = time()
+        ready = {}
+        for fp, previous in list(self.pending.items()):
+            try:
+                st = os.stat(fp)
+            except FileNotFoundError:
+                del self.pending[fp]
+                continue
+            key = (st.st_size,st.st_mtime_ns)
+            if finished or (key==previous and now-st.st_mtime>=self.settle):
+                del self.pending[fp]
+                folder, fn = os.path.split(fp)
+                self.done.setdefault(folder,{})[fn] = file_key(st)
+                ready.setdefault(folder,[]).append(fn)
+            else:
+                self.pending[fp] = key
+        for folder in ready:
+            ready[folder].sort()
+        return ready
+
+def extract_and_process(command,EML_folder,ignore_ext=False,headers_only=False,manifest=False,poll=0.5,settle=1.0,policy=None,metadata=None,index=False,errors=None):
+    """ runs the extractor command and post-processes its output files while it runs
+    Parameters:
+    -----------
+    command: list
+        extractor command line (readpst writing into EML_folder)
+    EML_folder: str
+        output folder of the extractor
+    poll: float
+        seconds between two looks at the output tree
+    settle: float
+        see OutputTreeWatcher
+    policy: str
+        file name length limits, see filename_policy.get_policy
+    metadata: str
+        metadata backend, see metadata.get_writer
+    index: bool
+        build the full-text search index (see search_index) of EML_folder
+    errors: ErrorPolicy, str or dict
+        see make_eml_search_friendly, the files which fail are quarantined or skipped while the extractor runs
+        (it is stopped once over the error budgets), None: the first failure stops the run
+    Returns:
+    --------
+    summary: dict
+        as for make_eml_search_friendly with the extractor return code and the extraction and total times
+    """
+    watcher = OutputTreeWatcher(EML_folder,settle)
+    run_manifest = Manifest(EML_folder) if manifest else None
+    search_index = SearchIndex(EML_folder) if index else None
+    error_policy = get_error_policy(errors,EML_folder)
+    summaries = []
+    folders = set()
+    #folder -> files held back until the extractor exited (see extractor_name)
+    held = {}
+
+    def process_folder(folder,files,hold):
+        summary = process_eml_folder(folder,files,ignore_ext,headers_only,known={},policy=policy,metadata=metadata,index=index,
+            errors=error_policy,hold=hold)
+        records = summary.pop("records")
+        #renamed files show up as new entries of the folder
+        watcher.processed(folder,records)
+        if run_manifest is not None:
+            run_manifest.record(folder,records)
+        if search_index is not None:
+            search_index.add(folder,summary.pop("documents"))
+        held_files = summary.pop("held",[])
+        if held_files:
+            held.setdefault(folder,[]).extend(held_files)
+        summaries.append(summary)
+        folders.add(folder)
+
+    start = time()
+    process = Popen(command)
+    extract_time = None
+    try:
+        while True:
+            returncode = process.poll()
+            finished = returncode is not None
+            if finished and extract_time is None:
+                extract_time = time()-start
+                logging.info(f"extractor finished in {extract_time:.1f}s with return code {returncode}")
+            for folder, files in watcher.completed(finished).items():
+                process_folder(folder,files,None if finished else extractor_name)
+            if finished and not watcher.pending:
+                break
+            sleep(poll)
+        for folder, files in held.items():
+            process_folder(folder,sorted(files),None)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        if run_manifest is not None:
+            run_manifest.close()
+        if search_index is not None:
+            search_index.close()
+        if error_policy is not None:
+            error_policy.save_report()
+    summary = merge_summaries(summaries)
+    if error_policy is not None:
+        summary["errors"] = error_policy.report()
+    summary["folders"] = len(folders)
+    summary["returncode"] = returncode
+    summary["extract_time"] = extract_time
+    summary["total_time"] = time()-start
+    logging.info(f"pipeline: extraction {extract_time:.1f}s, total {summary['total_time']:.1f}s")
+    return summary
@@ -24,35 +24,83 @@ python .\src\pst2eml.py --folder=C:\outlook\archives\eml\2020_Q1_Q3 -v=4"
 
 """ PYTHON STANDARD LIBRARY """
 import argparse
+from datetime import timezone
 import email
-from email.header import decode_header
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import io
 import logging
 import os
-from os.path import abspath,  basename, dirname, exists, join, pardir, splitext
+from os.path import abspath,  basename, dirname, exists, join, pardir, relpath, splitext
 from pathlib import Path
+from shutil import which
 from quopri import decodestring
+import re
 from subprocess import call
-from time import mktime, sleep, strptime
-
-""" REQUIRED INSTALLS """
-from dateutil.parser import parse as dateutil_parse
-
-try:
-    import win32file
-    import win32con
-    from win32com import storagecon
-    import pywintypes
-    import pythoncom
-except:
-    print("you might need to install pywin32")
-    print(">python -m pip install pywin32")
-    print("if this was not enough you might need to run")
-    print("python -m pip install --upgrade pywin32==225")
-    print("then")
-    print("python venv\Scripts\pywin32_postinstall.py -install")
-    raise
-
-stop_error = False
+from time import perf_counter
+
+# own modules
+from .attachments import AttachmentStore, is_store_folder, merge_stats
+from .catalog import Catalog, MessageRecord, is_catalog_file
+from .filename_policy import clean_subject, decode_subject, get_policy
+from .ical import read_ics
+from .layout import FolderBuckets, get_layout, is_buckets_folder, is_layout_file
+from .manifest import Manifest, file_key, is_manifest_file
+from .metadata import get_writer, is_sidecar_file
+from .metrics import Progress, get_metrics
+from .quarantine import ErrorBudgetExceeded, HeaderError, StageError, get_error_policy, is_quarantine_folder, restore_quarantined
+from .search_index import SearchIndex, is_index_file, message_text
+from .work_folder import is_work_folder
+
+#header-only mode: largest header block read before giving up on finding its end
+HEADER_MAX_BYTES = 1024*1024
+#header-only mode: bytes read past the header block for the To/Subject/filename=/SUMMARY fallbacks
+FALLBACK_SCAN_BYTES = 64*1024
+
+def read_header_block(eml_fp,encoding="latin-1",max_header=HEADER_MAX_BYTES,fallback_scan=FALLBACK_SCAN_BYTES):
+    """ reads only the header block of the file (single pass, bytes) without parsing the MIME body
+    Parameters:
+    -----------
+    eml_fp: str
+        full path to the .eml or .ics file
+    encoding: str
+        encoding used to decode the header lines (latin-1 for .eml, utf-8 for .ics)
+    max_header: int
+        maximum number of bytes read while looking for the blank line ending the header block
+    fallback_scan: int
+        number of bytes read after the header block for the line based fallbacks
+    Returns:
+    --------
+    msg: email.message.Message
+        message built from the header block only (empty body)
+    msg_strings: list
+        decoded lines of the header block and of the bounded fallback region
+    """
+    header = []
+    extra = []
+    read = 0
+    with open(eml_fp,"rb") as fi:
+        while read<max_header:
+            line = fi.readline(max_header-read)
+            if not line:
+                break
+            header.append(line)
+            read += len(line)
+            if line in (b"\n",b"\r\n"):
+                break
+        scanned = 0
+        while scanned<fallback_scan:
+            line = fi.readline(fallback_scan-scanned)
+            if not line:
+                break
+            extra.append(line)
+            scanned += len(line)
+    #newline=None gives the same line splitting as a file opened in text mode
+    header_text = io.StringIO(b"".join(header).decode(encoding,"replace"),newline=None).read()
+    extra_text = io.StringIO(b"".join(extra).decode(encoding,"replace"),newline=None).read()
+    msg = email.message_from_string(header_text)
+    msg_strings = io.StringIO(header_text+extra_text).readlines()
+    return msg, msg_strings
 
 def scan_email_property(msg_strings,prop_vals):
     result = ""
@@ -68,6 +116,8 @@ def scan_email_property(msg_strings,prop_vals):
 def scan_email_receive_header(msg_strings):
     dows = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
     result = ""
+    if len(msg_strings)<2:
+        return result
     second_line = msg_strings[1]
     for dow in dows:
         if second_line.find(dow)>=0:
@@ -103,52 +153,103 @@ def get_sentdate(msg_strings,msg,eml_fp,debug):
     if SentDate  == "" or SentDate is None:
         logmsg = "Cannot get SENT DATE: field from :%s"%(eml_fp)
         logging.error(logmsg)
-        raise Exception("HeaderError",logmsg)
+        raise HeaderError("missing date",logmsg)
 
     SentDate = SentDate.replace("\n","")
     SentDate = SentDate.replace("\r","")
     SentDate = SentDate.lstrip()
     SentDate = SentDate.rstrip()
 
-    #handle string formatting not handled by dateutil_parse
-    for tz in [" W. Europe Standard Time"," (GMT)", ' "GMT"']:
-        if SentDate.find(tz)>=0:
-            SentDate = SentDate.replace(tz,"")
-    #handle DOW not handled by dateutil_parse
-    weird_dow = {"Wen":"Wed"}
-    for dow in weird_dow:
-        if SentDate.find(dow)>=0:
-            SentDate=SentDate.replace(dow,weird_dow[dow])
-            
     if debug:
-        print("SentDate before dateutil_parse",SentDate)
+        print("SentDate before parse_sent_date",SentDate)
     try:
-        emailtime = dateutil_parse(SentDate)
+        emailtime = parse_sent_date(SentDate)
         if debug:
-            print("\t\temailtime parsed by dateutil_parse",emailtime)
+            print("\t\temailtime parsed by parse_sent_date",emailtime)
     except:
-        logmsg = "Cannot get SENT DATE: field from :%s"%(eml_fp)
+        logmsg = "Cannot parse SENT DATE: %s from :%s"%(SentDate,eml_fp)
         logging.error(logmsg)
-        raise Exception("HeaderError",msg)
+        raise HeaderError("invalid date",logmsg)
         
-    return SentDate
+    return emailtime
+
+#strict RFC 2822 date ("Fri, 24 Aug 2001 09:53:36 +0100" with optional day of week, seconds and comment)
+RFC2822_DATE = re.compile(r"(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), )?\d{1,2} "
+    r"(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) \d{4} \d{2}:\d{2}(?::\d{2})? [+-]\d{4}(?: \([^()]*\))?")
+
+#formatting not handled by dateutil_parse, removed (timezone names) or replaced (day of week)
+DATE_REPLACEMENTS = [(" W. Europe Standard Time",""),(" (GMT)",""),(' "GMT"',""),("Wen","Wed")]
 
-def eml_get_parameters(eml_fp,debug=False):
+def parse_sent_date(sent_date):
+    """ parses the date of a message (Date: header, DTSTART, ...) into a timezone aware datetime
+    strict RFC 2822 dates go through email.utils, the other formats through the tolerant dateutil parser
+    (see parse_date_tolerant), dates without timezone are in local time
+    Parameters:
+    -----------
+    sent_date: str
+        date string stripped of surrounding spaces and new lines
+    Returns:
+    --------
+    emailtime: datetime
+        timezone aware date
+    """
+    if RFC2822_DATE.fullmatch(sent_date):
+        emailtime = parsedate_to_datetime(sent_date)
+        if emailtime.tzinfo is None:
+            #-0000: UTC time without information on the local time zone
+            emailtime = emailtime.replace(tzinfo=timezone.utc)
+        return emailtime
+    return parse_date_tolerant(sent_date)
+
+@lru_cache(maxsize=4096)
+def parse_date_tolerant(sent_date):
+    """ dateutil_parse after removing the formatting it does not handle, the results are cached as the same
+    odd formats come back often within an archive (meeting invites, same sender client)
+    """
+    #REQUIRED INSTALL loaded on the first date email.utils cannot parse (faster startup)
+    from dateutil.parser import parse as dateutil_parse
+    for old, new in DATE_REPLACEMENTS:
+        if sent_date.find(old)>=0:
+            sent_date = sent_date.replace(old,new)
+    emailtime = dateutil_parse(sent_date)
+    if emailtime.tzinfo is None:
+        emailtime = emailtime.astimezone()
+    return emailtime
+
+def eml_get_parameters(eml_fp,debug=False,headers_only=False):
     """ Gets the Params from the email stored as text file on HDD
     Parameters:
     -----------
     eml_fp: str
         full path to the .eml file
+    headers_only: bool
+        if True reads the file once and stops after the header block (see read_header_block),
+        the memory used is bounded by the header size instead of the file size
     Returns: 
     --------
     send_to: str
     from_sender: str
     title: str
-    sent_date : str
+    sent_date : datetime
+        timezone aware (see parse_sent_date)
     """
-    SendTo = ""
+    msg, msg_strings = load_eml(eml_fp,headers_only)
+    return msg_get_parameters(msg,msg_strings,eml_fp,debug)
+
+def load_eml(eml_fp,headers_only=False):
+    """ Returns the parsed message (or header block) and its lines, see eml_get_parameters """
     try:
         if eml_fp.find(".ics")>=0:
+            #single pass over the first event, None if the file is not an iCalendar object
+            loaded = read_ics(eml_fp,headers_only)
+            if loaded is not None:
+                return loaded
+        if headers_only:
+            if eml_fp.find(".ics")>=0:
+                msg, msg_strings = read_header_block(eml_fp,encoding="utf-8")
+            else:
+                msg, msg_strings = read_header_block(eml_fp,encoding="latin-1")
+        elif eml_fp.find(".ics")>=0:
             msg = email.message_from_file(open(eml_fp,encoding="utf-8"))
             msg_file = open(eml_fp,'r',encoding="utf-8")
             msg_strings = msg_file.readlines()
@@ -162,7 +263,25 @@ def eml_get_parameters(eml_fp,debug=False):
         log_msg = "failed loading email : %s"%(eml_fp)
         logging.error(log_msg)
         raise
+    return msg, msg_strings
 
+def msg_get_parameters(msg,msg_strings,eml_fp,debug=False,metrics=None):
+    """ Gets the Params from a loaded message (see eml_get_parameters)
+    Parameters:
+    -----------
+    msg: email.message.Message
+        parsed message (or header block)
+    msg_strings: list
+        lines of the message used by the fallbacks when a header is missing
+    eml_fp: str
+        full path to the file (used for logging and to detect .ics files)
+    metrics: RunMetrics
+        times the "subject" and "date" stages (None: not timed), see metrics
+    Returns:
+    --------
+    send_to, from_sender, title, sent_date as for eml_get_parameters
+    """
+    SendTo = ""
     try:
         SendTo = msg.get("TO")
     except:	
@@ -182,6 +301,7 @@ def eml_get_parameters(eml_fp,debug=False):
 
     ######## FROM
 
+    From = ""
     try:
         From = msg.get("FROM")
     except:		
@@ -191,7 +311,7 @@ def eml_get_parameters(eml_fp,debug=False):
         if From == "":
             log_msg = "Cannot get FROM: field from :%s"%(eml_fp)
             logging.error(log_msg)
-            raise Exception("HeaderError",log_msg)
+            raise HeaderError("missing sender",log_msg)
     ######## SUBJECT 
     """ Gets the Subject topic """
     Subject = None
@@ -233,60 +353,37 @@ def eml_get_parameters(eml_fp,debug=False):
         logging.warning(LogMessage)
         Subject="No Subject"
 
-    default_charset = 'UTF-8'
-    default_charset = 'latin-1'
-    subject_lines = decode_header(Subject)
-    #https://docs.python.org/3/library/stdtypes.html#str
-    #class str(object=b'', encoding='utf-8', errors='strict')
-    try:
-        subject = ""
-        for subject_string, subject_encoding in subject_lines:
-            if not subject_encoding:
-                #when encoding is None, just append the fragment
-                if type(subject_string)==bytes:
-                    subject+=str(subject_string,default_charset)
-                else:
-                    subject+= subject_string
-            else:
-                #TL;DR: japanese encoding in outlook is a mess
-                if subject_encoding.upper() in ["ISO-2022-JP","ISO-2022-JP-1", "ISO-2022-JP-2",\
-                    "ISO-2022-JP-3", "ISO-2022-JP-2004", "CP932","WINDOWS-31J",
-                    "ShiftJIS","CP942","SJIS","UCS2","SHIFT_JISX0213","SHIFT_JISX0208"]:
-                    subject_encoding = "CP932"
-                res = subject_string.decode(subject_encoding,"ignore")
-                subject+= res
-    except:
-        log_msg = "failed to extract subject for : %s"%(eml_fp)
-        logging.error(log_msg)
-        raise
-
-    try:
-        subject = subject.replace("\n"," ").replace("\t"," ").replace("FW: ","").replace("RE: ","").replace(":"," ").replace("/","-").replace("\\","-").replace("*","-").replace("?","-").replace("\"","'").replace("<","-").replace(">","-").replace("|","-").replace("\n"," ")
-        #frequent encoding errors
-        subject = subject.replace("Ã©","é")
-    except TypeError:
-        log_msg = "Type Error for: %s"%(eml_fp)
-        logging.error(log_msg)
-        raise
+    metrics = get_metrics(metrics)
+    with metrics.stage("subject"):
+        try:
+            subject = decode_subject(Subject)
+        except:
+            log_msg = "failed to extract subject for : %s"%(eml_fp)
+            logging.error(log_msg)
+            raise
 
-    #remove characters from 1 to 31
-    #source https://docs.microsoft.com/en-us/windows/win32/fileio/naming-a-file
-    subject = "".join([c for c in subject if ord(c)>31])
-    if len(subject)==0:
-        subject="NoSubject"
+        try:
+            subject = clean_subject(subject)
+        except TypeError:
+            log_msg = "Type Error for: %s"%(eml_fp)
+            logging.error(log_msg)
+            raise
 
 
     ######## SENT DATE
-    SentDate = get_sentdate(msg_strings,msg,eml_fp,debug)
+    with metrics.stage("date"):
+        SentDate = get_sentdate(msg_strings,msg,eml_fp,debug)
 
 
     #sent_to,from_sender, title, sent_date
     return SendTo, From, subject, SentDate
 
-def incrementalfilename(path,fn):
+def incrementalfilename(path,fn,exists=None):
     """ create a new filename to avoid duplicates
     Parameters:
     -----------
+    exists: function
+        full path -> True if a file exists there (default: os.path.isfile)
     Return:
     -------
     new_fn: str
@@ -298,20 +395,16 @@ def incrementalfilename(path,fn):
     fne = fn.split(".")[-1]
     #idea is we keep incrementing until a first value for which 
     #no existing file with same name in folder can be found
-    final =0
-    for i in range(1,1024):
-        if final==0:		
-            #print path+fnb
-            new_fn = fnb+'['+str(i)+'].'+fne
-            new_fp = abspath(join(path, new_fn))
-            if not(os.path.isfile(new_fp)):
-                final = i
-                break
+    #no upper bound: a fixed one (1023) made the next files all renamed to name[0], replacing each other
+    exists = exists or os.path.isfile
+    final = 1
+    while exists(abspath(join(path,fnb+'['+str(final)+'].'+fne))):
+        final+=1
     #new_fn is filename + [1] + . eml
     new_fn = fnb+'['+str(final)+'].'+fne
     return new_fn
 
-def rename_eml(eml_fp,subject,ignore_ext = True, debug=False):
+def rename_eml(eml_fp,subject,ignore_ext = True, debug=False, policy=None, folder=None):
     """ rename the file on the HDD
     Parameters:
     -----------
@@ -319,115 +412,158 @@ def rename_eml(eml_fp,subject,ignore_ext = True, debug=False):
         current full path to file
     subject: str
         subject of email and future file name
+    policy: str
+        file name length limits, see filename_policy.get_policy
+    folder: str
+        destination folder (default: folder of the file), see layout
     Returns:
     --------
     new_eml_fp: str
         full path (folder and filename with extension)
     """
-    folder_path = dirname(eml_fp)
+    folder_path = folder or dirname(eml_fp)
     fp_ext = Path(eml_fp).suffix
     if ignore_ext:
         fp_ext = ".eml"
 
+    while True:
+        new_eml_fp = new_eml_path(folder_path,subject,fp_ext,debug,policy)
+        try:
+            rename_no_replace(eml_fp,new_eml_fp)
+        except FileExistsError:
+            if not os.path.isfile(new_eml_fp):
+                raise
+            #written since the probe (e.g. by a worker processing the same folder, see distributed): next name
+            LogMessage = "%s appeared while renaming %s"%(new_eml_fp,eml_fp)
+            logging.warning(LogMessage)
+            continue
+        except:
+            LogMessage = "cannot rename file: %s - %s"%(eml_fp,new_eml_fp)
+            logging.error(LogMessage)
+            raise
+        return new_eml_fp
+
+def rename_no_replace(src,dst):
+    """ os.rename raising FileExistsError instead of replacing an existing dst
+    (hard link then unlink, where hard links are not supported: existence check then rename)
+    """
+    if os.name=="nt":
+        #never replaces on windows
+        os.rename(src,dst)
+        return
+    try:
+        os.link(src,dst)
+    except FileExistsError:
+        if os.path.samefile(src,dst):
+            #change of case only on a case insensitive file system
+            os.rename(src,dst)
+            return
+        raise
+    except OSError:
+        if exists(dst):
+            raise FileExistsError(f"cannot rename {src}: {dst} exists")
+        os.rename(src,dst)
+        return
+    os.unlink(src)
+
+def new_eml_path(folder_path,subject,fp_ext,debug=False,policy=None,exists=None,incremental=None):
+    """ full path for a file named after the subject in folder_path, shortened for the file name
+    policy limits and incremented (see incrementalfilename) if the name already exists
+    Parameters:
+    -----------
+    folder_path: str
+        folder of the file
+    subject: str
+        subject of email and future file name
+    fp_ext: str
+        file extension (with the dot)
+    policy: str
+        file name length limits, see filename_policy.get_policy
+    exists: function
+        full path -> True if a file exists there (default: os.path.isfile), see rename_plan.NameIndex
+    incremental: function
+        (folder_path, file name) -> incremented file name (default: incrementalfilename with exists)
+    Returns:
+    --------
+    new_eml_fp: str
+        full path (folder and filename with extension)
+    """
+    exists = exists or os.path.isfile
     new_eml_fp = abspath(join(folder_path,subject+fp_ext))
-    log_msg = f"315 subject: -{subject}-, extension -{fp_ext}-,\n\t\t fp -{new_eml_fp}-"
+    log_msg = f"new path for subject: -{subject}-, extension -{fp_ext}-,\n\t\t fp -{new_eml_fp}-"
     if debug:
         print(log_msg)
     logging.debug(log_msg)
-    #windows seems to still have issues renaming when full path length >260
-    #https://docs.microsoft.com/en-us/windows/win32/fileio/naming-a-file#maximum-path-length-limitation
-    if len(new_eml_fp)>260:
-        subject = subject[:256-len(folder_path)]
+    policy = get_policy(policy)
+    fitted = policy.fit(folder_path,subject,fp_ext)
+    if fitted!=subject:
+        subject = fitted
         new_eml_fp = abspath(join(folder_path,subject+fp_ext))
-    if os.path.isfile(new_eml_fp):
+    if exists(new_eml_fp):
         #check if the file name already exists and create a new one
-        new_filename = incrementalfilename(folder_path,subject+fp_ext)
+        while True:
+            if incremental is not None:
+                new_filename = incremental(folder_path,subject+fp_ext)
+            else:
+                new_filename = incrementalfilename(folder_path,subject+fp_ext,exists)
+            #the [n] suffix can make a name at the limits too long: shortened by its size and incremented again
+            fitted = policy.fit(folder_path,subject,fp_ext,len(new_filename)-len(subject+fp_ext))
+            if fitted==subject:
+                break
+            subject = fitted
         new_eml_fp = abspath(join(folder_path,new_filename))
     if debug:
         print(f"new_eml_fp {new_eml_fp}")
-    try:
-        os.rename(eml_fp,new_eml_fp)
-    except:
-        LogMessage = "cannot rename file: %s - %s"%(eml_fp,new_eml_fp)
-        logging.error(LogMessage)
-        raise
     return new_eml_fp
 
-def change_creation_date(eml_fp,sent_date):
+def change_creation_date(eml_fp,sent_date,writer=None):
     """ change file creation date to match sent_date
     Parameters:
     -----------
     eml_fp: str
         full path to the file
-    sent_date: str
-        date at which email was sent
+    sent_date: datetime
+        date at which email was sent (as returned by eml_get_parameters, a string is parsed with parse_sent_date)
+    writer: str
+        metadata backend, see metadata.get_writer
     Returns:
     --------
     """
-    emailtime = dateutil_parse(sent_date).timetuple()
-    log_msg = "SENT ON: %s"%(str(emailtime))
+    if isinstance(sent_date,str):
+        sent_date = parse_sent_date(sent_date.strip())
+    log_msg = "SENT ON: %s"%(str(sent_date))
     logging.debug(log_msg)
-
-    atime = int(mktime(emailtime))
-    times = (atime, atime)
     try:
-        #new_fn_fp = abspath(join(dirname,new_filename)) #new filename full path
-        #ChangeFileCreationTime(dirname+"\\"+new_filename,atime)
-        #ChangeFileCreationTime(new_fn_fp,atime)
-        wintime = pywintypes.Time(atime)
-        try:
-            #HERE WE TRY TO CHANGE the FILE CREATE DATE
-            winfile = win32file.CreateFile(eml_fp, win32con.GENERIC_WRITE,
-                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
-                None, win32con.OPEN_EXISTING,
-                win32con.FILE_ATTRIBUTE_NORMAL, None)
-            win32file.SetFileTime(winfile, wintime, None, None)
-            winfile.close()
-        except:
-            log_msg = "179 error changing creation date for fname :%s"%(eml_fp)
-            logging.info(log_msg)
-            if stop_error:
-                raise
-
-        #NOW WE CHANGE THE LAST CHANGE TIME
-        #setFileAttributes(eml_fp, from_sender, title,comments)
-        os.utime(eml_fp, times)
+        metadata_writer = get_writer(writer)
+        metadata_writer.set_times(eml_fp,sent_date)
+        #a writer created here is not flushed by the caller
+        if metadata_writer is not writer and not metadata_writer.flush():
+            raise OSError(f"cannot write the metadata of {eml_fp}")
     except:
-        log_msg = "294 failed to change file flags for : %s"%(eml_fp)
+        log_msg = "failed to change file flags for : %s"%(eml_fp)
         logging.info(log_msg)
         raise
 
-def set_file_attributes(eml_fp, author, title,comments):
-    """ change the windows file attributes (author, title, comments) to make easier for searching
+def set_file_attributes(eml_fp, author, title,comments,writer=None):
+    """ change the file attributes (author, title, comments) to make easier for searching
     Parameters:
     -----------
     eml_fp: str
         full path to the email file on HDD
+    writer: str
+        metadata backend, see metadata.get_writer
     Returns:
     --------
     None 
     """
-    flags=storagecon.STGM_READWRITE | storagecon.STGM_SHARE_EXCLUSIVE | storagecon.STGM_DIRECT
-    pss=pythoncom.StgOpenStorageEx(eml_fp, flags, storagecon.STGFMT_FILE, 0 , pythoncom.IID_IPropertySetStorage,None)
-    try:
-        ps=pss.Create(pythoncom.FMTID_SummaryInformation,pythoncom.IID_IPropertyStorage,0,storagecon.STGM_READWRITE|storagecon.STGM_SHARE_EXCLUSIVE)
-    except:
-        try:
-            ps=pss.Open(pythoncom.FMTID_SummaryInformation,storagecon.STGM_READWRITE|storagecon.STGM_SHARE_EXCLUSIVE)
-        except:
-            print("80 Failed \teml_fp: %s\n\tauthor:: %s\n\ttitle:: %s\n\tcomments::%s"%(eml_fp,author,title,comments))
-            raise
-    ps.WriteMultiple((storagecon.PIDSI_KEYWORDS,storagecon.PIDSI_COMMENTS,storagecon.PIDSI_AUTHOR,storagecon.PIDSI_TITLE),('keywords',comments,author,title))
-
-    #add here wait loop to secure the filename change was effective
-    while not os.path.isfile(eml_fp):
-        sleep(0.01)
-        
-    ps=None
-    pss=None
+    metadata_writer = get_writer(writer)
+    metadata_writer.set_attributes(eml_fp,author,title,comments)
+    #a writer created here is not flushed by the caller
+    if metadata_writer is not writer and not metadata_writer.flush():
+        raise OSError(f"cannot write the metadata of {eml_fp}")
 
 def is_eml(send_to, sent_from, subject, sent_date):
-    if len(send_to)>3 and len(sent_from)>3 and len(subject)>=3 and len(sent_date)>8:
+    if len(send_to)>3 and len(sent_from)>3 and len(subject)>=3 and sent_date is not None:
         return True
     else:
         return False
@@ -443,7 +579,345 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
-def make_eml_search_friendly(eml_folder,ignore_ext = False): #,send_to, sent_from, subject, sent_date,OldArchives=False):
+def update_file_metadata(new_eml_fp,send_to,sent_from,subject,sent_date,writer=None):
+    """ sets the file attributes and creation date of a renamed file
+    Parameters:
+    -----------
+    writer: MetadataWriter
+        metadata backend (or backend name: the updates are flushed before returning), see metadata.get_writer
+    Returns:
+    --------
+    success: bool
+        False if one of the updates failed (the failure is logged)
+    """
+    metadata_writer = get_writer(writer)
+    success = metadata_writer.write(new_eml_fp,sent_from,subject,"TO:"+send_to,sent_date)
+    if metadata_writer is not writer:
+        success = metadata_writer.flush() and success
+    return success
+
+def flush_metadata(writer,summary,records=None,root=None):
+    """ flushes the batched metadata updates of writer, the files whose update failed then are counted
+    as failed instead of processed in summary
+    Parameters:
+    -----------
+    records: list
+        manifest records of the files (see FolderRun.done), their status is set to failed
+    root: str
+        folder the names of the records are relative to
+    """
+    if writer.flush():
+        return
+    failed = {abspath(fp) for fp in writer.failed_files}
+    writer.failed_files = []
+    if records is not None:
+        moved = 0
+        for record in records:
+            if record["status"]=="processed" and abspath(join(root,record["name"])) in failed:
+                record["status"] = "failed"
+                moved+=1
+    else:
+        moved = min(len(failed),summary["processed"])
+    summary["processed"]-=moved
+    summary["failed"]+=moved
+    log_msg = "metadata of %d files not written"%(len(failed))
+    logging.error(log_msg)
+
+class FolderRun:
+    """ per file decisions and bookkeeping of the processing of a folder, shared by process_eml_folder and
+    staged_io.process_folder_staged (which only differ in how the files are read, renamed and written):
+    summary counts, manifest records, search documents, catalog records, dedup and error policy
+    Parameters:
+    -----------
+    see process_eml_folder
+    """
+    def __init__(self,root,ignore_ext=False,headers_only=False,known=None,metadata=None,index=False,metrics=None,
+        attachments=None,dedup=None,catalog=False,layout=None,errors=None):
+        self.root = root
+        self.ignore_ext = ignore_ext
+        self.headers_only = headers_only
+        self.known = known
+        self.index = index
+        self.catalog = catalog
+        self.metrics = metrics
+        self.dedup = dedup
+        self.errors = errors
+        self.summary = {"processed":0,"skipped":0,"failed":0,"quarantined":0,"duplicates":0,"unchanged":0}
+        self.run_metrics = get_metrics(metrics)
+        self.writer = get_writer(metadata)
+        self.writer.metrics = self.run_metrics
+        self.store = AttachmentStore(attachments) if attachments else None
+        if dedup is not None:
+            from .dedup import DedupIndex
+        self.dedup_index = DedupIndex(dedup,shared=True) if isinstance(dedup,str) else dedup
+        layout = get_layout(layout)
+        self.buckets = FolderBuckets(layout,root) if layout is not None else None
+        self.error_policy = get_error_policy(errors)
+        self.records = []
+        self.documents = []
+        self.catalog_records = []
+
+    def ignored(self,fn):
+        """ True for the files written by the processing itself """
+        return is_manifest_file(fn) or is_sidecar_file(fn) or is_index_file(fn) or is_catalog_file(fn) or is_layout_file(fn)
+
+    def is_message(self,fn):
+        return fn.find(".eml")>=0 or fn.find(".ics")>=0 or self.ignore_ext
+
+    def unchanged(self,fn):
+        """ True if the file was processed by a previous run and not modified since (see known) """
+        return self.known is not None and fn in self.known and file_key(os.stat(join(self.root,fn)))==self.known[fn]
+
+    def decide(self,msg,msg_strings,eml_fp):
+        """ reads the parameters of a message and claims it in the dedup index
+        Returns:
+        --------
+        params: tuple
+            send_to, sent_from, subject, sent_date
+        key: bytes
+            dedup key (None without dedup index)
+        first: str
+            path of the first copy of a duplicate message (None if not a duplicate)
+        body: str
+            body text if it was read for the dedup key (None otherwise)
+        raises StageError (stage "headers" or "dedup")
+        """
+        stage = "headers"
+        try:
+            params = msg_get_parameters(msg,msg_strings,eml_fp,metrics=self.run_metrics)
+            send_to, sent_from, subject, sent_date = params
+            log_msg = "\t\t\tsubject: %s"%(subject)
+            logging.debug(log_msg)
+            log_msg = "\t\t\tsent_date: %s"%(sent_date)
+            logging.debug(log_msg)
+            body = None
+            key = None
+            first = None
+            if self.dedup_index is not None:
+                from .dedup import message_key
+                stage = "dedup"
+                with self.run_metrics.stage("dedup"):
+                    body = "" if self.headers_only else message_text(msg)
+                    message_id = msg.get("Message-ID")
+                    key = message_key(message_id,sent_from,send_to,subject,sent_date,body)
+                    first = self.dedup_index.claim(key,message_id,eml_fp)
+        except Exception as e:
+            raise StageError(stage,e) from e
+        if first is not None:
+            #copy of a message of this or a previous run: not renamed nor touched
+            log_msg = "duplicate of %s: %s"%(first,eml_fp)
+            logging.info(log_msg)
+        return params, key, first, body
+
+    def to_rename(self,params):
+        """ True if the message is renamed (with ignore_ext only the files which look like an email) """
+        #if we ignore ext need to verify this is an email to give it an .eml extension
+        #in the case where other scripts have corrupted file names
+        return not self.ignore_ext or is_eml(*params)
+
+    def fail(self,eml_fp,stage,e):
+        """ raises e without error policy, else counts the file as failed (and quarantined) """
+        if isinstance(e,StageError):
+            stage, e = e.stage, e.error
+        if self.error_policy is None:
+            raise e
+        record = self.error_policy.fail(eml_fp,stage,e)
+        self.summary["failed"]+=1
+        self.summary["quarantined"]+="quarantine" in record
+
+    def done(self,fn,status,new_eml_fp,params,msg,body,size,start,st=None):
+        """ counts a file and collects its manifest record, search document and catalog record
+        Parameters:
+        -----------
+        fn: str
+            original name of the file
+        status: str
+            processed, failed (metadata), skipped or duplicate
+        st: os.stat_result
+            of new_eml_fp if known (stat again otherwise)
+        size, start:
+            file size and perf_counter at the start of the file (for the metrics)
+        """
+        send_to, sent_from, subject, sent_date = params
+        try:
+            if self.known is not None:
+                size_, mtime_ns, inode = file_key(st or os.stat(new_eml_fp))
+                self.records.append({"name":relpath(new_eml_fp,self.root),"size":size_,"mtime_ns":mtime_ns,"inode":inode,
+                    "status":status,"original_name":fn,"send_to":send_to,"sent_from":sent_from,
+                    "subject":subject,"sent_date":sent_date.isoformat()})
+            if self.index and status not in ("skipped","duplicate"):
+                if body is None:
+                    with self.run_metrics.stage("body"):
+                        body = "" if self.headers_only else message_text(msg)
+                self.documents.append({"name":relpath(new_eml_fp,self.root),"send_to":str(send_to or ""),
+                    "sent_from":str(sent_from or ""),"subject":subject,"sent_date":sent_date,"body":body})
+            if self.catalog and status not in ("skipped","duplicate"):
+                self.catalog_records.append(MessageRecord(send_to,sent_from,subject,sent_date,self.root,relpath(new_eml_fp,self.root)))
+        except Exception as e:
+            self.fail(new_eml_fp if exists(new_eml_fp) else join(self.root,fn),"record",e)
+            return
+        self.summary[status if status!="duplicate" else "duplicates"]+=1
+        if self.error_policy is not None:
+            self.error_policy.file_done()
+        if self.run_metrics.enabled:
+            self.run_metrics.file_done(new_eml_fp,size,perf_counter()-start)
+
+    def finish(self):
+        """ saves the buckets, flushes the metadata and Returns the summary of the folder (see process_eml_folder) """
+        if self.buckets is not None:
+            self.buckets.save()
+        summary = self.summary
+        with self.run_metrics.stage("flush"):
+            flush_metadata(self.writer,summary,self.records if self.known is not None else None,self.root)
+        summary["metadata_seconds"] = self.writer.stats["seconds"]
+        if self.known is not None:
+            summary["records"] = self.records
+        if self.index:
+            summary["documents"] = self.documents
+        if self.catalog:
+            summary["catalog"] = self.catalog_records
+        if self.store is not None:
+            summary["attachments"] = self.store.stats
+        if isinstance(self.dedup,str):
+            self.dedup_index.close()
+            summary["dedup"] = self.dedup_index.stats
+            summary["dedup_keys"] = self.dedup_index.new_keys
+        if isinstance(self.errors,dict):
+            summary["errors"] = {"files":self.error_policy.files,"failures":self.error_policy.failures}
+        if self.metrics is True:
+            self.run_metrics.stop()
+            summary["metrics"] = self.run_metrics.to_dict()
+        return summary
+
+def process_eml_folder(root,files,ignore_ext = False,headers_only = False,known = None,policy = None,metadata = None,index = False,metrics = None,attachments = None,dedup = None,staged = None,catalog = False,layout = None,errors = None,hold = None):
+    """ rename and change creation date and attributes of the given files of a single folder
+    collisions (see incrementalfilename) only depend on the content of the folder,
+    so folders can be processed independently (see make_eml_search_friendly jobs)
+    Parameters:
+    -----------
+    root: str
+        folder path
+    files: list
+        file names (in the os.walk order) to process in the folder
+    known: dict
+        if not None, file name -> (size, mtime_ns, inode) of the files already processed by a previous
+        run (see manifest.Manifest.known_files), matching files are left untouched and the
+        summary gets the records to store in the manifest
+    policy: str
+        file name length limits, see filename_policy.get_policy
+    metadata: str
+        metadata backend, see metadata.get_writer
+    index: bool
+        the summary gets the "documents" to store in the search index (see search_index.SearchIndex)
+    metrics: RunMetrics or bool
+        instrumentation updated while processing the folder, True: a new one returned in the
+        summary "metrics" (as a dict, to be merged from another process), None: disabled
+    attachments: str
+        folder of the attachment store (see attachments.AttachmentStore) the attachments of the messages
+        are moved to, the summary gets the "attachments" stats (None: attachments left in the messages)
+    dedup: DedupIndex or str
+        messages already seen (see dedup.DedupIndex) are left untouched and counted as duplicates,
+        a str is the index file opened by a worker process, the summary gets the "dedup" stats and keys
+    staged: dict
+        overlaps the file system round trips (network shares) with the stage limits given (io_workers,
+        read_workers, io_queue, read_queue), see staged_io.process_folder_staged
+    catalog: bool
+        the summary gets the "catalog" records (catalog.MessageRecord) of the messages renamed
+    layout: Layout or str
+        the renamed files are moved to buckets (sub folders) of the folder, see layout.FolderBuckets
+        (None: renamed in place), the names of the records are relative to the folder
+    errors: ErrorPolicy or dict
+        a file which fails is counted as failed and quarantined or skipped (see quarantine.ErrorPolicy)
+        instead of stopping the run, a dict is the config of the policy of a worker process, the summary
+        gets its "errors" (files and failures) (None: the exception is raised)
+    hold: function
+        subject -> True if the file cannot be renamed after it yet (see pipeline), it is left as is and
+        listed in the summary "held" to be processed again later (without dedup nor staged)
+    Returns:
+    --------
+    summary: dict
+        number of files processed, skipped, failed, quarantined, duplicates and unchanged in the folder, time
+        spent writing the metadata (and "records" when known is not None)
+    """
+    if staged:
+        from .staged_io import process_folder_staged
+        return process_folder_staged(root,files,ignore_ext,headers_only,known,policy,metadata,index,metrics,
+            attachments,dedup,catalog=catalog,layout=layout,errors=errors,**staged)
+    run = FolderRun(root,ignore_ext,headers_only,known,metadata,index,metrics,attachments,dedup,catalog,layout,errors)
+    run_metrics = run.run_metrics
+    held = []
+    printed = False
+    for fn in files:
+        if run.ignored(fn):
+            continue
+        if run.unchanged(fn):
+            run.summary["unchanged"]+=1
+            continue
+        if not run.is_message(fn):
+            run.summary["skipped"]+=1
+            continue
+        if not printed:
+            print(f"processing folder {root}")
+            printed = True
+        # if fn.find("utf-8")>=0 or fn.find("iso-8859")>=0 or fn.find("gb2312")>=0:
+        log_msg = "processing:%s"%(fn)
+        logging.info(log_msg)
+        eml_fp = abspath(join(root,fn))
+        new_eml_fp = eml_fp
+        #step of the file being processed, see quarantine.failure_cause
+        stage = "parse"
+        try:
+            start = perf_counter()
+            file_size = os.path.getsize(eml_fp) if run_metrics.enabled else 0
+            with run_metrics.stage("parse"):
+                msg, msg_strings = load_eml(eml_fp,headers_only)
+            params, key, first, body = run.decide(msg,msg_strings,eml_fp)
+            send_to, sent_from, subject, sent_date = params
+            if first is not None:
+                status = "duplicate"
+            elif hold is not None and run.to_rename(params) and hold(subject):
+                held.append(fn)
+                continue
+            elif run.to_rename(params):
+                if run.store is not None:
+                    stage = "attachments"
+                    #before the metadata: the file is replaced by a new one
+                    with run_metrics.stage("attachments"):
+                        run.store.extract(eml_fp)
+                stage = "rename"
+                try:
+                    with run_metrics.stage("rename"):
+                        folder = run.buckets.destination(subject,sent_date) if run.buckets is not None else None
+                        new_eml_fp = rename_eml(eml_fp,subject,ignore_ext,policy=policy,folder=folder)
+                except:
+                    log_msg = "failed renaming file for: %s"%eml_fp
+                    logging.error(log_msg)
+                    raise
+                if key is not None:
+                    run.dedup_index.moved(key,new_eml_fp)
+                stage = "metadata"
+                status = "processed" if update_file_metadata(new_eml_fp,send_to,sent_from,subject,sent_date,run.writer) else "failed"
+            else:
+                status = "skipped"
+        except Exception as e:
+            run.fail(new_eml_fp if exists(new_eml_fp) else eml_fp,stage,e)
+            continue
+        run.done(fn,status,new_eml_fp,params,msg,body,file_size,start)
+    summary = run.finish()
+    if hold is not None:
+        summary["held"] = held
+    return summary
+
+def merge_summaries(summaries):
+    """ adds up the per folder summaries returned by process_eml_folder """
+    merged = {"processed":0,"skipped":0,"failed":0,"quarantined":0,"duplicates":0,"unchanged":0,"folders":0,"metadata_seconds":0.0}
+    for summary in summaries:
+        merged["folders"]+=1
+        for key in ["processed","skipped","failed","quarantined","duplicates","unchanged","metadata_seconds"]:
+            merged[key]+=summary.get(key,0)
+    return merged
+
+def make_eml_search_friendly(eml_folder,ignore_ext = False,headers_only = False,jobs = 1,manifest = False,policy = None,metadata = None,index = False,metrics = None,progress = False,attachments = False,dedup = None,staged = None,catalog = False,layout = None,distributed = None,errors = None,retry_quarantined = False): #,send_to, sent_from, subject, sent_date,OldArchives=False):
     """ rename and change files creation date and attributes  to reflect email content
 	Parses files in emlpath and sets the file properties to the email properties
 	if OldArchives ==True: considers that the files have been copied by the OS (file restore, back-up restore, ...) without the properties and will go through all .eml files
@@ -451,53 +925,283 @@ def make_eml_search_friendly(eml_folder,ignore_ext = False): #,send_to, sent_fro
     -----------
     eml_folder: str
         folder path to .eml file
+    headers_only: bool
+        only read the header block of each file (faster on messages with large attachments)
+    jobs: int
+        number of processes, each folder is processed by a single process (renamed files are
+        the same as with jobs=1)
+    manifest: bool
+        keep a manifest (see manifest.Manifest) at the root of eml_folder and skip the files and
+        folders which did not change since the previous run
+    policy: str
+        file name length limits, "windows" or "linux" (default: running platform), see filename_policy
+    metadata: str
+        metadata backend, "win32", "xattr" or "sidecar" (default: win32 on windows, xattr elsewhere), see metadata
+    index: bool
+        build a full-text search index (see search_index) at the root of eml_folder while processing
+        the files (the files left unchanged thanks to the manifest keep their previous entries)
+    metrics: RunMetrics or bool
+        per stage times, files/s, bytes/s and slowest files of the run (see metrics.RunMetrics),
+        True: a new RunMetrics, None: disabled (no overhead besides a no-op call per stage)
+    progress: bool
+        prints the number of files done, the rates and an ETA on stderr (counts the files first)
+    attachments: bool
+        move the attachments to a content-addressed store at the root of eml_folder, each one stored once
+        and replaced by a stub in the messages (see attachments, attachments.rehydrate rebuilds a message)
+    dedup: str
+        dedup index file (see dedup.DedupIndex) shared by the runs over several archives, the messages
+        already seen in this or a previous run are left untouched and counted as duplicates
+    staged: dict
+        for output trees on network shares: renames and metadata writes run in thread pools so their
+        round trips overlap, e.g. {"io_workers":16}, see staged_io (the files get the same names)
+    catalog: bool
+        keep a columnar catalog of the messages (sender, recipients, date, folder) at the root of eml_folder
+        for analytics (see catalog.Catalog), appended to when manifest is set, else rebuilt
+    layout: Layout or str
+        move the renamed messages of each folder to buckets, "date" (YYYY/MM) or "hash", see layout
+        (the buckets of the previous runs are not walked)
+    distributed: dict
+        process the folders as shards claimed by worker processes of this and other hosts (see distributed),
+        e.g. {"workers":8,"sharding":"hash"} with the other parameters of distributed.run_distributed
+        (jobs, metrics and progress are not used)
+    errors: ErrorPolicy, str or dict
+        each file which fails is quarantined or skipped and the run goes on within the error budgets
+        ("quarantine", "skip" or a dict of quarantine.ErrorPolicy parameters), None: the first failure stops the run
+    retry_quarantined: bool
+        only process the files quarantined by previous runs, moved back to their folders first
+        (see quarantine.restore_quarantined)
     Returns:
     --------
-    None
+    summary: dict
+        number of folders, files processed, skipped, failed, quarantined, duplicates and unchanged, time spent writing
+        the metadata (and the run "metrics" as a dict when metrics or progress are set, the "attachments" report of
+        the store, the "errors" report grouping the failures by cause, see quarantine.ErrorPolicy.report)
     """
-    old_root = ""
     logging.debug(f"walking folder ignoring extension: {ignore_ext}")
-    for root, directory, files in os.walk(eml_folder):
-        for fn in files:
-            if fn.find(".eml")>=0 or fn.find(".ics")>=0 or ignore_ext:
-                if not root==old_root:
-                    print(f"processing folder {root}")
-                    old_root = root
-                # if fn.find("utf-8")>=0 or fn.find("iso-8859")>=0 or fn.find("gb2312")>=0:
-                log_msg = "processing:%s"%(fn)
-                logging.info(log_msg)
-                eml_fp = abspath(join(root,fn))
-                send_to, sent_from, subject, sent_date = eml_get_parameters(eml_fp)
-                log_msg = "\t\t\tsubject: %s"%(subject)
-                logging.debug(log_msg)
-                log_msg = "***************327***sent_date: %s"%(sent_date)
-                logging.debug(log_msg)
-
-                if (ignore_ext and is_eml(send_to, sent_from, subject, sent_date)) or not ignore_ext:
-                    #if we ignore ext need to verify this is an email to give it an .eml extension
-                    #in the case where other scripts have corrupted file names
-
-                    try:
-                        new_eml_fp = rename_eml(eml_fp,subject,ignore_ext)
-                    except:
-                        log_msg = "failed renaming file for: %s"%eml_fp
-                        raise
-                    try:
-                        set_file_attributes(new_eml_fp, sent_from,subject,comments = "TO:"+send_to )
-                    except:
-                        log_msg = "failed updating file attrributes for: %s"%new_eml_fp
-                        logging.error(log_msg)
-
-                    try:
-                        change_creation_date(new_eml_fp,sent_date)
-                    except:
-                        log_msg ="failed changing creation date: %s"%new_eml_fp
-                        logging.error(log_msg)
-                        if stop_error:
+    if distributed and not retry_quarantined:
+        from .distributed import run_distributed
+        return run_distributed(eml_folder,ignore_ext=ignore_ext,headers_only=headers_only,manifest=manifest,policy=policy,
+            metadata=metadata,index=index,attachments=attachments,dedup=dedup,staged=staged,catalog=catalog,layout=layout,
+            errors=errors,**distributed)
+    if progress and not metrics:
+        metrics = True
+    run_metrics = get_metrics(metrics)
+    if progress:
+        run_metrics.progress = Progress(sum(len(files) for _, _, files in os.walk(eml_folder)))
+    run_manifest = Manifest(eml_folder) if manifest else None
+    search_index = SearchIndex(eml_folder) if index else None
+    store = AttachmentStore(eml_folder) if attachments else None
+    store_stats = []
+    dedup_index = None
+    if dedup:
+        from .dedup import DedupIndex
+        dedup_index = DedupIndex(dedup)
+    dedup_stats = []
+    run_catalog = (Catalog.load(eml_folder) if manifest else Catalog(eml_folder)) if catalog else None
+    error_policy = get_error_policy(errors,eml_folder)
+    summaries = []
+    def folders():
+        """ yields (root, files, known) for the folders needing processing """
+        if retry_quarantined:
+            for root, files in restore_quarantined(eml_folder,error_policy.folder if error_policy is not None else None).items():
+                yield root, files, run_manifest.known_files(root) if run_manifest is not None else None
+            return
+        for root, directory, files in os.walk(eml_folder):
+            directory[:] = [name for name in directory if not is_store_folder(name) and not is_work_folder(name)
+                and not is_quarantine_folder(name) and not is_buckets_folder(name)]
+            if run_manifest is None:
+                yield root, files, None
+            elif run_manifest.folder_unchanged(root):
+                unchanged = run_manifest.folder_file_count(root)
+                summaries.append({"processed":0,"skipped":0,"failed":0,"unchanged":unchanged})
+            else:
+                yield root, files, run_manifest.known_files(root)
+
+    def collect(root,summary):
+        if "metrics" in summary:
+            run_metrics.merge(summary.pop("metrics"))
+        if "attachments" in summary:
+            store_stats.append(summary.pop("attachments"))
+        if "dedup" in summary:
+            dedup_stats.append(summary.pop("dedup"))
+            dedup_index.add_keys(summary.pop("dedup_keys"))
+        if "errors" in summary:
+            error_policy.merge(summary.pop("errors"),check=False)
+        if run_manifest is not None:
+            with run_metrics.stage("manifest"):
+                run_manifest.record(root,summary.pop("records"))
+        if search_index is not None:
+            with run_metrics.stage("index"):
+                search_index.add(root,summary.pop("documents"))
+        if run_catalog is not None:
+            with run_metrics.stage("catalog"):
+                for record in summary.pop("catalog"):
+                    run_catalog.add(record)
+        summaries.append(summary)
+
+    try:
+        if jobs<=1:
+            for root, files, known in folders():
+                collect(root,process_eml_folder(root,files,ignore_ext,headers_only,known,policy,metadata,index,
+                    run_metrics if run_metrics.enabled else None,eml_folder if store is not None else None,dedup_index,staged,catalog,layout,
+                    error_policy))
+        else:
+            #the workers return their metrics, merged in collect
+            from concurrent.futures import ProcessPoolExecutor
+            worker_errors = None
+            if error_policy is not None:
+                #the budgets are checked here on the failures of all the folders
+                worker_errors = {**error_policy.config(),"max_errors":None,"max_error_rate":None}
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [(root,executor.submit(process_eml_folder,root,files,ignore_ext,headers_only,known,policy,metadata,index,
+                    run_metrics.enabled or None,eml_folder if store is not None else None,dedup_index.fp if dedup_index is not None else None,
+                    staged,catalog,layout,worker_errors))
+                    for root, files, known in folders()]
+                for root, future in futures:
+                    collect(root,future.result())
+                    if error_policy is not None:
+                        try:
+                            error_policy.check()
+                        except ErrorBudgetExceeded:
+                            for _, pending in futures:
+                                pending.cancel()
                             raise
+    finally:
+        if run_manifest is not None:
+            run_manifest.close()
+        if search_index is not None:
+            with run_metrics.stage("index"):
+                search_index.close()
+        if dedup_index is not None:
+            dedup_index.close()
+        if run_catalog is not None:
+            with run_metrics.stage("catalog"):
+                run_catalog.save()
+    summary = merge_summaries(summaries)
+    if error_policy is not None:
+        error_policy.save_report()
+        summary["errors"] = error_policy.report()
+    if dedup_index is not None:
+        summary["dedup"] = merge_stats([dedup_index.stats]+dedup_stats)
+        summary["dedup"]["messages"] = dedup_index.bloom.count
+    if store is not None:
+        store.stats = merge_stats(store_stats)
+        summary["attachments"] = store.report()
+        report = summary["attachments"]
+        logging.info(f"attachments: {report['attachments']} stored ({report['duplicates']} duplicates), "
+            f"{report['removed_bytes']/1e6:.1f} MB removed from the messages, store {report['store']['bytes']/1e6:.1f} MB")
+    if run_metrics.enabled:
+        run_metrics.stop()
+        summary["metrics"] = run_metrics.to_dict()
+    logging.info(f"processed {summary['processed']}, skipped {summary['skipped']}, failed {summary['failed']} ({summary['quarantined']} quarantined), duplicates {summary['duplicates']}, unchanged {summary['unchanged']} files in {summary['folders']} folders")
+    written = summary["processed"]+summary["failed"]
+    if summary["metadata_seconds"]>0:
+        logging.info(f"metadata: {written} files in {summary['metadata_seconds']:.2f}s ({written/summary['metadata_seconds']:.0f} files/s)")
+    return summary
+
+def safe_folder_name(name):
+    """ folder name usable on windows and linux for a pst folder display name """
+    for c in '\\/:*?"<>|':
+        name = name.replace(c,"-")
+    name = "".join([c for c in name if ord(c)>31]).strip().rstrip(".")
+    return name or "_"
+
+def pst_2_eml_native(pst_full_path,EML_folder,debug=False,policy=None,metadata=None,errors=None):
+    """ converts a pst with the pure python reader (see pst_reader), messages are renamed
+    and get their attributes as they are written so no second pass (make_eml_search_friendly) is needed
+    Parameters:
+    -----------
+    pst_full_path: str
+        full path to the .pst/.ost file
+    EML_folder: str
+        output folder, one sub folder per pst folder
+    policy: str
+        file name length limits, see filename_policy.get_policy
+    metadata: str
+        metadata backend, see metadata.get_writer
+    errors: ErrorPolicy, str or dict
+        see make_eml_search_friendly, a message which fails is written as <nid>.eml (when it could be read)
+        then quarantined or left in place, None: the first failure stops the run
+    Returns:
+    --------
+    summary: dict
+        number of messages processed, failed and quarantined, time spent writing the metadata
+        (with errors: the "errors" report)
+    """
+    from .pst_reader import PSTFile
+    summary = {"processed":0,"skipped":0,"failed":0,"quarantined":0,"unchanged":0}
+    writer = get_writer(metadata)
+    error_policy = get_error_policy(errors,EML_folder)
+    try:
+        with PSTFile(pst_full_path) as pst:
+            for message in pst.iter_messages():
+                folder_path = join(EML_folder,*[safe_folder_name(name) for name in message.folder_path])
+                if not os.path.exists(folder_path):
+                    os.makedirs(folder_path)
+                #virtual path of the message in the pst, only used for logging
+                eml_fp = join(pst_full_path,*message.folder_path,f"{message.nid}.eml")
+                #step of the message being converted, see quarantine.failure_cause
+                stage = "read"
+                data = None
+                try:
+                    headers = message.headers()
+                    data = message.to_eml(headers)
+                    stage = "headers"
+                    msg_strings = io.StringIO(headers.as_string()).readlines()
+                    send_to, sent_from, subject, sent_date = msg_get_parameters(headers,msg_strings,eml_fp,debug)
+                    stage = "rename"
+                    new_eml_fp = new_eml_path(folder_path,subject,".eml",debug,policy)
+                    with open(new_eml_fp,"xb") as fo:
+                        fo.write(data)
+                    stage = "metadata"
+                    status = "processed" if update_file_metadata(new_eml_fp,send_to or "",sent_from,subject,sent_date,writer) else "failed"
+                except Exception as e:
+                    if error_policy is None:
+                        raise
+                    if stage=="metadata":
+                        failed_fp = new_eml_fp
+                    else:
+                        #the message is kept under its nid to be quarantined and retried
+                        failed_fp = join(folder_path,f"{message.nid}.eml")
+                        if data is not None:
+                            if exists(failed_fp):
+                                failed_fp = join(folder_path,incrementalfilename(folder_path,basename(failed_fp)))
+                            with open(failed_fp,"xb") as fo:
+                                fo.write(data)
+                    record = error_policy.fail(failed_fp,stage,e)
+                    summary["failed"]+=1
+                    summary["quarantined"]+="quarantine" in record
+                    continue
+                summary[status]+=1
+                if error_policy is not None:
+                    error_policy.file_done()
+    finally:
+        flush_metadata(writer,summary)
+        if error_policy is not None:
+            error_policy.save_report()
+    summary["metadata_seconds"] = writer.stats["seconds"]
+    if error_policy is not None:
+        summary["errors"] = error_policy.report()
+    return summary
+
+def readpst_command(pst_full_path,EML_folder):
+    """ command line converting the pst into a tree of .eml files in EML_folder, with the bundled
+    readpst.exe or else a readpst found in the PATH (libpst package on linux)
+    """
+    pstlib_full_path = abspath(join(__file__,pardir,pardir,"bin","readpst.exe"))
+    if not exists(pstlib_full_path) and which("readpst") is not None:
+        pstlib_full_path = which("readpst")
+    if not exists(pstlib_full_path):
+        print("cannot find pstlib in given path:", pstlib_full_path)
+        raise Exception(FileNotFoundError)
+    return [pstlib_full_path,"-e",pst_full_path,"-o",EML_folder]
 
 def pst_2_eml(**kwargs):
-    """ wrapper around the readpst.exe """
+    """ wrapper around the readpst.exe (or the pure python reader if kwargs["reader"]=="native")
+    if kwargs["pipeline"] the .eml/.ics files are renamed and touched while readpst runs (see pipeline)
+    if kwargs["distributed"] (number of worker processes) each archive matching kwargs["fn"] (a glob pattern)
+    is a shard converted then processed by a worker of this or another host (see distributed)
+    """
 
     PST_folder = kwargs["folder"]
     PST_file   = kwargs["fn"]
@@ -511,14 +1215,25 @@ def pst_2_eml(**kwargs):
     #override_eml = kwargs["override_eml"]
     #old_archives = kwargs["old_archives"]
 
-    pstlib_full_path = abspath(join(__file__,pardir,pardir,"bin","readpst.exe"))
     pst_full_path = abspath(join(PST_folder,PST_file))
+    if kwargs.get("distributed"):
+        from .distributed import run_distributed
+        return run_distributed(EML_folder,workers=kwargs["distributed"],work_dir=kwargs.get("work_dir") or None,sharding="pst",
+            source=pst_full_path,reader=kwargs.get("reader","readpst"),readpst_jobs=kwargs.get("readpst_jobs",0),
+            headers_only=kwargs.get("headers_only",False),manifest=kwargs.get("manifest",False),policy=kwargs.get("policy"),
+            metadata=kwargs.get("metadata"),index=kwargs.get("index",False),catalog=kwargs.get("catalog",False),
+            errors=kwargs.get("errors"))
     if exists(pst_full_path):
-        if exists(pstlib_full_path):
-            call([pstlib_full_path,"-e",pst_full_path,"-o",EML_folder])
-        else:
-            print("cannot find pstlib in given path:", pstlib_full_path)
-            raise Exception(FileNotFoundError)
+        if kwargs.get("reader","readpst")=="native":
+            return pst_2_eml_native(pst_full_path,EML_folder,policy=kwargs.get("policy"),metadata=kwargs.get("metadata"),
+                errors=kwargs.get("errors"))
+        command = readpst_command(pst_full_path,EML_folder)
+        if kwargs.get("pipeline",False):
+            from .pipeline import extract_and_process
+            return extract_and_process(command,EML_folder,headers_only=kwargs.get("headers_only",False),
+                manifest=kwargs.get("manifest",False),policy=kwargs.get("policy"),metadata=kwargs.get("metadata"),
+                index=kwargs.get("index",False),errors=kwargs.get("errors"))
+        call(command)
     else:
         print("pst file path not found:",pst_full_path)
         
@@ -545,7 +1260,6 @@ if __name__=="__main__":
     if myargs["verbosity"]==4:
         logging.basicConfig(level=logging.DEBUG)
         logging.info("logging set to DEBUG")
-        stop_error = True
     else:
         logging.basicConfig(level=logging.WARN)
         logging.info("logging set to WARN")
@@ -0,0 +1,840 @@
+"""
+pure python streaming reader for Outlook .pst/.ost files (alternative to bin/readpst.exe)
+
+follows the [MS-PST] layers:
+* NDB (node database): header, node and block B-trees (NBT/BBT), data trees (XBLOCK/XXBLOCK),
+    subnode trees (SLBLOCK/SIBLOCK) and the block encryption (none, compressible/permute and cyclic)
+* LTP (lists, tables and properties): heap-on-node, BTree-on-heap, property contexts and table contexts
+* messaging: message store, folders (hierarchy and contents tables), messages, recipients and attachments
+
+both ANSI (wVer 14/15) and Unicode (wVer 23) files are supported, the 4K page variant
+written by Outlook 2013 for .ost files (wVer 36) is not
+
+PSTFile.iter_messages is a generator of PSTMessage: the subject, headers, folder path and other properties
+are read from the message property context only, the body and attachment data are only read when accessed
+
+Example:
+--------
+with PSTFile("2020_Q1_Q3.pst") as pst:
+    for message in pst.iter_messages():
+        print("/".join(message.folder_path), message.subject)
+        eml_bytes = message.to_eml()
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from collections import OrderedDict
+import codecs
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import HeaderParser
+from email.utils import format_datetime
+from email import encoders
+import logging
+import struct
+
+#[MS-PST] 5.1 permutation tables used by the compressible (permute) and cyclic encryptions
+MPBB_R = bytes.fromhex(
+    "41361362a8216ebbf416cc047f64e85d1ef2cb2a74c55e35d295479e962d9a88"
+    "4c7d843fdbac31b6485ff6c4d8398be7233b388ec8c1df25b120a546604e9cfb"
+    "aad35651457c550007c92b9d859b09a08fadb30f63ab894bd7a7155a716642bf"
+    "264a6b98faea7753b270052cfd593a867ece06eb827857c78d43afb41cd45bcd"
+    "e2e9274fc3087280cfb0eff5286dbe304d3492d50e3c2232e5e4f99fc2d10a81"
+    "12e1ee918376e397e6618a1779a4b7dc907a5c8c02a6ca69de501a1193b95287"
+    "58fced1d37491b6ae0293399bd6cd994f340546ff0c673b8d63e6518441fdd67"
+    "10f10c19ecae03a1147ba90bfff8a3c0a201f72ebc2468750dfeba2fb5d0da3d")
+MPBB_S = bytes.fromhex(
+    "14530f56b3c87a9ceb65481716159f02cc547c83000d0c0ba262a876dbd9edc7"
+    "c5a4dcac8574d6d0a79bae9a967166c36399b8dd73928e847da55ed15d93b157"
+    "5150808952944f4e0a6bbc8d7f6e47464140440111cb033ff7f4e1a98f3c3af9"
+    "fbf0193082092ec99da08649ee6f4d6dc42d813425871b88aafc06a11238fd4c"
+    "4272641337246a757743ffe6b44b365ce4d8353d45b92cecb7312b290768a30e"
+    "697b189e2139be281a5b78f523ca2ab0af3efe048ce7e5983295d3f64ae8a6ea"
+    "e9f3d52f7020f21f0567ad5510cecde3273bdabad7c226d4911dd21c2233f8fa"
+    "f15aefcf90b68bb5bdc0bf08971e6ce261e0c6c159abbb58de5fdf60797eb28a")
+MPBB_I = bytes.fromhex(
+    "47f1b4e60b6a7248854e9eebe2f89453e0bba002e85a09abdbe3bac67cc310dd"
+    "39059630f53760828cc9134a6b1df3fb8f2697ca911701c4322d6e3195ffd923"
+    "d1005e79dc443b1a28c5615720903d83b943be67d2464276c06d5b7eb20f1629"
+    "3ca903540dda5ddff6b7c762cd8d06d3695c86d614f7a56675acb1e94521700c"
+    "879f74a4224c6fbf1f56aa2eb3783350b0a392bccf191ca763cb1e4d3e4b1b9b"
+    "4fe7f0eead3ab55904ea40552551e57a893868527bfc27aed7bdfa07f4cc8e5f"
+    "ef359c842b15d5773449b6120a7f7188fd9d18417d93d8582ccefe24afdeb836"
+    "c8a180a69998a82f0e816573e4c2a28ad4e111d0088b2af2ed9a643fc16cf9ec")
+
+NDB_CRYPT_NONE = 0x00
+NDB_CRYPT_PERMUTE = 0x01
+NDB_CRYPT_CYCLIC = 0x02
+
+PTYPE_BBT = 0x80
+PTYPE_NBT = 0x81
+
+#special node ids
+NID_MESSAGE_STORE = 0x21
+NID_ROOT_FOLDER = 0x122
+NID_ATTACHMENT_TABLE = 0x671
+NID_RECIPIENT_TABLE = 0x692
+
+#node types (low 5 bits of a nid)
+NID_TYPE_HID = 0x00
+NID_TYPE_NORMAL_FOLDER = 0x02
+NID_TYPE_HIERARCHY_TABLE = 0x0D
+NID_TYPE_CONTENTS_TABLE = 0x0E
+
+#heap-on-node client signatures
+HN_SIG = 0xEC
+BTH_SIG = 0xB5
+PC_SIG = 0xBC
+TC_SIG = 0x7C
+
+#property types
+PT_SHORT = 0x0002
+PT_LONG = 0x0003
+PT_FLOAT = 0x0004
+PT_DOUBLE = 0x0005
+PT_CURRENCY = 0x0006
+PT_APPTIME = 0x0007
+PT_ERROR = 0x000A
+PT_BOOLEAN = 0x000B
+PT_OBJECT = 0x000D
+PT_LONGLONG = 0x0014
+PT_STRING8 = 0x001E
+PT_UNICODE = 0x001F
+PT_SYSTIME = 0x0040
+PT_CLSID = 0x0048
+PT_BINARY = 0x0102
+MV_FLAG = 0x1000
+
+#property ids
+PR_MESSAGE_CLASS = 0x001A
+PR_SUBJECT = 0x0037
+PR_CLIENT_SUBMIT_TIME = 0x0039
+PR_SENT_REPRESENTING_NAME = 0x0042
+PR_SENT_REPRESENTING_EMAIL_ADDRESS = 0x0065
+PR_TRANSPORT_MESSAGE_HEADERS = 0x007D
+PR_RECIPIENT_TYPE = 0x0C15
+PR_SENDER_NAME = 0x0C1A
+PR_SENDER_EMAIL_ADDRESS = 0x0C1F
+PR_DISPLAY_CC = 0x0E03
+PR_DISPLAY_TO = 0x0E04
+PR_MESSAGE_DELIVERY_TIME = 0x0E06
+PR_MESSAGE_SIZE = 0x0E08
+PR_BODY = 0x1000
+PR_HTML = 0x1013
+PR_INTERNET_MESSAGE_ID = 0x1035
+PR_DISPLAY_NAME = 0x3001
+PR_EMAIL_ADDRESS = 0x3003
+PR_CREATION_TIME = 0x3007
+PR_ATTACH_DATA = 0x3701
+PR_ATTACH_FILENAME = 0x3704
+PR_ATTACH_METHOD = 0x3705
+PR_ATTACH_LONG_FILENAME = 0x3707
+PR_ATTACH_MIME_TAG = 0x370E
+PR_SMTP_ADDRESS = 0x39FE
+PR_INTERNET_CODEPAGE = 0x3FDE
+PR_MESSAGE_CODEPAGE = 0x3FFD
+PR_LTP_ROW_ID = 0x67F2
+
+#values stored in the 4 bytes of the property record (all the others go through a HNID)
+INLINE_TYPES = (PT_SHORT, PT_LONG, PT_FLOAT, PT_ERROR, PT_BOOLEAN)
+
+#headers describing the MIME structure of the original message, replaced when rebuilding the .eml
+MIME_HEADERS = ("content-type", "content-transfer-encoding", "mime-version", "content-disposition")
+
+CODEPAGES = {20127:"ascii", 20932:"euc_jp", 28591:"latin-1", 50220:"iso2022_jp", 50221:"iso2022_jp",
+    50222:"iso2022_jp", 51932:"euc_jp", 51949:"euc_kr", 52936:"hz", 54936:"gb18030", 65000:"utf-7",
+    65001:"utf-8"}
+for _iso in range(2,17):
+    CODEPAGES[28590+_iso] = f"iso8859_{_iso}"
+
+FILETIME_EPOCH = datetime(1601,1,1,tzinfo=timezone.utc)
+
+class PSTError(Exception):
+    """ raised on files which are not .pst/.ost or use unsupported features """
+
+def codepage_codec(codepage):
+    """ python codec name for a windows code page (cp1252 when unknown) """
+    name = CODEPAGES.get(codepage,f"cp{codepage}")
+    try:
+        codecs.lookup(name)
+    except LookupError:
+        name = "cp1252"
+    return name
+
+def filetime_to_datetime(filetime):
+    """ FILETIME (100ns since 1601-01-01 UTC) to timezone aware datetime """
+    return FILETIME_EPOCH+timedelta(microseconds=filetime//10)
+
+def decrypt_permute(data):
+    """ NDB_CRYPT_PERMUTE decoding """
+    return data.translate(MPBB_I)
+
+def decrypt_cyclic(data,key):
+    """ NDB_CRYPT_CYCLIC decoding (the cipher is its own inverse), key is the low 32 bits of the bid """
+    w = (key^(key>>16))&0xFFFF
+    out = bytearray(data)
+    for i, b in enumerate(out):
+        b = (b+w)&0xFF
+        b = MPBB_R[b]
+        b = (b+(w>>8))&0xFF
+        b = MPBB_S[b]
+        b = (b-(w>>8))&0xFF
+        b = MPBB_I[b]
+        out[i] = (b-w)&0xFF
+        w = (w+1)&0xFFFF
+    return bytes(out)
+
+class PSTFile:
+    """ NDB layer of a .pst/.ost file: node and block lookups, data and subnode trees
+    Parameters:
+    -----------
+    pst_fp: str
+        full path to the .pst/.ost file
+    page_cache: int
+        number of B-tree pages kept in memory
+    """
+    def __init__(self,pst_fp,page_cache=4096):
+        self.pst_fp = pst_fp
+        self.fi = open(pst_fp,"rb")
+        self._pages = OrderedDict()
+        self._page_cache = page_cache
+        try:
+            self._read_header()
+        except:
+            self.fi.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        self.fi.close()
+
+    def _read_header(self):
+        header = self.fi.read(564)
+        if len(header)<512 or header[:4]!=b"!BDN":
+            raise PSTError(f"not a pst/ost file: {self.pst_fp}")
+        magic_client, version = struct.unpack_from("<2sH",header,8)
+        if magic_client not in (b"SM",b"SO"):
+            raise PSTError(f"unknown client magic {magic_client!r} in {self.pst_fp}")
+        if version in (14,15):
+            self.unicode = False
+            nbt_ib, bbt_ib = struct.unpack_from("<I4xI",header,188)
+            self.crypt = header[461]
+            self.ptr = 4
+        elif version in (23,):
+            self.unicode = True
+            nbt_ib, bbt_ib = struct.unpack_from("<Q8xQ",header,224)
+            self.crypt = header[513]
+            self.ptr = 8
+        else:
+            raise PSTError(f"unsupported pst version {version} in {self.pst_fp}")
+        if self.crypt not in (NDB_CRYPT_NONE,NDB_CRYPT_PERMUTE,NDB_CRYPT_CYCLIC):
+            raise PSTError(f"unsupported encryption {self.crypt} in {self.pst_fp}")
+        self.nbt_ib = nbt_ib
+        self.bbt_ib = bbt_ib
+        self.version = version
+        #rows of a table context are not split across the data blocks of 8192 bytes minus the trailer
+        self.max_block_data = 8192-(16 if self.unicode else 12)
+
+    def _unpack_ptr(self,data,offset):
+        if self.unicode:
+            return struct.unpack_from("<Q",data,offset)[0]
+        return struct.unpack_from("<I",data,offset)[0]
+
+    ######## NDB: B-trees
+
+    def _read_page(self,ib):
+        page = self._pages.get(ib)
+        if page is not None:
+            self._pages.move_to_end(ib)
+            return page
+        self.fi.seek(ib)
+        data = self.fi.read(512)
+        if len(data)!=512:
+            raise PSTError(f"truncated page at {ib} in {self.pst_fp}")
+        if self.unicode:
+            count, max_count, entry_size, level = struct.unpack_from("<BBBB",data,488)
+            ptype = data[496]
+        else:
+            count, max_count, entry_size, level = struct.unpack_from("<BBBB",data,496)
+            ptype = data[500]
+        page = (ptype,level,entry_size,count,data)
+        self._pages[ib] = page
+        if len(self._pages)>self._page_cache:
+            self._pages.popitem(last=False)
+        return page
+
+    def _btree_lookup(self,ib,key,ptype):
+        """ Returns the raw leaf entry of the B-tree rooted at page ib for key (None when not found) """
+        while True:
+            page_type, level, entry_size, count, data = self._read_page(ib)
+            if page_type!=ptype:
+                raise PSTError(f"unexpected page type {page_type:#x} at {ib} in {self.pst_fp}")
+            keys = [self._unpack_ptr(data,i*entry_size) for i in range(count)]
+            if level==0:
+                for i, entry_key in enumerate(keys):
+                    if self._key(entry_key,ptype)==key:
+                        return data[i*entry_size:(i+1)*entry_size]
+                return None
+            #intermediate page: last entry whose key is lower or equal
+            child = None
+            for i, entry_key in enumerate(keys):
+                if self._key(entry_key,ptype)>key:
+                    break
+                child = i
+            if child is None:
+                return None
+            ib = self._unpack_ptr(data,child*entry_size+2*self.ptr)
+
+    def _key(self,key,ptype):
+        if ptype==PTYPE_NBT:
+            return key&0xFFFFFFFF
+        return key&~1
+
+    def node(self,nid):
+        """ Returns (bid_data, bid_sub, nid_parent) of a node of the NBT """
+        entry = self._btree_lookup(self.nbt_ib,nid,PTYPE_NBT)
+        if entry is None:
+            raise PSTError(f"node {nid:#x} not found in {self.pst_fp}")
+        if self.unicode:
+            bid_data, bid_sub, nid_parent = struct.unpack_from("<QQI",entry,8)
+        else:
+            bid_data, bid_sub, nid_parent = struct.unpack_from("<III",entry,4)
+        return bid_data, bid_sub, nid_parent
+
+    def has_node(self,nid):
+        return self._btree_lookup(self.nbt_ib,nid,PTYPE_NBT) is not None
+
+    ######## NDB: blocks
+
+    def read_block(self,bid):
+        """ Returns the (decrypted) data of a block """
+        entry = self._btree_lookup(self.bbt_ib,bid&~1,PTYPE_BBT)
+        if entry is None:
+            raise PSTError(f"block {bid:#x} not found in {self.pst_fp}")
+        if self.unicode:
+            ib, cb = struct.unpack_from("<QH",entry,8)
+        else:
+            ib, cb = struct.unpack_from("<IH",entry,4)
+        self.fi.seek(ib)
+        data = self.fi.read(cb)
+        if len(data)!=cb:
+            raise PSTError(f"truncated block {bid:#x} in {self.pst_fp}")
+        #internal blocks (XBLOCK, SLBLOCK, ...) are never encrypted
+        if not bid&0x2:
+            if self.crypt==NDB_CRYPT_PERMUTE:
+                data = decrypt_permute(data)
+            elif self.crypt==NDB_CRYPT_CYCLIC:
+                data = decrypt_cyclic(data,bid&0xFFFFFFFF)
+        return data
+
+    def data_blocks(self,bid):
+        """ Returns the list of data blocks of a data tree (a single block or XBLOCK/XXBLOCK) """
+        if not bid:
+            return []
+        data = self.read_block(bid)
+        if not bid&0x2:
+            return [data]
+        btype, level, count = struct.unpack_from("<BBH",data,0)
+        if btype!=0x01:
+            raise PSTError(f"unexpected block type {btype:#x} for data tree {bid:#x}")
+        blocks = []
+        for i in range(count):
+            child = self._unpack_ptr(data,8+i*self.ptr)
+            if level==1:
+                blocks.append(self.read_block(child))
+            else:
+                blocks.extend(self.data_blocks(child))
+        return blocks
+
+    def read_data(self,bid):
+        """ Returns the content of a data tree as a single bytes """
+        return b"".join(self.data_blocks(bid))
+
+    def subnodes(self,bid_sub):
+        """ Returns dict nid -> (bid_data, bid_sub) of a subnode tree (SLBLOCK/SIBLOCK) """
+        result = {}
+        if not bid_sub:
+            return result
+        data = self.read_block(bid_sub)
+        btype, level, count = struct.unpack_from("<BBH",data,0)
+        if btype!=0x02:
+            raise PSTError(f"unexpected block type {btype:#x} for subnode tree {bid_sub:#x}")
+        offset = 8 if self.unicode else 4
+        if level==0:
+            for i in range(count):
+                nid = self._unpack_ptr(data,offset+i*3*self.ptr)&0xFFFFFFFF
+                bid_data = self._unpack_ptr(data,offset+(i*3+1)*self.ptr)
+                bid_sub_child = self._unpack_ptr(data,offset+(i*3+2)*self.ptr)
+                result[nid] = (bid_data,bid_sub_child)
+        else:
+            for i in range(count):
+                result.update(self.subnodes(self._unpack_ptr(data,offset+(i*2+1)*self.ptr)))
+        return result
+
+    ######## messaging layer
+
+    def message_store(self):
+        """ property context of the message store """
+        bid_data, bid_sub, _ = self.node(NID_MESSAGE_STORE)
+        return PropertyContext(self,bid_data,self.subnodes(bid_sub))
+
+    def folder(self,nid,path=()):
+        return PSTFolder(self,nid,path)
+
+    def root_folder(self):
+        return self.folder(NID_ROOT_FOLDER)
+
+    def iter_folders(self,folder=None):
+        """ yields every folder (depth first, root folder included) """
+        if folder is None:
+            folder = self.root_folder()
+        yield folder
+        for subfolder in folder.subfolders():
+            yield from self.iter_folders(subfolder)
+
+    def iter_messages(self):
+        """ yields a PSTMessage for every message of every folder, only the message property context
+        is read until the body or attachments are accessed """
+        for folder in self.iter_folders():
+            yield from folder.messages()
+
+class Heap:
+    """ LTP heap-on-node built from the data blocks of a node """
+    def __init__(self,blocks):
+        if not blocks:
+            raise PSTError("empty heap")
+        self.blocks = blocks
+        ib_hnpm, sig, self.client_sig, self.root = struct.unpack_from("<HBBI",blocks[0],0)
+        if sig!=HN_SIG:
+            raise PSTError(f"bad heap signature {sig:#x}")
+
+    def get(self,hid):
+        """ Returns the allocation referenced by a HID """
+        if not hid:
+            return b""
+        index = (hid>>5)&0x7FF
+        block = self.blocks[hid>>16]
+        ib_hnpm = struct.unpack_from("<H",block,0)[0]
+        start, end = struct.unpack_from("<HH",block,ib_hnpm+4+(index-1)*2)
+        return block[start:end]
+
+    def bth_records(self,hid):
+        """ Returns the (key, data) records of the BTree-on-heap whose header is at hid """
+        sig, key_size, entry_size, levels, root = struct.unpack_from("<BBBBI",self.get(hid),0)
+        if sig!=BTH_SIG:
+            raise PSTError(f"bad BTH signature {sig:#x}")
+        records = []
+        self._bth_walk(root,levels,key_size,entry_size,records)
+        return records
+
+    def _bth_walk(self,hid,level,key_size,entry_size,records):
+        if not hid:
+            return
+        data = self.get(hid)
+        if level==0:
+            size = key_size+entry_size
+            for i in range(len(data)//size):
+                record = data[i*size:(i+1)*size]
+                records.append((record[:key_size],record[key_size:]))
+        else:
+            size = key_size+4
+            for i in range(len(data)//size):
+                child = struct.unpack_from("<I",data,i*size+key_size)[0]
+                self._bth_walk(child,level-1,key_size,entry_size,records)
+
+class _HeapContext:
+    """ common part of property and table contexts: heap values referenced by HNID """
+    def __init__(self,pst,bid_data,subnodes,client_sig):
+        self.pst = pst
+        self.subnodes = subnodes
+        self.heap = Heap(pst.data_blocks(bid_data))
+        if self.heap.client_sig!=client_sig:
+            raise PSTError(f"unexpected heap client signature {self.heap.client_sig:#x}")
+        self.codec = "cp1252"
+
+    def hnid_data(self,hnid):
+        """ Returns the bytes referenced by a HNID: heap allocation or subnode data """
+        if not hnid:
+            return b""
+        if hnid&0x1F==NID_TYPE_HID:
+            return self.heap.get(hnid)
+        if hnid not in self.subnodes:
+            raise PSTError(f"subnode {hnid:#x} not found")
+        return self.pst.read_data(self.subnodes[hnid][0])
+
+    def decode(self,prop_type,raw):
+        """ decodes a property value (raw: value bytes, or the 4/8 inline bytes) """
+        if prop_type==PT_SHORT:
+            return struct.unpack_from("<h",raw,0)[0]
+        if prop_type in (PT_LONG,):
+            return struct.unpack_from("<i",raw,0)[0]
+        if prop_type==PT_ERROR:
+            return struct.unpack_from("<I",raw,0)[0]
+        if prop_type==PT_BOOLEAN:
+            return bool(raw[0])
+        if prop_type==PT_FLOAT:
+            return struct.unpack_from("<f",raw,0)[0]
+        if prop_type in (PT_DOUBLE,PT_APPTIME):
+            return struct.unpack_from("<d",raw,0)[0]
+        if prop_type in (PT_LONGLONG,PT_CURRENCY):
+            return struct.unpack_from("<q",raw,0)[0]
+        if prop_type==PT_SYSTIME:
+            return filetime_to_datetime(struct.unpack_from("<Q",raw,0)[0])
+        if prop_type==PT_UNICODE:
+            return raw.decode("utf-16-le","replace")
+        if prop_type==PT_STRING8:
+            return raw.decode(self.codec,"replace").rstrip("\x00")
+        if prop_type in (PT_UNICODE|MV_FLAG,PT_STRING8|MV_FLAG,PT_BINARY|MV_FLAG):
+            count = struct.unpack_from("<I",raw,0)[0]
+            offsets = list(struct.unpack_from(f"<{count}I",raw,4))+[len(raw)]
+            return [self.decode(prop_type&~MV_FLAG,raw[offsets[i]:offsets[i+1]]) for i in range(count)]
+        if prop_type==PT_LONG|MV_FLAG:
+            return list(struct.unpack(f"<{len(raw)//4}i",raw))
+        #binary, guid, object and other multi valued types are returned as bytes
+        return raw
+
+class PropertyContext(_HeapContext):
+    """ LTP property context, values are only read and decoded when accessed
+    Parameters:
+    -----------
+    pst: PSTFile
+    bid_data: int
+        data tree of the node holding the property context
+    subnodes: dict
+        subnodes of that node (see PSTFile.subnodes), holding the large values
+    """
+    def __init__(self,pst,bid_data,subnodes):
+        super().__init__(pst,bid_data,subnodes,PC_SIG)
+        self.props = {}
+        for key, data in self.heap.bth_records(self.heap.root):
+            prop_id = struct.unpack_from("<H",key,0)[0]
+            prop_type, value = struct.unpack_from("<HI",data,0)
+            self.props[prop_id] = (prop_type,value)
+        codepage = self.get(PR_MESSAGE_CODEPAGE) or self.get(PR_INTERNET_CODEPAGE)
+        if codepage:
+            self.codec = codepage_codec(codepage)
+
+    def __contains__(self,prop_id):
+        return prop_id in self.props
+
+    def prop_type(self,prop_id):
+        return self.props[prop_id][0]
+
+    def raw(self,prop_id):
+        """ Returns the undecoded bytes of a variable size property """
+        prop_type, value = self.props[prop_id]
+        if prop_type in INLINE_TYPES:
+            return struct.pack("<I",value)
+        return self.hnid_data(value)
+
+    def get(self,prop_id,default=None):
+        """ Returns the decoded value of a property (default when absent) """
+        if prop_id not in self.props:
+            return default
+        prop_type, value = self.props[prop_id]
+        return self.decode(prop_type,self.raw(prop_id))
+
+class TableContext(_HeapContext):
+    """ LTP table context (rows of a hierarchy, contents, recipient or attachment table) """
+    def __init__(self,pst,bid_data,subnodes):
+        super().__init__(pst,bid_data,subnodes,TC_SIG)
+        info = self.heap.get(self.heap.root)
+        sig, cols = struct.unpack_from("<BB",info,0)
+        self.row_size = struct.unpack_from("<4H",info,2)[3]
+        self.ceb_offset = struct.unpack_from("<4H",info,2)[2]
+        hid_row_index, self.hnid_rows = struct.unpack_from("<II",info,10)
+        self.columns = []
+        for i in range(cols):
+            tag, ib_data, cb_data, i_bit = struct.unpack_from("<IHBB",info,22+i*8)
+            self.columns.append((tag>>16,tag&0xFFFF,ib_data,cb_data,i_bit))
+        self.row_count = len(self.heap.bth_records(hid_row_index))
+
+    def _row_blocks(self):
+        if not self.hnid_rows or not self.row_size:
+            return []
+        if self.hnid_rows&0x1F==NID_TYPE_HID:
+            return [self.heap.get(self.hnid_rows)]
+        return self.pst.data_blocks(self.subnodes[self.hnid_rows][0])
+
+    def rows(self):
+        """ yields a dict prop_id -> value per row (absent cells are not in the dict) """
+        remaining = self.row_count
+        for block in self._row_blocks():
+            for i in range(len(block)//self.row_size):
+                if remaining<=0:
+                    return
+                remaining -= 1
+                row = block[i*self.row_size:(i+1)*self.row_size]
+                yield self._decode_row(row)
+
+    def _decode_row(self,row):
+        values = {}
+        ceb = row[self.ceb_offset:]
+        for prop_id, prop_type, ib_data, cb_data, i_bit in self.columns:
+            if not ceb[i_bit//8]&(1<<(7-i_bit%8)):
+                continue
+            cell = row[ib_data:ib_data+cb_data]
+            if prop_type in INLINE_TYPES or prop_type in (PT_LONGLONG,PT_SYSTIME,PT_DOUBLE,PT_CURRENCY,PT_APPTIME):
+                values[prop_id] = self.decode(prop_type,cell)
+            else:
+                values[prop_id] = self.decode(prop_type,self.hnid_data(struct.unpack_from("<I",cell,0)[0]))
+        return values
+
+    def row_ids(self):
+        return [row[PR_LTP_ROW_ID] for row in self.rows() if PR_LTP_ROW_ID in row]
+
+class PSTFolder:
+    """ folder of the pst (property context, hierarchy and contents tables) """
+    def __init__(self,pst,nid,path=()):
+        self.pst = pst
+        self.nid = nid
+        bid_data, bid_sub, self.nid_parent = pst.node(nid)
+        self.props = PropertyContext(pst,bid_data,pst.subnodes(bid_sub))
+        self.name = self.props.get(PR_DISPLAY_NAME) or ""
+        #the root folder has no name and is not part of the folder paths
+        self.path = tuple(path)+((self.name,) if nid!=NID_ROOT_FOLDER else ())
+
+    def _table(self,nid_type):
+        nid = (self.nid&~0x1F)|nid_type
+        if not self.pst.has_node(nid):
+            return None
+        bid_data, bid_sub, _ = self.pst.node(nid)
+        return TableContext(self.pst,bid_data,self.pst.subnodes(bid_sub))
+
+    def subfolders(self):
+        """ yields the normal (non search) subfolders """
+        table = self._table(NID_TYPE_HIERARCHY_TABLE)
+        if table is None:
+            return
+        for nid in table.row_ids():
+            if nid&0x1F==NID_TYPE_NORMAL_FOLDER:
+                try:
+                    yield PSTFolder(self.pst,nid,self.path)
+                except PSTError as e:
+                    logging.error(f"skipping folder {nid:#x} of {'/'.join(self.path)}: {e}")
+
+    def message_nids(self):
+        table = self._table(NID_TYPE_CONTENTS_TABLE)
+        if table is None:
+            return []
+        return table.row_ids()
+
+    def messages(self):
+        for nid in self.message_nids():
+            try:
+                yield PSTMessage(self.pst,nid,self.path)
+            except PSTError as e:
+                logging.error(f"skipping message {nid:#x} of {'/'.join(self.path)}: {e}")
+
+class PSTAttachment:
+    """ attachment of a message, data is only read when accessed """
+    def __init__(self,pst,bid_data,subnodes):
+        self.props = PropertyContext(pst,bid_data,subnodes)
+        self.filename = self.props.get(PR_ATTACH_LONG_FILENAME) or self.props.get(PR_ATTACH_FILENAME) or ""
+        self.mime_type = self.props.get(PR_ATTACH_MIME_TAG) or "application/octet-stream"
+        self.method = self.props.get(PR_ATTACH_METHOD,1)
+
+    @property
+    def data(self):
+        if PR_ATTACH_DATA not in self.props or self.props.prop_type(PR_ATTACH_DATA)!=PT_BINARY:
+            #embedded messages (PT_OBJECT) and OLE objects are not extracted
+            return None
+        return self.props.raw(PR_ATTACH_DATA)
+
+class PSTMessage:
+    """ message of the pst, the property context is read on creation, the body, recipients and
+    attachments on access
+    """
+    def __init__(self,pst,nid,folder_path=()):
+        self.pst = pst
+        self.nid = nid
+        self.folder_path = tuple(folder_path)
+        bid_data, bid_sub, _ = pst.node(nid)
+        self._bid_sub = bid_sub
+        self._subnodes = None
+        self.props = PropertyContext(pst,bid_data,self.subnodes)
+
+    @property
+    def subnodes(self):
+        if self._subnodes is None:
+            self._subnodes = self.pst.subnodes(self._bid_sub)
+        return self._subnodes
+
+    @property
+    def subject(self):
+        subject = self.props.get(PR_SUBJECT) or ""
+        #a leading \x01 is followed by the length of the subject prefix ("RE: ") which is kept in the text
+        if subject[:1]=="\x01":
+            subject = subject[2:]
+        return subject
+
+    @property
+    def message_class(self):
+        return self.props.get(PR_MESSAGE_CLASS) or ""
+
+    @property
+    def transport_headers(self):
+        return self.props.get(PR_TRANSPORT_MESSAGE_HEADERS) or ""
+
+    @property
+    def sent_date(self):
+        """ submit time, or delivery time or creation time when not submitted (UTC datetime) """
+        for prop_id in (PR_CLIENT_SUBMIT_TIME,PR_MESSAGE_DELIVERY_TIME,PR_CREATION_TIME):
+            value = self.props.get(prop_id)
+            if value is not None:
+                return value
+        return None
+
+    @property
+    def sender(self):
+        name = self.props.get(PR_SENDER_NAME) or self.props.get(PR_SENT_REPRESENTING_NAME) or ""
+        address = self.props.get(PR_SENDER_EMAIL_ADDRESS) or self.props.get(PR_SENT_REPRESENTING_EMAIL_ADDRESS) or ""
+        return _mailbox(name,address)
+
+    @property
+    def body(self):
+        return self.props.get(PR_BODY)
+
+    @property
+    def html(self):
+        """ html body as bytes (in the internet code page) """
+        if PR_HTML not in self.props:
+            return None
+        if self.props.prop_type(PR_HTML)==PT_BINARY:
+            return self.props.raw(PR_HTML)
+        return self.props.get(PR_HTML).encode("utf-8")
+
+    def _table(self,nid):
+        if nid not in self.subnodes:
+            return None
+        bid_data, bid_sub = self.subnodes[nid]
+        return TableContext(self.pst,bid_data,self.pst.subnodes(bid_sub))
+
+    def recipients(self):
+        """ Returns list of (recipient type 1:To 2:Cc 3:Bcc, display name, address) """
+        table = self._table(NID_RECIPIENT_TABLE)
+        if table is None:
+            return []
+        recipients = []
+        for row in table.rows():
+            address = row.get(PR_SMTP_ADDRESS) or row.get(PR_EMAIL_ADDRESS) or ""
+            recipients.append((row.get(PR_RECIPIENT_TYPE,1),row.get(PR_DISPLAY_NAME) or "",address))
+        return recipients
+
+    def attachments(self):
+        """ yields the PSTAttachment of the message """
+        table = self._table(NID_ATTACHMENT_TABLE)
+        if table is None:
+            return
+        for nid in table.row_ids():
+            if nid not in self.subnodes:
+                logging.warning(f"attachment {nid:#x} of message {self.nid:#x} not found")
+                continue
+            bid_data, bid_sub = self.subnodes[nid]
+            yield PSTAttachment(self.pst,bid_data,self.pst.subnodes(bid_sub))
+
+    def headers(self):
+        """ Returns the header block (email.message.Message without body) as it is written by to_eml:
+        the transport headers when the message was received from internet, else headers built
+        from the message properties
+        """
+        headers = Message()
+        transport = self.transport_headers.strip()
+        if transport:
+            parsed = HeaderParser().parsestr(transport+"\n\n",headersonly=True)
+            for name, value in parsed.items():
+                if name.lower() not in MIME_HEADERS:
+                    headers[name] = value
+            if headers["Subject"] is None and self.subject:
+                headers["Subject"] = _header_value(self.subject)
+            return headers
+        headers["From"] = _header_value(self.sender)
+        recipients = self.recipients()
+        to = [_mailbox(name,address) for kind, name, address in recipients if kind==1] or [self.props.get(PR_DISPLAY_TO) or ""]
+        cc = [_mailbox(name,address) for kind, name, address in recipients if kind==2]
+        headers["To"] = _header_value(", ".join(to))
+        if cc:
+            headers["Cc"] = _header_value(", ".join(cc))
+        headers["Subject"] = _header_value(self.subject)
+        if self.sent_date is not None:
+            headers["Date"] = format_datetime(self.sent_date)
+        message_id = self.props.get(PR_INTERNET_MESSAGE_ID)
+        if message_id:
+            headers["Message-ID"] = message_id
+        return headers
+
+    def to_eml(self,headers=None):
+        """ Returns the message as RFC 822 bytes (headers, text/html bodies and attachments)
+        Parameters:
+        -----------
+        headers: email.message.Message
+            header block already returned by headers() (read again when None)
+        """
+        if headers is None:
+            headers = self.headers()
+        body = self.body
+        html = self.html
+        text_part = MIMEText(body or "","plain","utf-8")
+        if html:
+            del text_part["MIME-Version"]
+            html_part = MIMEText("","html")
+            del html_part["MIME-Version"]
+            html_part.set_payload(html)
+            encoders.encode_base64(html_part)
+            content = MIMEMultipart("alternative",_subparts=[text_part,html_part])
+        else:
+            content = text_part
+        parts = []
+        for attachment in self.attachments():
+            data = attachment.data
+            if data is None:
+                logging.info(f"skipping non binary attachment {attachment.filename} of message {self.nid:#x}")
+                continue
+            maintype, _, subtype = attachment.mime_type.partition("/")
+            part = MIMEBase(maintype or "application",subtype or "octet-stream")
+            del part["MIME-Version"]
+            part.set_payload(data)
+            encoders.encode_base64(part)
+            if attachment.filename:
+                part.add_header("Content-Disposition","attachment",filename=("utf-8","",attachment.filename))
+            else:
+                part.add_header("Content-Disposition","attachment")
+            parts.append(part)
+        if parts:
+            if content is text_part:
+                del text_part["MIME-Version"]
+            root = MIMEMultipart("mixed",_subparts=[content]+parts)
+        else:
+            root = content
+        #message headers first, then the headers of the rebuilt MIME structure
+        mime_headers = [(name,value) for name, value in root.items() if name.lower()!="mime-version"]
+        for name in set(root.keys()):
+            del root[name]
+        for name, value in headers.items():
+            root[name] = value
+        root["MIME-Version"] = "1.0"
+        for name, value in mime_headers:
+            root[name] = value
+        return root.as_bytes()
+
+def _header_value(value):
+    """ encoded-word for non ascii header values """
+    try:
+        value.encode("ascii")
+        return value
+    except UnicodeEncodeError:
+        return Header(value,"utf-8").encode()
+
+def _mailbox(name,address):
+    """ "name <address>" (or whichever of the two is known) """
+    if name and address and name!=address:
+        return f"{name} <{address}>"
+    return name or address
@@ -0,0 +1,262 @@
+"""
+per file error isolation: quarantine and error budgets instead of whole run aborts
+
+without an error policy, a malformed message (a missing or unparsable date, a corrupt file) raises out of
+pst2eml.process_eml_folder and stops the run. With an ErrorPolicy the failure of a file is recorded with
+its cause (stage and exception, e.g. "headers: invalid date", "rename: PermissionError") and the run goes
+on with the next file:
+* quarantine: the file is moved to the quarantine folder (.pst2eml_quarantine at the root of the eml
+    folder by default, same sub folders as in the eml folder) with a reason record next to it
+    (<name>.reason.json: original path, cause, stage, error, time)
+* skip: the file is left where it is
+* raise: the first failure stops the run (the behaviour without policy)
+
+error budgets stop the run once more than max_errors files failed, or more than max_error_rate of the
+files (checked after min_files files), with ErrorBudgetExceeded: a run on a broken share or with a wrong
+option stops early instead of quarantining the whole archive.
+
+the report groups the failures by cause with a few examples, it is returned in the run summary and
+written in the quarantine folder (report.json). The quarantined files are retried by a later run
+(make_eml_search_friendly retry_quarantined): they are moved back to their folders and only they are
+processed.
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from os.path import abspath, basename, dirname, exists, join, relpath
+import shutil
+
+QUARANTINE_NAME = ".pst2eml_quarantine"
+REASON_SUFFIX = ".reason.json"
+REPORT_NAME = "report.json"
+ON_ERROR = ("quarantine","skip","raise")
+#files processed before max_error_rate applies
+MIN_FILES = 100
+#paths listed per cause in the report
+EXAMPLES = 5
+
+class HeaderError(Exception):
+    """ a header needed to rename the file is missing or invalid
+    Parameters:
+    -----------
+    cause: str
+        short reason used to group the failures, e.g. "missing date"
+    message: str
+        log message with the file path
+    """
+    def __init__(self,cause,message):
+        super().__init__("HeaderError",message)
+        self.cause = cause
+
+    def __reduce__(self):
+        return HeaderError, (self.cause,self.args[1])
+
+class StageError(Exception):
+    """ failure of a file at a processing step (see failure_cause), error: the exception raised """
+    def __init__(self,stage,error):
+        super().__init__(stage,error)
+        self.stage = stage
+        self.error = error
+
+class ErrorBudgetExceeded(Exception):
+    """ too many files failed, report: see ErrorPolicy.report """
+    def __init__(self,report):
+        super().__init__(f"error budget exceeded: {report['failures']} failed files out of {report['files']}")
+        self.report = report
+
+    def __reduce__(self):
+        return ErrorBudgetExceeded, (self.report,)
+
+def is_quarantine_folder(name):
+    return name==QUARANTINE_NAME
+
+def is_reason_file(fn):
+    return fn.endswith(REASON_SUFFIX)
+
+def failure_cause(stage,e):
+    """ "stage: reason" grouping key of a failure """
+    if isinstance(e,HeaderError):
+        return f"{stage}: {e.cause}"
+    return f"{stage}: {type(e).__name__}"
+
+class ErrorPolicy:
+    """ what to do with a file which failed
+    Parameters:
+    -----------
+    root: str
+        eml folder (paths of the records are relative to it)
+    mode: str
+        "quarantine", "skip" or "raise"
+    max_errors: int
+        failed files before the run stops (None: no limit)
+    max_error_rate: float
+        failed files / files processed before the run stops (None: no limit)
+    min_files: int
+        files processed before max_error_rate applies
+    folder: str
+        quarantine folder (default: .pst2eml_quarantine in root)
+    """
+    def __init__(self,root,mode="quarantine",max_errors=None,max_error_rate=None,min_files=MIN_FILES,folder=None):
+        if mode not in ON_ERROR:
+            raise ValueError(f"unknown error mode {mode}")
+        self.root = abspath(root)
+        self.mode = mode
+        self.max_errors = max_errors
+        self.max_error_rate = max_error_rate
+        self.min_files = min_files
+        self.folder = abspath(folder or join(self.root,QUARANTINE_NAME))
+        #files processed (failed or not) and failure records
+        self.files = 0
+        self.failures = []
+
+    def config(self):
+        """ parameters to build the same policy in another process """
+        return {"root":self.root,"mode":self.mode,"max_errors":self.max_errors,"max_error_rate":self.max_error_rate,
+            "min_files":self.min_files,"folder":self.folder}
+
+    def file_done(self):
+        self.files+=1
+
+    def fail(self,eml_fp,stage,e):
+        """ records the failure of a file (counted as processed, see file_done) and quarantines it, raises e
+        in raise mode and ErrorBudgetExceeded once over budget
+        Parameters:
+        -----------
+        eml_fp: str
+            current path of the file
+        stage: str
+            processing step which failed (parse, headers, dedup, attachments, rename, record)
+        e: Exception
+        Returns:
+        --------
+        record: dict
+            path, cause, stage, error, time (and quarantine: path in the quarantine folder)
+        """
+        if self.mode=="raise":
+            raise e
+        record = {"path":relpath(eml_fp,self.root).replace(os.sep,"/"),"cause":failure_cause(stage,e),"stage":stage,
+            "error":repr(e)[:1000],"time":datetime.now(timezone.utc).isoformat()}
+        log_msg = "%s failed (%s): %s"%(eml_fp,record["cause"],e)
+        logging.error(log_msg)
+        if self.mode=="quarantine" and exists(eml_fp):
+            record["quarantine"] = self.quarantine(eml_fp,record)
+        self.failures.append(record)
+        self.files+=1
+        self.check()
+        return record
+
+    def quarantine(self,eml_fp,record):
+        """ moves a file to the quarantine folder with its reason record, Returns its path in the folder """
+        from .pst2eml import incrementalfilename
+        folder = join(self.folder,relpath(dirname(abspath(eml_fp)),self.root))
+        os.makedirs(folder,exist_ok=True)
+        name = basename(eml_fp)
+        if exists(join(folder,name)):
+            name = incrementalfilename(folder,name)
+        fp = join(folder,name)
+        shutil.move(eml_fp,fp)
+        tmp_fp = fp+REASON_SUFFIX+".tmp"
+        with open(tmp_fp,"w",encoding="utf-8") as fo:
+            json.dump(record,fo,indent=1)
+        os.replace(tmp_fp,fp+REASON_SUFFIX)
+        return relpath(fp,self.folder).replace(os.sep,"/")
+
+    def merge(self,errors,check=True):
+        """ adds the files and failures of a policy of another process (see process_eml_folder) """
+        self.files+=errors["files"]
+        self.failures.extend(errors["failures"])
+        if check:
+            self.check()
+
+    def check(self):
+        failures = len(self.failures)
+        over = self.max_errors is not None and failures>self.max_errors
+        if self.max_error_rate is not None and self.files>=self.min_files:
+            over = over or failures>self.max_error_rate*self.files
+        if over:
+            self.save_report()
+            raise ErrorBudgetExceeded(self.report())
+
+    def report(self):
+        """ Returns the failures grouped by cause (count and example paths), most frequent first """
+        causes = {}
+        for record in self.failures:
+            cause = causes.setdefault(record["cause"],{"count":0,"examples":[]})
+            cause["count"]+=1
+            if len(cause["examples"])<EXAMPLES:
+                cause["examples"].append(record["path"])
+        return {"files":self.files,"failures":len(self.failures),
+            "quarantined":len([record for record in self.failures if "quarantine" in record]),
+            "causes":dict(sorted(causes.items(),key=lambda item:-item[1]["count"]))}
+
+    def save_report(self):
+        """ writes the report in the quarantine folder (if files were quarantined) """
+        if not any("quarantine" in record for record in self.failures):
+            return
+        with open(join(self.folder,REPORT_NAME),"w",encoding="utf-8") as fo:
+            json.dump(self.report(),fo,indent=1)
+
+def print_failures(report):
+    """ prints the failures of a report (see ErrorPolicy.report) grouped by cause """
+    for cause, group in report["causes"].items():
+        print(f"  {cause}: {group['count']} files, e.g. {', '.join(group['examples'])}")
+
+def get_error_policy(errors,root=None):
+    """ Returns the ErrorPolicy of errors: None, an ErrorPolicy, a mode or a dict of ErrorPolicy parameters
+    (root defaults to the given root) """
+    if errors is None or isinstance(errors,ErrorPolicy):
+        return errors
+    if isinstance(errors,str):
+        errors = {"mode":errors}
+    options = dict(errors)
+    return ErrorPolicy(options.pop("root",root),**options)
+
+def restore_quarantined(root,folder=None):
+    """ moves the quarantined files back to their original folders (suffixed if the name was taken since)
+    and removes their reason records
+    Parameters:
+    -----------
+    root: str
+        eml folder
+    folder: str
+        quarantine folder (default: .pst2eml_quarantine in root)
+    Returns:
+    --------
+    restored: dict
+        folder -> names of the files restored in it
+    """
+    from .pst2eml import incrementalfilename
+    root = abspath(root)
+    folder = abspath(folder or join(root,QUARANTINE_NAME))
+    restored = {}
+    if not exists(folder):
+        return restored
+    #report of the previous run, the failures of the retry get a new one
+    if exists(join(folder,REPORT_NAME)):
+        os.remove(join(folder,REPORT_NAME))
+    for quarantine_root, directory, files in os.walk(folder,topdown=False):
+        for fn in files:
+            if not is_reason_file(fn):
+                continue
+            reason_fp = join(quarantine_root,fn)
+            fp = reason_fp[:-len(REASON_SUFFIX)]
+            with open(reason_fp,encoding="utf-8") as fi:
+                record = json.load(fi)
+            original = join(root,*record["path"].split("/"))
+            original_folder = dirname(original)
+            os.makedirs(original_folder,exist_ok=True)
+            name = basename(original)
+            if exists(original):
+                name = incrementalfilename(original_folder,name)
+            if exists(fp):
+                shutil.move(fp,join(original_folder,name))
+                restored.setdefault(original_folder,[]).append(name)
+            os.remove(reason_fp)
+        if quarantine_root!=folder and not os.listdir(quarantine_root):
+            os.rmdir(quarantine_root)
+    log_msg = "%d quarantined files restored"%(sum(len(names) for names in restored.values()))
+    logging.info(log_msg)
+    return restored
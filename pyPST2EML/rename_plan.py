@@ -0,0 +1,353 @@
+"""
+two-phase renaming: plan, then apply with a journal (dry run and undo)
+
+rename_eml probes the folder with os.path.isfile for each new name and incrementalfilename probes
+name[1], name[2], ... one stat each, so a folder of 10000 "RE: status" messages costs ~50 million stats,
+and a file written in the folder by another program between the probe and the rename is replaced.
+
+* plan: each folder is listed once into a NameIndex (names in memory, case insensitive on windows / SMB
+    shares, next free [i] suffix per name so collisions cost O(1)) and every new name is decided
+    in the os.walk order, as the one-file-after-the-other renaming would decide it
+* apply: the renames are done in the plan order without ever replacing a file (rename_no_replace),
+    each one recorded in a journal (.pst2eml_rename_journal.jsonl at the root of the folder) before it
+    is done, then the metadata are written as with make_eml_search_friendly
+* undo: the journal is replayed backwards, the names and the access/modification times are restored
+    and the metadata written by apply are removed (the backend is recorded in the journal header)
+
+with a layout (see layout) the files are moved to the buckets of their folder, "to" is then the path
+relative to the folder.
+
+Example:
+--------
+python -m pyPST2EML rename -f C:\\outlook\\archives\\eml\\2021Q1 --dry-run
+python -m pyPST2EML rename -f C:\\outlook\\archives\\eml\\2021Q1
+python -m pyPST2EML rename -f C:\\outlook\\archives\\eml\\2021Q1 --undo
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from os.path import abspath, basename, dirname, exists, isdir, join, relpath
+from pathlib import Path
+import re
+
+# own modules
+from .attachments import is_store_folder
+from .quarantine import is_quarantine_folder
+from .catalog import is_catalog_file
+from .layout import LAYOUTS, MAX_FILES, FolderBuckets, Layout, get_layout, is_buckets_folder, is_layout_file
+from .manifest import is_manifest_file
+from .metadata import get_writer, is_sidecar_file
+from .search_index import is_index_file
+from . import pst2eml
+from .pst2eml import rename_no_replace
+from .work_folder import is_work_folder
+
+JOURNAL_NAME = ".pst2eml_rename_journal.jsonl"
+#name[i].ext as written by incrementalfilename
+INCREMENTED = re.compile(r"^(.*)\[([1-9][0-9]*)\]\.([^.]*)$",re.DOTALL)
+
+def is_journal_file(fn):
+    return fn.startswith(JOURNAL_NAME)
+
+def is_special_file(fn):
+    """ files written by the package next to the messages """
+    return (is_manifest_file(fn) or is_sidecar_file(fn) or is_index_file(fn) or is_catalog_file(fn) or is_journal_file(fn)
+        or is_layout_file(fn))
+
+class NameIndex:
+    """ file names of a folder, listed once and kept up to date with the renames decided
+    Parameters:
+    -----------
+    folder: str
+        folder path
+    """
+    def __init__(self,folder):
+        self.folder = abspath(folder)
+        #a bucket folder (see layout) may not be created yet
+        names = [entry.name for entry in os.scandir(folder) if entry.is_file()] if isdir(folder) else []
+        self.case_insensitive = self._probe_case(names)
+        self.names = {self._key(name) for name in names}
+        #(name, extension) -> lowest [i] suffix which may be free, all the lower ones are used
+        self.next_suffix = {}
+
+    def _probe_case(self,names):
+        """ True if the file system ignores the case (windows, most SMB shares) """
+        for name in names:
+            swapped = name.swapcase()
+            if swapped!=name:
+                return os.path.isfile(join(self.folder,swapped))
+        return os.name=="nt"
+
+    def _key(self,name):
+        return name.casefold() if self.case_insensitive else name
+
+    def exists(self,fp):
+        return dirname(fp)==self.folder and self._key(basename(fp)) in self.names
+
+    def incremental(self,path,fn):
+        """ same name as pst2eml.incrementalfilename (lowest free [i]) """
+        fnb = '.'.join(fn.split(".")[:-1])
+        fne = fn.split(".")[-1]
+        suffix_key = (self._key(fnb),self._key(fne))
+        i = self.next_suffix.get(suffix_key,1)
+        while self._key(f"{fnb}[{i}].{fne}") in self.names:
+            i+=1
+        self.next_suffix[suffix_key] = i
+        return f"{fnb}[{i}].{fne}"
+
+    def new_path(self,eml_fp,subject,ignore_ext,policy):
+        """ new full path of eml_fp as rename_eml would choose it """
+        fp_ext = ".eml" if ignore_ext else Path(eml_fp).suffix
+        return pst2eml.new_eml_path(self.folder,subject,fp_ext,policy=policy,exists=self.exists,
+            incremental=self.incremental)
+
+    def remove(self,name):
+        key = self._key(name)
+        self.names.discard(key)
+        match = INCREMENTED.match(key)
+        if match is not None:
+            stem, i, ext = match.groups()
+            if int(i)<self.next_suffix.get((stem,ext),1):
+                self.next_suffix[(stem,ext)] = int(i)
+
+    def add(self,name):
+        self.names.add(self._key(name))
+
+    def rename(self,old_fp,new_fp):
+        self.remove(basename(old_fp))
+        self.add(basename(new_fp))
+
+def plan_folder(root,files,ignore_ext=False,headers_only=False,policy=None,layout=None):
+    """ Returns the renames of the files of a folder: [{"folder", "from", "to", "send_to", "sent_from",
+    "subject", "sent_date"}] in the files order (see process_eml_folder for the parameters) """
+    names = NameIndex(root)
+    layout = get_layout(layout)
+    buckets = FolderBuckets(layout,root) if layout is not None else None
+    #bucket folder -> NameIndex
+    bucket_names = {}
+    entries = []
+    for fn in files:
+        if is_special_file(fn) or not (fn.find(".eml")>=0 or fn.find(".ics")>=0 or ignore_ext):
+            continue
+        eml_fp = abspath(join(root,fn))
+        msg, msg_strings = pst2eml.load_eml(eml_fp,headers_only)
+        send_to, sent_from, subject, sent_date = pst2eml.msg_get_parameters(msg,msg_strings,eml_fp)
+        if ignore_ext and not pst2eml.is_eml(send_to,sent_from,subject,sent_date):
+            continue
+        if buckets is None:
+            new_eml_fp = names.new_path(eml_fp,subject,ignore_ext,policy)
+            names.rename(eml_fp,new_eml_fp)
+        else:
+            folder = buckets.destination(subject,sent_date,create=False)
+            if folder not in bucket_names:
+                bucket_names[folder] = NameIndex(folder)
+            new_eml_fp = bucket_names[folder].new_path(eml_fp,subject,ignore_ext,policy)
+            bucket_names[folder].add(basename(new_eml_fp))
+        entries.append({"folder":root,"from":fn,"to":relpath(new_eml_fp,root),"send_to":send_to,
+            "sent_from":sent_from,"subject":subject,"sent_date":sent_date.isoformat()})
+    return entries
+
+def plan_renames(eml_folder,ignore_ext=False,headers_only=False,policy=None,jobs=1,layout=None):
+    """ plans the renames of all the files under eml_folder (nothing is changed on disk)
+    Parameters:
+    -----------
+    jobs: int
+        number of processes, one folder per process
+    layout: Layout or str
+        bucketed layout, see layout (the buckets of the previous runs are not walked)
+    Returns:
+    --------
+    entries: list
+        see plan_folder, folder by folder in the os.walk order
+    """
+    folders = []
+    for root, directory, files in os.walk(eml_folder):
+        directory[:] = [name for name in directory if not is_store_folder(name) and not is_work_folder(name)
+            and not is_quarantine_folder(name) and not is_buckets_folder(name)]
+        folders.append((root,files))
+    if jobs<=1:
+        plans = [plan_folder(root,files,ignore_ext,headers_only,policy,layout) for root, files in folders]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(plan_folder,root,files,ignore_ext,headers_only,policy,layout) for root, files in folders]
+            plans = [future.result() for future in futures]
+    return [entry for plan in plans for entry in plan]
+
+def apply_plan(eml_folder,entries,journal=None,metadata=None,layout=None):
+    """ renames the files (never replacing a file) and writes their metadata, recording each rename
+    in the journal before doing it
+    Parameters:
+    -----------
+    entries: list
+        see plan_renames
+    journal: str
+        journal file (default: JOURNAL_NAME at the root of eml_folder), must not exist
+    metadata: str
+        metadata backend, see metadata.get_writer
+    layout: Layout or str
+        layout of the plan, the buckets the files were moved to are recorded in the layout files
+    Returns:
+    --------
+    summary: dict
+        number of files processed, failed (metadata) and conflicts (target name used by a file written
+        since the plan, left unrenamed), time spent writing the metadata
+    """
+    journal = journal or join(eml_folder,JOURNAL_NAME)
+    if exists(journal):
+        raise FileExistsError(f"{journal} exists: undo the previous run (--undo) or remove the journal")
+    root = abspath(eml_folder)
+    writer = get_writer(metadata)
+    summary = {"processed":0,"failed":0,"conflicts":0}
+    #folder -> buckets the files were moved to
+    moved = {}
+    with open(journal,"x",encoding="utf-8") as fo:
+        fo.write(json.dumps({"root":root,"created":datetime.now(timezone.utc).isoformat(),"metadata":writer.name})+"\n")
+        for n, entry in enumerate(entries):
+            old_fp = join(entry["folder"],entry["from"])
+            new_eml_fp = join(entry["folder"],entry["to"])
+            st = os.stat(old_fp)
+            record = {"n":n,"folder":relpath(entry["folder"],root),"from":entry["from"],"to":entry["to"],
+                "atime_ns":st.st_atime_ns,"mtime_ns":st.st_mtime_ns}
+            fo.write(json.dumps(record,ensure_ascii=False)+"\n")
+            fo.flush()
+            bucket = dirname(entry["to"])
+            if bucket:
+                os.makedirs(dirname(new_eml_fp),exist_ok=True)
+                moved.setdefault(entry["folder"],set()).add(bucket.replace(os.sep,"/"))
+            try:
+                rename_no_replace(old_fp,new_eml_fp)
+            except FileExistsError:
+                log_msg = "cannot rename %s: %s was written since the plan"%(old_fp,new_eml_fp)
+                logging.error(log_msg)
+                fo.write(json.dumps({"conflict":n})+"\n")
+                summary["conflicts"]+=1
+                continue
+            sent_date = datetime.fromisoformat(entry["sent_date"])
+            if pst2eml.update_file_metadata(new_eml_fp,entry["send_to"],entry["sent_from"],entry["subject"],sent_date,writer):
+                summary["processed"]+=1
+            else:
+                summary["failed"]+=1
+        os.fsync(fo.fileno())
+    layout = get_layout(layout)
+    for folder, folder_buckets in moved.items():
+        buckets = FolderBuckets(layout,folder)
+        for bucket in folder_buckets:
+            buckets.recount(bucket)
+        buckets.save()
+    pst2eml.flush_metadata(writer,summary)
+    summary["metadata_seconds"] = writer.stats["seconds"]
+    return summary
+
+def undo(journal):
+    """ renames the files of the journal back (in reverse order), restores their access and
+    modification times and removes the metadata written by the run (metadata.MetadataWriter.clear, not
+    for the journals written before the backend was recorded), the journal is then renamed to journal+".undone"
+    Returns:
+    --------
+    summary: dict
+        number of files restored, not renamed by the run (skipped), conflicts (both names used since, left as is)
+        and failed (metadata not removed)
+    """
+    with open(journal,encoding="utf-8") as fi:
+        lines = fi.read().splitlines()
+    header = json.loads(lines[0])
+    root = header["root"]
+    writer = get_writer(header["metadata"]) if header.get("metadata") else None
+    summary = {"restored":0,"skipped":0,"conflicts":0,"failed":0}
+    records = []
+    for line in lines[1:]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            #last line cut by an interrupted run
+            pass
+    not_renamed = {record["conflict"] for record in records if "conflict" in record}
+    #folder -> buckets files were moved from (see layout)
+    moved = {}
+    for record in reversed(records):
+        if "conflict" in record:
+            continue
+        if record["n"] in not_renamed:
+            summary["skipped"]+=1
+            continue
+        folder = join(root,record["folder"])
+        old_fp = join(folder,record["from"])
+        new_eml_fp = join(folder,record["to"])
+        if not exists(new_eml_fp) or (exists(old_fp) and not os.path.samefile(old_fp,new_eml_fp)):
+            if exists(new_eml_fp):
+                log_msg = "cannot restore %s: %s exists"%(new_eml_fp,old_fp)
+                logging.error(log_msg)
+                summary["conflicts"]+=1
+            else:
+                summary["skipped"]+=1
+            continue
+        if writer is not None:
+            try:
+                writer.clear(new_eml_fp)
+            except Exception as e:
+                log_msg = "cannot remove the metadata of %s: %r"%(new_eml_fp,e)
+                logging.error(log_msg)
+                summary["failed"]+=1
+        rename_no_replace(new_eml_fp,old_fp)
+        os.utime(old_fp,ns=(record["atime_ns"],record["mtime_ns"]))
+        summary["restored"]+=1
+        if dirname(record["to"]):
+            moved.setdefault(folder,set()).add(dirname(record["to"]).replace(os.sep,"/"))
+    if writer is not None and not writer.flush():
+        summary["failed"]+=len(writer.failed_files)
+    for folder, folder_buckets in moved.items():
+        for bucket in folder_buckets:
+            #bucket left empty (once its sidecar index is removed)
+            try:
+                os.removedirs(join(folder,*bucket.split("/")))
+            except OSError:
+                pass
+        buckets = FolderBuckets(None,folder)
+        for bucket in folder_buckets:
+            buckets.recount(bucket)
+        buckets.save()
+    os.replace(journal,journal+".undone")
+    return summary
+
+def rename_cli(argv=None):
+    """ rename subcommand: python -m pyPST2EML rename -f <folder> [--dry-run] [--undo] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML rename",
+        description="rename the .eml/.ics files of a folder in two phases (plan, then apply with a journal)")
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True)
+    parser.add_argument("--dry-run",dest="dry_run",action="store_true",help="print the planned renames only")
+    parser.add_argument("--undo",dest="undo",action="store_true",help="restore the names recorded in the journal")
+    parser.add_argument("--journal",dest="journal",type=str,default=None,help=f"journal file (default: {JOURNAL_NAME} in the folder)")
+    parser.add_argument("--ignore","-i",dest="ignore",type=pst2eml.str2bool,default="N",
+        help="ignore file extensions (if N only processes .eml and .ics)")
+    parser.add_argument("--headers",dest="headers_only",type=pst2eml.str2bool,default="N")
+    parser.add_argument("--names",dest="policy",type=str,default=None,choices=["windows","linux"])
+    parser.add_argument("--metadata",dest="metadata",type=str,default=None,choices=["win32","xattr","sidecar"])
+    parser.add_argument("--jobs","-j",dest="jobs",type=int,default=1,help="processes planning the folders")
+    parser.add_argument("--layout",dest="layout",type=str,default="flat",choices=LAYOUTS,
+        help="move the messages of each folder to date (YYYY/MM) or hash buckets (default: flat)")
+    parser.add_argument("--bucket_files",dest="bucket_files",type=int,default=MAX_FILES,help=f"files per bucket (default: {MAX_FILES})")
+    args = parser.parse_args(argv)
+    layout = Layout(args.layout,args.bucket_files) if args.layout!="flat" else None
+    journal = args.journal or join(args.folder,JOURNAL_NAME)
+    if args.undo:
+        if not exists(journal):
+            print(f"no journal {journal} to undo")
+            return 1
+        summary = undo(journal)
+        print(f"restored {summary['restored']}, skipped {summary['skipped']}, conflicts {summary['conflicts']} files"
+            f" (metadata not removed: {summary['failed']})")
+        return 0 if not summary["conflicts"] and not summary["failed"] else 1
+    entries = plan_renames(args.folder,args.ignore,args.headers_only,args.policy,args.jobs,layout)
+    if args.dry_run:
+        for entry in entries:
+            print(f"{relpath(join(entry['folder'],entry['from']),args.folder)} -> {entry['to']}")
+        print(f"{len(entries)} files would be renamed")
+        return 0
+    summary = apply_plan(args.folder,entries,journal,args.metadata,layout)
+    print(f"processed {summary['processed']}, failed {summary['failed']}, conflicts {summary['conflicts']} files, journal: {journal}")
+    return 0 if not summary["conflicts"] else 1
@@ -0,0 +1,269 @@
+"""
+full-text search index of a folder of .eml/.ics files
+
+make_eml_search_friendly(index=True) reads every message anyway, so it also stores the subject, sender,
+recipients, sent date, folder and decoded text body of each message in a SQLite FTS5 index at the root
+of the folder (.pst2eml_index.sqlite). The documents are written by a single process in large
+transactions (see SearchIndex.batch_size). With headers_only only the headers are indexed.
+
+the files renamed or removed by a later run are dropped from the index when their folder is indexed again
+
+Example:
+--------
+python -m pyPST2EML search -f C:\\outlook\\archives\\eml\\2021Q1 "budget forecast" --sender alice@example.com --after 2021-01-01
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from html import unescape
+import os
+from os.path import exists, join, relpath
+import re
+import sqlite3
+from time import perf_counter
+
+INDEX_NAME = ".pst2eml_index.sqlite"
+
+#longest body text indexed per message
+BODY_MAX_CHARS = 200000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sent_date INTEGER,
+    sent_date_iso TEXT,
+    sent_from TEXT,
+    send_to TEXT,
+    subject TEXT,
+    UNIQUE (folder, name)
+);
+CREATE INDEX IF NOT EXISTS messages_sent_date ON messages (sent_date);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    subject, sent_from, send_to, folder, body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+HTML_SKIPPED = re.compile(r"<(script|style)[^>]*>.*?</\1\s*>",re.I|re.S)
+HTML_TAG = re.compile(r"<[^>]+>")
+
+def is_index_file(fn):
+    """ True for the index and its SQLite journal files """
+    return fn.startswith(INDEX_NAME)
+
+def html_to_text(html):
+    return unescape(HTML_TAG.sub(" ",HTML_SKIPPED.sub(" ",html)))
+
+def message_text(msg):
+    """ Returns the decoded text of a parsed message: its text/plain parts, or its text/html parts
+    without the markup when it has no text/plain part (cut at BODY_MAX_CHARS)
+    """
+    plain = []
+    html = []
+    for part in msg.walk():
+        if part.is_multipart() or part.get_content_maintype()!="text" or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        charset = part.get_content_charset() or "latin-1"
+        try:
+            text = payload.decode(charset,"replace")
+        except LookupError:
+            text = payload.decode("latin-1")
+        if part.get_content_subtype()=="html":
+            html.append(text)
+        else:
+            plain.append(text)
+    text = "\n".join(plain) if plain else html_to_text("\n".join(html))
+    return text[:BODY_MAX_CHARS]
+
+class SearchIndex:
+    """ SQLite FTS5 index of the messages of a folder tree
+    Parameters:
+    -----------
+    root: str
+        root folder of the tree, the index file is created in it
+    batch_size: int
+        number of documents written per transaction
+    """
+    def __init__(self,root,batch_size=5000):
+        self.root = root
+        self.fp = join(root,INDEX_NAME)
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(self.fp)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        #folder -> documents not yet written
+        self.pending = {}
+        self.pending_count = 0
+        #folders whose entries of removed files were already dropped
+        self.checked = set()
+
+    def add(self,folder,documents):
+        """ queues the documents of a folder, written once batch_size documents are queued
+        Parameters:
+        -----------
+        folder: str
+            folder of the files
+        documents: list
+            dicts with name, send_to, sent_from, subject, sent_date (datetime) and body
+        """
+        self.pending.setdefault(folder,[]).extend(documents)
+        self.pending_count+=len(documents)
+        if self.pending_count>=self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ writes the queued documents in a single transaction, replacing the entries of the files
+        with the same name and dropping (once per folder) the entries of the files not in their folder anymore
+        """
+        if not self.pending:
+            return
+        with self.db:
+            next_id = (self.db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0)+1
+            rows = []
+            fts_rows = []
+            for folder, documents in self.pending.items():
+                rel = relpath(folder,self.root)
+                if folder not in self.checked:
+                    present = set(os.listdir(folder))
+                    stale = [(id,) for id, name in self.db.execute("SELECT id, name FROM messages WHERE folder=?",(rel,))
+                        if name not in present and not exists(join(folder,name))]
+                    self.db.executemany("DELETE FROM messages_fts WHERE rowid=?",stale)
+                    self.db.executemany("DELETE FROM messages WHERE id=?",stale)
+                    self.checked.add(folder)
+                replaced = [(rel,document["name"]) for document in documents]
+                self.db.executemany("DELETE FROM messages_fts WHERE rowid=(SELECT id FROM messages WHERE folder=? AND name=?)",replaced)
+                self.db.executemany("DELETE FROM messages WHERE folder=? AND name=?",replaced)
+                for document in documents:
+                    sent_date = document["sent_date"]
+                    rows.append((next_id,rel,document["name"],
+                        int(sent_date.timestamp()) if sent_date else None,
+                        sent_date.isoformat() if sent_date else None,
+                        document["sent_from"],document["send_to"],document["subject"]))
+                    fts_rows.append((next_id,document["subject"],document["sent_from"],document["send_to"],
+                        rel,document["body"]))
+                    next_id+=1
+            self.db.executemany("""INSERT INTO messages
+                (id, folder, name, sent_date, sent_date_iso, sent_from, send_to, subject)
+                VALUES (?,?,?,?,?,?,?,?)""",rows)
+            self.db.executemany("""INSERT INTO messages_fts
+                (rowid, subject, sent_from, send_to, folder, body) VALUES (?,?,?,?,?,?)""",fts_rows)
+        self.pending = {}
+        self.pending_count = 0
+
+    def search(self,text="",sender=None,after=None,before=None,limit=50):
+        """ Returns the messages matching all the given filters, most recent first
+        Parameters:
+        -----------
+        text: str
+            words searched in the subject, sender, recipients, folder and body (a trailing * matches
+            a prefix)
+        sender: str
+            words or address searched in the sender only
+        after, before: datetime
+            sent date range (after included, before excluded)
+        limit: int
+            largest number of results
+        Returns:
+        --------
+        results: list
+            dicts with path (relative to the root), sent_date, sent_from, send_to and subject
+        """
+        match = fts_query(text)
+        if sender:
+            match = " AND ".join([m for m in [match,f"sent_from : ({fts_query(sender)})"] if m])
+        conditions = []
+        args = []
+        if match:
+            conditions.append("messages_fts MATCH ?")
+            args.append(match)
+        if after is not None:
+            conditions.append("m.sent_date >= ?")
+            args.append(int(after.timestamp()))
+        if before is not None:
+            conditions.append("m.sent_date < ?")
+            args.append(int(before.timestamp()))
+        if match:
+            query = "FROM messages_fts JOIN messages m ON m.id=messages_fts.rowid"
+        else:
+            query = "FROM messages m"
+        if conditions:
+            query+= " WHERE "+" AND ".join(conditions)
+        rows = self.db.execute(f"""SELECT m.folder, m.name, m.sent_date_iso, m.sent_from, m.send_to, m.subject
+            {query} ORDER BY m.sent_date DESC LIMIT ?""",args+[limit])
+        return [{"path":join(folder,name),"sent_date":sent_date,"sent_from":sent_from,"send_to":send_to,
+            "subject":subject} for folder, name, sent_date, sent_from, send_to, subject in rows]
+
+    def records(self):
+        """ yields the indexed messages as dicts with path (relative to the root), sent_date, sent_from,
+        send_to, subject and body, in indexing order (see exporters)
+        """
+        self.flush()
+        rows = self.db.execute("""SELECT m.folder, m.name, m.sent_date_iso, m.sent_from, m.send_to, m.subject,
+            messages_fts.body FROM messages m JOIN messages_fts ON messages_fts.rowid=m.id ORDER BY m.id""")
+        for folder, name, sent_date, sent_from, send_to, subject, body in rows:
+            yield {"path":join(folder,name),"sent_date":sent_date,"sent_from":sent_from,"send_to":send_to,
+                "subject":subject,"body":body}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def fts_query(text):
+    """ FTS5 query matching all the words of text (each word quoted, a trailing * kept as prefix match) """
+    terms = []
+    for word in (text or "").split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"','""')
+        if word:
+            terms.append(f'"{word}"'+("*" if prefix else ""))
+    return " AND ".join(terms)
+
+def parse_date_filter(value):
+    """ datetime of a --after/--before value, taken as local time when it has no timezone """
+    if value is None:
+        return None
+    #REQUIRED INSTALL, only loaded by the subcommands filtering on dates
+    from dateutil.parser import parse as dateutil_parse
+    date = dateutil_parse(value)
+    if date.tzinfo is None:
+        date = date.astimezone()
+    return date
+
+def search_cli(argv=None):
+    """ search subcommand: python -m pyPST2EML search -f <folder> [words] [--sender] [--after] [--before] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML search",
+        description='search the index built with --index Y')
+    parser.add_argument("words",nargs="*",help="words searched in the subject, sender, recipients, folder and body")
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True,
+                    help="folder processed with --index Y")
+    parser.add_argument("--sender","-s",dest="sender",type=str,default=None,
+                    help="sender name or address")
+    parser.add_argument("--after",dest="after",type=str,default=None,
+                    help="messages sent on or after this date (e.g. 2021-01-01)")
+    parser.add_argument("--before",dest="before",type=str,default=None,
+                    help="messages sent before this date")
+    parser.add_argument("--limit","-l",dest="limit",type=int,default=50)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(join(args.folder,INDEX_NAME)):
+        print(f"no index in {args.folder}, process it with --index Y first")
+        return 1
+    index = SearchIndex(args.folder)
+    try:
+        start = perf_counter()
+        results = index.search(" ".join(args.words),args.sender,parse_date_filter(args.after),
+            parse_date_filter(args.before),args.limit)
+        elapsed = perf_counter()-start
+    finally:
+        index.close()
+    for result in results:
+        print(f"{result['sent_date'] or '':25} {str(result['sent_from'] or '')[:30]:30} {result['subject']}")
+        print(f"{'':25} {join(args.folder,result['path'])}")
+    print(f"{len(results)} messages in {elapsed*1000:.1f}ms")
+    return 0
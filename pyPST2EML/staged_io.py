@@ -0,0 +1,188 @@
+"""
+staged processing of a folder for output trees on network shares (SMB/NFS)
+
+on a share each os.rename, os.utime, isfile probe or property set open is a network round trip, done one
+after the other by pst2eml.process_eml_folder they bound the throughput to a few hundred files/s.
+process_folder_staged gives the same result (same names, attributes and summary) in three stages:
+* read: a thread pool (read_workers) loads and parses the next files (read_queue files ahead)
+* decide (calling thread, in the folder order): parameters and dedup (see pst2eml.FolderRun, shared with
+    process_eml_folder as the summary, records and error handling) and the new file name, the collisions
+    (see pst2eml.incrementalfilename) are resolved on the folder listing read once (rename_plan.NameIndex)
+    instead of isfile probes
+* write: a thread pool (io_workers, at most io_queue pending files) extracts the attachments, renames
+    and writes the metadata of each file, a rename to a name freed by an earlier rename waits for it
+
+so the round trips of up to io_workers files overlap.
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from os.path import abspath, basename, join
+from threading import BoundedSemaphore
+from time import perf_counter
+
+# own modules
+from .quarantine import StageError
+from .rename_plan import NameIndex
+from . import pst2eml
+
+class FolderNames(NameIndex):
+    """ NameIndex tracking the renames in flight: a rename to a name freed by an earlier one waits for it """
+    def __init__(self,folder):
+        super().__init__(folder)
+        #name -> future of the pending rename which frees it
+        self.freed = {}
+
+    def rename(self,old_fp,new_fp):
+        """ Returns the future the rename must wait for (None if the new name was never used) """
+        super().rename(old_fp,new_fp)
+        return self.freed.pop(self._key(basename(new_fp)),None)
+
+    def renaming(self,old_fp,future):
+        self.freed[self._key(basename(old_fp))] = future
+
+def _read(run,fn):
+    """ read stage: Returns None for an unchanged file, else (eml_fp, size, start, msg, msg_strings) """
+    if run.unchanged(fn):
+        return None
+    start = perf_counter()
+    eml_fp = abspath(join(run.root,fn))
+    size = os.path.getsize(eml_fp) if run.run_metrics.enabled else 0
+    with run.run_metrics.stage("parse"):
+        msg, msg_strings = pst2eml.load_eml(eml_fp,run.headers_only)
+    return eml_fp, size, start, msg, msg_strings
+
+def _write(eml_fp,new_eml_fp,wait,send_to,sent_from,subject,sent_date,writer,store,metrics,stat):
+    """ write stage: Returns (status, stat of the new file or None), raises StageError """
+    stage = "attachments"
+    try:
+        if store is not None:
+            with metrics.stage("attachments"):
+                store.extract(eml_fp)
+        if wait is not None:
+            try:
+                wait.result()
+            except StageError:
+                #the file freeing the name failed: this name is taken
+                raise FileExistsError(new_eml_fp)
+        stage = "rename"
+        try:
+            with metrics.stage("rename"):
+                pst2eml.rename_no_replace(eml_fp,new_eml_fp)
+        except:
+            log_msg = "cannot rename file: %s - %s"%(eml_fp,new_eml_fp)
+            logging.error(log_msg)
+            raise
+        stage = "metadata"
+        failed = not pst2eml.update_file_metadata(new_eml_fp,send_to,sent_from,subject,sent_date,writer)
+        stage = "record"
+        return "failed" if failed else "processed", os.stat(new_eml_fp) if stat else None
+    except Exception as e:
+        raise StageError(stage,e) from e
+
+def process_folder_staged(root,files,ignore_ext=False,headers_only=False,known=None,policy=None,metadata=None,
+    index=False,metrics=None,attachments=None,dedup=None,io_workers=16,read_workers=8,io_queue=256,read_queue=64,catalog=False,
+    layout=None,errors=None):
+    """ same as pst2eml.process_eml_folder with the file system round trips overlapped
+    Parameters:
+    -----------
+    io_workers: int
+        threads renaming the files and writing their metadata
+    read_workers: int
+        threads reading and parsing the files
+    io_queue: int
+        files decided but not written yet, the decide stage waits above it
+    read_queue: int
+        files read ahead of the decide stage
+    the other parameters and the summary are those of pst2eml.process_eml_folder
+    """
+    run = pst2eml.FolderRun(root,ignore_ext,headers_only,known,metadata,index,metrics,attachments,dedup,catalog,
+        layout,errors)
+    run_metrics = run.run_metrics
+    candidates = [fn for fn in files if not run.ignored(fn)]
+    run.summary["skipped"] = sum(1 for fn in candidates if not run.is_message(fn))
+    candidates = [fn for fn in candidates if run.is_message(fn)]
+    if not candidates:
+        return run.finish()
+    print(f"processing folder {root}")
+    names = FolderNames(root)
+    #bucket folder -> NameIndex, the files are only added to the buckets
+    bucket_names = {}
+    slots = BoundedSemaphore(io_queue)
+    #per file in the folder order: [fn, status, future, eml_fp, new_eml_fp, key, params, msg, body, size, start]
+    pending = deque()
+
+    def done(entry):
+        """ collects the oldest file once written """
+        fn, status, future, eml_fp, new_eml_fp, key, params, msg, body, size, start = entry
+        st = None
+        if future is not None:
+            try:
+                status, st = future.result()
+            except StageError as e:
+                run.fail(new_eml_fp if os.path.exists(new_eml_fp) else eml_fp,e.stage,e)
+                return
+            if key is not None:
+                run.dedup_index.moved(key,new_eml_fp)
+        run.done(fn,status,new_eml_fp,params,msg,body,size,start,st)
+
+    def release(future):
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=read_workers) as readers, ThreadPoolExecutor(max_workers=io_workers) as io:
+        reads = deque()
+        next_read = 0
+        for fn in candidates:
+            while next_read<len(candidates) and len(reads)<read_queue:
+                reads.append(readers.submit(_read,run,candidates[next_read]))
+                next_read+=1
+            try:
+                read = reads.popleft().result()
+            except Exception as e:
+                run.fail(abspath(join(root,fn)),"parse",e)
+                continue
+            if read is None:
+                run.summary["unchanged"]+=1
+                continue
+            eml_fp, size, start, msg, msg_strings = read
+            log_msg = "processing:%s"%(fn)
+            logging.info(log_msg)
+            try:
+                params, key, first, body = run.decide(msg,msg_strings,eml_fp)
+            except StageError as e:
+                run.fail(eml_fp,e.stage,e)
+                continue
+            send_to, sent_from, subject, sent_date = params
+            future = None
+            new_eml_fp = eml_fp
+            if first is not None:
+                status = "duplicate"
+            elif run.to_rename(params):
+                status = None
+                with run_metrics.stage("decide"):
+                    if run.buckets is None:
+                        new_eml_fp = names.new_path(eml_fp,subject,ignore_ext,policy)
+                        wait = names.rename(eml_fp,new_eml_fp)
+                    else:
+                        folder = run.buckets.destination(subject,sent_date)
+                        if folder not in bucket_names:
+                            bucket_names[folder] = NameIndex(folder)
+                        new_eml_fp = bucket_names[folder].new_path(eml_fp,subject,ignore_ext,policy)
+                        bucket_names[folder].add(basename(new_eml_fp))
+                        wait = None
+                slots.acquire()
+                future = io.submit(_write,eml_fp,new_eml_fp,wait,send_to,sent_from,subject,sent_date,run.writer,run.store,
+                    run_metrics,known is not None)
+                future.add_done_callback(release)
+                names.renaming(eml_fp,future)
+            else:
+                status = "skipped"
+            pending.append([fn,status,future,eml_fp,new_eml_fp,key,params,msg,body,size,start])
+            while pending and (pending[0][2] is None or pending[0][2].done()):
+                done(pending.popleft())
+        while pending:
+            done(pending.popleft())
+    return run.finish()
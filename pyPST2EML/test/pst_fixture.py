@@ -0,0 +1,424 @@
+"""
+minimal [MS-PST] writer producing small .pst files to test pst_reader (see test_pst_reader)
+
+only what the reader needs is written: header, node and block B-trees (several levels when needed),
+data trees (XBLOCK), subnode blocks (SLBLOCK), heap-on-node, BTree-on-heap, property and table
+contexts, in ANSI or Unicode format with any of the three block encryptions. Allocation maps, the
+density list and the named properties map are not written.
+
+build writes a store with "Top of Personal Folders/Inbox" and "Top of Personal Folders/Sent Items",
+the messages alternate between them (see MESSAGES for their subjects):
+* message 0 has a body and an attachment larger than a block (data trees)
+* message 1 has transport headers (sender, recipients and date come from them)
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import struct
+import zlib
+
+# own modules
+from ..pst_reader import (MPBB_R, NDB_CRYPT_CYCLIC, NDB_CRYPT_PERMUTE, NID_ATTACHMENT_TABLE, NID_MESSAGE_STORE,
+    NID_RECIPIENT_TABLE, NID_ROOT_FOLDER, PR_ATTACH_DATA, PR_ATTACH_FILENAME, PR_ATTACH_LONG_FILENAME,
+    PR_ATTACH_METHOD, PR_ATTACH_MIME_TAG, PR_BODY, PR_CLIENT_SUBMIT_TIME, PR_DISPLAY_NAME, PR_DISPLAY_TO,
+    PR_EMAIL_ADDRESS, PR_INTERNET_MESSAGE_ID, PR_LTP_ROW_ID, PR_MESSAGE_CLASS, PR_RECIPIENT_TYPE,
+    PR_SENDER_EMAIL_ADDRESS, PR_SENDER_NAME, PR_SMTP_ADDRESS, PR_SUBJECT, PR_TRANSPORT_MESSAGE_HEADERS,
+    PT_BINARY, PT_BOOLEAN, PT_LONG, PT_LONGLONG, PT_SHORT, PT_STRING8, PT_SYSTIME, PT_UNICODE, decrypt_cyclic)
+
+PR_LTP_ROW_VER = 0x67F3
+PR_CONTENT_COUNT = 0x3602
+PR_CONTENT_UNREAD = 0x3603
+PR_SUBFOLDERS = 0x360A
+PR_RECORD_KEY = 0x0FF9
+PR_VALID_FOLDER_MASK = 0x35DF
+PR_ATTACH_SIZE = 0x0E20
+#values inline in the property records and table rows
+INLINE = (PT_SHORT,PT_LONG,PT_BOOLEAN)
+#largest value stored in the heap, larger ones go to a subnode
+MAX_HEAP_VALUE = 3580
+#2021-01-01 00:00 UTC as FILETIME
+FILETIME_2021 = 132539328000000000
+HOUR = 3600*10**7
+
+MESSAGES = ["RE: status","bonne ann\xe9e","report: q1/q2"]
+TRANSPORT_HEADERS = ("Received: from mx by mx; Fri, 1 Jan 2021 10:00:00 +0000\r\n"
+    "From: Carol <carol@example.com>\r\nTo: dave@example.com,\r\n\terin@example.com\r\n"
+    "Subject: =?utf-8?q?bonne_ann=C3=A9e?=\r\nDate: Fri, 1 Jan 2021 10:00:00 +0100\r\n"
+    "Message-ID: <x@y>\r\nMIME-Version: 1.0\r\nContent-Type: text/plain; charset=utf-8\r\n")
+INBOX = 0x8042
+SENT_ITEMS = 0x8062
+
+def crc(data):
+    """ [MS-PST] 5.3 CRC (CRC-32 without the final inversion) """
+    return (~zlib.crc32(data,0xFFFFFFFF))&0xFFFFFFFF
+
+def signature(ib,bid):
+    """ [MS-PST] 5.5 block / page signature """
+    ib ^= bid
+    return ((ib>>16)^ib)&0xFFFF
+
+def message_nid(i):
+    return ((0x10000+i)<<5)|0x04
+
+def message_subject(i):
+    return MESSAGES[i%len(MESSAGES)]
+
+def message_body(i,big=True):
+    return ("body %d "%i)*(3000 if big and i==0 else 3)
+
+def attachment_payload(big=True):
+    return bytes(range(256))*(100 if big else 2)
+
+class Heap:
+    """ heap-on-node of a single block """
+    def __init__(self,client_sig):
+        self.items = []
+        self.client_sig = client_sig
+        self.root = 0
+
+    def alloc(self,data):
+        """ Returns the HID of a new allocation """
+        self.items.append(bytes(data))
+        return len(self.items)<<5
+
+    def bth(self,key_size,entry_size,records):
+        """ Returns the HID of a BTree-on-heap header with the records in a single leaf """
+        records = sorted(records)
+        root = self.alloc(b"".join(key+value for key, value in records)) if records else 0
+        return self.alloc(struct.pack("<BBBBI",0xB5,key_size,entry_size,0,root))
+
+    def build(self):
+        data = bytearray(12)
+        offsets = [12]
+        for item in self.items:
+            data += item
+            offsets.append(len(data))
+        if len(data)%2:
+            data += b"\0"
+        ib_hnpm = len(data)
+        data += struct.pack("<HH",len(self.items),0)+struct.pack(f"<{len(offsets)}H",*offsets)
+        data[0:12] = struct.pack("<HBBI",ib_hnpm,0xEC,self.client_sig,self.root)+b"\0"*4
+        assert len(data)<=8176, "heap larger than a block"
+        return bytes(data)
+
+class PSTWriter:
+    """ collects the nodes and blocks of a pst and writes the file
+    Parameters:
+    -----------
+    unicode: bool
+        Unicode (wVer 23, 64 bits pointers) or ANSI (wVer 14, 32 bits pointers) file
+    crypt: int
+        block encryption (NDB_CRYPT_NONE, NDB_CRYPT_PERMUTE or NDB_CRYPT_CYCLIC)
+    """
+    def __init__(self,unicode=True,crypt=0):
+        self.unicode = unicode
+        self.crypt = crypt
+        self.ptr_format = "<Q" if unicode else "<I"
+        self.string_type = PT_UNICODE if unicode else PT_STRING8
+        self.max_block = 8176 if unicode else 8180
+        #(bid, data) in file order, nid -> (bid data, bid sub, nid parent)
+        self.blocks = []
+        self.nodes = {}
+        self.next_bid = 4
+        self.next_subnode = 1
+        #bid -> offset of the block in the file (see write)
+        self.offsets = {}
+
+    def ptr(self,value):
+        return struct.pack(self.ptr_format,value)
+
+    def add_block(self,data,internal=False):
+        """ Returns the bid of a new block, data blocks are encrypted """
+        bid = self.next_bid|(2 if internal else 0)
+        self.next_bid += 4
+        if not internal:
+            if self.crypt==NDB_CRYPT_PERMUTE:
+                data = data.translate(MPBB_R)
+            elif self.crypt==NDB_CRYPT_CYCLIC:
+                data = decrypt_cyclic(data,bid&0xFFFFFFFF)
+        self.blocks.append((bid,data))
+        return bid
+
+    def data_tree(self,data):
+        """ Returns the bid of a single block or of an XBLOCK of blocks """
+        if len(data)<=self.max_block:
+            return self.add_block(data)
+        bids = [self.add_block(data[i:i+self.max_block]) for i in range(0,len(data),self.max_block)]
+        return self.add_block(struct.pack("<BBHI",1,1,len(bids),len(data))+b"".join(self.ptr(bid) for bid in bids),True)
+
+    def subnode_block(self,entries):
+        """ Returns the bid of the SLBLOCK of (nid, bid data, bid sub) entries (0 without entries) """
+        if not entries:
+            return 0
+        data = struct.pack("<BBH",2,0,len(entries))+(b"\0"*4 if self.unicode else b"")
+        for nid, bid_data, bid_sub in sorted(entries):
+            data += self.ptr(nid)+self.ptr(bid_data)+self.ptr(bid_sub)
+        return self.add_block(data,True)
+
+    def encode(self,prop_type,value):
+        if prop_type==PT_UNICODE:
+            return value.encode("utf-16-le")
+        if prop_type==PT_STRING8:
+            return value.encode("cp1252")
+        if prop_type in (PT_LONGLONG,PT_SYSTIME):
+            return struct.pack("<q",value)
+        if prop_type==PT_BINARY:
+            return value
+        raise ValueError(f"unsupported property type {prop_type:#x}")
+
+    def value_ref(self,heap,subnodes,prop_type,value):
+        """ Returns the HNID of a variable size value: heap allocation or new subnode """
+        data = self.encode(prop_type,value)
+        if len(data)>MAX_HEAP_VALUE:
+            nid = (self.next_subnode<<5)|0x1F
+            self.next_subnode += 1
+            subnodes.append((nid,self.data_tree(data),0))
+            return nid
+        return heap.alloc(data)
+
+    def property_context(self,props,subnodes):
+        """ Returns the bid of the property context of props, list of (property id, type, value), the
+        subnodes of the large values are added to subnodes """
+        heap = Heap(0xBC)
+        records = []
+        for prop_id, prop_type, value in props:
+            if prop_type==PT_SHORT:
+                data = struct.unpack("<I",struct.pack("<hh",value,0))[0]
+            elif prop_type in INLINE:
+                data = struct.unpack("<I",struct.pack("<i",int(value)))[0]
+            else:
+                data = self.value_ref(heap,subnodes,prop_type,value)
+            records.append((struct.pack("<H",prop_id),struct.pack("<HI",prop_type,data)))
+        heap.root = heap.bth(2,6,records)
+        return self.data_tree(heap.build())
+
+    def table_context(self,columns,rows,subnodes):
+        """ Returns the bid of the table context of rows, list of dict property id -> value (with the
+        PR_LTP_ROW_ID), columns: list of (property id, type) """
+        columns = [(PR_LTP_ROW_ID,PT_LONG),(PR_LTP_ROW_VER,PT_LONG)]+list(columns)
+        size = lambda prop_type: 8 if prop_type in (PT_LONGLONG,PT_SYSTIME) else 2 if prop_type==PT_SHORT else 1 if prop_type==PT_BOOLEAN else 4
+        #row id and version first, then the 8, 4, 2 and 1 byte values and the cell existence bits
+        layout = {}
+        offset = 0
+        ordered = columns[:2]+[column for column in columns[2:] if size(column[1])==8]+[column for column in columns[2:] if size(column[1])==4]
+        for prop_id, prop_type in ordered:
+            layout[prop_id] = [offset,size(prop_type)]
+            offset += size(prop_type)
+        end_4 = offset
+        for prop_id, prop_type in columns:
+            if size(prop_type)==2:
+                layout[prop_id] = [offset,2]
+                offset += 2
+        end_2 = offset
+        for prop_id, prop_type in columns:
+            if size(prop_type)==1:
+                layout[prop_id] = [offset,1]
+                offset += 1
+        end_1 = offset
+        for i, (prop_id, prop_type) in enumerate(columns):
+            layout[prop_id].append(i)
+        row_size = end_1+(len(columns)+7)//8
+        heap = Heap(0x7C)
+        matrix = b""
+        for row in rows:
+            data = bytearray(row_size)
+            row = {PR_LTP_ROW_VER:1,**row}
+            for prop_id, prop_type in columns:
+                if prop_id not in row:
+                    continue
+                offset, cell_size, bit = layout[prop_id]
+                value = row[prop_id]
+                if prop_type==PT_SHORT:
+                    cell = struct.pack("<h",value)
+                elif prop_type in INLINE:
+                    cell = struct.pack("<i",int(value))[:cell_size]
+                elif prop_type in (PT_LONGLONG,PT_SYSTIME):
+                    cell = struct.pack("<q",value)
+                else:
+                    cell = struct.pack("<I",self.value_ref(heap,subnodes,prop_type,value))
+                data[offset:offset+cell_size] = cell
+                data[end_1+bit//8] |= 1<<(7-bit%8)
+            matrix += bytes(data)
+        row_index = heap.bth(4,4 if self.unicode else 2,[(struct.pack("<I",row[PR_LTP_ROW_ID]),struct.pack("<I" if self.unicode else "<H",i))
+            for i, row in enumerate(rows)])
+        hnid_rows = heap.alloc(matrix) if rows else 0
+        info = struct.pack("<BB4HIII",0x7C,len(columns),end_4,end_2,end_1,row_size,row_index,hnid_rows,0)
+        for prop_id, prop_type in sorted(columns):
+            offset, cell_size, bit = layout[prop_id]
+            info += struct.pack("<IHBB",(prop_id<<16)|prop_type,offset,cell_size,bit)
+        heap.root = heap.alloc(info)
+        return self.data_tree(heap.build())
+
+    def node(self,nid,bid_data,bid_sub=0,parent=0):
+        self.nodes[nid] = (bid_data,bid_sub,parent)
+
+    def _page(self,out,entries,entry_size,level,page_type,bid):
+        """ appends a B-tree page to out, Returns its offset """
+        area = 488 if self.unicode else 496
+        data = bytearray(b"".join(entries).ljust(area,b"\0"))
+        data += struct.pack("<BBBB",len(entries),area//entry_size,entry_size,level)
+        ib = len(out)
+        if self.unicode:
+            data += b"\0"*4
+            data += struct.pack("<BBHIQ",page_type,page_type,signature(ib,bid),crc(bytes(data)),bid)
+        else:
+            data += struct.pack("<BBHII",page_type,page_type,signature(ib,bid),bid,crc(bytes(data)))
+        out += data
+        return ib
+
+    def _btree(self,out,entries,entry_size,page_type):
+        """ appends the pages of a B-tree of (key, leaf entry) to out, Returns (bid, offset) of its root """
+        area = 488 if self.unicode else 496
+        level = 0
+        while True:
+            pages = []
+            capacity = area//entry_size
+            for i in range(0,len(entries),capacity):
+                chunk = entries[i:i+capacity]
+                bid = self.next_page_bid
+                self.next_page_bid += 4
+                pages.append((chunk[0][0],bid,self._page(out,[entry for key, entry in chunk],entry_size,level,page_type,bid)))
+            if len(pages)==1:
+                return pages[0][1:]
+            level += 1
+            entry_size = 3*(8 if self.unicode else 4)
+            entries = [(key,self.ptr(key)+self.ptr(bid)+self.ptr(ib)) for key, bid, ib in pages]
+
+    def write(self,fp):
+        """ writes the blocks, the node and block B-trees and the header """
+        out = bytearray(0x4600)
+        trailer = 16 if self.unicode else 12
+        bbt = []
+        for bid, data in self.blocks:
+            ib = len(out)
+            block = bytearray((len(data)+trailer+63)//64*64)
+            block[:len(data)] = data
+            if self.unicode:
+                block[-16:] = struct.pack("<HHIQ",len(data),signature(ib,bid),crc(data),bid)
+            else:
+                block[-12:] = struct.pack("<HHII",len(data),signature(ib,bid),bid,crc(data))
+            out += block
+            bbt.append((bid,ib,len(data)))
+            self.offsets[bid] = ib
+        out += b"\0"*(-len(out)%512)
+        self.next_page_bid = 0x100
+        if self.unicode:
+            nbt_entries = [(nid,struct.pack("<QQQII",nid,bid_data,bid_sub,parent,0)) for nid, (bid_data,bid_sub,parent) in sorted(self.nodes.items())]
+            bbt_entries = [(bid,struct.pack("<QQHHI",bid,ib,cb,2,0)) for bid, ib, cb in sorted(bbt)]
+            nbt = self._btree(out,nbt_entries,32,0x81)
+            bbt_root = self._btree(out,bbt_entries,24,0x80)
+        else:
+            nbt_entries = [(nid,struct.pack("<IIII",nid,bid_data,bid_sub,parent)) for nid, (bid_data,bid_sub,parent) in sorted(self.nodes.items())]
+            bbt_entries = [(bid,struct.pack("<IIHH",bid,ib,cb,2)) for bid, ib, cb in sorted(bbt)]
+            nbt = self._btree(out,nbt_entries,16,0x81)
+            bbt_root = self._btree(out,bbt_entries,12,0x80)
+        eof = len(out)
+        header = bytearray(564 if self.unicode else 512)
+        header[0:4] = b"!BDN"
+        header[8:10] = b"SM"
+        rgnid = struct.pack("<32I",*([0x400]*32))
+        if self.unicode:
+            struct.pack_into("<HHBB",header,10,23,19,1,1)
+            struct.pack_into("<QQI",header,24,0,self.next_page_bid,1)
+            header[44:172] = rgnid
+            struct.pack_into("<IQQQQQQQQBBH",header,180,0,eof,0x4400,0,0,nbt[0],nbt[1],bbt_root[0],bbt_root[1],0,0,0)
+            header[512] = 0x80
+            header[513] = self.crypt
+            struct.pack_into("<Q",header,516,self.next_bid)
+            struct.pack_into("<I",header,4,crc(bytes(header[8:8+471])))
+            struct.pack_into("<I",header,524,crc(bytes(header[8:8+516])))
+        else:
+            struct.pack_into("<HHBB",header,10,14,19,1,1)
+            struct.pack_into("<III",header,24,self.next_bid,self.next_page_bid,1)
+            header[36:164] = rgnid
+            struct.pack_into("<IIIIIIIIIBBH",header,164,0,eof,0x4400,0,0,nbt[0],nbt[1],bbt_root[0],bbt_root[1],0,0,0)
+            header[460] = 0x80
+            header[461] = self.crypt
+            struct.pack_into("<I",header,4,crc(bytes(header[8:8+471])))
+        out[0:len(header)] = header
+        with open(fp,"wb") as fo:
+            fo.write(out)
+
+    def folder(self,nid,name,parent,children,messages):
+        """ adds a folder: property context, hierarchy table of children (nid, name) and contents
+        table of messages (nid, subject) """
+        string = self.string_type
+        subnodes = []
+        bid = self.property_context([(PR_DISPLAY_NAME,string,name),(PR_CONTENT_COUNT,PT_LONG,len(messages)),
+            (PR_CONTENT_UNREAD,PT_LONG,0),(PR_SUBFOLDERS,PT_BOOLEAN,bool(children))],subnodes)
+        self.node(nid,bid,self.subnode_block(subnodes),parent)
+        tables = [(0x0D,[(PR_DISPLAY_NAME,string),(PR_CONTENT_COUNT,PT_LONG),(PR_SUBFOLDERS,PT_BOOLEAN)],
+            [{PR_LTP_ROW_ID:child,PR_DISPLAY_NAME:child_name,PR_CONTENT_COUNT:0,PR_SUBFOLDERS:False} for child, child_name in children]),
+            (0x0E,[(PR_SUBJECT,string)],[{PR_LTP_ROW_ID:message,PR_SUBJECT:subject} for message, subject in messages]),
+            (0x0F,[],[])]
+        for nid_type, columns, rows in tables:
+            subnodes = []
+            bid = self.table_context(columns,rows,subnodes)
+            self.node((nid&~0x1F)|nid_type,bid,self.subnode_block(subnodes),nid)
+
+    def message(self,i,parent,big=True):
+        """ adds message i (see MESSAGES), Returns its nid """
+        string = self.string_type
+        subject = message_subject(i)
+        subnodes = []
+        props = [(PR_MESSAGE_CLASS,string,"IPM.Note"),
+            (PR_SUBJECT,string,("\x01\x04"+subject) if subject.startswith("RE: ") else subject),
+            (PR_CLIENT_SUBMIT_TIME,PT_SYSTIME,FILETIME_2021+i*HOUR),(PR_SENDER_NAME,string,"Alice Sender"),
+            (PR_SENDER_EMAIL_ADDRESS,string,"alice@example.com"),(PR_DISPLAY_TO,string,"Bob Receiver"),
+            (PR_BODY,string,message_body(i,big)),(PR_INTERNET_MESSAGE_ID,string,f"<msg{i}@example.com>")]
+        if i==1:
+            props.append((PR_TRANSPORT_MESSAGE_HEADERS,string,TRANSPORT_HEADERS))
+        bid = self.property_context(props,subnodes)
+        table_subnodes = []
+        table = self.table_context([(PR_RECIPIENT_TYPE,PT_LONG),(PR_DISPLAY_NAME,string),(PR_EMAIL_ADDRESS,string),(PR_SMTP_ADDRESS,string)],
+            [{PR_LTP_ROW_ID:0,PR_RECIPIENT_TYPE:1,PR_DISPLAY_NAME:"Bob Receiver",PR_EMAIL_ADDRESS:"bob@example.com",PR_SMTP_ADDRESS:"bob@example.com"},
+            {PR_LTP_ROW_ID:1,PR_RECIPIENT_TYPE:2,PR_DISPLAY_NAME:"Cc Person",PR_SMTP_ADDRESS:"cc@example.com"}],table_subnodes)
+        subnodes.append((NID_RECIPIENT_TABLE,table,self.subnode_block(table_subnodes)))
+        if i==0:
+            payload = attachment_payload(big)
+            attachment_subnodes = []
+            attachment = self.property_context([(PR_ATTACH_FILENAME,string,"deck.bin"),(PR_ATTACH_LONG_FILENAME,string,"deck long name.bin"),
+                (PR_ATTACH_MIME_TAG,string,"application/octet-stream"),(PR_ATTACH_METHOD,PT_LONG,1),(PR_ATTACH_DATA,PT_BINARY,payload)],attachment_subnodes)
+            attachment_nid = (1<<5)|0x05
+            subnodes.append((attachment_nid,attachment,self.subnode_block(attachment_subnodes)))
+            table_subnodes = []
+            table = self.table_context([(PR_ATTACH_FILENAME,string),(PR_ATTACH_METHOD,PT_LONG),(PR_ATTACH_SIZE,PT_LONG)],
+                [{PR_LTP_ROW_ID:attachment_nid,PR_ATTACH_FILENAME:"deck.bin",PR_ATTACH_METHOD:1,PR_ATTACH_SIZE:len(payload)}],table_subnodes)
+            subnodes.append((NID_ATTACHMENT_TABLE,table,self.subnode_block(table_subnodes)))
+        nid = message_nid(i)
+        self.node(nid,bid,self.subnode_block(subnodes),parent)
+        return nid
+
+def build(fp,unicode=True,crypt=0,messages=3,big=True):
+    """ writes a test pst (see the module docstring)
+    Parameters:
+    -----------
+    fp: str
+        path of the .pst file
+    unicode: bool
+        Unicode or ANSI file
+    crypt: int
+        block encryption
+    messages: int
+        number of messages (even ones in the Inbox, odd ones in Sent Items)
+    big: bool
+        body and attachment of message 0 larger than a block
+    Returns:
+    --------
+    writer: PSTWriter
+        with the nodes and the offsets of the blocks in the file
+    """
+    writer = PSTWriter(unicode,crypt)
+    subnodes = []
+    bid = writer.property_context([(PR_DISPLAY_NAME,writer.string_type,"Test PST"),(PR_RECORD_KEY,PT_BINARY,b"\x11"*16),
+        (PR_VALID_FOLDER_MASK,PT_LONG,0x89)],subnodes)
+    writer.node(NID_MESSAGE_STORE,bid,writer.subnode_block(subnodes))
+    folders = {INBOX:[],SENT_ITEMS:[]}
+    for i in range(messages):
+        parent = INBOX if i%2==0 else SENT_ITEMS
+        folders[parent].append((writer.message(i,parent,big),message_subject(i)))
+    writer.folder(NID_ROOT_FOLDER,"",NID_ROOT_FOLDER,[(0x8022,"Top of Personal Folders")],[])
+    writer.folder(0x8022,"Top of Personal Folders",NID_ROOT_FOLDER,[(INBOX,"Inbox"),(SENT_ITEMS,"Sent Items")],[])
+    writer.folder(INBOX,"Inbox",0x8022,[],folders[INBOX])
+    writer.folder(SENT_ITEMS,"Sent Items",0x8022,[],folders[SENT_ITEMS])
+    writer.write(fp)
+    return writer
@@ -0,0 +1,54 @@
+"""
+catalog columns and queries, with messages sent before and after 1970
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+import os
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..catalog import Catalog, MessageRecord
+from ..pst2eml import make_eml_search_friendly
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_dates_before_1970(self):
+        catalog = Catalog(self.tmp.name)
+        catalog.add(MessageRecord("bob@example.com","alice@example.com","old",datetime(1960,1,4,10,tzinfo=timezone.utc)))
+        catalog.add(MessageRecord("bob@example.com, cc@example.com","alice@example.com","new",datetime(2021,3,1,tzinfo=timezone.utc)))
+        self.assertEqual(list(catalog.columns["month"]),[-120,614])
+        self.assertEqual(catalog.counts_per_sender_month(),{("alice@example.com","1960-01"):1,("alice@example.com","2021-03"):1})
+        self.assertEqual(catalog.count(before=datetime(1970,1,1,tzinfo=timezone.utc)),1)
+        catalog.save()
+        loaded = Catalog.load(self.tmp.name)
+        self.assertEqual(list(loaded.columns["month"]),[-120,614])
+        self.assertEqual(list(loaded.columns["recipient_offsets"]),[0,1,3])
+
+    def test_failed_record_leaves_columns_aligned(self):
+        catalog = Catalog(self.tmp.name)
+        with self.assertRaises(AttributeError):
+            catalog.add(MessageRecord("bob@example.com","alice@example.com","no date",None))
+        self.assertEqual({name:len(column) for name, column in catalog.columns.items()},
+            {"sender":0,"recipient_offsets":1,"recipients":0,"date":0,"month":0,"folder":0})
+
+    def test_run_with_message_before_1970(self):
+        inbox = join(self.tmp.name,"Inbox")
+        os.makedirs(inbox)
+        with open(join(inbox,"1.eml"),"w",newline="") as fo:
+            fo.write("From: alice@example.com\r\nTo: bob@example.com\r\nSubject: old\r\n"
+                "Date: Mon, 4 Jan 1960 10:00:00 +0000\r\n\r\nbody\r\n")
+        summary = make_eml_search_friendly(self.tmp.name,catalog=True,metadata="sidecar")
+        self.assertEqual(summary["processed"],1)
+        catalog = Catalog.load(self.tmp.name)
+        self.assertEqual(catalog.counts_per_sender_month(),{("alice@example.com","1960-01"):1})
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+dedup index: duplicates found across runs and the Bloom filter grown while the messages are claimed
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from hashlib import blake2b
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..dedup import DedupIndex
+
+def key(i):
+    return blake2b(str(i).encode("ascii"),digest_size=16).digest()
+
+class DedupIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.fp = join(self.tmp.name,"dedup.db")
+
+    def claim(self,index,i):
+        return index.claim(key(i),f"<{i}@example.com>",join(self.tmp.name,f"{i}.eml"))
+
+    def test_bloom_grows_while_claiming(self):
+        index = DedupIndex(self.fp,capacity=100,batch_size=300)
+        for i in range(2000):
+            self.assertIsNone(self.claim(index,i))
+        self.assertGreaterEqual(index.bloom.capacity,2000)
+        #1% design rate
+        self.assertLess(index.stats["false_positives"],60)
+        #keys pending and flushed are in the rebuilt filter
+        for i in range(0,2000,7):
+            self.assertEqual(index.claim(key(i),f"<{i}@example.com>",join(self.tmp.name,"copy.eml")),join(self.tmp.name,f"{i}.eml"))
+        index.close()
+
+    def test_duplicates_across_runs(self):
+        index = DedupIndex(self.fp,capacity=10)
+        for i in range(50):
+            self.claim(index,i)
+        index.close()
+        index = DedupIndex(self.fp,capacity=10)
+        self.assertEqual(index.bloom.count,50)
+        self.assertEqual(index.claim(key(3),"<3@example.com>",join(self.tmp.name,"copy.eml")),join(self.tmp.name,"3.eml"))
+        self.assertIsNone(self.claim(index,50))
+        index.close()
+        index = DedupIndex(self.fp)
+        self.assertEqual(index.count(),51)
+        index.close()
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+distributed runs: the shard results written as json and read back by the coordinator, the renames of a
+worker never replace a file
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+import json
+import os
+from os.path import join
+import tempfile
+import unittest
+from unittest import mock
+
+# own modules
+from .. import pst2eml
+from ..catalog import MessageRecord
+from ..distributed import read_result, result_path, write_result
+
+class ShardResultTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        os.makedirs(join(self.tmp.name,"results"))
+
+    def test_result_round_trip(self):
+        sent_date = datetime(1960,1,4,10,tzinfo=timezone.utc)
+        summary = {"processed":1,"skipped":0,"failed":0,
+            "records":[{"name":"old.eml","size":10,"mtime_ns":1,"inode":2,"sent_date":sent_date.isoformat()}],
+            "documents":[{"name":"old.eml","sent_from":"alice@example.com","send_to":"bob@example.com","subject":"old",
+                "sent_date":sent_date,"body":"body"},{"name":"undated.eml","sent_from":"","send_to":"","subject":"",
+                "sent_date":None,"body":""}],
+            "catalog":[MessageRecord("bob@example.com","alice@example.com","old",sent_date,"/somewhere","old.eml")],
+            "dedup_keys":[bytes(range(16))]}
+        shard = {"id":"00000"}
+        write_result(self.tmp.name,shard,{"id":"00000","status":"ok","folders":[("Inbox",summary)]})
+        with open(result_path(self.tmp.name,shard),encoding="utf-8") as fi:
+            json.load(fi)
+        (rel, loaded), = read_result(self.tmp.name,shard)["folders"]
+        self.assertEqual(rel,"Inbox")
+        self.assertEqual(loaded["records"],summary["records"])
+        self.assertEqual(loaded["documents"],summary["documents"])
+        self.assertEqual([record.__getstate__() for record in loaded["catalog"]],
+            [("bob@example.com","alice@example.com","old",sent_date,"/somewhere","old.eml")])
+        self.assertEqual(loaded["dedup_keys"],[bytes(range(16))])
+        self.assertEqual(read_result(self.tmp.name,shard,folders=False)["folders"][0][1]["catalog"],
+            [["bob@example.com","alice@example.com","old",sent_date.isoformat(),"/somewhere","old.eml"]])
+
+    def test_missing_result(self):
+        self.assertIsNone(read_result(self.tmp.name,{"id":"00001"}))
+
+class RenameRaceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_rename_never_replaces(self):
+        fp = join(self.tmp.name,"1.eml")
+        with open(fp,"w") as fo:
+            fo.write("mine")
+        new_eml_path = pst2eml.new_eml_path
+        def racing_new_eml_path(*args,**kwargs):
+            #another worker (whose lease was taken over) renames a message to the same name after the probe
+            new_fp = new_eml_path(*args,**kwargs)
+            if not os.path.exists(join(self.tmp.name,"hello.eml")):
+                with open(new_fp,"w") as fo:
+                    fo.write("theirs")
+            return new_fp
+        with mock.patch.object(pst2eml,"new_eml_path",racing_new_eml_path):
+            new_fp = pst2eml.rename_eml(fp,"hello")
+        self.assertEqual(new_fp,join(self.tmp.name,"hello[1].eml"))
+        with open(join(self.tmp.name,"hello.eml")) as fi:
+            self.assertEqual(fi.read(),"theirs")
+        with open(new_fp) as fi:
+            self.assertEqual(fi.read(),"mine")
+
+if __name__=="__main__":
+    unittest.main()
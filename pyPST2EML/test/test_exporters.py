@@ -0,0 +1,118 @@
+"""
+exporters against the local stand-ins of fake_servers: batching, retries of the failed items only,
+malformed replies, ids of long paths and the reported rate and latencies
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import unittest
+
+# own modules
+from ..exporters import ElasticsearchExporter, SonicExporter, document_id
+from ..fake_servers import FakeElasticsearch, FakeSonic
+
+def make_records(count,folder="Inbox"):
+    return [{"path":f"{folder}/message {i}.eml","sent_date":"2021-03-01T10:00:00+00:00","sent_from":"alice@example.com",
+        "send_to":"bob@example.com","subject":f"message {i}","body":f"body of message {i}"} for i in range(count)]
+
+class MalformedElasticsearch(FakeElasticsearch):
+    """ answers every _bulk request 200 with a body which is not json """
+    def make_server(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self,*args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length",0)))
+                with fake.lock:
+                    fake.requests+=1
+                data = b"<html>proxy error</html>"
+                self.send_response(200)
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        return ThreadingHTTPServer(("127.0.0.1",0),Handler)
+
+class ExporterTest(unittest.TestCase):
+    def check_report(self,report,records,batches):
+        self.assertEqual((report["records"],report["batches"]),(records,batches))
+        self.assertAlmostEqual(report["records_per_second"],report["sent"]/report["seconds"])
+        latency = report["batch_latency"]
+        self.assertLessEqual(latency["p50"],latency["p95"])
+        self.assertLessEqual(latency["p95"],latency["max"])
+        self.assertLessEqual(latency["max"],report["seconds"])
+
+class ElasticsearchExporterTest(ExporterTest):
+    def test_batches(self):
+        with FakeElasticsearch() as server:
+            report = ElasticsearchExporter(server.url,batch_size=10,workers=2).export(make_records(25))
+        self.assertEqual((report["sent"],report["failed"],report["retries"]),(25,0,0))
+        self.check_report(report,25,3)
+        self.assertEqual(server.requests,3)
+        self.assertEqual(server.documents[("pst2eml","Inbox/message 3.eml")]["subject"],"message 3")
+
+    def test_partial_failure_retries_failed_items(self):
+        with FakeElasticsearch(fail_rate=0.3,seed=1) as server:
+            report = ElasticsearchExporter(server.url,batch_size=20,workers=2,max_retries=10,backoff=0).export(make_records(100))
+        self.assertGreater(server.failures,0)
+        self.assertEqual((report["sent"],report["failed"]),(100,0))
+        self.assertGreater(report["retries"],0)
+        #only the items answered 429 were sent again
+        self.assertEqual(server.items,100+server.failures)
+        self.assertEqual(len(server.documents),100)
+        self.check_report(report,100,5)
+
+    def test_malformed_reply(self):
+        with MalformedElasticsearch() as server:
+            with self.assertLogs(level="ERROR"):
+                report = ElasticsearchExporter(server.url,batch_size=10,workers=1,max_retries=2,backoff=0).export(make_records(15))
+        self.assertEqual((report["sent"],report["failed"],report["retries"]),(0,15,4))
+        self.assertEqual(server.requests,6)
+        self.check_report(report,15,2)
+
+    def test_long_path_id(self):
+        records = make_records(2,"folder "*100)
+        self.assertGreater(len(records[0]["path"].encode("utf-8")),512)
+        with FakeElasticsearch() as server:
+            report = ElasticsearchExporter(server.url).export(records+make_records(1))
+        self.assertEqual(report["sent"],3)
+        ids = {id for index, id in server.documents}
+        self.assertEqual(len(ids),3)
+        self.assertTrue(all(len(id.encode("utf-8"))<=512 for id in ids))
+        self.assertIn("Inbox/message 0.eml",ids)
+        self.assertEqual(server.documents[("pst2eml",document_id(records[1]["path"]))]["path"],records[1]["path"])
+
+class SonicExporterTest(ExporterTest):
+    def test_batches(self):
+        with FakeSonic() as server:
+            report = SonicExporter("127.0.0.1",server.port,batch_size=10,workers=2).export(make_records(25))
+        self.assertEqual((report["sent"],report["failed"],report["retries"]),(25,0,0))
+        self.check_report(report,25,3)
+        self.assertEqual(server.requests,25)
+        self.assertEqual(server.documents[("pst2eml","default","Inbox/message%203.eml")],
+            ["message 3 alice@example.com bob@example.com body of message 3"])
+
+    def test_dropped_connections_are_retried(self):
+        with FakeSonic(fail_rate=0.05,seed=1) as server:
+            report = SonicExporter("127.0.0.1",server.port,batch_size=10,workers=2,max_retries=20,backoff=0).export(make_records(60))
+        self.assertGreater(server.failures,0)
+        self.assertEqual((report["sent"],report["failed"]),(60,0))
+        self.assertGreater(report["retries"],0)
+        self.assertEqual(len(server.documents),60)
+        self.check_report(report,60,6)
+
+    def test_malformed_reply(self):
+        #the server ends the session instead of STARTED
+        with FakeSonic(password="other") as server:
+            with self.assertLogs(level="ERROR"):
+                report = SonicExporter("127.0.0.1",server.port,batch_size=10,workers=1,max_retries=1,backoff=0).export(make_records(15))
+        self.assertEqual((report["sent"],report["failed"],report["retries"]),(0,15,2))
+        self.check_report(report,15,2)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+incremental runs with the manifest: unchanged files and folders are skipped, new and modified files
+are processed again
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import os
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..pst2eml import make_eml_search_friendly
+
+def write_eml(fp,subject,second=0):
+    with open(fp,"w",newline="") as fo:
+        fo.write(f"From: alice@example.com\r\nTo: bob@example.com\r\nSubject: {subject}\r\n"
+            f"Date: Mon, 1 Mar 2021 10:00:{second:02d} +0000\r\n\r\nbody\r\n")
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.inbox = join(self.tmp.name,"Inbox")
+        os.makedirs(self.inbox)
+        for i in range(3):
+            write_eml(join(self.inbox,f"{i}.eml"),f"hello {i}",i)
+
+    def run_manifest(self):
+        return make_eml_search_friendly(self.tmp.name,manifest=True,metadata="sidecar")
+
+    def test_unchanged_folder_is_skipped(self):
+        self.assertEqual(self.run_manifest()["processed"],3)
+        summary = self.run_manifest()
+        self.assertEqual((summary["processed"],summary["unchanged"]),(0,3))
+
+    def test_new_file_is_processed(self):
+        self.run_manifest()
+        write_eml(join(self.inbox,"3.eml"),"hello 3",3)
+        summary = self.run_manifest()
+        self.assertEqual((summary["processed"],summary["unchanged"]),(1,3))
+        self.assertIn("hello 3.eml",os.listdir(self.inbox))
+
+    def test_file_modified_in_place_is_processed(self):
+        self.run_manifest()
+        st = os.stat(self.inbox)
+        #rewriting a file does not change the folder mtime
+        with open(join(self.inbox,"hello 1.eml"),"a",newline="") as fo:
+            fo.write("appended\r\n")
+        os.utime(self.inbox,ns=(st.st_atime_ns,st.st_mtime_ns))
+        summary = self.run_manifest()
+        self.assertEqual((summary["processed"],summary["unchanged"]),(1,2))
+        summary = self.run_manifest()
+        self.assertEqual((summary["processed"],summary["unchanged"]),(0,3))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+metadata backends: the sidecar index written by the helpers and flush failures reported in the summary
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+import json
+import os
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..metadata import SIDECAR_NAME
+from ..pst2eml import change_creation_date, make_eml_search_friendly, set_file_attributes, update_file_metadata
+
+SENT_DATE = datetime(2021,3,1,10,tzinfo=timezone.utc)
+
+def write_eml(fp,subject):
+    with open(fp,"w",newline="") as fo:
+        fo.write(f"From: alice@example.com\r\nTo: bob@example.com\r\nSubject: {subject}\r\n"
+            f"Date: Mon, 1 Mar 2021 10:00:00 +0000\r\n\r\nbody\r\n")
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.fp = join(self.tmp.name,"hello.eml")
+        write_eml(self.fp,"hello")
+
+    def sidecar(self):
+        with open(join(self.tmp.name,SIDECAR_NAME),encoding="utf-8") as fi:
+            return json.load(fi)
+
+    def test_update_file_metadata(self):
+        self.assertTrue(update_file_metadata(self.fp,"bob@example.com","alice@example.com","hello",SENT_DATE,"sidecar"))
+        self.assertEqual(self.sidecar(),{"hello.eml":{"author":"alice@example.com","title":"hello",
+            "comments":"TO:bob@example.com","sent_date":SENT_DATE.isoformat()}})
+
+    def test_helpers(self):
+        set_file_attributes(self.fp,"alice@example.com","hello","TO:bob@example.com","sidecar")
+        change_creation_date(self.fp,SENT_DATE,"sidecar")
+        self.assertEqual(self.sidecar()["hello.eml"],{"author":"alice@example.com","title":"hello",
+            "comments":"TO:bob@example.com","sent_date":SENT_DATE.isoformat()})
+        self.assertEqual(os.stat(self.fp).st_mtime,SENT_DATE.timestamp())
+
+    def test_flush_failure_is_reported(self):
+        #the index cannot be written
+        os.makedirs(join(self.tmp.name,SIDECAR_NAME+".tmp"))
+        write_eml(join(self.tmp.name,"other.eml"),"other")
+        summary = make_eml_search_friendly(self.tmp.name,manifest=True,metadata="sidecar")
+        self.assertEqual((summary["processed"],summary["failed"]),(0,2))
+
+if __name__=="__main__":
+    unittest.main()
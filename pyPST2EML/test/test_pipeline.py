@@ -0,0 +1,49 @@
+"""
+overlapped extraction and post-processing: a message is never renamed to a name the extractor writes later
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import os
+from os.path import join
+import sys
+import tempfile
+import unittest
+
+# own modules
+from ..pipeline import extract_and_process, extractor_name
+
+#writes N.eml like readpst, one file every 0.5s
+EXTRACTOR = """
+import sys, time
+from os.path import join
+for i, subject in enumerate(sys.argv[2:]):
+    with open(join(sys.argv[1],f"{i+1}.eml"),"w",newline="") as fo:
+        fo.write(f"From: alice@example.com\\r\\nTo: bob@example.com\\r\\nSubject: {subject}\\r\\n"
+            f"Date: Mon, 1 Mar 2021 10:00:0{i} +0000\\r\\n\\r\\nbody {i+1}\\r\\n")
+    time.sleep(0.5)
+"""
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_extractor_name(self):
+        self.assertTrue(extractor_name("12"))
+        self.assertFalse(extractor_name("RE: 12"))
+        self.assertFalse(extractor_name("12[1]"))
+
+    def test_numeric_subject_held_until_extractor_exited(self):
+        #1.eml would be renamed 3.eml before the extractor writes 3.eml
+        command = [sys.executable,"-c",EXTRACTOR,self.tmp.name,"3","hello","world"]
+        summary = extract_and_process(command,self.tmp.name,poll=0.05,settle=0.1,metadata="sidecar")
+        self.assertEqual((summary["processed"],summary["failed"],summary["returncode"]),(3,0,0))
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp.name) if name.endswith(".eml")),
+            ["3.eml","hello.eml","world.eml"])
+        with open(join(self.tmp.name,"3.eml"),newline="") as fi:
+            self.assertIn("body 1",fi.read())
+
+if __name__=="__main__":
+    unittest.main()
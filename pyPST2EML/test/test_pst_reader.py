@@ -0,0 +1,123 @@
+"""
+pst_reader on the files written by pst_fixture: ANSI and Unicode files with each block encryption,
+B-trees of several levels and corrupt blocks
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+from datetime import datetime, timezone
+from email import message_from_bytes
+from email.utils import parsedate_to_datetime
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..pst_reader import NDB_CRYPT_CYCLIC, NDB_CRYPT_NONE, NDB_CRYPT_PERMUTE, PSTError, PSTFile
+from .pst_fixture import attachment_payload, build, message_body, message_nid, message_subject
+
+INBOX = ("Top of Personal Folders","Inbox")
+SENT_ITEMS = ("Top of Personal Folders","Sent Items")
+FORMATS = [(unicode,crypt) for unicode in (False,True) for crypt in (NDB_CRYPT_NONE,NDB_CRYPT_PERMUTE,NDB_CRYPT_CYCLIC)]
+
+class PSTReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def build(self,name="test.pst",**kwargs):
+        fp = join(self.tmp.name,name)
+        return fp, build(fp,**kwargs)
+
+    def corrupt(self,fp,writer,bid,offset=2):
+        """ changes one byte of a block in the file (by default the heap signature of a heap block) """
+        with open(fp,"r+b") as fo:
+            fo.seek(writer.offsets[bid]+offset)
+            byte = fo.read(1)[0]
+            fo.seek(-1,1)
+            fo.write(bytes([byte^0xFF]))
+
+    def test_formats(self):
+        for unicode, crypt in FORMATS:
+            with self.subTest(unicode=unicode,crypt=crypt):
+                fp, writer = self.build(f"{unicode}_{crypt}.pst",unicode=unicode,crypt=crypt)
+                with PSTFile(fp) as pst:
+                    self.assertEqual(pst.unicode,unicode)
+                    self.assertEqual(pst.crypt,crypt)
+                    self.assertEqual(pst.message_store().get(0x3001),"Test PST")
+                    messages = {message.nid:message for message in pst.iter_messages()}
+                    self.assertEqual(sorted(messages),[message_nid(i) for i in range(3)])
+                    for i in range(3):
+                        message = messages[message_nid(i)]
+                        self.assertEqual(message.folder_path,INBOX if i%2==0 else SENT_ITEMS)
+                        self.assertEqual(message.subject,message_subject(i))
+                        self.assertEqual(message.body,message_body(i))
+                        self.assertEqual(message.sent_date,datetime(2021,1,1,i,tzinfo=timezone.utc))
+                        self.assertEqual(message.recipients(),[(1,"Bob Receiver","bob@example.com"),(2,"Cc Person","cc@example.com")])
+                    first = messages[message_nid(0)]
+                    self.assertEqual(first.sender,"Alice Sender <alice@example.com>")
+                    attachments = list(first.attachments())
+                    self.assertEqual([attachment.filename for attachment in attachments],["deck long name.bin"])
+                    self.assertEqual(attachments[0].data,attachment_payload())
+
+    def test_to_eml(self):
+        for unicode, crypt in FORMATS:
+            with self.subTest(unicode=unicode,crypt=crypt):
+                fp, writer = self.build(f"{unicode}_{crypt}.pst",unicode=unicode,crypt=crypt)
+                with PSTFile(fp) as pst:
+                    emls = {message.nid:message_from_bytes(message.to_eml()) for message in pst.iter_messages()}
+                first = emls[message_nid(0)]
+                self.assertEqual(first["Subject"],"RE: status")
+                self.assertEqual(first["Message-ID"],"<msg0@example.com>")
+                self.assertEqual(parsedate_to_datetime(first["Date"]),datetime(2021,1,1,tzinfo=timezone.utc))
+                parts = [part for part in first.walk() if part.get_filename()]
+                self.assertEqual(parts[0].get_filename(),"deck long name.bin")
+                self.assertEqual(parts[0].get_payload(decode=True),attachment_payload())
+                #the headers of a message received from internet are its transport headers
+                second = emls[message_nid(1)]
+                self.assertEqual(second["From"],"Carol <carol@example.com>")
+                self.assertEqual(second["Date"],"Fri, 1 Jan 2021 10:00:00 +0100")
+                self.assertEqual(second.get_payload(decode=True).decode("utf-8"),message_body(1))
+
+    def test_multi_level_btrees(self):
+        for unicode in (False,True):
+            with self.subTest(unicode=unicode):
+                fp, writer = self.build(f"{unicode}.pst",unicode=unicode,crypt=NDB_CRYPT_CYCLIC,messages=120,big=False)
+                with PSTFile(fp) as pst:
+                    subjects = {message.nid:message.subject for message in pst.iter_messages()}
+                self.assertEqual(subjects,{message_nid(i):message_subject(i) for i in range(120)})
+
+    def test_corrupt_message_is_skipped(self):
+        for unicode, crypt in FORMATS:
+            with self.subTest(unicode=unicode,crypt=crypt):
+                fp, writer = self.build(f"{unicode}_{crypt}.pst",unicode=unicode,crypt=crypt)
+                self.corrupt(fp,writer,writer.nodes[message_nid(2)][0])
+                with PSTFile(fp) as pst:
+                    with self.assertLogs(level="ERROR"):
+                        nids = [message.nid for message in pst.iter_messages()]
+                self.assertEqual(nids,[message_nid(0),message_nid(1)])
+
+    def test_corrupt_attachment_raises(self):
+        for unicode, crypt in FORMATS:
+            with self.subTest(unicode=unicode,crypt=crypt):
+                fp, writer = self.build(f"{unicode}_{crypt}.pst",unicode=unicode,crypt=crypt)
+                with PSTFile(fp) as pst:
+                    message = next(pst.folder(0x8042).messages())
+                    bid_attachment = message.subnodes[(1<<5)|0x05][0]
+                self.corrupt(fp,writer,bid_attachment)
+                with PSTFile(fp) as pst:
+                    message = next(message for message in pst.iter_messages() if message.nid==message_nid(0))
+                    self.assertEqual(message.subject,"RE: status")
+                    with self.assertRaises(PSTError):
+                        message.to_eml()
+
+    def test_not_a_pst(self):
+        fp = join(self.tmp.name,"test.pst")
+        with open(fp,"wb") as fo:
+            fo.write(b"From: alice@example.com\r\n"*100)
+        with self.assertRaises(PSTError):
+            PSTFile(fp)
+
+if __name__=="__main__":
+    unittest.main()
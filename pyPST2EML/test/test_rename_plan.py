@@ -0,0 +1,81 @@
+"""
+two-phase renaming: plan, apply and undo give back the original names, times and metadata
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import os
+from os.path import join
+import tempfile
+import unittest
+
+# own modules
+from ..layout import Layout
+from ..metadata import SIDECAR_NAME, XATTR_NAMES
+from ..rename_plan import JOURNAL_NAME, apply_plan, plan_renames, undo
+
+def write_eml(fp,subject,month):
+    with open(fp,"w",newline="") as fo:
+        fo.write(f"From: alice@example.com\r\nTo: bob@example.com\r\nSubject: {subject}\r\n"
+            f"Date: Mon, 1 {month} 2021 10:00:00 +0000\r\n\r\nbody\r\n")
+
+def xattr_available(folder):
+    fp = join(folder,"xattr")
+    open(fp,"w").close()
+    try:
+        os.setxattr(fp,"user.pst2eml_test",b"1")
+        return True
+    except (AttributeError,OSError):
+        return False
+    finally:
+        os.remove(fp)
+
+class RenamePlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.inbox = join(self.tmp.name,"Inbox")
+        os.makedirs(self.inbox)
+        for i, month in enumerate(["Mar","Mar","Apr"]):
+            write_eml(join(self.inbox,f"{i}.eml"),"status",month)
+        self.before = self.snapshot()
+
+    def snapshot(self):
+        """ relative path -> (mtime_ns, size) of every file of the tree """
+        files = {}
+        for root, directory, names in os.walk(self.tmp.name):
+            for name in names:
+                st = os.stat(join(root,name))
+                files[os.path.relpath(join(root,name),self.tmp.name)] = (st.st_mtime_ns,st.st_size)
+        return files
+
+    def round_trip(self,metadata,layout=None):
+        entries = plan_renames(self.tmp.name,layout=layout)
+        summary = apply_plan(self.tmp.name,entries,metadata=metadata,layout=layout)
+        self.assertEqual((summary["processed"],summary["failed"],summary["conflicts"]),(3,0,0))
+        self.assertNotIn("0.eml",os.listdir(self.inbox))
+        summary = undo(join(self.tmp.name,JOURNAL_NAME))
+        self.assertEqual((summary["restored"],summary["skipped"],summary["conflicts"],summary["failed"]),(3,0,0,0))
+        os.remove(join(self.tmp.name,JOURNAL_NAME+".undone"))
+        self.assertEqual(self.snapshot(),self.before)
+
+    def test_sidecar(self):
+        entries = plan_renames(self.tmp.name)
+        self.assertEqual(sorted(entry["to"] for entry in entries),["status.eml","status[1].eml","status[2].eml"])
+        self.round_trip("sidecar")
+        self.assertNotIn(SIDECAR_NAME,os.listdir(self.inbox))
+
+    def test_sidecar_with_layout(self):
+        self.round_trip("sidecar",Layout("date"))
+        self.assertEqual(sorted(os.listdir(self.inbox)),["0.eml","1.eml","2.eml"])
+
+    def test_xattr(self):
+        if not xattr_available(self.tmp.name):
+            self.skipTest("extended attributes are not supported")
+        self.round_trip("xattr")
+        for i in range(3):
+            self.assertFalse(set(XATTR_NAMES.values())&set(os.listxattr(join(self.inbox,f"{i}.eml"))))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+watch mode and the output tree watcher: a name freed by a rename or a file written again is processed again
+
+> python -m pytest pyPST2EML/test
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import os
+from os.path import exists, join
+import tempfile
+from threading import Event, Thread
+from time import sleep, time
+import unittest
+
+# own modules
+from ..pipeline import OutputTreeWatcher
+from ..watch import Inotify, watch
+
+def write_eml(fp,subject):
+    with open(fp,"w",newline="") as fo:
+        fo.write(f"From: alice@example.com\r\nTo: bob@example.com\r\nSubject: {subject}\r\n"
+            f"Date: Mon, 1 Mar 2021 10:00:00 +0000\r\n\r\nbody\r\n")
+
+def inotify_available():
+    try:
+        Inotify().close()
+        return True
+    except OSError:
+        return False
+
+class OutputTreeWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.watcher = OutputTreeWatcher(self.tmp.name,settle=0)
+
+    def test_renamed_name_is_free_again(self):
+        write_eml(join(self.tmp.name,"1.eml"),"first")
+        self.watcher.completed()
+        self.assertEqual(self.watcher.completed(True),{self.tmp.name:["1.eml"]})
+        os.rename(join(self.tmp.name,"1.eml"),join(self.tmp.name,"first.eml"))
+        st = os.stat(join(self.tmp.name,"first.eml"))
+        self.watcher.processed(self.tmp.name,[{"name":"first.eml","original_name":"1.eml","size":st.st_size,
+            "mtime_ns":st.st_mtime_ns,"inode":st.st_ino}])
+        write_eml(join(self.tmp.name,"1.eml"),"second")
+        self.watcher.completed()
+        self.assertEqual(self.watcher.completed(True),{self.tmp.name:["1.eml"]})
+        self.assertEqual(sorted(self.watcher.done[self.tmp.name]),["1.eml","first.eml"])
+
+    def test_changed_file_is_added_again(self):
+        fp = join(self.tmp.name,"1.eml")
+        write_eml(fp,"first")
+        self.watcher.completed(True)
+        self.assertFalse(self.watcher.add(fp,os.stat(fp)))
+        write_eml(fp,"first, edited")
+        self.assertTrue(self.watcher.add(fp,os.stat(fp)))
+
+    def test_removed_files_are_forgotten(self):
+        for i in range(3):
+            write_eml(join(self.tmp.name,f"{i}.eml"),"hello")
+        self.watcher.completed(True)
+        for i in range(3):
+            os.remove(join(self.tmp.name,f"{i}.eml"))
+        write_eml(join(self.tmp.name,"3.eml"),"hello")
+        self.watcher.completed(True)
+        self.assertEqual(sorted(self.watcher.done[self.tmp.name]),["3.eml"])
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def wait_for(self,fp,timeout=10):
+        end = time()+timeout
+        while not exists(fp) and time()<end:
+            sleep(0.05)
+        return exists(fp)
+
+    def run_watch(self,backend):
+        landing = join(self.tmp.name,backend)
+        inbox = join(landing,"Inbox")
+        os.makedirs(inbox)
+        stop = Event()
+        result = {}
+        thread = Thread(target=lambda:result.update(watch(landing,settle=0.2,poll=0.05,backend=backend,metadata="sidecar",stop=stop)))
+        thread.start()
+        try:
+            sleep(0.3)
+            #two exports dropping a file with the same name one after the other
+            write_eml(join(inbox,"1.eml"),"first")
+            self.assertTrue(self.wait_for(join(inbox,"first.eml")))
+            write_eml(join(inbox,"1.eml"),"second")
+            self.assertTrue(self.wait_for(join(inbox,"second.eml")))
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(result["processed"],2)
+        self.assertFalse(exists(join(inbox,"1.eml")))
+
+    def test_poll(self):
+        self.run_watch("poll")
+
+    @unittest.skipUnless(inotify_available(),"inotify is not available")
+    def test_inotify(self):
+        self.run_watch("inotify")
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,499 @@
+"""
+watch mode: continuous ingestion of a landing folder
+
+a long running process watching a folder where .pst/.ost archives and loose .eml/.ics exports are dropped
+all day, instead of sweeping the whole tree again from cron:
+* events: linux inotify (through ctypes, no dependency) on every folder of the tree, or polling of the
+    folders whose mtime changed (see pipeline.OutputTreeWatcher) where inotify is not available or
+    the watch limit (fs.inotify.max_user_watches) is reached
+* debounce: a file is complete once its size and mtime did not change for settle seconds (copies over
+    SMB close and reopen the file several times), the partially written files are never read
+* batches: the files completed at the same time are processed together, batch_size at most, with
+    pst2eml.process_eml_folder, the manifest, search index, dedup index and catalog at the root of the
+    landing folder stay open and are flushed after each batch so the new messages are searchable
+    right away
+* archives: converted (by a pool of workers threads) into the eml sub folder of the landing folder,
+    one folder per archive like pst_2_eml, their .eml/.ics files are then processed like the loose ones
+    as they are written
+
+the manifest is always kept: a restart only processes the files which arrived or changed while the
+watcher was stopped, the converted archives are recorded in it too.
+
+the queue depth (files waiting to settle, completed files waiting for their batch, archives being
+converted) and the lag (seconds from the first event of a file to the end of its batch) are written to
+.pst2eml_watch_status.json at the root of the landing folder after each change.
+
+Example:
+--------
+python -m pyPST2EML watch -f /srv/landing --index Y --catalog Y --dedup /srv/dedup.sqlite
+"""
+
+""" PYTHON STANDARD LIBRARY """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from os.path import abspath, basename, exists, join, splitext
+import select
+import signal
+import struct
+from threading import Event
+from time import perf_counter, sleep, time
+
+# own modules
+from .attachments import AttachmentStore, merge_stats
+from .batch import PST_EXTENSIONS, extract_archive
+from .catalog import Catalog, is_catalog_file
+from .layout import LAYOUTS, MAX_FILES, Layout
+from .manifest import Manifest, file_key
+from .pipeline import OutputTreeWatcher
+from .pst2eml import merge_summaries, process_eml_folder, safe_folder_name, str2bool
+from .quarantine import ON_ERROR, ErrorBudgetExceeded, get_error_policy, print_failures
+from .rename_plan import is_journal_file
+from .search_index import SearchIndex
+
+STATUS_NAME = ".pst2eml_watch_status.json"
+#output folder of the archives in the landing folder
+ARCHIVES_FOLDER = "eml"
+
+#inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE|IN_MOVED_FROM|IN_DELETE
+IN_REMOVED = IN_MOVED_FROM|IN_DELETE
+#struct inotify_event without its name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+def is_status_file(fn):
+    return fn.startswith(STATUS_NAME)
+
+class Inotify:
+    """ inotify instance of the linux kernel (OSError elsewhere or when no instance is left) """
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+        if not hasattr(self.libc,"inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self.fd<0:
+            errno = ctypes.get_errno()
+            raise OSError(errno,os.strerror(errno))
+        #watch descriptor -> folder
+        self.folders = {}
+
+    def add(self,folder):
+        """ watches the files written, created, moved and removed in the folder (not its sub folders) """
+        wd = self.libc.inotify_add_watch(self.fd,os.fsencode(folder),WATCH_MASK)
+        if wd<0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno,os.strerror(errno),folder)
+        self.folders[wd] = folder
+
+    def read(self,timeout):
+        """ Returns [(path, is_dir, removed)] of the events received within timeout seconds (removed: the
+        file was moved out or deleted), None if the kernel queue overflowed (events were lost) """
+        ready, _, _ = select.select([self.fd],[],[],timeout)
+        if not ready:
+            return []
+        events = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd,64*1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset<len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data,offset)
+                name = data[offset+INOTIFY_EVENT.size:offset+INOTIFY_EVENT.size+length].rstrip(b"\0")
+                offset+= INOTIFY_EVENT.size+length
+                if mask&IN_Q_OVERFLOW:
+                    overflow = True
+                elif mask&IN_IGNORED:
+                    #folder removed
+                    self.folders.pop(wd,None)
+                elif name and wd in self.folders:
+                    events.append((join(self.folders[wd],os.fsdecode(name)),bool(mask&IN_ISDIR),bool(mask&IN_REMOVED)))
+        return None if overflow else events
+
+    def close(self):
+        os.close(self.fd)
+
+class LandingWatcher(OutputTreeWatcher):
+    """ OutputTreeWatcher of a landing folder fed by inotify events, or by polling the tree
+    Parameters:
+    -----------
+    root: str
+        landing folder
+    settle: float
+        seconds without modification before a file is considered complete
+    backend: str
+        "inotify", "poll" or "auto" (inotify when available, else poll)
+    """
+    def __init__(self,root,settle=2.0,backend="auto"):
+        super().__init__(abspath(root),settle)
+        #file path -> time of its first event, for the lag
+        self.arrived = {}
+        #folder -> first event of the files returned by the last completed call
+        self.ready_since = {}
+        self.inotify = None
+        if backend!="poll":
+            try:
+                self.inotify = Inotify()
+                self._watch_tree(self.root)
+            except OSError as e:
+                if backend=="inotify":
+                    raise
+                self._stop_inotify(e)
+        self.backend = "poll" if self.inotify is None else "inotify"
+        #files already in the tree
+        self._scan(self.root)
+
+    def _stop_inotify(self,error):
+        log_msg = "inotify not usable (%s), polling the folder tree instead"%(error)
+        logging.warning(log_msg)
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _watch_tree(self,folder):
+        for root, directory, _ in os.walk(folder):
+            directory[:] = [name for name in directory if not self.ignored(name,True)]
+            self.inotify.add(root)
+
+    def ignored(self,name,is_dir=False):
+        if is_dir:
+            return super().ignored(name,is_dir)
+        return super().ignored(name) or is_catalog_file(name) or is_journal_file(name) or is_status_file(name)
+
+    def add(self,fp,st=None):
+        added = super().add(fp,st)
+        if added:
+            self.arrived[fp] = time()
+        return added
+
+    def wait(self,timeout):
+        """ waits up to timeout seconds for new files (added to the pending ones) """
+        if self.inotify is None:
+            sleep(timeout)
+            self._scan(self.root)
+            return
+        events = self.inotify.read(timeout)
+        if events is None:
+            logging.warning("inotify queue overflow, scanning the folder tree")
+            self._scan(self.root)
+            return
+        for fp, is_dir, removed in events:
+            if self.ignored(basename(fp),is_dir):
+                continue
+            if removed:
+                if not is_dir:
+                    self.forget(fp)
+                continue
+            if not is_dir:
+                #written again after it was processed: processed again
+                try:
+                    self.add(fp,os.stat(fp))
+                except FileNotFoundError:
+                    pass
+                continue
+            #new folder: watched, then scanned for the files written before the watch
+            try:
+                self._watch_tree(fp)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                #watch limit reached
+                self._stop_inotify(e)
+                self._scan(self.root)
+                return
+            self._scan(fp)
+
+    def completed(self,finished=False,scan=False):
+        """ see OutputTreeWatcher.completed, ready_since gets the first event of the files of each folder """
+        ready = super().completed(finished,scan)
+        arrived = self.arrived
+        now = time()
+        self.ready_since = {folder:min(arrived.get(join(folder,fn),now) for fn in files) for folder, files in ready.items()}
+        self.arrived = {fp:arrived[fp] for fp in self.pending if fp in arrived}
+        return ready
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+def archive_record(fp,status):
+    """ manifest record of an archive (see manifest.Manifest.record) """
+    size, mtime_ns, inode = file_key(os.stat(fp))
+    name = basename(fp)
+    return {"name":name,"size":size,"mtime_ns":mtime_ns,"inode":inode,"status":status,"original_name":name,
+        "send_to":None,"sent_from":None,"subject":None,"sent_date":None}
+
+def watch(landing,settle=2.0,poll=0.5,backend="auto",batch_size=1000,reader="readpst",readpst_jobs=0,workers=1,
+        ignore_ext=False,headers_only=False,policy=None,metadata=None,index=False,attachments=False,dedup=None,
+        catalog=False,staged=None,layout=None,errors=None,duration=None,stop=None):
+    """ processes the files dropped in the landing folder until stopped
+    Parameters:
+    -----------
+    landing: str
+        folder watched (with its sub folders)
+    settle: float
+        seconds without modification before a file is processed
+    poll: float
+        seconds between two looks at the pending files (and at the tree when polling)
+    backend: str
+        "inotify", "poll" or "auto", see LandingWatcher
+    batch_size: int
+        files of a folder processed at most per batch
+    reader: str
+        archives reader, "readpst" or "native", see batch.extract_archive
+    readpst_jobs: int
+        readpst -j parallel jobs per archive
+    workers: int
+        archives converted at the same time
+    policy, metadata, index, attachments, dedup, catalog, staged, layout, errors:
+        as for pst2eml.make_eml_search_friendly (kept at the root of the landing folder)
+    duration: float
+        seconds after which the watcher stops (None: until stop is set, SIGTERM or Ctrl+C)
+    stop: threading.Event
+        set to stop the watcher (after the current batch)
+    Returns:
+    --------
+    summary: dict
+        as for make_eml_search_friendly with the "archives" reports and the "status" at the end
+    """
+    landing = abspath(landing)
+    stop = stop or Event()
+    watcher = LandingWatcher(landing,settle,backend)
+    archives_folder = join(landing,ARCHIVES_FOLDER)
+    run_manifest = Manifest(landing)
+    search_index = SearchIndex(landing) if index else None
+    run_catalog = Catalog.load(landing) if catalog else None
+    dedup_index = None
+    if dedup:
+        from .dedup import DedupIndex
+        dedup_index = DedupIndex(dedup)
+    error_policy = get_error_policy(errors,landing)
+    store_stats = []
+    summaries = []
+    reports = []
+    #future -> (archive path, output folder)
+    converting = {}
+    executor = ThreadPoolExecutor(max_workers=max(1,workers))
+    status = {"landing":landing,"backend":watcher.backend,"pending":0,"queued":0,"archives":0,"batches":0,
+        "files":0,"lag_seconds":None,"max_lag_seconds":0.0,"oldest_pending_seconds":0.0}
+
+    def write_status(queued=0):
+        now = time()
+        status.update({"updated":datetime.now(timezone.utc).isoformat(),"pending":len(watcher.pending),
+            "queued":queued,"archives":len(converting),
+            "oldest_pending_seconds":round(now-min(watcher.arrived.values()),3) if watcher.arrived else 0.0})
+        tmp_fp = join(landing,STATUS_NAME+".tmp")
+        with open(tmp_fp,"w",encoding="utf-8") as fo:
+            json.dump(status,fo,indent=2)
+        os.replace(tmp_fp,join(landing,STATUS_NAME))
+
+    def process(folder,files):
+        """ one batch, file by file when the batch fails (a bad file does not stop the others) """
+        args = (ignore_ext,headers_only,run_manifest.known_files(folder),policy,metadata,index,None,
+            landing if attachments else None,dedup_index,staged,catalog,layout,error_policy)
+        try:
+            return [process_eml_folder(folder,files,*args)]
+        except ErrorBudgetExceeded:
+            raise
+        except Exception as e:
+            log_msg = "batch of %d files failed in %s (%r), processing them one by one"%(len(files),folder,e)
+            logging.warning(log_msg)
+        results = []
+        for fn in files:
+            try:
+                results.append(process_eml_folder(folder,[fn],*args))
+            except ErrorBudgetExceeded:
+                raise
+            except Exception:
+                log_msg = "failed processing %s"%(join(folder,fn))
+                logging.exception(log_msg)
+                results.append({"processed":0,"skipped":0,"failed":1,"duplicates":0,"unchanged":0})
+        return results
+
+    def collect(folder,summary):
+        records = summary.pop("records",[])
+        #renamed files show up as new entries of the folder
+        watcher.processed(folder,records)
+        run_manifest.record(folder,records)
+        if search_index is not None:
+            search_index.add(folder,summary.pop("documents",[]))
+        if run_catalog is not None:
+            for record in summary.pop("catalog",[]):
+                run_catalog.add(record)
+        if "attachments" in summary:
+            store_stats.append(summary.pop("attachments"))
+        summaries.append(summary)
+
+    def convert(folder,files):
+        """ starts the conversion of the new archives of a folder, Returns the other files """
+        known = run_manifest.known_files(folder)
+        others = []
+        for fn in files:
+            fp = join(folder,fn)
+            if splitext(fn)[1].lower() not in PST_EXTENSIONS:
+                others.append(fn)
+            elif fn in known and file_key(os.stat(fp))==known[fn]:
+                log_msg = "archive already converted: %s"%(fp)
+                logging.info(log_msg)
+            else:
+                name = safe_folder_name(splitext(fn)[0])
+                output_folder = join(archives_folder,name)
+                i = 1
+                busy = {output for _, output in converting.values()}
+                while exists(output_folder) or output_folder in busy:
+                    output_folder = join(archives_folder,f"{name}[{i}]")
+                    i+=1
+                print(f"converting {fp} into {output_folder}")
+                converting[executor.submit(extract_archive,fp,output_folder,reader,readpst_jobs)] = (fp,output_folder)
+        return others
+
+    def converted():
+        for future in [future for future in converting if future.done()]:
+            fp, _ = converting.pop(future)
+            report = future.result()
+            reports.append(report)
+            print(f"converted {fp}: {report['status']}, {report['files']} files in {report['seconds']:.1f}s")
+            if exists(fp):
+                run_manifest.record(os.path.dirname(fp),[archive_record(fp,"converted" if report["status"]=="ok" else "failed")])
+
+    previous = None
+    handler = None
+    end = None if duration is None else time()+duration
+    print(f"watching {landing} ({watcher.backend}), stop with Ctrl+C")
+    try:
+        try:
+            handler = signal.signal(signal.SIGTERM,lambda signum, frame: stop.set())
+        except ValueError:
+            #not the main thread
+            pass
+        while not stop.is_set() and (end is None or time()<end):
+            watcher.wait(poll)
+            converted()
+            ready = watcher.completed()
+            queued = sum(len(files) for files in ready.values())
+            for folder, files in ready.items():
+                files = convert(folder,files)
+                queued-= len(ready[folder])-len(files)
+                for i in range(0,len(files),batch_size):
+                    chunk = files[i:i+batch_size]
+                    start = perf_counter()
+                    for summary in process(folder,chunk):
+                        collect(folder,summary)
+                    if search_index is not None:
+                        search_index.flush()
+                    if dedup_index is not None:
+                        dedup_index.flush()
+                    if run_catalog is not None:
+                        run_catalog.save()
+                    queued-= len(chunk)
+                    lag = time()-watcher.ready_since[folder]
+                    status["batches"]+=1
+                    status["files"]+=len(chunk)
+                    status["lag_seconds"] = round(lag,3)
+                    status["max_lag_seconds"] = round(max(status["max_lag_seconds"],lag),3)
+                    print(f"{len(chunk)} files of {folder} in {perf_counter()-start:.2f}s, lag {lag:.1f}s, "
+                        f"{len(watcher.pending)} pending, {queued} queued, {len(converting)} archives converting")
+                    write_status(queued)
+            current = (len(watcher.pending),len(converting))
+            if current!=previous:
+                write_status()
+                previous = current
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if handler is not None:
+            signal.signal(signal.SIGTERM,handler)
+        executor.shutdown(wait=True)
+        converted()
+        watcher.close()
+        run_manifest.close()
+        if search_index is not None:
+            search_index.close()
+        if dedup_index is not None:
+            dedup_index.close()
+        if run_catalog is not None:
+            run_catalog.save()
+        if error_policy is not None:
+            error_policy.save_report()
+    summary = merge_summaries(summaries)
+    summary["archives"] = reports
+    if error_policy is not None:
+        summary["errors"] = error_policy.report()
+    if store_stats:
+        store = AttachmentStore(landing)
+        store.stats = merge_stats(store_stats)
+        summary["attachments"] = store.report()
+    write_status()
+    summary["status"] = status
+    return summary
+
+def watch_cli(argv=None):
+    """ watch subcommand: python -m pyPST2EML watch -f <landing folder> [options] """
+    parser = argparse.ArgumentParser(prog="python -m pyPST2EML watch",
+        description='process the archives and .eml/.ics files dropped in a folder as they arrive')
+    parser.add_argument("--folder","-f",dest="folder",type=str,required=True,help="landing folder")
+    parser.add_argument("--settle",dest="settle",type=float,default=2.0,help="seconds without modification before a file is processed (default: 2)")
+    parser.add_argument("--poll",dest="poll",type=float,default=0.5,help="seconds between two checks of the pending files (default: 0.5)")
+    parser.add_argument("--backend",dest="backend",type=str,default="auto",choices=["auto","inotify","poll"],
+        help="file system events: inotify (linux) or polling (default: inotify when available)")
+    parser.add_argument("--batch",dest="batch_size",type=int,default=1000,help="files of a folder processed at most per batch (default: 1000)")
+    parser.add_argument("--reader",dest="reader",type=str,default="readpst",choices=["readpst","native"],help="archives reader (default: readpst)")
+    parser.add_argument("--readpst_jobs",dest="readpst_jobs",type=int,default=0,help="readpst -j parallel jobs per archive")
+    parser.add_argument("--workers",dest="workers",type=int,default=1,help="archives converted at the same time (default: 1)")
+    parser.add_argument("--headers",dest="headers_only",type=str2bool,default="N",help="only read the header block of each file (default: N)")
+    parser.add_argument("--names",dest="policy",type=str,default=None,choices=["windows","linux"],help="file name length limits")
+    parser.add_argument("--metadata",dest="metadata",type=str,default=None,choices=["win32","xattr","sidecar"],help="metadata backend")
+    parser.add_argument("--index",dest="index",type=str2bool,default="N",help="full-text search index of the landing folder (default: N)")
+    parser.add_argument("--attachments",dest="attachments",type=str2bool,default="N",help="content-addressed attachment store (default: N)")
+    parser.add_argument("--dedup",dest="dedup",type=str,default="",help="dedup index file")
+    parser.add_argument("--catalog",dest="catalog",type=str2bool,default="N",help="columnar catalog of the messages (default: N)")
+    parser.add_argument("--layout",dest="layout",type=str,default="flat",choices=LAYOUTS,help="bucketed layout of the folders (default: flat)")
+    parser.add_argument("--bucket_files",dest="bucket_files",type=int,default=MAX_FILES,help=f"files per bucket (default: {MAX_FILES})")
+    parser.add_argument("--io_workers",dest="io_workers",type=int,default=0,help="threads overlapping the renames and metadata writes (network shares)")
+    parser.add_argument("--on_error",dest="on_error",type=str,default="quarantine",choices=ON_ERROR,help="files which fail: moved to the quarantine folder, left in place or stop the watcher (default: quarantine)")
+    parser.add_argument("--max_errors",dest="max_errors",type=int,default=None,help="failed files before the watcher stops (default: no limit)")
+    parser.add_argument("--max_error_rate",dest="max_error_rate",type=float,default=None,help="share of failed files before the watcher stops, e.g. 0.05 (default: no limit)")
+    parser.add_argument("--quarantine",dest="quarantine",type=str,default=None,help="quarantine folder (default: .pst2eml_quarantine in the landing folder)")
+    parser.add_argument("--duration",dest="duration",type=float,default=None,help="seconds after which the watcher stops (default: until Ctrl+C or SIGTERM)")
+    parser.add_argument("--verbose","-v",dest="verbosity",type=int,default=2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbosity==4 else logging.WARN)
+    if not os.path.isdir(args.folder):
+        print(f"landing folder not found: {args.folder}")
+        return 1
+    try:
+        summary = watch(args.folder,settle=args.settle,poll=args.poll,backend=args.backend,batch_size=args.batch_size,
+            reader=args.reader,readpst_jobs=args.readpst_jobs,workers=args.workers,headers_only=args.headers_only,
+            policy=args.policy,metadata=args.metadata,index=args.index,attachments=args.attachments,
+            dedup=args.dedup or None,catalog=args.catalog,layout=Layout(args.layout,args.bucket_files) if args.layout!="flat" else None,staged={"io_workers":args.io_workers} if args.io_workers>0 else None,
+            errors={"mode":args.on_error,"max_errors":args.max_errors,"max_error_rate":args.max_error_rate,"folder":args.quarantine},
+            duration=args.duration)
+    except ErrorBudgetExceeded as e:
+        print(e)
+        print_failures(e.report)
+        return 2
+    status = summary["status"]
+    print(f"processed {summary['processed']}, skipped {summary['skipped']}, failed {summary['failed']}, duplicates {summary['duplicates']}, "
+        f"unchanged {summary['unchanged']} files in {status['batches']} batches, {len(summary['archives'])} archives converted, "
+        f"max lag {status['max_lag_seconds']:.1f}s")
+    print_failures(summary["errors"])
+    return 0
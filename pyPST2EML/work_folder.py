@@ -0,0 +1,11 @@
+"""
+work folder of the distributed runs (plan, leases, results, see distributed)
+
+in a module without dependencies of its own: the folder walks skip the work folder without importing
+distributed (and its socket, uuid, ... imports) on every start
+"""
+
+WORK_NAME = ".pst2eml_work"
+
+def is_work_folder(name):
+    return name==WORK_NAME
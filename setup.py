@@ -45,7 +45,13 @@ setuptools.setup(
         "Operating System :: Windows 10",
     ],
     install_requires=[
-          'pywin32','python-dateutil'
+          'pywin32; sys_platform == "win32"','python-dateutil'
       ],
+    extras_require={
+          'catalog':['numpy']
+      },
+    entry_points={
+          'console_scripts':['pst2eml=pyPST2EML.__main__:main']
+      },
     python_requires='>=3.7',
 )
\ No newline at end of file